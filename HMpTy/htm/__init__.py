@@ -2,5 +2,5 @@
 *The HTM and Matcher Objects*
 """
 from __future__ import absolute_import
-from .htm import HTM, Matcher
+from .htm import HTM, Matcher, cached_meshes, clear_cached_meshes, choose_depth
 from .sets import sets
@@ -98,39 +98,54 @@ class HTMC(_object):
     __getattr__ = lambda self, name: _swig_getattr(self, HTMC, name)
     __repr__ = _swig_repr
 
-    def __init__(self, depth=16, log=False):
+    def __init__(self, depth=16, log=False, buildlevel=2):
         if log == False:
             if log == False:
                 from fundamentals.logs import emptyLogger
                 self.log = emptyLogger()
         else:
             self.log = log
-        this = _htmc.new_HTMC(depth)
+        this = _htmc.new_HTMC(depth, buildlevel)
         try:
             self.this.append(this)
         except:
             self.this = this
 
-    def init(self, depth=16):
-        return _htmc.HTMC_init(self, depth)
+    def init(self, depth=16, buildlevel=2):
+        return _htmc.HTMC_init(self, depth, buildlevel)
     __swig_destroy__ = _htmc.delete_HTMC
     __del__ = lambda self: None
 
     def lookup_id(self, *args):
         return _htmc.HTMC_lookup_id(self, *args)
 
+    def lookup_id_xyz(self, *args):
+        return _htmc.HTMC_lookup_id_xyz(self, *args)
+
     def intersect(self, *args):
         return _htmc.HTMC_intersect(self, *args)
 
+    def intersect_many(self, *args):
+        return _htmc.HTMC_intersect_many(self, *args)
+
+    def intersect_many_xyz(self, *args):
+        return _htmc.HTMC_intersect_many_xyz(self, *args)
+
+    def intersect_polygons(self, *args):
+        return _htmc.HTMC_intersect_polygons(self, *args)
+
+    def intersect_ranges(self, *args):
+        return _htmc.HTMC_intersect_ranges(self, *args)
+
     def cmatch(self, *args):
         return _htmc.HTMC_cmatch(self, *args)
 
-    def cbincount(self, *args):
-        return _htmc.HTMC_cbincount(self, *args)
-
     def depth(self):
         return _htmc.HTMC_depth(self)
 
+    def buildlevel(self):
+        return _htmc.HTMC_buildlevel(self)
+
 HTMC_swigregister = _htmc.HTMC_swigregister
 HTMC_swigregister(HTMC)
 
@@ -155,9 +170,60 @@ class Matcher(_object):
     def get_depth(self):
         return _htmc.Matcher_get_depth(self)
 
+    def get_buildlevel(self):
+        return _htmc.Matcher_get_buildlevel(self)
+
+    def get_coordinates(self):
+        return _htmc.Matcher_get_coordinates(self)
+
+    def get_buckets(self):
+        return _htmc.Matcher_get_buckets(self)
+
     def match(self, *args):
         return _htmc.Matcher_match(self, *args)
+
+    def match_xyz(self, *args):
+        return _htmc.Matcher_match_xyz(self, *args)
+
+    def bincount(self, *args):
+        return _htmc.Matcher_bincount(self, *args)
+
+    def self_match(self, *args):
+        return _htmc.Matcher_self_match(self, *args)
+
+    def within_polygons(self, *args):
+        return _htmc.Matcher_within_polygons(self, *args)
+
+    def nearest(self, *args):
+        return _htmc.Matcher_nearest(self, *args)
+
+    def add(self, *args):
+        return _htmc.Matcher_add(self, *args)
+
+    def remove(self, *args):
+        return _htmc.Matcher_remove(self, *args)
+
+    def compact(self):
+        return _htmc.Matcher_compact(self)
+
+    def get_npoints(self):
+        return _htmc.Matcher_get_npoints(self)
+
+    def get_nremoved(self):
+        return _htmc.Matcher_get_nremoved(self)
 Matcher_swigregister = _htmc.Matcher_swigregister
 Matcher_swigregister(Matcher)
 
+
+def cached_indexes():
+    return _htmc.cached_indexes()
+
+
+def clear_cached_indexes():
+    return _htmc.clear_cached_indexes()
+
+
+def group_labels(*args):
+    return _htmc.group_labels(*args)
+
 # This file is compatible with both classic and new-style classes.
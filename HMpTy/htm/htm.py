@@ -17,6 +17,44 @@ import sys
 import os
 os.environ['TERM'] = 'vt100'
 
+# SAVED MATCHER FILE LAYOUT: A 64 BYTE LITTLE-ENDIAN HEADER FOLLOWED BY THE
+# ra, dec, hmap_ids, hmap_offsets, hmap_perm AND hmap_xyz ARRAYS, EACH
+# STARTING ON A 64 BYTE BOUNDARY SO THEY CAN BE MEMORY-MAPPED IN PLACE. THE
+# BUCKETS HOLD nbucketed POINTS, WHICH IS LESS THAN npoints WHEN POINTS HAVE
+# BEEN REMOVED
+_MATCHER_FILE_MAGIC = b"HMPTYMCH"
+_MATCHER_FILE_VERSION = 1
+_MATCHER_FILE_ALIGN = 64
+_MATCHER_FILE_HEADER = numpy.dtype([
+    ("magic", "S8"),
+    ("version", "<u4"),
+    ("depth", "<u4"),
+    ("buildlevel", "<u4"),
+    ("reserved", "<u4"),
+    ("npoints", "<i8"),
+    ("nids", "<i8"),
+    ("nbucketed", "<i8"),
+    ("padding", "V16")
+])
+
+# DEGREES TO RADIANS AS THE NATIVE CODE CONVERTS THEM, SO UNIT VECTORS BUILT
+# HERE ARE THE SAME AS THOSE THE Matcher BUILDS ITSELF
+_D2R = 0.0174532925199433
+
+# COST MODEL USED BY choose_depth. THE TIME TO MATCH ONE POINT (MICROSECONDS,
+# ONE THREAD) IS ~ LEVEL x depth + TRIXEL x (TRIXELS IN ITS COVER) + CANDIDATE x
+# (CATALOGUE POINTS IN THOSE TRIXELS), FITTED TO Matcher.match TIMINGS OVER
+# DEPTHS 4-22, RADII 1 ARCSEC TO 0.2 DEG AND 50K-1M POINTS (WITHIN ~30%). A
+# CIRCLE OF RADIUS r IS COVERED BY ~ 1 + AREA x pi r^2 / a + EDGE x 2 pi r /
+# sqrt(a) TRIXELS OF MEAN AREA a (WITHIN ~12% OF THE MEASURED COVERS)
+_DEPTH_COST_LEVEL = 0.85
+_DEPTH_COST_TRIXEL = 0.088
+_DEPTH_COST_CANDIDATE = 0.0025
+_DEPTH_COVER_AREA = 1.25
+_DEPTH_COVER_EDGE = 0.83
+_DEPTH_MAX = 24
+_SKY_AREA_DEG2 = 4. * numpy.pi * (180. / numpy.pi)**2
+
 
 class HTM(_htmcCode.HTMC):
     """
@@ -25,6 +63,7 @@ class HTM(_htmcCode.HTMC):
     **Key Arguments**
 
     - ``depth`` -- the depth of the mesh you wish to create. Default *16*
+    - ``buildlevel`` -- the number of mesh levels to keep in memory. Deeper levels are computed on the fly at lookup time. Default *2*
 
 
     **Usage**
@@ -38,6 +77,15 @@ class HTM(_htmcCode.HTMC):
     )
     ```
 
+    Meshes are cached for the life of the process, so creating another ``HTM`` or ``Matcher`` with the same ``depth`` and ``buildlevel`` reuses the mesh already built. To keep more levels of the mesh in memory (check the memory cost with ``cached_meshes``):
+
+    ```python
+    mesh16 = HTM(
+        depth=16,
+        buildlevel=6
+    )
+    ```
+
     """
 
     @property
@@ -54,6 +102,20 @@ class HTM(_htmcCode.HTMC):
         """
         return super(HTM, self).depth()
 
+    @property
+    def buildlevel(
+            self):
+        """*the number of levels of the HTM tree kept in memory*
+
+        **Usage**
+
+        ```python
+        mesh.buildlevel
+        ```
+
+        """
+        return super(HTM, self).buildlevel()
+
     @property
     def area(
             self):
@@ -115,6 +177,94 @@ class HTM(_htmcCode.HTMC):
         self.log.debug('completed the ``lookup_id`` method')
         return super(HTM, self).lookup_id(raArray, decArray)
 
+    def lookup_ids(
+            self,
+            ra,
+            dec,
+            depths=[7, 10, 13, 16]):
+        """*Lookup the IDs of the HTM trixels that a coordinate or lists of coordinates lie on, at several depths at once*
+
+        The coordinates are converted and looked up once, at the deepest requested depth. The ID of the trixel containing a point at a shallower depth is that deep ID shifted right by 2 bits per level.
+
+        **Key Arguments**
+
+        - ``ra`` -- list, numpy array or single ra value
+        - ``dec`` -- list, numpy array or single dec value (must match ra array length)
+        - ``depths`` -- the mesh depths to return IDs for. Default *[7, 10, 13, 16]*
+
+
+        **Return**
+
+        - ``htmIds`` -- a dictionary of numpy arrays of HTM trixel ids, keyed by depth
+
+
+        **Usage**
+
+        ```python
+        htmIds = mesh.lookup_ids(raList1, decList1, depths=[7, 10, 13, 16])
+        for h16, h7 in zip(htmIds[16], htmIds[7]):
+            print(h16, " --> ", h7)
+        ```
+
+        """
+        self.log.debug('starting the ``lookup_ids`` method')
+
+        depths = [int(d) for d in depths]
+        if not len(depths):
+            raise ValueError("at least one depth is required")
+        for d in depths:
+            if d < 0 or d > 25:
+                raise ValueError("depth (%s) must be between 0 and 25" % (d,))
+
+        deepest = max(depths)
+        if deepest == self.depth:
+            mesh = self
+        else:
+            mesh = HTM(depth=deepest, log=self.log, buildlevel=self.buildlevel)
+        deepIds = mesh.lookup_id(ra, dec)
+
+        htmIds = {}
+        for d in depths:
+            htmIds[d] = deepIds >> (2 * (deepest - d))
+
+        self.log.debug('completed the ``lookup_ids`` method')
+        return htmIds
+
+    def lookup_id_xyz(
+            self,
+            x,
+            y,
+            z):
+        """*Lookup the ID of HTM trixel that a cartesian vector or lists of vectors point at*
+
+        For data already stored as cartesian unit vectors (e.g. the ``cx``, ``cy``, ``cz`` columns added by ``add_htm_ids_to_mysql_database_table``) this skips the conversion to and from ra, dec.
+
+        **Key Arguments**
+
+        - ``x`` -- list, numpy array or single x value
+        - ``y`` -- list, numpy array or single y value (must match x array length)
+        - ``z`` -- list, numpy array or single z value (must match x array length). The vectors need not be of unit length, but must not be zero
+
+
+        **Return**
+
+        - ``htmIds`` -- a numpy array of HTM trixel ids the vectors point at
+
+
+        **Usage**
+
+        ```python
+        htmids = mesh.lookup_id_xyz(cx, cy, cz)
+        ```
+
+        """
+        self.log.debug('starting the ``lookup_id_xyz`` method')
+
+        x, y, z = _xyz_to_arrays(x, y, z)
+
+        self.log.debug('completed the ``lookup_id_xyz`` method')
+        return super(HTM, self).lookup_id_xyz(x, y, z)
+
     # use the tab-trigger below for new method
     # xt-class-method
     def intersect(self, ra, dec, radius, inclusive=True, convertCoordinates=True):
@@ -179,267 +329,1658 @@ class HTM(_htmcCode.HTMC):
             inc = 0
         return super(HTM, self).intersect(ra, dec, radius, inc)
 
-    def match(self, ra1, dec1, ra2, dec2, radius, maxmatch=1, convertToArray=True):
-        """*Crossmatch two lists of ra/dec points*
-
-        This is very efficient for large search angles and large lists. Note, if you need to match against the same points many times, you should use a `Matcher` object
+    def intersect_many(self, ra, dec, radius, inclusive=True, unique=True, convertToArray=True):
+        """*return IDs of all triangles contained within and/or intersecting many circles, in a single native call*
 
         **Key Arguments**
 
-        - ``ra1`` -- list, numpy array or single ra value (first coordinate set)
-        - ``dec1`` -- list, numpy array or single dec value (first coordinate set - must match ra1 array length)
-        - ``ra2`` -- list, numpy array or single ra value (second coordinate set)
-        - ``dec2`` -- list, numpy array or single dec value (second coordinate set - must match ra2 array length)
-        - ``radius`` -- search radius in degrees. Can be list, numpy array or single value. If list or numpy array must be same length as ra1 array length)
-        - ``maxmatch`` -- maximum number of matches to return. Set to `0` to match all points. Default *1* (i.e. closest match)
+        - ``ra`` -- list or numpy array of circle centre RAs
+        - ``dec`` -- list or numpy array of circle centre DECs (must match ra array length)
+        - ``radius`` -- radius of the circles in degrees. A single value or one per circle
+        - ``inclusive`` -- include IDs of triangles that intersect the circles as well as those completely inclosed by the circles. Default *True*
+        - ``unique`` -- return the distinct IDs covering any of the circles. Set to `False` to get the IDs for each circle. Default *True*
         - ``convertToArray`` -- convert the coordinates into an array. Default *True*. Can bypass the conversion check if you are sure coordinates in numpy array
 
 
         **Return**
 
-        - ``matchIndices1`` -- match indices for list1 (ra1, dec1)
-        - ``matchIndices2`` -- match indices for list2 (ra2, dec2)
-        - ``sepDeg`` -- separations between matched corrdinates in degrees. All returned arrays are the same size
+        - ``trixelArray`` -- a sorted numpy array of the distinct trixel IDs (``unique=True``), or
+        - ``offsets``, ``trixelArray`` -- if ``unique=False``, the IDs of circle ``i`` are ``trixelArray[offsets[i]:offsets[i + 1]]``, in the same order `intersect` returns them
 
 
         **Usage**
 
-        To match 2 lists of corrdinates try something like this:
+        To return all the trixels overlapping 10 arcsec circles around a set of coordinates:
 
         ```python
-        twoArcsec = 2.0 / 3600.
-        raList1 = [200.0, 200.0, 200.0, 175.23, 21.36]
-        decList1 = [24.3,  24.3,  24.3,  -28.25, -15.32]
-        raList2 = [200.0, 200.0, 200.0, 175.23, 55.25]
-        decList2 = [24.3 + 0.75 * twoArcsec, 24.3 + 0.25 * twoArcsec,
-                    24.3 - 0.33 * twoArcsec, -28.25 + 0.58 * twoArcsec, 75.22]
-        matchIndices1, matchIndices2, seps = mesh.match(
-            ra1=raList1,
-            dec1=decList1,
-            ra2=raList2,
-            dec2=decList2,
-            radius=twoArcsec,
-            maxmatch=0
+        overlappingTrixels = mesh16.intersect_many(
+            ra=raList,
+            dec=decList,
+            radius=10 / (60 * 60),
+            inclusive=True
         )
-
-        for m1, m2, s in zip(matchIndices1, matchIndices2, seps):
-            print(raList1[m1], decList1[m1], " -> ", s * 3600.,
-                  " arcsec -> ", raList2[m2], decList2[m2])
         ```
 
-        Note from the print statement, you can index the arrays ``raList1``, ``decList1`` with the ``matchIndices1`` array values and  ``raList2``, ``decList2`` with the ``matchIndices2`` values.
+        Or to get the trixels overlapping each circle:
 
-        """
-        from scipy.spatial import cKDTree
+        ```python
+        offsets, trixelArray = mesh16.intersect_many(
+            ra=raList,
+            dec=decList,
+            radius=10 / (60 * 60),
+            unique=False
+        )
+        for i in range(len(raList)):
+            print(raList[i], decList[i], trixelArray[offsets[i]:offsets[i + 1]])
+        ```
 
-        # CONVERT LISTS AND SINGLE VALUES TO ARRAYS OF FLOATS
-        ra1 = numpy.array(ra1, dtype='f8', ndmin=1)
-        dec1 = numpy.array(dec1, dtype='f8', ndmin=1)
-        ra2 = numpy.array(ra2, dtype='f8', ndmin=1)
-        dec2 = numpy.array(dec2, dtype='f8', ndmin=1)
+        """
+        if convertToArray == True:
+            from astrocalc.coords import coordinates_to_array
+            ra, dec = coordinates_to_array(
+                log=self.log,
+                ra=ra,
+                dec=dec
+            )
+        ra = numpy.asarray(ra, dtype='f8')
+        dec = numpy.asarray(dec, dtype='f8')
         radius = numpy.array(radius, dtype='f8', ndmin=1)
 
-        # CHECK ARRAY SIZES MATCH
-        if (ra1.size != dec1.size
-                or ra2.size != ra2.size):
-            stup = (ra1.size, dec1.size, ra2.size, dec2.size)
-            raise ValueError("ra1 must equal dec1 in size "
-                             "and ra2 must equal dec2 in size, "
-                             "got %d,%d and %d,%d" % stup)
+        if ra.size != dec.size:
+            raise ValueError("ra size (%d) != "
+                             "dec size (%d)" % (ra.size, dec.size))
 
-        if radius.size != 1 and radius.size != ra2.size:
+        if radius.size != 1 and radius.size != ra.size:
             raise ValueError("radius size (%d) != 1 and"
-                             " != ra2,dec2 size (%d)" % (radius.size, ra2.size))
-
-        # QUICK TRIMMING IN DEC SPACE OF BOTH SETS OF ARRAYS (FAST VERSION)
-        tree2 = cKDTree(dec2[:, None])
-        idxs2 = tree2.query_ball_point(
-            dec1[:, None], r=radius if numpy.isscalar(radius) else radius[0])
-        # idxs2 is a list of arrays: for each dec1, indices in dec2 within radius
-
-        # Flatten and get unique indices in dec2 that are close to any dec1
-        if len(idxs2) > 0:
-            decMatchIndices2 = numpy.unique(
-                numpy.concatenate(idxs2)).astype(int)
-        else:
-            decMatchIndices2 = numpy.array([], dtype=int)
-        ra2a = ra2[decMatchIndices2]
-        dec2a = dec2[decMatchIndices2]
+                             " != ra,dec size (%d)" % (radius.size, ra.size))
 
-        tree1 = cKDTree(dec1[:, None])
-        idxs1 = tree1.query_ball_point(
-            dec2[:, None], r=radius if numpy.isscalar(radius) else radius[0])
-        if len(idxs1) > 0:
-            decMatchIndices1 = numpy.unique(
-                numpy.concatenate(idxs1)).astype(int)
+        if inclusive:
+            inc = 1
         else:
-            decMatchIndices1 = numpy.array([], dtype=int)
-        ra1a = ra1[decMatchIndices1]
-        dec1a = dec1[decMatchIndices1]
+            inc = 0
+        if unique:
+            unq = 1
+        else:
+            unq = 0
+        return super(HTM, self).intersect_many(ra, dec, radius, inc, unq)
 
-        if len(ra1a) == 0 or len(ra2a) == 0:
-            return numpy.array([], dtype='i8'), numpy.array([], dtype='i8'), numpy.array([], dtype='f8')
+    def intersect_xyz(self, x, y, z, radius, inclusive=True, unique=True):
+        """*return IDs of all triangles contained within and/or intersecting circles centred on cartesian vectors*
 
-        # new way using a Matcher
-        depth = self.depth
-        matcher = Matcher(
-            log=self.log,
-            depth=depth,
-            ra=ra2a,
-            dec=dec2a,
-            convertToArray=convertToArray)
-        matchIndices1, matchIndices2, seps = matcher.match(
-            ra=ra1a,
-            dec=dec1a,
-            radius=radius,
-            maxmatch=maxmatch)
+        The cartesian counterpart of `intersect_many`.
 
-        matchIndices1 = decMatchIndices1[matchIndices1]
-        matchIndices2 = decMatchIndices2[matchIndices2]
+        **Key Arguments**
 
-        return matchIndices1, matchIndices2, seps
+        - ``x`` -- list, numpy array or single x value of the circle centres
+        - ``y`` -- list, numpy array or single y value (must match x array length)
+        - ``z`` -- list, numpy array or single z value (must match x array length). The vectors need not be of unit length, but must not be zero
+        - ``radius`` -- radius of the circles in degrees. A single value or one per circle
+        - ``inclusive`` -- include IDs of triangles that intersect the circles as well as those completely inclosed by the circles. Default *True*
+        - ``unique`` -- return the distinct IDs covering any of the circles. Set to `False` to get the IDs for each circle. Default *True*
 
 
-class Matcher(_htmcCode.Matcher):
-    """*A matcher-array object to match other arrays of ra,dec against*
+        **Return**
 
-    The Matcher object is initialized with a set of ra,dec coordinates and can then be used and reused to match against other sets of coordinates
+        - ``trixelArray`` -- a sorted numpy array of the distinct trixel IDs (``unique=True``), or
+        - ``offsets``, ``trixelArray`` -- if ``unique=False``, the IDs of circle ``i`` are ``trixelArray[offsets[i]:offsets[i + 1]]``
 
-    **Key Arguments**
 
-    - ``log`` -- logger
-    - ``depth`` -- the depth of the mesh generate the Matcher object at. Default *16*
-    - ``ra`` -- list, numpy array or single ra value
-    - ``dec`` -- --list, numpy array or single dec value (must match ra array length)
-    - ``convertToArray`` -- convert the coordinates into an array. Default *True*. Can bypass the conversion check if you are sure coordinates in numpy array
+        **Usage**
 
+        ```python
+        overlappingTrixels = mesh16.intersect_xyz(
+            x=cx,
+            y=cy,
+            z=cz,
+            radius=10 / (60 * 60)
+        )
+        ```
 
-    **Return**
+        """
+        x, y, z = _xyz_to_arrays(x, y, z)
+        radius = numpy.array(radius, dtype='f8', ndmin=1)
 
-    - None
+        if radius.size != 1 and radius.size != x.size:
+            raise ValueError("radius size (%d) != 1 and"
+                             " != x,y,z size (%d)" % (radius.size, x.size))
 
+        if inclusive:
+            inc = 1
+        else:
+            inc = 0
+        if unique:
+            unq = 1
+        else:
+            unq = 0
+        return super(HTM, self).intersect_many_xyz(x, y, z, radius, inc, unq)
 
-    **Usage**
+    def intersect_polygon(self, ra_vertices, dec_vertices, inclusive=True):
+        """*return IDs of all triangles contained within and/or intersecting a convex polygon*
 
-    If we have a set of coordinates such that:
+        The polygon is the convex hull of the vertices, so they can be given in any order. Each side is the great circle through two vertices.
 
-    ```python
-    raList1 = [200.0, 200.0, 200.0, 175.23, 21.36]
-    decList1 = [24.3,  24.3,  24.3,  -28.25, -15.32]
-    ```
+        **Key Arguments**
 
-    We can initialise a matcher object like so:
+        - ``ra_vertices`` -- list or numpy array of the RAs of the polygon vertices in decimal degrees (at least 3)
+        - ``dec_vertices`` -- list or numpy array of the DECs of the polygon vertices in decimal degrees (must match ra_vertices length). The vertices must lie within one hemisphere and not all on one great circle
+        - ``inclusive`` -- include IDs of triangles that intersect the polygon as well as those completely inclosed by the polygon. Default *True*
 
-    ```python
-    from HMpTy import Matcher
-    coordinateSet = Matcher(
-        log=log,
-        ra=raList1,
-        dec=decList1,
-        depth=16
-    )
-    ```
 
-    """
+        **Return**
 
-    def __init__(
-            self,
-            ra,
-            dec,
-            depth=16,
-            log=False,
-            convertToArray=True):
+        - ``trixelArray`` -- a numpy array of the trixel IDs, those completely inside the polygon first
 
-        self.convertToArray = convertToArray
 
-        if log == False:
-            if log == False:
-                from fundamentals.logs import emptyLogger
-                self.log = emptyLogger()
-        else:
-            self.log = log
+        **Usage**
 
-        if convertToArray == True:
-            from astrocalc.coords import coordinates_to_array
-            ra, dec = coordinates_to_array(
-                log=log,
-                ra=ra,
-                dec=dec
-            )
+        To return the trixels overlapping a CCD footprint:
 
-        if ra.size != dec.size:
-            raise ValueError("ra size (%d) != "
-                             "dec size (%d)" % (ra.size, dec.size))
+        ```python
+        overlappingTrixels = mesh16.intersect_polygon(
+            ra_vertices=[150.1, 150.3, 150.3, 150.1],
+            dec_vertices=[2.1, 2.1, 2.3, 2.3]
+        )
+        ```
 
-        super(Matcher, self).__init__(depth, ra, dec)
+        """
+        offsets, trixelArray = self.intersect_polygon_many(
+            [ra_vertices], [dec_vertices], inclusive=inclusive)
+        return trixelArray
+
+    def intersect_polygon_many(self, ra_vertices, dec_vertices, inclusive=True):
+        """*return IDs of all triangles contained within and/or intersecting many convex polygons, in a single native call*
+
+        **Key Arguments**
+
+        - ``ra_vertices`` -- a list of the vertex RA lists or arrays, one per polygon (see `intersect_polygon`)
+        - ``dec_vertices`` -- a list of the vertex DEC lists or arrays, one per polygon
+        - ``inclusive`` -- include IDs of triangles that intersect the polygons as well as those completely inclosed by the polygons. Default *True*
+
+
+        **Return**
+
+        - ``offsets``, ``trixelArray`` -- the IDs of polygon ``i`` are ``trixelArray[offsets[i]:offsets[i + 1]]``, in the order `intersect_polygon` returns them
 
-    @property
-    def depth(
-            self):
-        """*the depth of the Matcher object*
 
         **Usage**
 
         ```python
-        coordinateSet.depth
+        offsets, trixelArray = mesh16.intersect_polygon_many(
+            ra_vertices=[[150.1, 150.3, 150.3, 150.1], [151.0, 151.2, 151.1]],
+            dec_vertices=[[2.1, 2.1, 2.3, 2.3], [2.0, 2.0, 2.2]]
+        )
         ```
 
         """
-        return super(Matcher, self).depth
+        ra, dec, vertexOffsets = _polygons_to_arrays(ra_vertices, dec_vertices)
 
-    def match(self, ra, dec, radius, maxmatch=1):
-        """*match a corrdinate set against this Matcher object's coordinate set*
+        if inclusive:
+            inc = 1
+        else:
+            inc = 0
+        return super(HTM, self).intersect_polygons(ra, dec, vertexOffsets, inc)
+
+    def intersect_ranges(self, ra, dec, radius, depth=None, inclusive=True, convertCoordinates=True):
+        """*return the trixels contained within and/or intersecting a circle as merged ranges of IDs*
+
+        The circle is covered with trixels at the depth of the mesh, as in `intersect`, and the cover is then expressed as sorted, merged ``[lo, hi]`` ranges of the IDs at ``depth``. A contiguous run of trixels (e.g. all the children of a fully covered parent) becomes a single range, so the cover has far fewer elements than the ID list. If ``depth`` is shallower than the mesh, each trixel is replaced by the trixel containing it.
 
         **Key Arguments**
 
-        - ``ra`` -- list, numpy array or single ra value
-        - ``dec`` -- --list, numpy array or single dec value (must match ra array length)
+        - ``ra`` -- RA of central point in decimal degrees or sexagesimal
+        - ``dec`` -- DEC of central point in decimal degrees or sexagesimal
         - ``radius`` -- radius of circle in degrees
-        - ``maxmatch`` -- maximum number of matches to return. Set to `0` to match all points. Default *1* (i.e. closest match)
+        - ``depth`` -- the depth of the IDs in the returned ranges. Default *None* (the depth of the mesh)
+        - ``inclusive`` -- include IDs of triangles that intersect the circle as well as those completely inclosed by the circle. Default *True*
+        - ``convertCoordinates`` -- convert the corrdinates passed to intersect. Default *True*
 
 
         **Return**
 
-        - None
+        - ``ranges`` -- an (n, 2) numpy array of the inclusive ``[lo, hi]`` ID ranges, sorted and non-overlapping
 
 
         **Usage**
 
-        Once we have initialised a Matcher coordinateSet object we can match other coordinate sets against it:
+        To query a table with a depth 16 htm ID column using the ranges covering a 1 arcmin circle:
 
         ```python
-        twoArcsec = 2.0 / 3600.
-        raList2 = [200.0, 200.0, 200.0, 175.23, 55.25]
-        decList2 = [24.3 + 0.75 * twoArcsec, 24.3 + 0.25 * twoArcsec,
-            24.3 - 0.33 * twoArcsec, -28.25 + 0.58 * twoArcsec, 75.22]
-
-        matchIndices1, matchIndices2, seps = coordinateSet.match(
-            ra=raList2,
-            dec=decList2,
-            radius=twoArcsec,
-            maxmatch=0
+        ranges = mesh16.intersect_ranges(
+            ra="23:25:53.56",
+            dec="+26:54:23.9",
+            radius=1 / 60.
         )
+        htmWhereClause = " or ".join(
+            "htm16ID between %d and %d" % (lo, hi) for lo, hi in ranges)
+        ```
 
-        for m1, m2, s in zip(matchIndices1, matchIndices2, seps):
+        """
+        if convertCoordinates == True:
+            converter = unit_conversion(
+                log=self.log
+            )
+            ra = converter.ra_sexegesimal_to_decimal(
+                ra=ra
+            )
+            dec = converter.dec_sexegesimal_to_decimal(
+                dec=dec
+            )
+
+        return self.intersect_ranges_many(
+            ra=[ra],
+            dec=[dec],
+            radius=radius,
+            depth=depth,
+            inclusive=inclusive,
+            convertToArray=False)
+
+    def intersect_ranges_many(self, ra, dec, radius, depth=None, inclusive=True, unique=True, convertToArray=True):
+        """*return the trixels contained within and/or intersecting many circles as merged ranges of IDs, in a single native call*
+
+        See `intersect_ranges` for how the ranges are built.
+
+        **Key Arguments**
+
+        - ``ra`` -- list or numpy array of circle centre RAs
+        - ``dec`` -- list or numpy array of circle centre DECs (must match ra array length)
+        - ``radius`` -- radius of the circles in degrees. A single value or one per circle
+        - ``depth`` -- the depth of the IDs in the returned ranges. Default *None* (the depth of the mesh)
+        - ``inclusive`` -- include IDs of triangles that intersect the circles as well as those completely inclosed by the circles. Default *True*
+        - ``unique`` -- merge the ranges of all the circles together. Set to `False` to get the ranges for each circle. Default *True*
+        - ``convertToArray`` -- convert the coordinates into an array. Default *True*. Can bypass the conversion check if you are sure coordinates in numpy array
+
+
+        **Return**
+
+        - ``ranges`` -- an (n, 2) numpy array of the inclusive ``[lo, hi]`` ID ranges covering all the circles (``unique=True``), or
+        - ``offsets``, ``ranges`` -- if ``unique=False``, the ranges of circle ``i`` are ``ranges[offsets[i]:offsets[i + 1]]``
+
+
+        **Usage**
+
+        ```python
+        ranges = mesh16.intersect_ranges_many(
+            ra=raList,
+            dec=decList,
+            radius=10 / (60 * 60),
+            depth=16
+        )
+        ```
+
+        """
+        if convertToArray == True:
+            from astrocalc.coords import coordinates_to_array
+            ra, dec = coordinates_to_array(
+                log=self.log,
+                ra=ra,
+                dec=dec
+            )
+        ra = numpy.asarray(ra, dtype='f8')
+        dec = numpy.asarray(dec, dtype='f8')
+        radius = numpy.array(radius, dtype='f8', ndmin=1)
+
+        if ra.size != dec.size:
+            raise ValueError("ra size (%d) != "
+                             "dec size (%d)" % (ra.size, dec.size))
+
+        if radius.size != 1 and radius.size != ra.size:
+            raise ValueError("radius size (%d) != 1 and"
+                             " != ra,dec size (%d)" % (radius.size, ra.size))
+
+        if depth is None:
+            depth = self.depth
+        if depth < 0 or depth > 25:
+            raise ValueError("depth (%s) must be between 0 and 25" % (depth,))
+
+        if inclusive:
+            inc = 1
+        else:
+            inc = 0
+        if unique:
+            return super(HTM, self).intersect_ranges(ra, dec, radius, int(depth), inc, 1).reshape(-1, 2)
+
+        offsets, ranges = super(HTM, self).intersect_ranges(
+            ra, dec, radius, int(depth), inc, 0)
+        return offsets, ranges.reshape(-1, 2)
+
+    def match(self, ra1, dec1, ra2, dec2, radius, maxmatch=1, convertToArray=True, nthreads=1, separations=True, depth=None):
+        """*Crossmatch two lists of ra/dec points*
+
+        This is very efficient for large search angles and large lists. Note, if you need to match against the same points many times, you should use a `Matcher` object
+
+        **Key Arguments**
+
+        - ``ra1`` -- list, numpy array or single ra value (first coordinate set)
+        - ``dec1`` -- list, numpy array or single dec value (first coordinate set - must match ra1 array length)
+        - ``ra2`` -- list, numpy array or single ra value (second coordinate set)
+        - ``dec2`` -- list, numpy array or single dec value (second coordinate set - must match ra2 array length)
+        - ``radius`` -- search radius in degrees. Can be list, numpy array or single value. If list or numpy array must be same length as ra1 array length)
+        - ``maxmatch`` -- maximum number of matches to return. Set to `0` to match all points. Default *1* (i.e. closest match)
+        - ``convertToArray`` -- convert the coordinates into an array. Default *True*. Can bypass the conversion check if you are sure coordinates in numpy array
+        - ``nthreads`` -- number of native threads to split the matching across. Set to `0` to use all available cores; more threads than cores are never started. The output order does not depend on the number of threads. Default *1*
+        - ``separations`` -- return the separations of the matched pairs. Set to `False` to return only the two index arrays; with `maxmatch=0` this also skips the distance calculations for points in trixels lying wholly inside the search circle, and the matches to each point are not sorted by separation. Default *True*
+        - ``depth`` -- the depth of the `Matcher` built on the second coordinate set. Set to *"auto"* to choose the depth from the radius and the density of the coordinates (see `choose_depth`). Default *None*, the depth of this mesh
+
+
+        **Return**
+
+        - ``matchIndices1`` -- match indices for list1 (ra1, dec1)
+        - ``matchIndices2`` -- match indices for list2 (ra2, dec2)
+        - ``sepDeg`` -- separations between matched corrdinates in degrees. All returned arrays are the same size. Not returned if ``separations`` is `False`
+
+
+        **Usage**
+
+        To match 2 lists of corrdinates try something like this:
+
+        ```python
+        twoArcsec = 2.0 / 3600.
+        raList1 = [200.0, 200.0, 200.0, 175.23, 21.36]
+        decList1 = [24.3,  24.3,  24.3,  -28.25, -15.32]
+        raList2 = [200.0, 200.0, 200.0, 175.23, 55.25]
+        decList2 = [24.3 + 0.75 * twoArcsec, 24.3 + 0.25 * twoArcsec,
+                    24.3 - 0.33 * twoArcsec, -28.25 + 0.58 * twoArcsec, 75.22]
+        matchIndices1, matchIndices2, seps = mesh.match(
+            ra1=raList1,
+            dec1=decList1,
+            ra2=raList2,
+            dec2=decList2,
+            radius=twoArcsec,
+            maxmatch=0
+        )
+
+        for m1, m2, s in zip(matchIndices1, matchIndices2, seps):
+            print(raList1[m1], decList1[m1], " -> ", s * 3600.,
+                  " arcsec -> ", raList2[m2], decList2[m2])
+        ```
+
+        Note from the print statement, you can index the arrays ``raList1``, ``decList1`` with the ``matchIndices1`` array values and  ``raList2``, ``decList2`` with the ``matchIndices2`` values.
+
+        """
+        # CONVERT LISTS AND SINGLE VALUES TO ARRAYS OF FLOATS
+        ra1 = numpy.array(ra1, dtype='f8', ndmin=1)
+        dec1 = numpy.array(dec1, dtype='f8', ndmin=1)
+        ra2 = numpy.array(ra2, dtype='f8', ndmin=1)
+        dec2 = numpy.array(dec2, dtype='f8', ndmin=1)
+        radius = numpy.array(radius, dtype='f8', ndmin=1)
+
+        # CHECK ARRAY SIZES MATCH
+        if (ra1.size != dec1.size
+                or ra2.size != dec2.size):
+            stup = (ra1.size, dec1.size, ra2.size, dec2.size)
+            raise ValueError("ra1 must equal dec1 in size "
+                             "and ra2 must equal dec2 in size, "
+                             "got %d,%d and %d,%d" % stup)
+
+        if radius.size != 1 and radius.size != ra1.size:
+            raise ValueError("radius size (%d) != 1 and"
+                             " != ra1,dec1 size (%d)" % (radius.size, ra1.size))
+
+        # QUICK TRIMMING IN DEC SPACE OF BOTH SETS OF ARRAYS
+        decMatchIndices1, decMatchIndices2 = _dec_band_trim(
+            dec1, dec2, radius)
+        ra1a = ra1[decMatchIndices1]
+        dec1a = dec1[decMatchIndices1]
+        ra2a = ra2[decMatchIndices2]
+        dec2a = dec2[decMatchIndices2]
+        if radius.size != 1:
+            radius = radius[decMatchIndices1]
+
+        if len(ra1a) == 0 or len(ra2a) == 0:
+            if not separations:
+                return numpy.array([], dtype='i8'), numpy.array([], dtype='i8')
+            return numpy.array([], dtype='i8'), numpy.array([], dtype='i8'), numpy.array([], dtype='f8')
+
+        # new way using a Matcher
+        if depth is None:
+            depth = self.depth
+        elif depth == "auto":
+            depth = choose_depth(
+                ra=ra2a,
+                dec=dec2a,
+                radius=radius,
+                queryRa=ra1a,
+                queryDec=dec1a,
+                convertToArray=False,
+                log=self.log)["depth"]
+        matcher = Matcher(
+            log=self.log,
+            depth=depth,
+            ra=ra2a,
+            dec=dec2a,
+            convertToArray=convertToArray,
+            buildlevel=self.buildlevel)
+        results = matcher.match(
+            ra=ra1a,
+            dec=dec1a,
+            radius=radius,
+            maxmatch=maxmatch,
+            nthreads=nthreads,
+            separations=separations)
+
+        matchIndices1 = decMatchIndices1[results[0]]
+        matchIndices2 = decMatchIndices2[results[1]]
+
+        if not separations:
+            return matchIndices1, matchIndices2
+        return matchIndices1, matchIndices2, results[2]
+
+    def self_match(self, ra, dec, radius, include_self=False, convertToArray=True, nthreads=1, separations=True):
+        """*find all the pairs of points within a radius of each other in a single list of ra/dec points*
+
+        Each pair is found once, as ``(i, j)`` with ``i < j``, from a single index of the list. Matching the list against itself with `match` finds every pair twice and every point against itself.
+
+        **Key Arguments**
+
+        - ``ra`` -- list, numpy array or single ra value
+        - ``dec`` -- list, numpy array or single dec value (must match ra array length)
+        - ``radius`` -- search radius in degrees (a single value)
+        - ``include_self`` -- also return each point's match to itself, as ``(i, i)`` with a separation of 0. Default *False*
+        - ``convertToArray`` -- convert the coordinates into an array. Default *True*. Can bypass the conversion check if you are sure coordinates in numpy array
+        - ``nthreads`` -- number of native threads to split the matching across. Set to `0` to use all available cores; more threads than cores are never started. The output order does not depend on the number of threads. Default *1*
+        - ``separations`` -- return the separations of the matched pairs. See `match`. Default *True*
+
+
+        **Return**
+
+        - ``matchIndices1`` -- the lower index of each pair, ascending
+        - ``matchIndices2`` -- the higher index of each pair. The partners of each point are sorted by separation (unless ``separations`` is `False`)
+        - ``sepDeg`` -- separations between the paired coordinates in degrees. Not returned if ``separations`` is `False`
+
+
+        **Usage**
+
+        ```python
+        matchIndices1, matchIndices2, seps = mesh.self_match(
+            ra=raList,
+            dec=decList,
+            radius=2.0 / 3600.
+        )
+        ```
+
+        """
+        self.log.debug('starting the ``self_match`` method')
+
+        matcher = Matcher(ra=ra, dec=dec, depth=self.depth, log=self.log,
+                          convertToArray=convertToArray, buildlevel=self.buildlevel)
+        results = matcher.self_match(
+            radius, include_self=include_self, nthreads=nthreads, separations=separations)
+
+        self.log.debug('completed the ``self_match`` method')
+        return results
+
+    def match_iter(self, ra1, dec1, ra2, dec2, radius, maxmatch=1, chunk_size=1000000, convertToArray=True, nthreads=1, separations=True):
+        """*Crossmatch two lists of ra/dec points, yielding the matches chunk by chunk*
+
+        A `Matcher` is built on the second coordinate set and the first set is matched against it ``chunk_size`` points at a time (see `Matcher.match_iter`), so a very large first list can be matched with bounded memory.
+
+        **Key Arguments**
+
+        - ``ra1`` -- list, numpy array or single ra value (first coordinate set)
+        - ``dec1`` -- list, numpy array or single dec value (first coordinate set - must match ra1 array length)
+        - ``ra2`` -- list, numpy array or single ra value (second coordinate set)
+        - ``dec2`` -- list, numpy array or single dec value (second coordinate set - must match ra2 array length)
+        - ``radius`` -- search radius in degrees. Can be list, numpy array or single value. If list or numpy array must be same length as ra1 array length)
+        - ``maxmatch`` -- maximum number of matches to return. Set to `0` to match all points. Default *1* (i.e. closest match)
+        - ``chunk_size`` -- the number of coordinates from the first set matched per chunk. Default *1000000*
+        - ``convertToArray`` -- convert the coordinates into an array. Default *True*. Can bypass the conversion check if you are sure coordinates in numpy array
+        - ``nthreads`` -- number of native threads to split each chunk across. Set to `0` to use all available cores. Default *1*
+        - ``separations`` -- yield the separations of the matched pairs. See `match`. Default *True*
+
+
+        **Return**
+
+        - a generator yielding one ``(matchIndices1, matchIndices2, sepDeg)`` tuple per chunk of the first coordinate set (``(matchIndices1, matchIndices2)`` if ``separations`` is `False`). The indices always index the full coordinate lists
+
+
+        **Usage**
+
+        ```python
+        for matchIndices1, matchIndices2, seps in mesh.match_iter(
+            ra1=raList1,
+            dec1=decList1,
+            ra2=raList2,
+            dec2=decList2,
+            radius=twoArcsec,
+            maxmatch=1,
+            chunk_size=5000000
+        ):
+            writeMatches(matchIndices1, matchIndices2, seps)
+        ```
+
+        """
+        self.log.debug('starting the ``match_iter`` method')
+
+        matcher = Matcher(
+            log=self.log,
+            depth=self.depth,
+            ra=ra2,
+            dec=dec2,
+            convertToArray=convertToArray,
+            buildlevel=self.buildlevel)
+
+        for results in matcher.match_iter(
+                ra=ra1,
+                dec=dec1,
+                radius=radius,
+                maxmatch=maxmatch,
+                chunk_size=chunk_size,
+                nthreads=nthreads,
+                separations=separations):
+            yield results
+
+        self.log.debug('completed the ``match_iter`` method')
+
+    def bincount(self, rmin, rmax, nbin, ra1, dec1, ra2=None, dec2=None, scale=None, nthreads=1, progress=None, convertToArray=True):
+        """*count the pairs between two coordinate sets, or within one, in logarithmic bins of separation*
+
+        The pairs are found with a `Matcher` built on the second coordinate set at the depth of this mesh (see `Matcher.bincount`). Nothing is printed; pass a ``progress`` callback to follow long counts.
+
+        **Key Arguments**
+
+        - ``rmin`` -- the lower edge of the first bin, in degrees (or in units of ``scale`` * radians)
+        - ``rmax`` -- the upper edge of the last bin
+        - ``nbin`` -- the number of logarithmic bins between ``rmin`` and ``rmax``
+        - ``ra1`` -- list, numpy array or single ra value (first coordinate set)
+        - ``dec1`` -- list, numpy array or single dec value (first coordinate set - must match ra1 array length)
+        - ``ra2`` -- list, numpy array or single ra value (second coordinate set). Default *None*, count the pairs within the first coordinate set, each unordered pair once
+        - ``dec2`` -- list, numpy array or single dec value (second coordinate set - must match ra2 array length). Default *None*
+        - ``scale`` -- bin in units of ``scale`` * radians rather than degrees, e.g. a comoving distance to bin in projected separation. A single value or one per first-set coordinate (a single value only when counting pairs within one set). Default *None*
+        - ``nthreads`` -- number of native threads to split the first coordinate set across. Set to `0` to use all available cores. Default *1*
+        - ``progress`` -- a function called as ``progress(ndone, ntotal)`` after each chunk of points is counted. Default *None*
+        - ``convertToArray`` -- convert the coordinates into an array. Default *True*. Can bypass the conversion check if you are sure coordinates in numpy array
+
+
+        **Return**
+
+        - ``rlower`` -- the lower edges of the bins
+        - ``rupper`` -- the upper edges of the bins
+        - ``counts`` -- the number of pairs in each bin
+
+
+        **Usage**
+
+        To count the pairs within a catalogue in 10 bins from 1 arcsec to 1 degree:
+
+        ```python
+        rlower, rupper, counts = mesh.bincount(
+            rmin=1. / 3600,
+            rmax=1.,
+            nbin=10,
+            ra1=raList,
+            dec1=decList,
+            nthreads=0
+        )
+        ```
+
+        """
+        self.log.debug('starting the ``bincount`` method')
+
+        if (ra2 is None) != (dec2 is None):
+            raise ValueError("ra2 and dec2 must both be given or both be None")
+
+        if ra2 is None:
+            matcher = Matcher(ra=ra1, dec=dec1, depth=self.depth, log=self.log,
+                              convertToArray=convertToArray, buildlevel=self.buildlevel)
+            results = matcher.bincount(
+                rmin, rmax, nbin, scale=scale, nthreads=nthreads, progress=progress)
+        else:
+            matcher = Matcher(ra=ra2, dec=dec2, depth=self.depth, log=self.log,
+                              convertToArray=convertToArray, buildlevel=self.buildlevel)
+            results = matcher.bincount(
+                rmin, rmax, nbin, ra=ra1, dec=dec1, scale=scale, nthreads=nthreads, progress=progress)
+
+        self.log.debug('completed the ``bincount`` method')
+        return results
+
+    def cbincount(self, rmin, rmax, nbin, ra1, dec1, ra2, dec2, htmrev2=None, minid=None, maxid=None, scale=None):
+        """*deprecated, use* ``bincount``
+
+        Counts the pairs between the two coordinate sets with `bincount` and returns only the counts. ``htmrev2``, ``minid`` and ``maxid`` are no longer needed and are ignored.
+
+        **Return**
+
+        - ``counts`` -- the number of pairs in each bin
+
+        """
+        import warnings
+        warnings.warn("HTM.cbincount is deprecated, use HTM.bincount",
+                      DeprecationWarning, stacklevel=2)
+        rlower, rupper, counts = self.bincount(
+            rmin, rmax, nbin, ra1, dec1, ra2, dec2, scale=scale)
+        return counts
+
+
+class Matcher(_htmcCode.Matcher):
+    """*A matcher-array object to match other arrays of ra,dec against*
+
+    The Matcher object is initialized with a set of ra,dec coordinates and can then be used and reused to match against other sets of coordinates
+
+    **Key Arguments**
+
+    - ``log`` -- logger
+    - ``depth`` -- the depth of the mesh generate the Matcher object at. Set to *"auto"* to choose the depth from ``radius`` and the density of the coordinates (see `choose_depth`), the estimate is kept in the ``depthEstimate`` attribute. Default *16*
+    - ``ra`` -- list, numpy array or single ra value
+    - ``dec`` -- --list, numpy array or single dec value (must match ra array length)
+    - ``convertToArray`` -- convert the coordinates into an array. Default *True*. Can bypass the conversion check if you are sure coordinates in numpy array
+    - ``buildlevel`` -- the number of mesh levels to keep in memory. Default *2*
+    - ``radius`` -- the search radius in degrees the Matcher will typically be queried with. Only used (and required) when ``depth`` is *"auto"*. Default *None*
+
+
+    **Return**
+
+    - None
+
+
+    **Usage**
+
+    If we have a set of coordinates such that:
+
+    ```python
+    raList1 = [200.0, 200.0, 200.0, 175.23, 21.36]
+    decList1 = [24.3,  24.3,  24.3,  -28.25, -15.32]
+    ```
+
+    We can initialise a matcher object like so:
+
+    ```python
+    from HMpTy import Matcher
+    coordinateSet = Matcher(
+        log=log,
+        ra=raList1,
+        dec=decList1,
+        depth=16
+    )
+    ```
+
+    To let the Matcher choose its depth for the radius it will be searched with:
+
+    ```python
+    coordinateSet = Matcher(
+        log=log,
+        ra=raList1,
+        dec=decList1,
+        depth="auto",
+        radius=2 / 3600.
+    )
+    print(coordinateSet.depth, coordinateSet.depthEstimate["candidates"])
+    ```
+
+    """
+
+    def __init__(
+            self,
+            ra,
+            dec,
+            depth=16,
+            log=False,
+            convertToArray=True,
+            buildlevel=2,
+            radius=None):
+
+        self.convertToArray = convertToArray
+
+        if log == False:
+            if log == False:
+                from fundamentals.logs import emptyLogger
+                self.log = emptyLogger()
+        else:
+            self.log = log
+
+        if convertToArray == True:
+            from astrocalc.coords import coordinates_to_array
+            ra, dec = coordinates_to_array(
+                log=log,
+                ra=ra,
+                dec=dec
+            )
+
+        if ra.size != dec.size:
+            raise ValueError("ra size (%d) != "
+                             "dec size (%d)" % (ra.size, dec.size))
+
+        self.depthEstimate = None
+        if depth == "auto":
+            if radius is None:
+                raise ValueError(
+                    "a search radius is needed to choose the depth automatically")
+            self.depthEstimate = choose_depth(
+                ra=ra,
+                dec=dec,
+                radius=radius,
+                convertToArray=False,
+                log=self.log)
+            depth = self.depthEstimate["depth"]
+
+        super(Matcher, self).__init__(depth, ra, dec, buildlevel)
+
+    @property
+    def depth(
+            self):
+        """*the depth of the Matcher object*
+
+        **Usage**
+
+        ```python
+        coordinateSet.depth
+        ```
+
+        """
+        return super(Matcher, self).get_depth()
+
+    @property
+    def buildlevel(
+            self):
+        """*the number of levels of the Matcher's HTM tree kept in memory*
+
+        **Usage**
+
+        ```python
+        coordinateSet.buildlevel
+        ```
+
+        """
+        return super(Matcher, self).get_buildlevel()
+
+    def save(
+            self,
+            path):
+        """*save the Matcher to a binary file that can be reloaded (and memory-mapped) with* ``Matcher.load``
+
+        The file holds the coordinates, the HTM bucket index and the depth of the Matcher, so loading it skips the HTM lookups and sorting done when building a Matcher. Points added or removed since the last `compact` are merged into the index first; removed points keep their indices in the loaded Matcher. The Matcher must not be changed from another thread while it is being saved. The file is written alongside ``path`` and then moved over it, so Matchers already loaded from ``path`` keep working.
+
+        **Key Arguments**
+
+        - ``path`` -- path to the file to write
+
+        **Usage**
+
+        ```python
+        coordinateSet.save("/path/to/catalogue.matcher")
+        ```
+
+        """
+        self.log.debug('starting the ``save`` method')
+
+        ra, dec = super(Matcher, self).get_coordinates()
+        ids, offsets, perm, xyz = super(Matcher, self).get_buckets()
+
+        header = numpy.zeros(1, dtype=_MATCHER_FILE_HEADER)
+        header["magic"] = _MATCHER_FILE_MAGIC
+        header["version"] = _MATCHER_FILE_VERSION
+        header["depth"] = self.depth
+        header["buildlevel"] = self.buildlevel
+        header["npoints"] = ra.size
+        header["nids"] = ids.size
+        header["nbucketed"] = perm.size
+
+        # WRITE A NEW FILE AND MOVE IT OVER path, SO MATCHERS STILL MAPPING
+        # THE OLD FILE (E.G. THIS ONE, OR ONES IN OTHER PROCESSES) KEEP
+        # READING THE OLD INODE RATHER THAN A TRUNCATED FILE
+        import threading
+        tmpPath = "%s.%d.%d.tmp" % (
+            path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmpPath, "wb") as f:
+                header.tofile(f)
+                for arr, dtype in ((ra, "<f8"), (dec, "<f8"), (ids, "<i8"), (offsets, "<i8"), (perm, "<i8"), (xyz, "<f8")):
+                    f.write(b"\0" * (-f.tell() % _MATCHER_FILE_ALIGN))
+                    numpy.ascontiguousarray(arr, dtype=dtype).tofile(f)
+            os.replace(tmpPath, path)
+        except BaseException:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+        self.log.debug('completed the ``save`` method')
+        return None
+
+    @classmethod
+    def load(
+            cls,
+            path,
+            mmap=True,
+            log=False):
+        """*load a Matcher written with* ``Matcher.save``
+
+        **Key Arguments**
+
+        - ``path`` -- path to the saved Matcher file
+        - ``mmap`` -- memory-map the file rather than reading it into memory. Loading is then near-instant and every process mapping the same file shares the same pages of the OS page cache. Default *True*
+        - ``log`` -- logger
+
+        **Return**
+
+        - ``matcher`` -- the Matcher object
+
+        **Usage**
+
+        ```python
+        from HMpTy import Matcher
+        coordinateSet = Matcher.load("/path/to/catalogue.matcher")
+        ```
+
+        """
+        if mmap:
+            buf = numpy.memmap(path, dtype="u1", mode="r")
+        else:
+            buf = numpy.fromfile(path, dtype="u1")
+
+        if buf.size < _MATCHER_FILE_HEADER.itemsize:
+            raise ValueError("%s is not a saved Matcher file" % (path,))
+        header = buf[:_MATCHER_FILE_HEADER.itemsize].view(
+            _MATCHER_FILE_HEADER)[0]
+        if header["magic"] != _MATCHER_FILE_MAGIC:
+            raise ValueError("%s is not a saved Matcher file" % (path,))
+        if header["version"] != _MATCHER_FILE_VERSION:
+            raise ValueError("%s is a version %d Matcher file, only version %d is supported" % (
+                path, header["version"], _MATCHER_FILE_VERSION))
+
+        npoints = int(header["npoints"])
+        nids = int(header["nids"])
+        nbucketed = int(header["nbucketed"])
+        if npoints < 0 or nids < 0 or nbucketed < 0:
+            raise ValueError("%s holds a corrupt bucket index" % (path,))
+        layout = [(npoints, "<f8"), (npoints, "<f8"), (nids, "<i8"),
+                  (nids + 1, "<i8"), (nbucketed, "<i8"), (3 * nbucketed, "<f8")]
+        arrays = []
+        offset = _MATCHER_FILE_HEADER.itemsize
+        for size, dtype in layout:
+            offset += -offset % _MATCHER_FILE_ALIGN
+            end = offset + size * 8
+            if end > buf.size:
+                raise ValueError("%s is truncated" % (path,))
+            arrays.append(buf[offset:end].view(dtype))
+            offset = end
+
+        # THE NATIVE MATCHING TRUSTS THE BUCKET INDEX, SO A CORRUPT FILE MUST
+        # BE CAUGHT HERE RATHER THAN CRASH THE FIRST MATCH
+        depth = int(header["depth"])
+        ids, offsets, perm = arrays[2:5]
+        if (not 0 <= depth <= 25
+                or offsets[0] != 0 or offsets[-1] != nbucketed
+                or (offsets[1:] < offsets[:-1]).any()
+                or (ids[1:] <= ids[:-1]).any()
+                or (ids.size and (ids[0] < 8 << 2 * depth or ids[-1] >= 16 << 2 * depth))
+                or (perm.size and (perm.min() < 0 or perm.max() >= npoints))):
+            raise ValueError("%s holds a corrupt bucket index" % (path,))
+
+        matcher = cls.__new__(cls)
+        matcher.convertToArray = True
+        matcher.depthEstimate = None
+        if log == False:
+            from fundamentals.logs import emptyLogger
+            matcher.log = emptyLogger()
+        else:
+            matcher.log = log
+        _htmcCode.Matcher.__init__(
+            matcher, depth, *arrays, int(header["buildlevel"]))
+        return matcher
+
+    @classmethod
+    def from_xyz(
+            cls,
+            x,
+            y,
+            z,
+            depth=16,
+            log=False,
+            buildlevel=2):
+        """*build a Matcher from coordinates stored as cartesian vectors*
+
+        The HTM lookups are made on the vectors themselves and the Matcher keeps them as its unit vectors, so no precision is lost to a round trip through ra, dec. The ra, dec of the points are only derived for `save` and `get_coordinates`.
+
+        **Key Arguments**
+
+        - ``x`` -- list, numpy array or single x value
+        - ``y`` -- list, numpy array or single y value (must match x array length)
+        - ``z`` -- list, numpy array or single z value (must match x array length). The vectors need not be of unit length, but must not be zero
+        - ``depth`` -- the depth of the mesh generate the Matcher object at. Default *16*
+        - ``log`` -- logger
+        - ``buildlevel`` -- the number of mesh levels to keep in memory. Default *2*
+
+
+        **Return**
+
+        - ``matcher`` -- the Matcher object
+
+
+        **Usage**
+
+        ```python
+        from HMpTy import Matcher
+        coordinateSet = Matcher.from_xyz(cx, cy, cz, depth=16)
+        ```
+
+        """
+        x, y, z = _xyz_to_arrays(x, y, z)
+
+        mesh = HTM(depth=depth, log=log, buildlevel=buildlevel)
+        htmids = mesh.lookup_id_xyz(x, y, z)
+
+        norm = numpy.sqrt(x * x + y * y + z * z)
+        xyz = numpy.empty((x.size, 3), dtype='f8')
+        xyz[:, 0] = x / norm
+        xyz[:, 1] = y / norm
+        xyz[:, 2] = z / norm
+        ra = numpy.degrees(numpy.arctan2(xyz[:, 1], xyz[:, 0])) % 360.
+        dec = numpy.degrees(numpy.arctan2(
+            xyz[:, 2], numpy.hypot(xyz[:, 0], xyz[:, 1])))
+
+        # BUCKET THE POINTS BY HTM ID, AS THE NATIVE CONSTRUCTOR DOES
+        perm = numpy.argsort(htmids, kind="stable").astype('i8')
+        ids, starts = numpy.unique(htmids[perm], return_index=True)
+        offsets = numpy.append(starts, x.size).astype('i8')
+        xyz = numpy.ascontiguousarray(xyz[perm]).ravel()
+
+        matcher = cls.__new__(cls)
+        matcher.convertToArray = True
+        matcher.depthEstimate = None
+        if log == False:
+            from fundamentals.logs import emptyLogger
+            matcher.log = emptyLogger()
+        else:
+            matcher.log = log
+        _htmcCode.Matcher.__init__(
+            matcher, depth, ra, dec, ids.astype('i8'), offsets, perm, xyz, buildlevel)
+        return matcher
+
+    @classmethod
+    def from_htmids(
+            cls,
+            ra,
+            dec,
+            htmids,
+            depth=16,
+            log=False,
+            validate=1000,
+            convertToArray=True,
+            buildlevel=2):
+        """*build a Matcher from coordinates with precomputed HTM ids, e.g. the* ``htm16ID`` *column written by* ``add_htm_ids_to_mysql_database_table``
+
+        The supplied ids are trusted, so no HTM lookups are made and building the Matcher costs little more than sorting the ids. Ids deeper than ``depth`` are truncated to the trixels containing them, so a Matcher of any depth up to 16 can be built from ``htm16ID``.
+
+        **Key Arguments**
+
+        - ``ra`` -- list, numpy array or single ra value
+        - ``dec`` -- --list, numpy array or single dec value (must match ra array length)
+        - ``htmids`` -- list or numpy array of the HTM ids of the coordinates, at ``depth`` or deeper (must match ra array length)
+        - ``depth`` -- the depth of the mesh generate the Matcher object at. Default *16*
+        - ``log`` -- logger
+        - ``validate`` -- the number of coordinates, evenly spread through the input, whose ids are checked against a fresh lookup. A ValueError is raised on any mismatch. Set to `0` to trust every id. Default *1000*
+        - ``convertToArray`` -- convert the coordinates into an array. Default *True*
+        - ``buildlevel`` -- the number of mesh levels to keep in memory. Default *2*
+
+
+        **Return**
+
+        - ``matcher`` -- the Matcher object
+
+
+        **Usage**
+
+        ```python
+        from HMpTy import Matcher
+        coordinateSet = Matcher.from_htmids(
+            ra=raList,
+            dec=decList,
+            htmids=htm16IdList,
+            depth=13
+        )
+        ```
+
+        """
+        if log == False:
+            from fundamentals.logs import emptyLogger
+            log = emptyLogger()
+        log.debug('starting the ``from_htmids`` method')
+
+        if convertToArray == True:
+            from astrocalc.coords import coordinates_to_array
+            ra, dec = coordinates_to_array(
+                log=log,
+                ra=ra,
+                dec=dec
+            )
+        # THE MATCHER KEEPS THESE ARRAYS, SO TAKE 1-D FLOAT COPIES THE
+        # CALLER CANNOT CHANGE (DECIMAL-DEGREE LISTS ARE FINE WITHOUT
+        # convertToArray)
+        ra = numpy.array(ra, dtype='f8', ndmin=1).ravel()
+        dec = numpy.array(dec, dtype='f8', ndmin=1).ravel()
+        htmids = _htmids_to_depth(htmids, depth)
+
+        if ra.size != dec.size or ra.size != htmids.size:
+            raise ValueError("ra size (%d), dec size (%d) and htmids size (%d) "
+                             "differ" % (ra.size, dec.size, htmids.size))
+
+        if validate and ra.size:
+            sample = numpy.unique(numpy.linspace(
+                0, ra.size - 1, min(int(validate), ra.size)).astype('i8'))
+            mesh = HTM(depth=depth, log=log, buildlevel=buildlevel)
+            wrong = sample[mesh.lookup_id(ra[sample], dec[sample])
+                           != htmids[sample]]
+            if wrong.size:
+                raise ValueError("%d of %d sampled htmids do not match their coordinates (e.g. index %d)" % (
+                    wrong.size, sample.size, wrong[0]))
+
+        # BUCKET THE POINTS BY HTM ID, AS THE NATIVE CONSTRUCTOR DOES
+        perm = numpy.argsort(htmids, kind="stable").astype('i8')
+        ids, starts = numpy.unique(htmids[perm], return_index=True)
+        offsets = numpy.append(starts, ra.size).astype('i8')
+        raRad = ra[perm] * _D2R
+        decRad = dec[perm] * _D2R
+        cosDec = numpy.cos(decRad)
+        xyz = numpy.column_stack((cosDec * numpy.cos(raRad), cosDec *
+                                  numpy.sin(raRad), numpy.sin(decRad))).ravel()
+
+        matcher = cls.__new__(cls)
+        matcher.convertToArray = convertToArray
+        matcher.depthEstimate = None
+        matcher.log = log
+        _htmcCode.Matcher.__init__(
+            matcher, depth, ra, dec, ids.astype('i8'), offsets, perm, xyz, buildlevel)
+
+        log.debug('completed the ``from_htmids`` method')
+        return matcher
+
+    def match(self, ra, dec, radius, maxmatch=1, nthreads=1, separations=True):
+        """*match a corrdinate set against this Matcher object's coordinate set*
+
+        **Key Arguments**
+
+        - ``ra`` -- list, numpy array or single ra value
+        - ``dec`` -- --list, numpy array or single dec value (must match ra array length)
+        - ``radius`` -- radius of circle in degrees
+        - ``maxmatch`` -- maximum number of matches to return. Set to `0` to match all points. Default *1* (i.e. closest match)
+        - ``nthreads`` -- number of native threads to split the input coordinates across. Set to `0` to use all available cores; more threads than cores are never started. The output order does not depend on the number of threads. Default *1*
+        - ``separations`` -- return the separations of the matched pairs. Set to `False` to return only the two index arrays; with `maxmatch=0` this also skips the distance calculations for points in trixels lying wholly inside the search circle, and the matches to each point are not sorted by separation. Default *True*
+
+
+        **Return**
+
+        - ``matchIndices1`` -- match indices for the input coordinate set (ra, dec)
+        - ``matchIndices2`` -- match indices for this Matcher's coordinate set
+        - ``sepDeg`` -- separations between matched corrdinates in degrees. All returned arrays are the same size. Not returned if ``separations`` is `False`
+
+
+        **Usage**
+
+        Once we have initialised a Matcher coordinateSet object we can match other coordinate sets against it:
+
+        ```python
+        twoArcsec = 2.0 / 3600.
+        raList2 = [200.0, 200.0, 200.0, 175.23, 55.25]
+        decList2 = [24.3 + 0.75 * twoArcsec, 24.3 + 0.25 * twoArcsec,
+            24.3 - 0.33 * twoArcsec, -28.25 + 0.58 * twoArcsec, 75.22]
+
+        matchIndices1, matchIndices2, seps = coordinateSet.match(
+            ra=raList2,
+            dec=decList2,
+            radius=twoArcsec,
+            maxmatch=0
+        )
+
+        for m1, m2, s in zip(matchIndices1, matchIndices2, seps):
             print(raList1[m1], decList1[m1], " -> ", s * 3600.,
                   " arcsec -> ", raList2[m2], decList2[m2])
         ```
 
-        Or to return just the nearest matches:
+        Or to return just the nearest matches:
+
+        ```python
+        matchIndices1, matchIndices2, seps = coordinateSet.match(
+            ra=raList2,
+            dec=decList2,
+            radius=twoArcsec,
+            maxmatch=1
+        )
+        ```
+
+        To spread a large match over 8 threads:
+
+        ```python
+        matchIndices1, matchIndices2, seps = coordinateSet.match(
+            ra=raList2,
+            dec=decList2,
+            radius=twoArcsec,
+            maxmatch=1,
+            nthreads=8
+        )
+        ```
+
+        If only the matched pairs are needed (e.g. counting neighbours within a large radius), skip the separations:
+
+        ```python
+        matchIndices1, matchIndices2 = coordinateSet.match(
+            ra=raList2,
+            dec=decList2,
+            radius=0.5,
+            maxmatch=0,
+            separations=False
+        )
+        ```
+
+        Note from the print statement, you can index the arrays ``raList1``, ``decList1`` with the ``matchIndices1`` array values and  ``raList2``, ``decList2`` with the ``matchIndices2`` values.
+
+        """
+
+        ra, dec, radius = self._prepare_input(ra, dec, radius)
+
+        return super(Matcher, self).match(ra, dec, radius, maxmatch, False, nthreads, int(bool(separations)))
+
+    def match_to_file(self, ra, dec, radius, filename, maxmatch=1, nthreads=1, separations=True):
+        """*match a corrdinate set against this Matcher object's coordinate set, writing the matches to a .npy file instead of returning them*
+
+        The matches are written as they are found (in large buffered blocks), so the result never has to fit in memory. The file holds a 1-d structured array with ``i1``, ``i2`` and ``sep`` fields that can be memory-mapped back with `numpy.load`.
+
+        **Key Arguments**
+
+        - ``ra`` -- list, numpy array or single ra value
+        - ``dec`` -- --list, numpy array or single dec value (must match ra array length)
+        - ``radius`` -- radius of circle in degrees. Can be a single value or one per input coordinate
+        - ``filename`` -- path of the .npy file to write. Any existing file is overwritten
+        - ``maxmatch`` -- maximum number of matches to return. Set to `0` to match all points. Default *1* (i.e. closest match)
+        - ``nthreads`` -- number of native threads to split the input coordinates across. Set to `0` to use all available cores. Default *1*
+        - ``separations`` -- write the separations of the matched pairs. If `False` the records only have the ``i1`` and ``i2`` fields. See `match`. Default *True*
+
+
+        **Return**
+
+        - ``nmatches`` -- the number of matched pairs written
+
+
+        **Usage**
+
+        ```python
+        nmatches = coordinateSet.match_to_file(
+            ra=raList2,
+            dec=decList2,
+            radius=twoArcsec,
+            filename="/tmp/matches.npy",
+            maxmatch=0
+        )
+
+        import numpy as np
+        matches = np.load("/tmp/matches.npy", mmap_mode="r")
+        matchIndices1, matchIndices2, seps = matches["i1"], matches["i2"], matches["sep"]
+        ```
+
+        """
+        self.log.debug('starting the ``match_to_file`` method')
+
+        ra, dec, radius = self._prepare_input(ra, dec, radius)
+        nmatches = super(Matcher, self).match(
+            ra, dec, radius, maxmatch, os.fsencode(filename), nthreads, int(bool(separations)), 1)
+
+        self.log.debug('completed the ``match_to_file`` method')
+        return nmatches
+
+    def match_iter(self, ra, dec, radius, maxmatch=1, chunk_size=1000000, nthreads=1, separations=True):
+        """*match a corrdinate set against this Matcher object's coordinate set, yielding the matches chunk by chunk*
+
+        The input coordinates are matched ``chunk_size`` points at a time, so only one chunk of matches is held in memory and downstream work can start before the whole match has finished.
+
+        **Key Arguments**
+
+        - ``ra`` -- list, numpy array or single ra value. A numpy memmap can be used for very large inputs (with the Matcher's ``convertToArray`` set to `False`)
+        - ``dec`` -- --list, numpy array or single dec value (must match ra array length)
+        - ``radius`` -- radius of circle in degrees. Can be a single value or one per input coordinate
+        - ``maxmatch`` -- maximum number of matches to return. Set to `0` to match all points. Default *1* (i.e. closest match)
+        - ``chunk_size`` -- the number of input coordinates matched per chunk. Default *1000000*
+        - ``nthreads`` -- number of native threads to split each chunk across. Set to `0` to use all available cores. Default *1*
+        - ``separations`` -- yield the separations of the matched pairs. See `match`. Default *True*
+
+
+        **Return**
+
+        - a generator yielding one ``(matchIndices1, matchIndices2, sepDeg)`` tuple per chunk of input coordinates (``(matchIndices1, matchIndices2)`` if ``separations`` is `False`). ``matchIndices1`` index the full input coordinate set, not the chunk. Chunks with no matches yield empty arrays
+
+
+        **Usage**
+
+        ```python
+        for matchIndices1, matchIndices2, seps in coordinateSet.match_iter(
+            ra=raList2,
+            dec=decList2,
+            radius=twoArcsec,
+            maxmatch=1,
+            chunk_size=5000000
+        ):
+            writeMatches(matchIndices1, matchIndices2, seps)
+        ```
+
+        Concatenating the chunks gives exactly the output of `match`.
+
+        """
+        self.log.debug('starting the ``match_iter`` method')
+
+        chunk_size = int(chunk_size)
+        if chunk_size < 1:
+            raise ValueError("chunk_size (%d) must be at least 1" %
+                             (chunk_size,))
+
+        ra, dec, radius = self._prepare_input(ra, dec, radius)
+
+        for start in range(0, ra.size, chunk_size):
+            stop = min(start + chunk_size, ra.size)
+            if radius.size == 1:
+                chunkRadius = radius
+            else:
+                chunkRadius = radius[start:stop]
+            results = super(Matcher, self).match(
+                ra[start:stop], dec[start:stop], chunkRadius, maxmatch, False, nthreads, int(bool(separations)))
+            # MAKE THE INPUT INDICES GLOBAL
+            results[0][:] += start
+            yield results
+
+        self.log.debug('completed the ``match_iter`` method')
+
+    def match_xyz(self, x, y, z, radius, maxmatch=1, nthreads=1, separations=True):
+        """*match a set of cartesian vectors against this Matcher object's coordinate set*
+
+        The cartesian counterpart of `match`; the vectors are matched directly, without a conversion to ra, dec.
+
+        **Key Arguments**
+
+        - ``x`` -- list, numpy array or single x value
+        - ``y`` -- list, numpy array or single y value (must match x array length)
+        - ``z`` -- list, numpy array or single z value (must match x array length). The vectors need not be of unit length, but must not be zero
+        - ``radius`` -- radius of circle in degrees. Can be a single value or one per input vector
+        - ``maxmatch`` -- maximum number of matches to return. Set to `0` to match all points. Default *1* (i.e. closest match)
+        - ``nthreads`` -- number of native threads to split the input across. See `match`. Default *1*
+        - ``separations`` -- return the separations of the matched pairs. See `match`. Default *True*
+
+
+        **Return**
+
+        - ``matchIndices1`` -- match indices for the input vectors
+        - ``matchIndices2`` -- match indices for this Matcher's coordinate set
+        - ``sepDeg`` -- separations between matched corrdinates in degrees. Not returned if ``separations`` is `False`
+
+
+        **Usage**
+
+        ```python
+        matchIndices1, matchIndices2, seps = coordinateSet.match_xyz(
+            x=cx,
+            y=cy,
+            z=cz,
+            radius=2.0 / 3600.
+        )
+        ```
+
+        """
+        x, y, z = _xyz_to_arrays(x, y, z)
+        radius = numpy.array(radius, dtype='f8', ndmin=1)
+
+        if radius.size != 1 and radius.size != x.size:
+            raise ValueError("radius size (%d) != 1 and"
+                             " != x,y,z size (%d)" % (radius.size, x.size))
+
+        return super(Matcher, self).match_xyz(x, y, z, radius, maxmatch, False, nthreads, int(bool(separations)))
+
+    def self_match(self, radius, include_self=False, nthreads=1, separations=True):
+        """*find all the pairs of this Matcher's coordinates within a radius of each other*
+
+        Only the ``(i, j)`` pairs with ``i < j`` are evaluated, so each pair is found (and its separation calculated) once.
+
+        **Key Arguments**
+
+        - ``radius`` -- search radius in degrees (a single value)
+        - ``include_self`` -- also return each point's match to itself, as ``(i, i)`` with a separation of 0. Default *False*
+        - ``nthreads`` -- number of native threads to split the matching across. Set to `0` to use all available cores. Default *1*
+        - ``separations`` -- return the separations of the matched pairs. See `match`. Default *True*
+
+
+        **Return**
+
+        - ``matchIndices1`` -- the lower index of each pair, ascending
+        - ``matchIndices2`` -- the higher index of each pair
+        - ``sepDeg`` -- separations between the paired coordinates in degrees. Not returned if ``separations`` is `False`
+
+
+        **Usage**
+
+        ```python
+        matchIndices1, matchIndices2, seps = coordinateSet.self_match(
+            radius=2.0 / 3600.
+        )
+        ```
+
+        """
+        radius = numpy.array(radius, dtype='f8', ndmin=1)
+        if radius.size != 1:
+            raise ValueError("radius size (%d) != 1, self_match takes "
+                             "a single radius" % (radius.size,))
+
+        return super(Matcher, self).self_match(radius, int(bool(include_self)), nthreads, int(bool(separations)))
+
+    def nearest(self, ra, dec, k=1, max_radius=None, nthreads=1):
+        """*find the k nearest of this Matcher's coordinates to each input coordinate, without a search radius*
+
+        The HTM tree is searched best-first from the 8 root trixels, always opening the trixel that could hold the closest unseen point, and stops once no remaining trixel can beat the k-th nearest found. Sparse regions need no larger radius and dense regions are never searched wider than the k-th neighbour.
+
+        **Key Arguments**
+
+        - ``ra`` -- list, numpy array or single ra value
+        - ``dec`` -- --list, numpy array or single dec value (must match ra array length)
+        - ``k`` -- number of neighbours to find for each coordinate. Default *1*
+        - ``max_radius`` -- only find neighbours within this radius in degrees. Default *None* (no limit)
+        - ``nthreads`` -- number of native threads to split the input coordinates across. Set to `0` to use all available cores. Default *1*
+
+
+        **Return**
+
+        - ``indices`` -- (n, k) array of the indices of this Matcher's nearest coordinates, nearest first. Missing neighbours (fewer than k points, or none left within ``max_radius``) are -1
+        - ``sepDeg`` -- (n, k) array of the separations in degrees, `inf` for missing neighbours
+
+
+        **Usage**
 
         ```python
-        matchIndices1, matchIndices2, seps = coordinateSet.match(
+        indices, seps = coordinateSet.nearest(
             ra=raList2,
             dec=decList2,
-            radius=twoArcsec,
-            maxmatch=1
+            k=3
         )
         ```
 
-        Note from the print statement, you can index the arrays ``raList1``, ``decList1`` with the ``matchIndices1`` array values and  ``raList2``, ``decList2`` with the ``matchIndices2`` values.
+        Pending additions and removals (see `add` and `remove`) are compacted first.
+        """
+        self.log.debug('starting the ``nearest`` method')
+
+        k = int(k)
+        if k < 1:
+            raise ValueError("k (%d) must be at least 1" % (k,))
+        if max_radius is None:
+            max_radius = 0.
+        elif not max_radius > 0:
+            raise ValueError(
+                "max_radius (%s) must be positive or None" % (max_radius,))
+
+        ra, dec, radius = self._prepare_input(ra, dec, max_radius)
+        indices, seps = super(Matcher, self).nearest(
+            ra, dec, k, float(max_radius), nthreads)
+
+        self.log.debug('completed the ``nearest`` method')
+        return indices.reshape(-1, k), seps.reshape(-1, k)
+
+    def within_polygon(self, ra_vertices, dec_vertices):
+        """*return the indices of this Matcher's coordinates that lie inside a convex polygon*
+
+        **Key Arguments**
+
+        - ``ra_vertices`` -- list or numpy array of the RAs of the polygon vertices in decimal degrees (see `HTM.intersect_polygon`)
+        - ``dec_vertices`` -- list or numpy array of the DECs of the polygon vertices in decimal degrees
+
+
+        **Return**
+
+        - ``indices`` -- sorted numpy array of the indices of the coordinates inside the polygon (or on its edge)
+
+
+        **Usage**
+
+        ```python
+        inside = coordinateSet.within_polygon(
+            ra_vertices=[150.1, 150.3, 150.3, 150.1],
+            dec_vertices=[2.1, 2.1, 2.3, 2.3]
+        )
+        ```
+
+        """
+        offsets, indices = self.within_polygon_many(
+            [ra_vertices], [dec_vertices])
+        return indices
+
+    def within_polygon_many(self, ra_vertices, dec_vertices):
+        """*return the indices of this Matcher's coordinates that lie inside each of many convex polygons*
+
+        Points in trixels lying wholly inside a polygon are accepted without testing them against the polygon's sides.
+
+        **Key Arguments**
+
+        - ``ra_vertices`` -- a list of the vertex RA lists or arrays, one per polygon (see `HTM.intersect_polygon`)
+        - ``dec_vertices`` -- a list of the vertex DEC lists or arrays, one per polygon
+
+
+        **Return**
+
+        - ``offsets``, ``indices`` -- the sorted indices of the coordinates inside polygon ``i`` are ``indices[offsets[i]:offsets[i + 1]]``
+
+
+        **Usage**
+
+        ```python
+        offsets, indices = coordinateSet.within_polygon_many(
+            ra_vertices=chipRaVertices,
+            dec_vertices=chipDecVertices
+        )
+        for i in range(len(chipRaVertices)):
+            print(i, indices[offsets[i]:offsets[i + 1]])
+        ```
+
+        """
+        ra, dec, vertexOffsets = _polygons_to_arrays(ra_vertices, dec_vertices)
+        return super(Matcher, self).within_polygons(ra, dec, vertexOffsets)
+
+    @property
+    def npoints(
+            self):
+        """*the number of points in the Matcher, counting removed points*
+
+        Points are indexed from 0 to ``npoints - 1`` in the order they were given to the Matcher and to `add`.
+
+        **Usage**
+
+        ```python
+        coordinateSet.npoints
+        ```
+
+        """
+        return super(Matcher, self).get_npoints()
+
+    @property
+    def nremoved(
+            self):
+        """*the number of points flagged with* `remove`
+
+        **Usage**
+
+        ```python
+        coordinateSet.nremoved
+        ```
+
+        """
+        return super(Matcher, self).get_nremoved()
+
+    def add(
+            self,
+            ra,
+            dec):
+        """*add coordinates to the Matcher, in place*
+
+        The new points are indexed on from the existing points (removed points included), in the order given, and every existing index is unchanged. They are kept in a side index of the trixels they fall in until `compact` merges them into the main HTM bucket index, so adding a batch costs time in proportion to the batch rather than to the whole Matcher. The merge is made automatically once the points added and removed since the last one outnumber a quarter of the indexed points.
+
+        A Matcher can be changed from one thread while other threads query it. `add`, `remove` and `compact` wait for any `match`, `nearest`, `self_match`, `bincount` or `within_polygon` calls already running on the Matcher to finish, and queries made meanwhile wait for the change, so every query sees the Matcher either wholly before or wholly after it. A query split into several calls (`match_iter`, or `bincount` with a ``progress`` callback) can see changes made between its calls.
+
+        **Key Arguments**
+
+        - ``ra`` -- list, numpy array or single ra value
+        - ``dec`` -- list, numpy array or single dec value (must match ra array length)
+
+
+        **Return**
+
+        - ``indices`` -- numpy array of the indices given to the new points
+
+
+        **Usage**
+
+        ```python
+        newIndices = coordinateSet.add(
+            ra=newRaList,
+            dec=newDecList
+        )
+        ```
+
+        """
+        self.log.debug('starting the ``add`` method')
+
+        ra, dec, _ = self._prepare_input(ra, dec, 1.)
+        indices = super(Matcher, self).add(ra, dec)
+
+        self.log.debug('completed the ``add`` method')
+        return indices
+
+    def remove(
+            self,
+            indices):
+        """*remove points from the Matcher, in place*
+
+        The points are flagged as removed (a tombstone) and are never matched again, but keep their indices, so the indices of all other points are unchanged. Removing a point twice has no effect. The removed points are dropped from the HTM bucket index at the next `compact`. Like `add`, this waits for queries running in other threads to finish.
+
+        **Key Arguments**
+
+        - ``indices`` -- list, numpy array or single index of the points to remove
+
+
+        **Usage**
+
+        ```python
+        coordinateSet.remove([3, 17, 42])
+        ```
 
         """
+        self.log.debug('starting the ``remove`` method')
 
+        indices = numpy.array(indices, dtype='i8', ndmin=1)
+        if indices.size and (indices.min() < 0 or indices.max() >= self.npoints):
+            raise ValueError("indices must be in the range 0 to %d" %
+                             (self.npoints - 1,))
+        super(Matcher, self).remove(indices)
+
+        self.log.debug('completed the ``remove`` method')
+        return None
+
+    def compact(
+            self):
+        """*merge the points added to the Matcher into its HTM bucket index and drop the removed points from it*
+
+        Indices are unchanged. This is optional: it is done automatically once enough changes are pending, and before `nearest`, `self_match`, `bincount`, `within_polygon`, `save` and `get_coordinates`, which read the whole index. Calling it after a burst of changes moves the cost of the merge out of the next of those calls. Queries running in other threads are waited for, as for `add`.
+
+        **Usage**
+
+        ```python
+        coordinateSet.compact()
+        ```
+
+        """
+        self.log.debug('starting the ``compact`` method')
+
+        super(Matcher, self).compact()
+
+        self.log.debug('completed the ``compact`` method')
+        return None
+
+    def bincount(self, rmin, rmax, nbin, ra=None, dec=None, scale=None, nthreads=1, progress=None, chunk_size=100000):
+        """*count the pairs between a coordinate set and this Matcher object's coordinate set, or within this Matcher's set, in logarithmic bins of separation*
+
+        **Key Arguments**
+
+        - ``rmin`` -- the lower edge of the first bin, in degrees (or in units of ``scale`` * radians)
+        - ``rmax`` -- the upper edge of the last bin
+        - ``nbin`` -- the number of logarithmic bins between ``rmin`` and ``rmax``
+        - ``ra`` -- list, numpy array or single ra value. Default *None*, count the pairs within this Matcher's coordinate set, each unordered pair once
+        - ``dec`` -- list, numpy array or single dec value (must match ra array length). Default *None*
+        - ``scale`` -- bin in units of ``scale`` * radians rather than degrees. A single value or one per input coordinate (a single value only when counting pairs within this Matcher's set). Default *None*
+        - ``nthreads`` -- number of native threads to split the input across. Set to `0` to use all available cores. Default *1*
+        - ``progress`` -- a function called as ``progress(ndone, ntotal)`` after each chunk of input points is counted. Default *None*
+        - ``chunk_size`` -- the number of input points counted between ``progress`` calls. Default *100000*
+
+
+        **Return**
+
+        - ``rlower`` -- the lower edges of the bins
+        - ``rupper`` -- the upper edges of the bins
+        - ``counts`` -- the number of pairs in each bin
+
+
+        **Usage**
+
+        ```python
+        def report(ndone, ntotal):
+            log.info("%(ndone)s/%(ntotal)s points counted" % locals())
+
+        rlower, rupper, counts = coordinateSet.bincount(
+            rmin=1. / 3600,
+            rmax=1.,
+            nbin=10,
+            nthreads=0,
+            progress=report
+        )
+        ```
+
+        """
+        self.log.debug('starting the ``bincount`` method')
+
+        nbin = int(nbin)
+        if nbin < 1:
+            raise ValueError("nbin (%d) must be at least 1" % (nbin,))
+        if not 0 < rmin < rmax:
+            raise ValueError("rmin (%s) must be positive and less than "
+                             "rmax (%s)" % (rmin, rmax))
+        chunk_size = int(chunk_size)
+        if chunk_size < 1:
+            raise ValueError("chunk_size (%d) must be at least 1" %
+                             (chunk_size,))
+
+        if ra is None:
+            if dec is not None:
+                raise ValueError("ra and dec must both be given or both be None")
+            ntotal = super(Matcher, self).get_buckets()[2].size
+            ra = dec = None
+        else:
+            ra, dec, _ = self._prepare_input(ra, dec, 1.)
+            ra = numpy.asarray(ra, dtype='f8')
+            dec = numpy.asarray(dec, dtype='f8')
+            ntotal = ra.size
+
+        if scale is not None:
+            scale = numpy.array(scale, dtype='f8', ndmin=1)
+            if scale.size != 1 and (ra is None or scale.size != ntotal):
+                raise ValueError("scale size (%d) != 1 and"
+                                 " != ra,dec size (%d)" % (scale.size, ntotal))
+
+        counts = numpy.zeros(nbin, dtype='i8')
+        for start in range(0, ntotal, chunk_size):
+            stop = min(start + chunk_size, ntotal)
+            counts += super(Matcher, self).bincount(
+                float(rmin), float(rmax), nbin, ra, dec, scale, start, stop, nthreads)
+            if progress is not None:
+                progress(stop, ntotal)
+
+        edges = numpy.linspace(numpy.log10(rmin), numpy.log10(rmax), nbin + 1)
+        rlower = 10.**edges[:-1]
+        rupper = 10.**edges[1:]
+
+        self.log.debug('completed the ``bincount`` method')
+        return rlower, rupper, counts
+
+    def _prepare_input(self, ra, dec, radius):
+        """*convert and check the coordinates and radii to match against this Matcher*
+
+        **Key Arguments**
+
+        - ``ra`` -- list, numpy array or single ra value
+        - ``dec`` -- --list, numpy array or single dec value (must match ra array length)
+        - ``radius`` -- radius of circle in degrees. A single value or one per coordinate
+
+
+        **Return**
+
+        - ``ra``, ``dec``, ``radius`` -- as 1-d numpy arrays
+        """
         if self.convertToArray == True:
             from astrocalc.coords import coordinates_to_array
             ra, dec = coordinates_to_array(
@@ -458,4 +1999,312 @@ class Matcher(_htmcCode.Matcher):
             raise ValueError("radius size (%d) != 1 and"
                              " != ra,dec size (%d)" % (radius.size, ra.size))
 
-        return super(Matcher, self).match(ra, dec, radius, maxmatch, False)
+        return ra, dec, radius
+
+
+def _dec_band_trim(dec1, dec2, radius):
+    """*find the points of two coordinate sets that could have a match in the other set, from their declinations alone*
+
+    Two points can only be within ``radius`` of each other if their declinations are, so a point of set 1 is kept if a set 2 declination lies within its radius, and a point of set 2 if it lies in the union of the set 1 declination bands. Both tests are sorts and binary searches, with no per-point lists.
+
+    **Key Arguments**
+
+    - ``dec1`` -- numpy array of set 1 declinations
+    - ``dec2`` -- numpy array of set 2 declinations
+    - ``radius`` -- numpy array of the search radius in degrees, a single value or one per set 1 point
+
+
+    **Return**
+
+    - ``decMatchIndices1``, ``decMatchIndices2`` -- sorted indices of the points kept from each set
+    """
+    # A LITTLE SLACK SO ROUNDING NEVER DROPS A PAIR THE MATCHER WOULD KEEP
+    radius = radius + 1e-9
+    lower = dec1 - radius
+    upper = dec1 + radius
+
+    dec2Sorted = numpy.sort(dec2)
+    keep1 = (numpy.searchsorted(dec2Sorted, upper, side='right') >
+             numpy.searchsorted(dec2Sorted, lower, side='left'))
+    del dec2Sorted
+
+    # A SET 2 POINT IS INSIDE THE UNION OF THE BANDS IF THE FURTHEST REACH
+    # OF THE BANDS STARTING BELOW IT GETS UP TO IT
+    if lower.size > 1:
+        order = numpy.argsort(lower)
+        lower = lower[order]
+        upper = numpy.maximum.accumulate(
+            numpy.broadcast_to(upper, order.shape)[order])
+        del order
+    band = numpy.searchsorted(lower, dec2, side='right') - 1
+    keep2 = band >= 0
+    keep2[keep2] = upper[band[keep2]] >= dec2[keep2]
+
+    return numpy.nonzero(keep1)[0], numpy.nonzero(keep2)[0]
+
+
+def _xyz_to_arrays(x, y, z):
+    """*convert and check cartesian coordinates*
+
+    **Key Arguments**
+
+    - ``x``, ``y``, ``z`` -- lists, numpy arrays or single values of the same length
+
+
+    **Return**
+
+    - ``x``, ``y``, ``z`` -- as 1-d float64 numpy arrays
+    """
+    x = numpy.asarray(x, dtype='f8').ravel()
+    y = numpy.asarray(y, dtype='f8').ravel()
+    z = numpy.asarray(z, dtype='f8').ravel()
+
+    if x.size != y.size or x.size != z.size:
+        raise ValueError("x size (%d), y size (%d) and z size (%d) "
+                         "differ" % (x.size, y.size, z.size))
+
+    return x, y, z
+
+
+def _htmids_to_depth(htmids, depth):
+    """*convert and check HTM ids, truncating deeper ids to the trixels containing them at a depth*
+
+    A depth ``d`` id has ``2d + 4`` significant bits, the leading one of its root trixel (8-15) then two per level, so each id can be at its own depth.
+
+    **Key Arguments**
+
+    - ``htmids`` -- list or numpy array of HTM ids at ``depth`` or deeper
+    - ``depth`` -- the depth to return the ids at
+
+
+    **Return**
+
+    - ``htmids`` -- the ids at ``depth``, as a 1-d int64 numpy array
+    """
+    htmids = numpy.asarray(htmids).ravel()
+    if htmids.size and not numpy.issubdtype(htmids.dtype, numpy.integer):
+        raise ValueError("htmids must be integers, not %s" % (htmids.dtype,))
+    htmids = htmids.astype('i8', copy=False)
+
+    # THE SMALLEST ID AT EACH DEPTH THAT FITS IN AN INT64, SO THE DEPTH OF AN
+    # ID IS FOUND BY BISECTION. IDS BETWEEN 16 << 2d AND 8 << 2(d + 1) HAVE
+    # AN ODD NUMBER OF BITS AND ARE NOT HTM IDS
+    firstIds = numpy.left_shift(8, 2 * numpy.arange(30, dtype='i8'))
+    idDepths = numpy.searchsorted(firstIds, htmids, side="right") - 1
+    bad = (idDepths < 0) | (htmids >= numpy.left_shift(
+        16, 2 * numpy.maximum(idDepths, 0)))
+    if bad.any():
+        raise ValueError("%d of the htmids are not valid HTM ids (e.g. %d)" % (
+            bad.sum(), htmids[bad][0]))
+    shallow = idDepths < depth
+    if shallow.any():
+        raise ValueError("%d of the htmids are shallower than depth %d (e.g. %d, at depth %d)" % (
+            shallow.sum(), depth, htmids[shallow][0], idDepths[shallow][0]))
+
+    return numpy.right_shift(htmids, 2 * (idDepths - depth))
+
+
+def _polygons_to_arrays(ra_vertices, dec_vertices):
+    """*flatten lists of polygon vertices*
+
+    **Key Arguments**
+
+    - ``ra_vertices``, ``dec_vertices`` -- lists of the vertex RA and DEC lists or arrays, one per polygon
+
+
+    **Return**
+
+    - ``ra``, ``dec`` -- the vertices of all the polygons as 1-d float64 numpy arrays
+    - ``vertexOffsets`` -- the vertices of polygon ``i`` are ``ra[vertexOffsets[i]:vertexOffsets[i + 1]]``
+    """
+    if len(ra_vertices) != len(dec_vertices):
+        raise ValueError("ra_vertices size (%d) != dec_vertices size (%d)" % (
+            len(ra_vertices), len(dec_vertices)))
+
+    ra = [numpy.asarray(r, dtype='f8').ravel() for r in ra_vertices]
+    dec = [numpy.asarray(d, dtype='f8').ravel() for d in dec_vertices]
+    vertexOffsets = numpy.zeros(len(ra) + 1, dtype='i8')
+    for i, (r, d) in enumerate(zip(ra, dec)):
+        if r.size != d.size:
+            raise ValueError("polygon %d has %d ra and %d dec vertices" % (
+                i, r.size, d.size))
+        vertexOffsets[i + 1] = vertexOffsets[i] + r.size
+
+    if not len(ra):
+        return numpy.zeros(0, dtype='f8'), numpy.zeros(0, dtype='f8'), vertexOffsets
+    return numpy.concatenate(ra), numpy.concatenate(dec), vertexOffsets
+
+
+def choose_depth(
+        ra,
+        dec,
+        radius,
+        queryRa=None,
+        queryDec=None,
+        sampleSize=50000,
+        convertToArray=True,
+        log=False):
+    """*choose the HTM depth that minimises the modelled time to match points within a radius against a set of coordinates*
+
+    Shallow meshes give few trixels per search but many candidate points to test, deep meshes the reverse. The number of trixels covering the search circle at each depth comes from the trixel size, and the number of candidates in them from the measured occupancy of the coordinates (how many points share a trixel with a search position), so clustered coordinates are handled as well as uniform ones. The occupancy is measured on a random sample of at most ``sampleSize`` points. Each depth from 0 to 24 is costed with a model calibrated on `Matcher.match` timings and the cheapest is chosen.
+
+    **Key Arguments**
+
+    - ``ra`` -- list or numpy array of the ra of the coordinates to be matched against (the `Matcher` coordinates)
+    - ``dec`` -- list or numpy array of the dec of the coordinates to be matched against (must match ra array length)
+    - ``radius`` -- search radius in degrees. Can be list, numpy array or single value; the median is used for a list
+    - ``queryRa`` -- list or numpy array of the ra of the positions that will be searched from. Default *None*, the searches are assumed to come from ``ra``, ``dec`` themselves
+    - ``queryDec`` -- list or numpy array of the dec of the search positions (must match queryRa array length). Default *None*
+    - ``sampleSize`` -- the maximum number of points used to measure the occupancy. Default *50000*
+    - ``convertToArray`` -- convert the (sampled) coordinates into arrays. Default *True*. Can bypass the conversion check if you are sure coordinates in numpy array
+    - ``log`` -- logger
+
+
+    **Return**
+
+    - ``depthEstimate`` -- a dictionary with the chosen ``depth`` and the estimated ``trixels`` (in the cover), ``candidates`` (points tested) and ``cost`` (modelled microseconds on one thread, not counting the matches returned) per search at that depth
+
+
+    **Usage**
+
+    ```python
+    from HMpTy.htm import choose_depth
+    depthEstimate = choose_depth(
+        ra=raList,
+        dec=decList,
+        radius=2 / 3600.,
+        log=log
+    )
+    print(depthEstimate["depth"], depthEstimate["candidates"])
+    ```
+
+    """
+    if log == False:
+        from fundamentals.logs import emptyLogger
+        log = emptyLogger()
+    log.debug('starting the ``choose_depth`` function')
+
+    radius = float(numpy.median(numpy.array(radius, dtype='f8', ndmin=1)))
+    if radius < 0:
+        raise ValueError("radius must be >= 0, got %s" % (radius,))
+
+    # HTM IDS OF A SAMPLE OF THE POINTS AT THE DEEPEST DEPTH, THE IDS AT EVERY
+    # SHALLOWER DEPTH ARE THESE SHIFTED RIGHT
+    rng = numpy.random.RandomState(0)
+
+    def _sample_ids(ra, dec):
+        ra = numpy.array(ra, ndmin=1)
+        dec = numpy.array(dec, ndmin=1)
+        if ra.size != dec.size:
+            raise ValueError("ra size (%d) != "
+                             "dec size (%d)" % (ra.size, dec.size))
+        if ra.size > sampleSize:
+            keep = rng.choice(ra.size, sampleSize, replace=False)
+            ra = ra[keep]
+            dec = dec[keep]
+        if convertToArray == True:
+            from astrocalc.coords import coordinates_to_array
+            ra, dec = coordinates_to_array(
+                log=log,
+                ra=ra,
+                dec=dec
+            )
+        if not len(ra):
+            return numpy.array([], dtype='i8')
+        ids = HTM(depth=_DEPTH_MAX, log=log).lookup_id(ra, dec)
+        ids.sort()
+        return ids
+
+    npoints = len(ra)
+    ids = _sample_ids(ra, dec)
+    queryIds = None
+    if queryRa is not None:
+        queryIds = _sample_ids(queryRa, queryDec)
+    scale = float(npoints) / max(ids.size, 1)
+
+    # occupancy[d] IS THE MEAN NUMBER OF POINTS IN THE DEPTH d TRIXEL OF A
+    # SEARCH POSITION
+    occupancy = numpy.zeros(_DEPTH_MAX + 1)
+    for d in range(_DEPTH_MAX + 1):
+        shift = 2 * (_DEPTH_MAX - d)
+        dids = ids >> shift
+        if queryIds is None:
+            # PAIRS OF SAMPLED POINTS SHARING A TRIXEL, SCALED UP TO THE FULL
+            # SET, PLUS THE POINT ITSELF
+            if not dids.size:
+                continue
+            counts = numpy.diff(numpy.flatnonzero(
+                numpy.diff(numpy.r_[-1, dids, -1])))
+            occupancy[d] = 1. + (counts * (counts - 1.)).sum() * \
+                scale * scale / npoints
+        elif queryIds.size:
+            qids = queryIds >> shift
+            counts = numpy.searchsorted(dids, qids, side='right') - \
+                numpy.searchsorted(dids, qids, side='left')
+            occupancy[d] = counts.mean() * scale
+
+    depths = numpy.arange(_DEPTH_MAX + 1)
+    trixelArea = _SKY_AREA_DEG2 / (8. * 4.**depths)
+    trixels = 1. + _DEPTH_COVER_AREA * numpy.pi * radius**2 / trixelArea + \
+        _DEPTH_COVER_EDGE * 2. * numpy.pi * radius / numpy.sqrt(trixelArea)
+    trixels = numpy.minimum(trixels, 8. * 4.**depths)
+
+    # THE POINTS IN THE COVER ARE COUNTED WITH THE OCCUPANCY AT THE DEPTH
+    # WHOSE TRIXELS ARE THE SIZE OF THE WHOLE COVER
+    coverDepth = numpy.clip(numpy.round(
+        depths - numpy.log(trixels) / numpy.log(4.)), 0, _DEPTH_MAX).astype(int)
+    candidates = numpy.minimum(
+        occupancy[coverDepth] * trixels * trixelArea / trixelArea[coverDepth], npoints)
+
+    cost = _DEPTH_COST_LEVEL * depths + _DEPTH_COST_TRIXEL * trixels + \
+        _DEPTH_COST_CANDIDATE * candidates
+    depth = int(numpy.argmin(cost))
+
+    depthEstimate = {
+        "depth": depth,
+        "trixels": float(trixels[depth]),
+        "candidates": float(candidates[depth]),
+        "cost": float(cost[depth])
+    }
+    log.info('chose HTM depth %(depth)s for a %(radius)s deg radius on %(npoints)s points: ~%(trixels)0.1f trixels and ~%(candidates)0.1f candidates per search' % dict(
+        depthEstimate, radius=radius, npoints=npoints))
+
+    log.debug('completed the ``choose_depth`` function')
+    return depthEstimate
+
+
+def cached_meshes():
+    """*report the HTM meshes held in the process-wide mesh cache*
+
+    Every ``HTM`` and ``Matcher`` object shares the mesh built for its ``depth`` and ``buildlevel``; the mesh is built the first time it is requested and kept for the life of the process.
+
+    **Return**
+
+    - ``meshes`` -- a list of dictionaries, one per cached mesh, with ``depth``, ``buildlevel`` and ``bytes`` (approximate memory used by the mesh) keys
+
+    **Usage**
+
+    ```python
+    from HMpTy.htm import cached_meshes
+    for m in cached_meshes():
+        print(m["depth"], m["buildlevel"], m["bytes"])
+    ```
+
+    """
+    return _htmcCode.cached_indexes()
+
+
+def clear_cached_meshes():
+    """*drop all meshes from the process-wide mesh cache*
+
+    ``HTM`` and ``Matcher`` objects still using a mesh keep it alive until they are deleted.
+
+    **Usage**
+
+    ```python
+    from HMpTy.htm import clear_cached_meshes
+    clear_cached_meshes()
+    ```
+
+    """
+    return _htmcCode.clear_cached_indexes()
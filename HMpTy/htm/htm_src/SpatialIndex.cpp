@@ -521,12 +521,11 @@ SpatialIndex::idByPoint(SpatialVector & v) const {
     // return if we have reached maxlevel
     if(maxlevel_ == buildlevel_)return N(index).id_;
 
-    // from now on, continue to build name dynamically.
-    // until maxlevel_ levels depth, continue to append the
-    // correct index, build the index on the fly.
-    char name[HTMNAMEMAX];
-    nameById(N(index).id_,name);
-    size_t len = strlen(name);
+    // from now on, descend dynamically until maxlevel_ levels depth.
+    // each level appends the 2-bit child number to the id directly
+    // (same bits idByName would decode from the appended name digit),
+    // so no name string needs to be built or parsed.
+    uint64 id = N(index).id_;
     SpatialVector v0 = V(0);
     SpatialVector v1 = V(1);
     SpatialVector v2 = V(2);
@@ -538,25 +537,24 @@ SpatialIndex::idByPoint(SpatialVector & v) const {
       SpatialVector w2 = v1 + v0; w2.normalize();
 
       if(isInside(v, v0, w2, w1)) {
-	name[len++] = '0';
+	id = (id << 2);
 	v1 = w2; v2 = w1;
 	continue;
       } else if(isInside(v, v1, w0, w2)) {
-	name[len++] = '1';
+	id = (id << 2) | 1;
 	v0 = v1; v1 = w0; v2 = w2;
 	continue;
       } else if(isInside(v, v2, w1, w0)) {
-	name[len++] = '2';
+	id = (id << 2) | 2;
 	v0 = v2; v1 = w1; v2 = w0;
 	continue;
       } else if(isInside(v, w0, w1, w2)) {
-	name[len++] = '3';
+	id = (id << 2) | 3;
 	v0 = w0; v1 = w1; v2 = w2;
 	continue;
       }
     }
-    name[len] = '\0';
-    return idByName(name);
+    return id;
 }
 
 //////////////////ISINSIDE/////////////////////////////////////////////////
@@ -145,6 +145,15 @@ public:
   /// print all vertices to output stream
   void showVertices(std::ostream & out) const;
 
+  /// return the depth of the index
+  size_t maxlevel() const;
+
+  /// return the number of levels kept in memory
+  size_t buildlevel() const;
+
+  /// approximate number of bytes held by the stored nodes and vertices
+  size_t memoryUsage() const;
+
 private:
 
   // STRUCTURES
@@ -38,6 +38,33 @@ SpatialIndex::nVertices() const
   return vertices_.length();
 }
 
+/////////////MAXLEVEL/////////////////////////////////////
+// maxlevel: return the depth of the index
+inline size_t
+SpatialIndex::maxlevel() const
+{
+  return maxlevel_;
+}
+
+/////////////BUILDLEVEL///////////////////////////////////
+// buildlevel: return the number of levels kept in memory
+inline size_t
+SpatialIndex::buildlevel() const
+{
+  return buildlevel_;
+}
+
+/////////////MEMORYUSAGE//////////////////////////////////
+// memoryUsage: approximate number of bytes held by the index
+inline size_t
+SpatialIndex::memoryUsage() const
+{
+  return sizeof(SpatialIndex) +
+    nodes_.length() * sizeof(QuadNode) +
+    layers_.length() * sizeof(Layer) +
+    vertices_.length() * sizeof(SpatialVector);
+}
+
 //////////////////LEAFNUMBERBYID///////////////////////////////////////////
 //
 inline uint32
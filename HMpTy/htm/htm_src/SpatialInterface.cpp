@@ -48,14 +48,24 @@ htmInterface::htmInterface(
     init(depth, savedepth);
 }
 void htmInterface::init(size_t depth, size_t savedepth) {
-    if (index_) delete index_;
+    if (index_ && !sharedIndex_) delete index_;
     if (t_) delete t_;
+    t_ = NULL;
+    sharedIndex_.reset();
     index_ = new SpatialIndex(depth, savedepth);
 }
+void htmInterface::init(std::shared_ptr<const SpatialIndex> index) {
+    if (index_ && !sharedIndex_) delete index_;
+    if (t_) delete t_;
+    t_ = NULL;
+    // the index is only ever read through index_
+    sharedIndex_ = index;
+    index_ = const_cast<SpatialIndex *>(sharedIndex_.get());
+}
 
 ///////////DESTRUCTOR////////////////////////
 htmInterface::~htmInterface() {
-  delete index_;
+  if(!sharedIndex_) delete index_;
   if(t_) delete t_;
 }
 
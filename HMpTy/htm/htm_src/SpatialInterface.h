@@ -23,6 +23,7 @@
 //# provided or otherwise made available to any other person.
 //#
 //#
+#include <memory>
 #include "SpatialIndex.h"
 #include "SpatialDomain.h"
 #include "VarVec.h"
@@ -59,6 +60,11 @@ public:
   htmInterface(size_t depth = 5, size_t saveDepth = 2);
   void init(size_t depth = 5, size_t saveDepth = 2);
 
+  /** Use an index that is shared with other interfaces rather than
+      building a private one. The interface holds a reference to the
+      index and never modifies or deletes it. */
+  void init(std::shared_ptr<const SpatialIndex> index);
+
   /** Destructor. */
   ~htmInterface();
 
@@ -230,6 +236,7 @@ private:
 
   char name_[HTMNAMEMAX];
   SpatialIndex *index_;
+  std::shared_ptr<const SpatialIndex> sharedIndex_; // set if index_ is shared
   ValVec<htmRange> range_;
   ValVec<uint64> idList_;
   ValVec<htmPolyCorner> polyCorners_;
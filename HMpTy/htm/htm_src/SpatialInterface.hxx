@@ -64,7 +64,8 @@ const char * htmInterface::lookupName(uint64 id) {
 inline
 void htmInterface::changeDepth(size_t depth, size_t saveDepth) {
   if(index_->maxlevel_ != depth || index_->buildlevel_ != saveDepth) {
-    delete index_;
+    if(!sharedIndex_) delete index_;
+    sharedIndex_.reset();
     index_ = new SpatialIndex(depth, saveDepth);
   }
 }
@@ -1,11 +1,17 @@
 #include <iostream>
 #include <sstream>
 #include <cstdio>
+#include <sys/stat.h>
 #include <vector>
 #include <math.h>
 #include "htmc.h"
 #include "NumpyVector.h"
 #include <algorithm> // for transform
+#include <thread>
+#include <atomic>
+#include <system_error>
+#include <exception>
+#include <limits>
 
 
 
@@ -52,15 +58,725 @@ double gcirc(
 
 
 
-HTMC::HTMC(int depth) throw (const char *)
+// unit vector pointing at ra, dec (degrees)
+static inline void radec_to_xyz(double ra, double dec, double* xyz)
 {
-    init(depth);
+    static const double D2R = 0.0174532925199433;
+    double cosdec = cos(dec * D2R);
+    xyz[0] = cosdec * cos(ra * D2R);
+    xyz[1] = cosdec * sin(ra * D2R);
+    xyz[2] = sin(dec * D2R);
+}
+
+// unit vector along x, y, z
+static inline void normalize_xyz(double x, double y, double z, double* xyz)
+{
+    double norm = sqrt(x * x + y * y + z * z);
+    xyz[0] = x / norm;
+    xyz[1] = y / norm;
+    xyz[2] = z / norm;
+}
+
+// cartesian input must be the same size with every vector finite and
+// non-zero, so it can be normalized
+static void check_xyz(NumpyVector<double>& x,
+                      NumpyVector<double>& y,
+                      NumpyVector<double>& z)
+{
+    if (y.size() != x.size() || z.size() != x.size()) {
+        throw "x, y and z must be the same size";
+    }
+    for (npy_intp i = 0; i < x.size(); i++) {
+        double norm2 = x[i] * x[i] + y[i] * y[i] + z[i] * z[i];
+        if (!(norm2 > 0) || !std::isfinite(norm2)) {
+            throw "x, y and z must be finite and not all zero";
+        }
+    }
+}
+
+// add the circle of cosine-radius d about the unit vector xyz to the
+// domain, the cartesian version of SpatialDomain::setRaDecD
+static inline void set_circle_xyz(SpatialDomain& domain,
+                                  const double* xyz, double d)
+{
+    SpatialConstraint constraint(SpatialVector(xyz[0], xyz[1], xyz[2]), d);
+    SpatialConvex convex;
+    convex.add(constraint);
+    domain.add(convex);
+}
+
+// the unit normals of the great circles bounding the convex hull of
+// polygons [vertex_offsets[p], vertex_offsets[p+1]) of the ra, dec
+// vertices, in any order.  Hull edge i->j is kept when all the vertices
+// lie on or to the left of it, so the inside of the polygon is where
+// the dot product with every normal is >= 0.  The normals of polygon p
+// are normals[3 * nstart[p]:3 * nstart[p + 1]], in counterclockwise
+// order as SpatialConvex expects (see htmInterface::doHull).
+static void polygon_normals(NumpyVector<double>& ra,
+                            NumpyVector<double>& dec,
+                            NumpyVector<int64_t>& vertex_offsets,
+                            std::vector<double>& normals,
+                            std::vector<size_t>& nstart)
+{
+    static const double eps = 1.0e-12;
+
+    npy_intp npoly = vertex_offsets.size() - 1;
+    if (npoly < 0 || vertex_offsets[0] != 0
+            || vertex_offsets[npoly] != ra.size()) {
+        throw "vertex offsets must run from 0 to the number of vertices";
+    }
+
+    std::vector<double> xyz;
+    for (npy_intp p = 0; p < npoly; p++) {
+        nstart.push_back(normals.size() / 3);
+
+        npy_intp begin = vertex_offsets[p];
+        npy_intp nvert = vertex_offsets[p + 1] - begin;
+        if (nvert < 3) {
+            throw "a polygon needs at least 3 vertices";
+        }
+        xyz.resize(3 * nvert);
+        for (npy_intp i = 0; i < nvert; i++) {
+            radec_to_xyz(ra[begin + i], dec[begin + i], &xyz[3 * i]);
+        }
+
+        for (npy_intp i = 0; i < nvert; i++) {
+            for (npy_intp j = 0; j < nvert; j++) {
+                const double* a = &xyz[3 * i];
+                const double* b = &xyz[3 * j];
+                double n[3] = {a[1] * b[2] - a[2] * b[1],
+                               a[2] * b[0] - a[0] * b[2],
+                               a[0] * b[1] - a[1] * b[0]
+                              };
+                double norm = sqrt(n[0] * n[0] + n[1] * n[1] + n[2] * n[2]);
+                if (i == j || norm < eps) {
+                    continue;
+                }
+                n[0] /= norm;
+                n[1] /= norm;
+                n[2] /= norm;
+
+                bool edge = true;
+                for (npy_intp k = 0; k < nvert && edge; k++) {
+                    const double* c = &xyz[3 * k];
+                    edge = n[0] * c[0] + n[1] * c[1] + n[2] * c[2] >= -eps;
+                }
+                if (!edge) {
+                    continue;
+                }
+
+                // collinear vertices give the same edge more than once
+                bool duplicate = false;
+                for (size_t m = 3 * nstart[p]; m < normals.size(); m += 3) {
+                    double dot = n[0] * normals[m] + n[1] * normals[m + 1]
+                                 + n[2] * normals[m + 2];
+                    if (dot < -1.0 + eps) {
+                        throw "the vertices of a polygon must not all lie on one great circle";
+                    }
+                    if (dot > 1.0 - eps) {
+                        duplicate = true;
+                        break;
+                    }
+                }
+                if (!duplicate) {
+                    normals.insert(normals.end(), n, n + 3);
+                }
+            }
+        }
+
+        size_t nnormals = normals.size() / 3 - nstart[p];
+        if (nnormals < 3) {
+            throw "the vertices of a polygon must lie within one hemisphere and not all on one great circle";
+        }
+
+        // order the edges by the angle of their outward normals around
+        // the centre of the vertices
+        double c[3] = {0, 0, 0};
+        for (npy_intp i = 0; i < nvert; i++) {
+            c[0] += xyz[3 * i];
+            c[1] += xyz[3 * i + 1];
+            c[2] += xyz[3 * i + 2];
+        }
+        double axis[3] = {0, 0, 0};
+        axis[fabs(c[0]) < fabs(c[1]) ? (fabs(c[0]) < fabs(c[2]) ? 0 : 2)
+                                      : (fabs(c[1]) < fabs(c[2]) ? 1 : 2)] = 1;
+        double e1[3] = {c[1] * axis[2] - c[2] * axis[1],
+                        c[2] * axis[0] - c[0] * axis[2],
+                        c[0] * axis[1] - c[1] * axis[0]
+                       };
+        double e2[3] = {c[1] * e1[2] - c[2] * e1[1],
+                        c[2] * e1[0] - c[0] * e1[2],
+                        c[0] * e1[1] - c[1] * e1[0]
+                       };
+
+        double* pnormals = &normals[3 * nstart[p]];
+        std::vector<std::pair<double, size_t> > order(nnormals);
+        for (size_t m = 0; m < nnormals; m++) {
+            const double* n = pnormals + 3 * m;
+            order[m].first = atan2(-(n[0] * e2[0] + n[1] * e2[1] + n[2] * e2[2]),
+                                   -(n[0] * e1[0] + n[1] * e1[1] + n[2] * e1[2]));
+            order[m].second = m;
+        }
+        std::sort(order.begin(), order.end());
+        std::vector<double> sorted(3 * nnormals);
+        for (size_t m = 0; m < nnormals; m++) {
+            memcpy(&sorted[3 * m], pnormals + 3 * order[m].second, 3 * sizeof(double));
+        }
+        memcpy(pnormals, &sorted[0], 3 * nnormals * sizeof(double));
+    }
+    nstart.push_back(normals.size() / 3);
+}
+
+// add the convex polygon bounded by the great circles with the nnormals
+// unit normals to the domain
+static inline void set_polygon(SpatialDomain& domain,
+                               const double* normals, size_t nnormals)
+{
+    SpatialConvex convex;
+    for (size_t m = 0; m < nnormals; m++) {
+        SpatialConstraint constraint(SpatialVector(
+                                         normals[3 * m], normals[3 * m + 1], normals[3 * m + 2]), 0.0);
+        convex.add(constraint);
+    }
+    domain.add(convex);
+}
+
+// squared chord length between two unit vectors separated by angle
+// (radians).  Candidates are cut on the chord rather than on the dot
+// product against cos(angle), which runs out of precision below ~1e-8
+// radians.
+static inline double angle_to_chord2(double angle)
+{
+    if (angle >= M_PI) {
+        return 4.0;
+    }
+    double chord = 2.0 * sin(0.5 * angle);
+    return chord * chord;
+}
+
+// squared chord length between two unit vectors
+static inline double xyz_chord2(const double* a, const double* b)
+{
+    double dx = a[0] - b[0];
+    double dy = a[1] - b[1];
+    double dz = a[2] - b[2];
+    return dx * dx + dy * dy + dz * dz;
+}
+
+// angle (radians) between two unit vectors. Unlike acos of the dot
+// product this is accurate at all separations.
+static inline double xyz_angle(const double* a, const double* b)
+{
+    double cx = a[1] * b[2] - a[2] * b[1];
+    double cy = a[2] * b[0] - a[0] * b[2];
+    double cz = a[0] * b[1] - a[1] * b[0];
+    double dot = a[0] * b[0] + a[1] * b[1] + a[2] * b[2];
+    return atan2(sqrt(cx * cx + cy * cy + cz * cz), dot);
+}
+
+// add a candidate to the pairs found for the current input point. For
+// maxmatch=1 only a running minimum is kept.
+static inline void add_pair(std::vector<PAIR_INFO>& pairs,
+                            int64_t i2, double chord2, int64_t maxmatch)
+{
+    PAIR_INFO pi;
+    pi.i2 = i2;
+    pi.chord2 = chord2;
+    if (maxmatch == 1 && !pairs.empty()) {
+        if (PAIR_INFO_ORDERING()(pi, pairs[0])) {
+            pairs[0] = pi;
+        }
+        return;
+    }
+    pairs.push_back(pi);
+}
+
+// move the closest maxmatch pairs, sorted by distance, to the front and
+// return how many to keep.  maxmatch <= 0 keeps (and sorts) them all.
+static inline size_t select_closest(std::vector<PAIR_INFO>& pairs,
+                                    int64_t maxmatch)
+{
+    size_t npairs = pairs.size();
+    if (maxmatch <= 0 || (size_t) maxmatch >= npairs) {
+        std::sort(pairs.begin(), pairs.end(), PAIR_INFO_ORDERING());
+        return npairs;
+    }
+    if (maxmatch == 1) {
+        std::iter_swap(pairs.begin(), std::min_element(
+                           pairs.begin(), pairs.end(), PAIR_INFO_ORDERING()));
+        return 1;
+    }
+    std::nth_element(pairs.begin(), pairs.begin() + (maxmatch - 1),
+                     pairs.end(), PAIR_INFO_ORDERING());
+    std::sort(pairs.begin(), pairs.begin() + maxmatch, PAIR_INFO_ORDERING());
+    return maxmatch;
+}
+
+// the number of threads to use for an nthreads argument: 0 for all the
+// available cores, and never more than there are cores
+static int resolve_nthreads(int nthreads) throw (const char *)
+{
+    if (nthreads < 0) {
+        throw "nthreads must be >= 0";
+    }
+    int ncores = std::thread::hardware_concurrency();
+    if (ncores <= 0) {
+        ncores = 1;
+    }
+    if (nthreads == 0 || nthreads > ncores) {
+        nthreads = ncores;
+    }
+    return nthreads;
 }
 
-void HTMC::init(int depth) throw (const char *)
+// Calls work(ithread, iblock, begin, end) for each block [begin, end) of
+// blocksize items of [0, nitems), on up to nthreads threads including
+// the calling one.  The threads are started once and take the blocks in
+// order from a shared counter, so uneven blocks balance out.  If a
+// thread can not be started the others take its share.  After an
+// exception no more blocks are started, and the first exception is
+// rethrown once all the threads are done.
+template <class Work>
+static void run_blocks(int nthreads, npy_intp nitems, npy_intp blocksize,
+                       Work work)
+{
+    npy_intp nblocks = (nitems + blocksize - 1) / blocksize;
+    if (nthreads > nblocks) {
+        nthreads = nblocks;
+    }
+    if (nthreads < 1) {
+        nthreads = 1;
+    }
+
+    std::atomic<npy_intp> next(0);
+    std::atomic<bool> failed(false);
+    std::vector<std::exception_ptr> errors(nthreads);
+
+    auto worker = [&](int ithread) {
+        try {
+            while (!failed) {
+                npy_intp iblock = next++;
+                if (iblock >= nblocks) {
+                    break;
+                }
+                npy_intp begin = iblock * blocksize;
+                work(ithread, iblock, begin, std::min(begin + blocksize, nitems));
+            }
+        }
+        catch (...) {
+            errors[ithread] = std::current_exception();
+            failed = true;
+        }
+    };
+
+    std::vector<std::thread> workers;
+    for (int ithread = 1; ithread < nthreads; ithread++) {
+        try {
+            workers.push_back(std::thread(worker, ithread));
+        }
+        catch (const std::system_error&) {
+            break;
+        }
+    }
+    worker(0);
+    for (size_t i = 0; i < workers.size(); i++) {
+        workers[i].join();
+    }
+    for (int ithread = 0; ithread < nthreads; ithread++) {
+        if (errors[ithread]) {
+            std::rethrow_exception(errors[ithread]);
+        }
+    }
+}
+
+// The file a match is written to.  The file is closed when this goes
+// out of scope and, unless close() was reached, removed if it is a
+// regular file, so an error part way through a match leaves neither an
+// open handle nor a partial file with a wrong .npy header behind.
+class OutputFile {
+    public:
+        OutputFile() : mFptr(NULL), mRegular(false) {}
+
+        ~OutputFile() {
+            if (mFptr != NULL) {
+                fclose(mFptr);
+                discard();
+            }
+        }
+
+        // open the file if filename_obj is a bytes path, otherwise the
+        // results stay in memory and get() returns NULL
+        void open(PyObject* filename_obj) throw (const char *) {
+            if (!PyBytes_Check(filename_obj)) {
+                return;
+            }
+            mName = PyBytes_AsString(filename_obj);
+            mFptr = fopen(mName.c_str(), "w");
+            if (mFptr == NULL) {
+                // the message must outlive this frame, as the wrapper reads
+                // it after the stack has unwound
+                static thread_local std::string message;
+                std::stringstream err;
+                err << "Cannot open file: " << mName << " : " << strerror(errno);
+                message = err.str();
+                throw message.c_str();
+            }
+            // never remove a device or pipe the caller pointed us at
+            struct stat info;
+            mRegular = fstat(fileno(mFptr), &info) == 0 && S_ISREG(info.st_mode);
+        }
+
+        FILE* get() const {
+            return mFptr;
+        }
+
+        // close the finished file and keep it. Returns false (and removes
+        // the file) if closing failed
+        bool close() {
+            int status = fclose(mFptr);
+            mFptr = NULL;
+            if (status != 0) {
+                discard();
+            }
+            return status == 0;
+        }
+
+    private:
+        void discard() {
+            if (mRegular) {
+                std::remove(mName.c_str());
+            }
+        }
+
+        FILE* mFptr;
+        bool mRegular;
+        std::string mName;
+};
+
+// Writes the matched pairs to an open file, either as the original
+// "i1 i2 sep" text lines or (binary) as a .npy file of (i1, i2, sep)
+// records that numpy.load(filename, mmap_mode="r") maps straight back.
+// The records are gathered into large blocks before each write.
+class MatchWriter {
+    public:
+        MatchWriter(FILE* fptr, bool binary, bool separations) :
+            mFptr(fptr), mBinary(binary), mSeparations(separations),
+            mRecordSize(separations ? 24 : 16), mUsed(0), mCount(0),
+            mFailed(false) {
+            if (mFptr == NULL) {
+                return;
+            }
+            if (mBinary) {
+                mBuffer.resize(blocksize);
+                // a placeholder until the number of records is known
+                write_npy_header();
+            }
+            else {
+                setvbuf(mFptr, NULL, _IOFBF, blocksize);
+            }
+        }
+
+        void write(int64_t i1, int64_t i2, double d12) {
+            if (mBinary) {
+                if (mUsed + mRecordSize > mBuffer.size()) {
+                    flush();
+                }
+                char* record = &mBuffer[mUsed];
+                memcpy(record, &i1, 8);
+                memcpy(record + 8, &i2, 8);
+                if (mSeparations) {
+                    memcpy(record + 16, &d12, 8);
+                }
+                mUsed += mRecordSize;
+            }
+            else if (mSeparations) {
+                fprintf(mFptr, "%lld %lld %.16g\n",
+                        (long long) i1, (long long) i2, d12);
+            }
+            else {
+                fprintf(mFptr, "%lld %lld\n", (long long) i1, (long long) i2);
+            }
+            mCount++;
+        }
+
+        // write the last block and fill in the .npy record count. Returns
+        // false if any write failed.
+        bool finish() {
+            if (mBinary) {
+                flush();
+                if (fseek(mFptr, 0, SEEK_SET) != 0) {
+                    mFailed = true;
+                }
+                write_npy_header();
+            }
+            if (fflush(mFptr) != 0 || ferror(mFptr)) {
+                mFailed = true;
+            }
+            return !mFailed;
+        }
+
+    private:
+        static const size_t blocksize = 4 << 20;
+        // the whole .npy preamble, a multiple of 64 bytes with room for
+        // any record count
+        static const size_t npy_header_size = 256;
+
+        void flush() {
+            if (mUsed > 0 && fwrite(&mBuffer[0], 1, mUsed, mFptr) != mUsed) {
+                mFailed = true;
+            }
+            mUsed = 0;
+        }
+
+        void write_npy_header() {
+            uint16_t one = 1;
+            const char* order = (*(char*) &one == 1) ? "<" : ">";
+
+            std::stringstream dict;
+            dict << "{'descr': [('i1', '" << order << "i8'), ('i2', '"
+                 << order << "i8')";
+            if (mSeparations) {
+                dict << ", ('sep', '" << order << "f8')";
+            }
+            dict << "], 'fortran_order': False, 'shape': ("
+                 << (long long) mCount << ",), }";
+
+            // format version 1.0: magic, version, little-endian header
+            // length, then the dict padded with spaces and ending in \n
+            std::string text = dict.str();
+            text.resize(npy_header_size - 11, ' ');
+            text += '\n';
+            char preamble[10] = {'\x93', 'N', 'U', 'M', 'P', 'Y', 1, 0,
+                                 (char)(text.size() & 0xff),
+                                 (char)(text.size() >> 8)
+                                };
+            if (fwrite(preamble, 1, 10, mFptr) != 10 ||
+                    fwrite(text.data(), 1, text.size(), mFptr) != text.size()) {
+                mFailed = true;
+            }
+        }
+
+        FILE* mFptr;
+        bool mBinary;
+        bool mSeparations;
+        size_t mRecordSize;
+        std::vector<char> mBuffer;
+        size_t mUsed;
+        int64_t mCount;
+        bool mFailed;
+};
+
+
+
+
+
+
+
+std::mutex IndexRegistry::mLock;
+std::map<std::pair<int, int>, std::shared_ptr<const SpatialIndex> >
+IndexRegistry::mIndexes;
+
+std::shared_ptr<const SpatialIndex> IndexRegistry::get(
+    int depth,
+    int buildlevel) throw (const char *)
+{
+    if (depth < 0 || depth > 25) {
+        throw "depth must be between 0 and 25";
+    }
+    if (buildlevel < 0) {
+        throw "buildlevel must be >= 0";
+    }
+    // SpatialIndex keeps the full tree in memory for buildlevel 0 or
+    // buildlevel > depth, so key on the level that is actually built
+    if (buildlevel == 0 || buildlevel > depth) {
+        buildlevel = depth;
+    }
+
+    std::pair<int, int> key(depth, buildlevel);
+
+    std::lock_guard<std::mutex> guard(mLock);
+    std::map<std::pair<int, int>, std::shared_ptr<const SpatialIndex> >::iterator
+    iter = mIndexes.find(key);
+    if (iter != mIndexes.end()) {
+        return iter->second;
+    }
+
+    std::shared_ptr<const SpatialIndex> index;
+    try {
+        index = std::make_shared<const SpatialIndex>(depth, buildlevel);
+    }
+    catch (std::bad_alloc&) {
+        throw "not enough memory to build the index at this buildlevel";
+    }
+    mIndexes[key] = index;
+    return index;
+}
+
+PyObject* IndexRegistry::info()
+{
+    std::lock_guard<std::mutex> guard(mLock);
+
+    PyObject* output_list = PyList_New(0);
+    std::map<std::pair<int, int>, std::shared_ptr<const SpatialIndex> >::iterator
+    iter;
+    for (iter = mIndexes.begin(); iter != mIndexes.end(); ++iter) {
+        PyObject* entry = Py_BuildValue(
+                              "{s:i,s:i,s:n}",
+                              "depth", iter->first.first,
+                              "buildlevel", iter->first.second,
+                              "bytes", (Py_ssize_t) iter->second->memoryUsage());
+        PyList_Append(output_list, entry);
+        Py_XDECREF(entry);
+    }
+    return output_list;
+}
+
+void IndexRegistry::clear()
+{
+    std::lock_guard<std::mutex> guard(mLock);
+    mIndexes.clear();
+}
+
+PyObject* cached_indexes()
+{
+    return IndexRegistry::info();
+}
+
+void clear_cached_indexes()
+{
+    IndexRegistry::clear();
+}
+
+// the root of point i, halving the path on the way
+static inline int64_t find_root(std::vector<int64_t>& parent, int64_t i)
+{
+    while (parent[i] != i) {
+        parent[i] = parent[parent[i]];
+        i = parent[i];
+    }
+    return i;
+}
+
+PyObject* group_labels(
+    long long npoints,
+    PyObject* m1_array,
+    PyObject* m2_array,
+    int transitive) throw (const char *)
+{
+
+    NumpyVector<int64_t> m1(m1_array);
+    NumpyVector<int64_t> m2(m2_array);
+
+    npy_intp n = npoints;
+    npy_intp npairs = m1.size();
+    if (n < 0) {
+        throw "npoints must not be negative";
+    }
+    if (m2.size() != npairs) {
+        throw "m1 and m2 must be the same size";
+    }
+    for (npy_intp ipair = 0; ipair < npairs; ipair++) {
+        if (m1[ipair] < 0 || m1[ipair] >= n || m2[ipair] < 0 || m2[ipair] >= n) {
+            throw "pair indices must be between 0 and npoints - 1";
+        }
+        if (!transitive && ipair > 0 && m1[ipair] < m1[ipair - 1]) {
+            throw "pairs must be sorted by m1";
+        }
+    }
+
+    NumpyVector<int64_t> labels(n);
+    NumpyVector<int64_t> order(n);
+
+    {
+        GILRelease nogil;
+
+        for (npy_intp i = 0; i < n; i++) {
+            labels[i] = -1;
+        }
+
+        if (transitive) {
+            // union-find, the root of each set is its lowest index
+            std::vector<int64_t> parent(n);
+            for (npy_intp i = 0; i < n; i++) {
+                parent[i] = i;
+            }
+            for (npy_intp ipair = 0; ipair < npairs; ipair++) {
+                int64_t r1 = find_root(parent, m1[ipair]);
+                int64_t r2 = find_root(parent, m2[ipair]);
+                if (r1 < r2) {
+                    parent[r2] = r1;
+                }
+                else if (r2 < r1) {
+                    parent[r1] = r2;
+                }
+            }
+
+            // number the sets by their lowest index, then list the points
+            // set by set with a counting sort
+            int64_t nsets = 0;
+            for (npy_intp i = 0; i < n; i++) {
+                int64_t root = find_root(parent, i);
+                if (root == i) {
+                    labels[i] = nsets++;
+                }
+                else {
+                    labels[i] = labels[root];
+                }
+            }
+            std::vector<int64_t> start(nsets + 1, 0);
+            for (npy_intp i = 0; i < n; i++) {
+                start[labels[i] + 1]++;
+            }
+            for (int64_t k = 0; k < nsets; k++) {
+                start[k + 1] += start[k];
+            }
+            for (npy_intp i = 0; i < n; i++) {
+                order[start[labels[i]]++] = i;
+            }
+        }
+        else {
+            // every set is complete before the next is started, so the
+            // points are listed in the order they are assigned
+            int64_t current = -1;
+            npy_intp nassigned = 0;
+            npy_intp ipair = 0;
+            for (npy_intp i = 0; i < n; i++) {
+                if (labels[i] < 0) {
+                    labels[i] = ++current;
+                    order[nassigned++] = i;
+                }
+                for (; ipair < npairs && m1[ipair] == i; ipair++) {
+                    int64_t j = m2[ipair];
+                    if (labels[j] < 0) {
+                        labels[j] = current;
+                        order[nassigned++] = j;
+                    }
+                }
+            }
+        }
+    }
+
+    PyObject* output_tuple = PyTuple_New(2);
+    PyTuple_SetItem(output_tuple, 0, labels.getref());
+    PyTuple_SetItem(output_tuple, 1, order.getref());
+    return output_tuple;
+}
+
+
+
+
+
+
+
+HTMC::HTMC(int depth, int buildlevel) throw (const char *)
+{
+    init(depth, buildlevel);
+}
+
+void HTMC::init(int depth, int buildlevel) throw (const char *)
 {
     mDepth = depth;
-    mHtmInterface.init(depth);
+    mHtmInterface.init(IndexRegistry::get(depth, buildlevel));
 }
 
 PyObject* HTMC::lookup_id(
@@ -80,14 +796,44 @@ PyObject* HTMC::lookup_id(
 
     NumpyVector<npy_int64> htmid(ra.size());
 
-    for (npy_intp i = 0; i < ra.size(); i++) {
-        htmid[i] = mHtmInterface.lookupID(ra[i], dec[i]);
+    {
+        GILRelease nogil;
+
+        for (npy_intp i = 0; i < ra.size(); i++) {
+            htmid[i] = mHtmInterface.lookupID(ra[i], dec[i]);
+        }
     }
 
     PyObject* htmidPyObj = htmid.getref();
     return htmidPyObj;
 }
 
+PyObject* HTMC::lookup_id_xyz(
+    PyObject* x_array,
+    PyObject* y_array,
+    PyObject* z_array) throw (const char*)
+{
+
+    NumpyVector<double> x(x_array);
+    NumpyVector<double> y(y_array);
+    NumpyVector<double> z(z_array);
+    check_xyz(x, y, z);
+
+    NumpyVector<npy_int64> htmid(x.size());
+
+    {
+        GILRelease nogil;
+
+        for (npy_intp i = 0; i < x.size(); i++) {
+            double xyz[3];
+            normalize_xyz(x[i], y[i], z[i], xyz);
+            htmid[i] = mHtmInterface.lookupID(xyz[0], xyz[1], xyz[2]);
+        }
+    }
+
+    return htmid.getref();
+}
+
 PyObject* HTMC::intersect(
     double ra, // all in degrees
     double dec,
@@ -108,9 +854,13 @@ PyObject* HTMC::intersect(
     SpatialDomain domain;    // initialize empty domain
     ValVec<uint64> plist, flist;	// List results
 
-    // Find the triangles around this point
-    domain.setRaDecD(ra, dec, d);
-    domain.intersect(&index, plist, flist);
+    {
+        GILRelease nogil;
+
+        // Find the triangles around this point
+        domain.setRaDecD(ra, dec, d);
+        domain.intersect(&index, plist, flist);
+    }
 
     // number of triangles found
     if (inclusive) {
@@ -137,8 +887,337 @@ PyObject* HTMC::intersect(
         }
     }
 
-    PyObject* idlist_pyobj = idlist.getref();
-    return idlist_pyobj;
+    PyObject* idlist_pyobj = idlist.getref();
+    return idlist_pyobj;
+}
+
+// the depth of an htm id: a depth d id has 2d + 4 significant bits
+static inline int htmid_depth(uint64_t id)
+{
+    int nbits = 0;
+    while (id) {
+        id >>= 1;
+        nbits++;
+    }
+    return (nbits - 4) / 2;
+}
+
+typedef std::pair<int64_t, int64_t> HTM_RANGE;
+
+// append the ids as [lo, hi] ranges of ids at the target depth.  Deeper
+// ids are truncated to the trixel containing them, so the ranges always
+// cover the ids.
+static void append_ranges(const ValVec<uint64>& ids, int depth,
+                          std::vector<HTM_RANGE>& ranges)
+{
+    for (size_t i = 0; i < ids.length(); i++) {
+        int64_t id = ids(i);
+        int shift = 2 * (depth - htmid_depth(id));
+        if (shift >= 0) {
+            int64_t lo = id << shift;
+            ranges.push_back(HTM_RANGE(lo, lo + (((int64_t) 1) << shift) - 1));
+        }
+        else {
+            ranges.push_back(HTM_RANGE(id >> -shift, id >> -shift));
+        }
+    }
+}
+
+// sort ranges[begin:] and merge the overlapping and adjacent ones in place
+static void merge_ranges(std::vector<HTM_RANGE>& ranges, size_t begin)
+{
+    if (ranges.size() <= begin) {
+        return;
+    }
+    std::sort(ranges.begin() + begin, ranges.end());
+    size_t last = begin;
+    for (size_t i = begin + 1; i < ranges.size(); i++) {
+        if (ranges[i].first <= ranges[last].second + 1) {
+            ranges[last].second = std::max(ranges[last].second, ranges[i].second);
+        }
+        else {
+            ranges[++last] = ranges[i];
+        }
+    }
+    ranges.resize(last + 1);
+}
+
+PyObject* HTMC::intersect_many(
+    PyObject* ra_array, // all in degrees
+    PyObject* dec_array,
+    PyObject* radius_array, // degrees
+    int inclusive,
+    int unique
+) throw (const char *)
+{
+    NumpyVector<double> ra(ra_array);
+    NumpyVector<double> dec(dec_array);
+    if (dec.size() != ra.size()) {
+        throw "ra and dec must be the same size";
+    }
+    return intersect_circles(ra, dec, NULL, radius_array, inclusive, unique);
+}
+
+PyObject* HTMC::intersect_many_xyz(
+    PyObject* x_array,
+    PyObject* y_array,
+    PyObject* z_array,
+    PyObject* radius_array, // degrees
+    int inclusive,
+    int unique
+) throw (const char *)
+{
+    NumpyVector<double> x(x_array);
+    NumpyVector<double> y(y_array);
+    NumpyVector<double> z(z_array);
+    check_xyz(x, y, z);
+    return intersect_circles(x, y, &z, radius_array, inclusive, unique);
+}
+
+PyObject* HTMC::intersect_circles(
+    NumpyVector<double>& ra, // degrees, or x when z is given
+    NumpyVector<double>& dec, // degrees, or y when z is given
+    NumpyVector<double>* z,
+    PyObject* radius_array, // degrees
+    int inclusive,
+    int unique
+) throw (const char *)
+{
+
+    static const double D2R = 0.0174532925199433;
+
+    NumpyVector<double> radius(radius_array);
+
+    npy_intp ncircles = ra.size();
+    npy_intp nrad = radius.size();
+    if (nrad != 1 && nrad != ncircles) {
+        throw "radius must be a single value or one per circle";
+    }
+
+    // This is used in the basic calculations
+    const SpatialIndex &index = mHtmInterface.index();
+
+    std::vector<int64_t> ids;
+    NumpyVector<int64_t> offsets(unique ? 0 : ncircles + 1);
+
+    {
+        GILRelease nogil;
+
+        double d = 0;
+        if (nrad == 1) {
+            d = cos(radius[0] * D2R);
+        }
+        for (npy_intp i = 0; i < ncircles; i++) {
+            if (!unique) {
+                offsets[i] = ids.size();
+            }
+            if (nrad > 1) {
+                d = cos(radius[i] * D2R);
+            }
+
+            // Declare the domain and the lists
+            SpatialDomain domain;    // initialize empty domain
+            ValVec<uint64> plist, flist;	// List results
+
+            // Find the triangles around this point
+            if (z) {
+                double xyz[3];
+                normalize_xyz(ra[i], dec[i], (*z)[i], xyz);
+                set_circle_xyz(domain, xyz, d);
+            }
+            else {
+                domain.setRaDecD(ra[i], dec[i], d);
+            }
+            domain.intersect(&index, plist, flist);
+
+            // ----------- FULL NODES -------------
+            for (size_t j = 0; j < flist.length(); j++) {
+                ids.push_back(flist(j));
+            }
+            if (inclusive) {
+                // ----------- Partial Nodes ----------
+                for (size_t j = 0; j < plist.length(); j++) {
+                    ids.push_back(plist(j));
+                }
+            }
+        }
+
+        if (unique) {
+            std::sort(ids.begin(), ids.end());
+            ids.erase(std::unique(ids.begin(), ids.end()), ids.end());
+        }
+        else {
+            offsets[ncircles] = ids.size();
+        }
+    }
+
+    NumpyVector<int64_t> idlist(ids.size());
+    if (ids.size() > 0) {
+        memcpy(idlist.ptr(), &ids[0], ids.size() * sizeof(int64_t));
+    }
+
+    if (unique) {
+        return idlist.getref();
+    }
+
+    PyObject* output_tuple = PyTuple_New(2);
+    PyTuple_SetItem(output_tuple, 0, offsets.getref());
+    PyTuple_SetItem(output_tuple, 1, idlist.getref());
+    return output_tuple;
+}
+
+PyObject* HTMC::intersect_polygons(
+    PyObject* ra_array, // all in degrees
+    PyObject* dec_array,
+    PyObject* vertex_offsets_array,
+    int inclusive
+) throw (const char *)
+{
+
+    NumpyVector<double> ra(ra_array);
+    NumpyVector<double> dec(dec_array);
+    NumpyVector<int64_t> vertex_offsets(vertex_offsets_array);
+    if (dec.size() != ra.size()) {
+        throw "ra and dec must be the same size";
+    }
+
+    std::vector<double> normals;
+    std::vector<size_t> nstart;
+    polygon_normals(ra, dec, vertex_offsets, normals, nstart);
+
+    // This is used in the basic calculations
+    const SpatialIndex &index = mHtmInterface.index();
+
+    npy_intp npoly = vertex_offsets.size() - 1;
+    std::vector<int64_t> ids;
+    NumpyVector<int64_t> offsets(npoly + 1);
+
+    {
+        GILRelease nogil;
+
+        for (npy_intp p = 0; p < npoly; p++) {
+            offsets[p] = ids.size();
+
+            // Declare the domain and the lists
+            SpatialDomain domain;    // initialize empty domain
+            ValVec<uint64> plist, flist;	// List results
+
+            set_polygon(domain, &normals[3 * nstart[p]], nstart[p + 1] - nstart[p]);
+            domain.intersect(&index, plist, flist);
+
+            // ----------- FULL NODES -------------
+            for (size_t j = 0; j < flist.length(); j++) {
+                ids.push_back(flist(j));
+            }
+            if (inclusive) {
+                // ----------- Partial Nodes ----------
+                for (size_t j = 0; j < plist.length(); j++) {
+                    ids.push_back(plist(j));
+                }
+            }
+        }
+        offsets[npoly] = ids.size();
+    }
+
+    NumpyVector<int64_t> idlist(ids.size());
+    if (ids.size() > 0) {
+        memcpy(idlist.ptr(), &ids[0], ids.size() * sizeof(int64_t));
+    }
+
+    PyObject* output_tuple = PyTuple_New(2);
+    PyTuple_SetItem(output_tuple, 0, offsets.getref());
+    PyTuple_SetItem(output_tuple, 1, idlist.getref());
+    return output_tuple;
+}
+
+PyObject* HTMC::intersect_ranges(
+    PyObject* ra_array, // all in degrees
+    PyObject* dec_array,
+    PyObject* radius_array, // degrees
+    int depth,
+    int inclusive,
+    int unique
+) throw (const char *)
+{
+
+    static const double D2R = 0.0174532925199433;
+
+    if (depth < 0 || depth > 25) {
+        throw "depth must be between 0 and 25";
+    }
+
+    NumpyVector<double> ra(ra_array);
+    NumpyVector<double> dec(dec_array);
+    NumpyVector<double> radius(radius_array);
+
+    npy_intp ncircles = ra.size();
+    npy_intp nrad = radius.size();
+    if (dec.size() != ncircles) {
+        throw "ra and dec must be the same size";
+    }
+    if (nrad != 1 && nrad != ncircles) {
+        throw "radius must be a single value or one per circle";
+    }
+
+    // This is used in the basic calculations
+    const SpatialIndex &index = mHtmInterface.index();
+
+    std::vector<HTM_RANGE> ranges;
+    NumpyVector<int64_t> offsets(unique ? 0 : ncircles + 1);
+
+    {
+        GILRelease nogil;
+
+        double d = 0;
+        if (nrad == 1) {
+            d = cos(radius[0] * D2R);
+        }
+        for (npy_intp i = 0; i < ncircles; i++) {
+            size_t begin = ranges.size();
+            if (!unique) {
+                offsets[i] = begin;
+            }
+            if (nrad > 1) {
+                d = cos(radius[i] * D2R);
+            }
+
+            // Declare the domain and the lists
+            SpatialDomain domain;    // initialize empty domain
+            ValVec<uint64> plist, flist;	// List results
+
+            // Find the triangles around this point
+            domain.setRaDecD(ra[i], dec[i], d);
+            domain.intersect(&index, plist, flist);
+
+            append_ranges(flist, depth, ranges);
+            if (inclusive) {
+                append_ranges(plist, depth, ranges);
+            }
+            merge_ranges(ranges, begin);
+        }
+
+        if (unique) {
+            merge_ranges(ranges, 0);
+        }
+        else {
+            offsets[ncircles] = ranges.size();
+        }
+    }
+
+    NumpyVector<int64_t> rangelist(2 * ranges.size());
+    for (size_t i = 0; i < ranges.size(); i++) {
+        rangelist[2 * i] = ranges[i].first;
+        rangelist[2 * i + 1] = ranges[i].second;
+    }
+
+    if (unique) {
+        return rangelist.getref();
+    }
+
+    PyObject* output_tuple = PyTuple_New(2);
+    PyTuple_SetItem(output_tuple, 0, offsets.getref());
+    PyTuple_SetItem(output_tuple, 1, rangelist.getref());
+    return output_tuple;
 }
 
 
@@ -161,7 +1240,8 @@ PyObject* HTMC::cmatch(
     PyObject* minid_obj,
     PyObject* maxid_obj,
     PyObject* maxmatch_obj,
-    PyObject* filename_obj) throw (const char *)
+    PyObject* filename_obj,
+    int binary) throw (const char *)
 {
 
     // no copies made if already double vectors
@@ -186,24 +1266,18 @@ PyObject* HTMC::cmatch(
     int64_t maxmatch = maxmatchVec[0];
 
 
-    // These will temporarily hold the results
-    std::vector<int64_t> m1;
-    std::vector<int64_t> m2;
-    std::vector<double> d12;
+    // The results, handed over to numpy arrays at the end
+    ResultBuffer<int64_t> m1;
+    ResultBuffer<int64_t> m2;
+    ResultBuffer<double> d12;
 
     // total number of pairs
     int64_t ntotal = 0;
 
-    FILE* fptr = NULL;
-    if (PyBytes_Check(filename_obj)) {
-        char* filename = PyBytes_AsString(filename_obj);
-        fptr = fopen(filename, "w");
-        if (fptr == NULL) {
-            std::stringstream err;
-            err << "Cannot open file: " << filename << " : " << strerror(errno);
-            throw err.str().c_str();
-        }
-    }
+    OutputFile output;
+    output.open(filename_obj);
+    FILE* fptr = output.get();
+    MatchWriter writer(fptr, binary, true);
 
 
 
@@ -214,38 +1288,654 @@ PyObject* HTMC::cmatch(
     const SpatialIndex &index = mHtmInterface.index();
 
 
-    double rad = 0, d = 0;
+    double rad = 0, d = 0, chord2max = 0;
     if (nrad == 1) {
         rad = radius[0];
         d = cos(rad * D2R);
+        chord2max = angle_to_chord2(rad * D2R);
+    }
+
+
+
+    {
+        GILRelease nogil;
+
+        // unit vectors for list 2, so each candidate pair costs a few
+        // multiplies instead of trig calls
+        npy_intp n2 = ra2.size();
+        std::vector<double> xyz2(3 * n2);
+        for (npy_intp i2 = 0; i2 < n2; i2++) {
+            radec_to_xyz(ra2[i2], dec2[i2], &xyz2[3 * i2]);
+        }
+
+        // reused for every point in list 1
+        std::vector<int64_t> idlist;
+        std::vector<PAIR_INFO> pair_info;
+
+        npy_intp n1 = ra1.size();
+        for (npy_intp i1 = 0; i1 < n1; i1++) {
+            // Declare the domain and the lists
+            SpatialDomain domain;    // initialize empty domain
+            ValVec<uint64> plist, flist;	// List results
+
+            if (nrad > 1) {
+                rad = radius[i1];
+                d = cos(rad * D2R);
+                chord2max = angle_to_chord2(rad * D2R);
+            }
+
+            double xyz1[3];
+            radec_to_xyz(ra1[i1], dec1[i1], xyz1);
+
+            // Find the triangles around this point
+            domain.setRaDecD(ra1[i1], dec1[i1], d); //put in ra,dec,d E.S.S.
+            domain.intersect(&index, plist, flist);	 // intersect with list
+
+
+            // number of triangles found
+            npy_intp nfound = flist.length() + plist.length();
+            idlist.resize(nfound);
+            npy_intp idcount = 0;
+
+            // ----------- FULL NODES -------------
+            for (size_t i = 0; i < flist.length(); i++) {
+                idlist[idcount] = flist(i);
+                idcount++;
+            }
+            // ----------- Partial Nodes ----------
+            for (size_t i = 0; i < plist.length(); i++) {
+                idlist[idcount] = plist(i);
+                idcount++;
+            }
+
+
+            // the candidate matches to this point
+            pair_info.clear();
+
+            for (npy_intp j = 0; j < nfound; j++) {
+
+                int64_t leafid = idlist[j];
+
+                // Make sure leaf is in list for ra2,dec2
+                if (leafid >= minid && leafid <= maxid) {
+
+                    int64_t leafbin = idlist[j] - minid;
+
+                    // Any found in this leaf?
+                    if (htmrev2[leafbin] != htmrev2[leafbin + 1]) {
+
+                        // Now loop over the sources
+                        int64_t nLeafBin = htmrev2[leafbin + 1] - htmrev2[leafbin];
+
+                        for (int64_t ileaf = 0; ileaf < nLeafBin; ileaf++) {
+
+                            npy_intp i2 = htmrev2[ htmrev2[leafbin] + ileaf ];
+                            const double* xyz = &xyz2[3 * i2];
+
+                            double chord2 = xyz_chord2(xyz1, xyz);
+                            if (chord2 <= chord2max) {
+                                add_pair(pair_info, i2, chord2, maxmatch);
+                            } // Within max distance
+
+                        } // loop over objects in leaf
+
+                    } // any in leaf?
+
+                } // leaf id in list 2?
+            } // loop over leaves
+
+            // setting maxmatch to zero is same as "keep all matches"
+            size_t nkeep = select_closest(pair_info, maxmatch);
+            for (size_t ci = 0; ci < nkeep; ci++) {
+                int64_t i2 = pair_info[ci].i2;
+                // distance in degrees
+                double dis = xyz_angle(xyz1, &xyz2[3 * i2]) / D2R;
+                if (fptr) {
+                    writer.write(i1, i2, dis);
+                }
+                else {
+                    m1.push_back(i1);
+                    m2.push_back(i2);
+                    d12.push_back(dis);
+                }
+                // keep track of the total number actually saved or written
+                ntotal += 1;
+            }
+
+        } // loop over list 1
+    }
+
+
+    // This will hold the tuple of match1 and match2 and possibly
+    // d12
+
+
+    if (fptr == NULL) {
+
+        // If we are not writing to a file, we *always* return arrays, even if
+        // they are zero size
+
+        PyObject* output_tuple = PyTuple_New(3);
+
+        PyTuple_SetItem(output_tuple, 0, m1.release(NPY_INT64));
+        PyTuple_SetItem(output_tuple, 1, m2.release(NPY_INT64));
+        PyTuple_SetItem(output_tuple, 2, d12.release(NPY_FLOAT64));
+
+        return output_tuple;
+
+    }
+    else {
+        if (!writer.finish() || !output.close()) {
+            throw "Error writing the output file";
+        }
+        return PyLong_FromLongLong((long long) ntotal);
+    }
+
+
+
+
+}
+
+
+
+
+Matcher::Matcher(int depth,
+                 PyObject* ra_input,
+                 PyObject* dec_input,
+                 int buildlevel) throw (const char *)
+{
+    this->depth = depth;
+    this->htm_interface.init(IndexRegistry::get(depth, buildlevel));
+
+    // hold the input ra,dec as doubles.  They are copied even when they
+    // are already double arrays, as the buckets built from them would
+    // be wrong if the caller changed them in place
+    this->ra.init_copy(ra_input);
+    this->dec.init_copy(dec_input);
+    this->nremoved = 0;
+    this->nremoved_pending = 0;
+
+    init_hmap();
+}
+Matcher::Matcher(int depth,
+                 PyObject* ra_input,
+                 PyObject* dec_input,
+                 PyObject* hmap_ids_input,
+                 PyObject* hmap_offsets_input,
+                 PyObject* hmap_perm_input,
+                 PyObject* hmap_xyz_input,
+                 int buildlevel) throw (const char *)
+{
+    this->depth = depth;
+    this->htm_interface.init(IndexRegistry::get(depth, buildlevel));
+
+    this->ra.init(ra_input);
+    this->dec.init(dec_input);
+    this->hmap_ids.init(hmap_ids_input);
+    this->hmap_offsets.init(hmap_offsets_input);
+    this->hmap_perm.init(hmap_perm_input);
+    this->nremoved = 0;
+    this->nremoved_pending = 0;
+
+    // points missing from the buckets were removed before a compact
+    if (ra.size() != dec.size() || ra.size() < hmap_perm.size()) {
+        throw "ra and dec must be the same size, and no smaller than hmap_perm";
+    }
+    if (hmap_offsets.size() != hmap_ids.size() + 1) {
+        throw "hmap_offsets must be one longer than hmap_ids";
+    }
+    // match_range walks the bucket arrays with plain pointers
+    if ((hmap_ids.size() > 0 && hmap_ids.stride() != sizeof(int64_t))
+            || hmap_offsets.stride() != sizeof(int64_t)
+            || (hmap_perm.size() > 0 && hmap_perm.stride() != sizeof(int64_t))) {
+        throw "hmap_ids, hmap_offsets and hmap_perm must be contiguous";
+    }
+
+    if (hmap_perm.size() < ra.size()) {
+        removed.assign(ra.size(), 1);
+        for (npy_intp k = 0; k < hmap_perm.size(); k++) {
+            int64_t i = hmap_perm[k];
+            if (i < 0 || i >= ra.size()) {
+                throw "hmap_perm holds an index outside ra";
+            }
+            removed[i] = 0;
+        }
+        nremoved = ra.size() - hmap_perm.size();
+    }
+
+    this->hmap_xyz.init(hmap_xyz_input);
+    if (hmap_xyz.size() != 3 * hmap_perm.size()) {
+        throw "hmap_xyz must be 3 times the size of hmap_perm";
+    }
+    if (hmap_xyz.size() > 0 && hmap_xyz.stride() != sizeof(double)) {
+        throw "hmap_xyz must be contiguous";
+    }
+}
+
+PyObject* Matcher::get_coordinates() throw (const char *)
+{
+    lock_shared_compacted();
+    ReadWriteLock::Shared reading(rwlock, true);
+
+    PyObject* output_tuple = PyTuple_New(2);
+    PyTuple_SetItem(output_tuple, 0, ra.getref());
+    PyTuple_SetItem(output_tuple, 1, dec.getref());
+    return output_tuple;
+}
+
+PyObject* Matcher::get_buckets() throw (const char *)
+{
+    lock_shared_compacted();
+    ReadWriteLock::Shared reading(rwlock, true);
+
+    PyObject* output_tuple = PyTuple_New(4);
+    PyTuple_SetItem(output_tuple, 0, hmap_ids.getref());
+    PyTuple_SetItem(output_tuple, 1, hmap_offsets.getref());
+    PyTuple_SetItem(output_tuple, 2, hmap_perm.getref());
+    PyTuple_SetItem(output_tuple, 3, hmap_xyz.getref());
+    return output_tuple;
+}
+
+void Matcher::init_hmap(void)
+{
+    // The catalogue is bucketed by htm id in three flat arrays (a
+    // compressed sparse row layout):
+    //
+    //   hmap_ids      sorted, unique ids of the occupied trixels
+    //   hmap_offsets  the points in trixel hmap_ids[k] are
+    //                 hmap_perm[hmap_offsets[k]:hmap_offsets[k+1]]
+    //   hmap_perm     catalogue indices ordered by htm id, ascending
+    //                 index within each trixel
+    int64_t num = ra.size();
+
+    std::vector<int64_t> htmids(num);
+    std::vector<int64_t> perm(num);
+    npy_intp nids = 0;
+    {
+        GILRelease nogil;
+
+        for (int64_t i = 0; i < num; i++) {
+            htmids[i] = htm_interface.lookupID(ra[i], dec[i]);
+            perm[i] = i;
+        }
+        std::stable_sort(perm.begin(), perm.end(),
+        [&htmids](int64_t i1, int64_t i2) {
+            return htmids[i1] < htmids[i2];
+        });
+        for (int64_t i = 0; i < num; i++) {
+            if (i == 0 || htmids[perm[i]] != htmids[perm[i - 1]]) {
+                nids++;
+            }
+        }
+    }
+
+    hmap_ids.init(nids);
+    hmap_offsets.init(nids + 1);
+    hmap_perm.init(num);
+
+    int64_t* ids_ptr = hmap_ids.ptr();
+    int64_t* offsets_ptr = hmap_offsets.ptr();
+    int64_t* perm_ptr = hmap_perm.ptr();
+
+    npy_intp k = 0;
+    for (int64_t i = 0; i < num; i++) {
+        int64_t htmid = htmids[perm[i]];
+        if (i == 0 || htmid != ids_ptr[k - 1]) {
+            ids_ptr[k] = htmid;
+            offsets_ptr[k] = i;
+            k++;
+        }
+        perm_ptr[i] = perm[i];
+    }
+    offsets_ptr[nids] = num;
+
+    init_xyz();
+}
+
+void Matcher::init_xyz(void)
+{
+    // unit vectors in bucket order (hmap_xyz[3*k:3*k+3] is the point
+    // hmap_perm[k]), so scanning a bucket reads contiguous memory
+    int64_t num = hmap_perm.size();
+    hmap_xyz.init(3 * num);
+    double* xyz_ptr = hmap_xyz.ptr();
+
+    GILRelease nogil;
+
+    for (int64_t k = 0; k < num; k++) {
+        int64_t i = hmap_perm[k];
+        radec_to_xyz(ra[i], dec[i], xyz_ptr + 3 * k);
+    }
+}
+
+// point target at the array held by source
+template <class T>
+static void replace_array(NumpyVector<T>& target, NumpyVector<T>& source)
+{
+    PyObject* obj = source.getref();
+    target.init(obj);
+    Py_DECREF(obj);
+}
+
+PyObject* Matcher::add(
+    PyObject* ra_array, // degrees
+    PyObject* dec_array) throw (const char *)
+{
+    NumpyVector<double> ra_new(ra_array);
+    NumpyVector<double> dec_new(dec_array);
+    npy_intp nnew = ra_new.size();
+    if (dec_new.size() != nnew) {
+        throw "ra and dec must be the same size";
+    }
+
+    ReadWriteLock::Exclusive writing(rwlock);
+
+    int64_t first = count_points();
+    NumpyVector<int64_t> indices(nnew);
+    int64_t* indices_ptr = nnew > 0 ? indices.ptr() : NULL;
+
+    {
+        GILRelease nogil;
+
+        int64_t nadded = added_ra.size();
+        for (npy_intp i = 0; i < nnew; i++) {
+            double xyz[3];
+            radec_to_xyz(ra_new[i], dec_new[i], xyz);
+            int64_t htmid = htm_interface.lookupID(ra_new[i], dec_new[i]);
+
+            added_ids[htmid].push_back(nadded + i);
+            added_ra.push_back(ra_new[i]);
+            added_dec.push_back(dec_new[i]);
+            added_xyz.insert(added_xyz.end(), xyz, xyz + 3);
+            indices_ptr[i] = first + i;
+        }
+        if (!removed.empty()) {
+            removed.resize(first + nnew, 0);
+        }
+    }
+
+    compact_if_needed();
+    return indices.getref();
+}
+
+void Matcher::remove(PyObject* indices_array) throw (const char *)
+{
+    NumpyVector<int64_t> indices(indices_array);
+    npy_intp nindices = indices.size();
+
+    ReadWriteLock::Exclusive writing(rwlock);
+
+    int64_t npoints = count_points();
+
+    for (npy_intp i = 0; i < nindices; i++) {
+        if (indices[i] < 0 || indices[i] >= npoints) {
+            throw "indices must be in the range [0, number of points)";
+        }
+    }
+
+    if (removed.empty() && nindices > 0) {
+        removed.assign(npoints, 0);
+    }
+    for (npy_intp i = 0; i < nindices; i++) {
+        int64_t index = indices[i];
+        if (!removed[index]) {
+            removed[index] = 1;
+            nremoved++;
+            nremoved_pending++;
+        }
+    }
+
+    compact_if_needed();
+}
+
+void Matcher::compact_if_needed() throw (const char *)
+{
+    // a compact costs a pass over the buckets, so doing one each time the
+    // pending changes reach a fixed fraction of the buckets keeps the
+    // amortized cost of a change constant
+    npy_intp npending = added_ra.size() + nremoved_pending;
+    if (npending > hmap_perm.size() / 4 + 1024) {
+        compact_locked();
+    }
+}
+
+void Matcher::lock_shared_compacted() throw (const char *)
+{
+    rwlock.lock_shared();
+    while (added_ra.size() > 0 || nremoved_pending > 0) {
+        rwlock.unlock_shared();
+        compact();
+        rwlock.lock_shared();
+    }
+}
+
+void Matcher::compact() throw (const char *)
+{
+    ReadWriteLock::Exclusive writing(rwlock);
+    compact_locked();
+}
+
+void Matcher::compact_locked() throw (const char *)
+{
+    npy_intp nadded = added_ra.size();
+    if (nadded == 0 && nremoved_pending == 0) {
+        return;
+    }
+
+    npy_intp nbuilt = ra.size();
+    npy_intp nbucketed = hmap_perm.size();
+    npy_intp nids = hmap_ids.size();
+    npy_intp nlive = nbucketed + nadded - nremoved_pending;
+
+    NumpyVector<double> new_ra;
+    NumpyVector<double> new_dec;
+    if (nadded > 0) {
+        new_ra.init(nbuilt + nadded);
+        new_dec.init(nbuilt + nadded);
+    }
+    NumpyVector<int64_t> new_perm(nlive);
+    NumpyVector<double> new_xyz(3 * nlive);
+
+    const int64_t* ids_old = nids > 0 ? hmap_ids.ptr() : NULL;
+    const int64_t* offsets_old = nids > 0 ? hmap_offsets.ptr() : NULL;
+    const int64_t* perm_old = nids > 0 ? hmap_perm.ptr() : NULL;
+    const double* xyz_old = nids > 0 ? hmap_xyz.ptr() : NULL;
+    int64_t* perm_ptr = nlive > 0 ? new_perm.ptr() : NULL;
+    double* xyz_ptr = nlive > 0 ? new_xyz.ptr() : NULL;
+    double* ra_ptr = nadded > 0 ? new_ra.ptr() : NULL;
+    double* dec_ptr = nadded > 0 ? new_dec.ptr() : NULL;
+
+    std::vector<int64_t> ids;
+    std::vector<int64_t> offsets;
+    {
+        GILRelease nogil;
+
+        if (nadded > 0) {
+            for (npy_intp i = 0; i < nbuilt; i++) {
+                ra_ptr[i] = ra[i];
+                dec_ptr[i] = dec[i];
+            }
+            std::copy(added_ra.begin(), added_ra.end(), ra_ptr + nbuilt);
+            std::copy(added_dec.begin(), added_dec.end(), dec_ptr + nbuilt);
+        }
+
+        std::vector<int64_t> added_keys;
+        added_keys.reserve(added_ids.size());
+        for (std::unordered_map<int64_t, std::vector<int64_t> >::const_iterator
+                it = added_ids.begin(); it != added_ids.end(); ++it) {
+            added_keys.push_back(it->first);
+        }
+        std::sort(added_keys.begin(), added_keys.end());
+
+        // merge the buckets and the added points by htm id.  Within a
+        // trixel the bucketed points all have lower indices than the
+        // added ones, so the points stay in ascending index order
+        const char* is_removed = removed.empty() ? NULL : &removed[0];
+        npy_intp ibucket = 0;
+        size_t ikey = 0;
+        npy_intp k = 0;
+        while (ibucket < nids || ikey < added_keys.size()) {
+            bool from_buckets = ibucket < nids
+                                && (ikey == added_keys.size()
+                                    || ids_old[ibucket] <= added_keys[ikey]);
+            bool from_added = ikey < added_keys.size()
+                              && (ibucket == nids
+                                  || added_keys[ikey] <= ids_old[ibucket]);
+            int64_t htmid = from_buckets ? ids_old[ibucket] : added_keys[ikey];
+            npy_intp kstart = k;
+
+            if (from_buckets) {
+                for (int64_t ileaf = offsets_old[ibucket];
+                        ileaf < offsets_old[ibucket + 1]; ileaf++) {
+                    int64_t index = perm_old[ileaf];
+                    if (is_removed && is_removed[index]) {
+                        continue;
+                    }
+                    perm_ptr[k] = index;
+                    std::copy(xyz_old + 3 * ileaf, xyz_old + 3 * ileaf + 3,
+                              xyz_ptr + 3 * k);
+                    k++;
+                }
+                ibucket++;
+            }
+            if (from_added) {
+                const std::vector<int64_t>& slots = added_ids.find(htmid)->second;
+                for (size_t j = 0; j < slots.size(); j++) {
+                    int64_t index = nbuilt + slots[j];
+                    if (is_removed && is_removed[index]) {
+                        continue;
+                    }
+                    perm_ptr[k] = index;
+                    std::copy(&added_xyz[3 * slots[j]], &added_xyz[3 * slots[j]] + 3,
+                              xyz_ptr + 3 * k);
+                    k++;
+                }
+                ikey++;
+            }
+
+            if (k > kstart) {
+                ids.push_back(htmid);
+                offsets.push_back(kstart);
+            }
+        }
+        offsets.push_back(k);
+    }
+
+    hmap_ids.init(ids.size());
+    hmap_offsets.init(offsets.size());
+    if (!ids.empty()) {
+        std::copy(ids.begin(), ids.end(), hmap_ids.ptr());
+    }
+    std::copy(offsets.begin(), offsets.end(), hmap_offsets.ptr());
+    replace_array(hmap_perm, new_perm);
+    replace_array(hmap_xyz, new_xyz);
+    if (nadded > 0) {
+        replace_array(ra, new_ra);
+        replace_array(dec, new_dec);
     }
 
+    std::vector<double>().swap(added_ra);
+    std::vector<double>().swap(added_dec);
+    std::vector<double>().swap(added_xyz);
+    added_ids.clear();
+    nremoved_pending = 0;
+}
+
+void Matcher::match_range(
+    NumpyVector<double>& ra, // degrees, or x when z is given
+    NumpyVector<double>& dec, // degrees, or y when z is given
+    NumpyVector<double>* z,
+    NumpyVector<double>& radius, // degrees
+    int64_t maxmatch,
+    npy_intp begin,
+    npy_intp end,
+    ResultBuffer<int64_t>& m1,
+    ResultBuffer<int64_t>& m2,
+    ResultBuffer<double>& d12,
+    bool separations,
+    int self_pairs)
+{
+
+    static const double
+    D2R = 0.0174532925199433;
+
+    // This is used in the basic calculations
+    const SpatialIndex &index = this->htm_interface.index();
+
+    // when all matches are wanted and no separations, points in the
+    // full trixels are inside the circle by construction and are kept
+    // without any distance calculation.  Only the partial trixels need
+    // the distance cut, and the pairs are left in candidate order.
+    bool index_only = !separations && maxmatch <= 0;
+
+    // the bucket index (see init_hmap)
+    npy_intp nids = hmap_ids.size();
+    const int64_t* ids_begin = nids > 0 ? hmap_ids.ptr() : NULL;
+    const int64_t* ids_end = ids_begin + nids;
+    const int64_t* offsets = nids > 0 ? hmap_offsets.ptr() : NULL;
+    const int64_t* perm = nids > 0 ? hmap_perm.ptr() : NULL;
+    const double* xyz_sorted = nids > 0 ? hmap_xyz.ptr() : NULL;
+
+    // the points added and removed since the last compact.  Candidates
+    // are held by bucket position, with the added points numbered on
+    // from the end of the buckets
+    const char* is_removed = removed.empty() ? NULL : &removed[0];
+    bool any_added = !added_ids.empty();
+    int64_t nbucketed = hmap_perm.size();
+    int64_t added_base = this->ra.size();
+    const double* xyz_added = any_added ? &added_xyz[0] : NULL;
+
+    npy_intp nrad = radius.size();
+    double rad = 0, d = 0, chord2max = 0;
+    if (nrad == 1) {
+        rad = radius[0];
+        d = cos(rad * D2R);
+        chord2max = angle_to_chord2(rad * D2R);
+    }
 
+    // reused for every input point
+    std::vector<int64_t> idlist;
+    std::vector<PAIR_INFO> pair_info;
 
-    npy_intp n1 = ra1.size();
-    for (npy_intp i1 = 0; i1 < n1; i1++) {
+    for (npy_intp i_input = begin; i_input < end; i_input++) {
         // Declare the domain and the lists
         SpatialDomain domain;    // initialize empty domain
         ValVec<uint64> plist, flist;	// List results
 
+        // the smallest catalogue index kept as a partner
+        int64_t min_partner = -1;
+        if (self_pairs) {
+            if (is_removed && is_removed[i_input]) {
+                continue;
+            }
+            min_partner = self_pairs == 1 ? i_input + 1 : i_input;
+        }
+
         if (nrad > 1) {
-            rad = radius[i1];
+            rad = radius[i_input];
             d = cos(rad * D2R);
+            chord2max = angle_to_chord2(rad * D2R);
         }
 
+        double xyz_input[3];
+
         // Find the triangles around this point
-        domain.setRaDecD(ra1[i1], dec1[i1], d); //put in ra,dec,d E.S.S.
+        if (z) {
+            normalize_xyz(ra[i_input], dec[i_input], (*z)[i_input], xyz_input);
+            set_circle_xyz(domain, xyz_input, d);
+        }
+        else {
+            radec_to_xyz(ra[i_input], dec[i_input], xyz_input);
+            domain.setRaDecD(ra[i_input], dec[i_input], d); //put in ra,dec,d E.S.S.
+        }
         domain.intersect(&index, plist, flist);	 // intersect with list
 
 
         // number of triangles found
         npy_intp nfound = flist.length() + plist.length();
-        std::vector<int64_t> idlist(nfound);
+        idlist.resize(nfound);
         npy_intp idcount = 0;
-
-        // We could speed this up when no distance is needed by
-        // just keeping everything in the full nodes without
-        // doing a distance calculation
+        npy_intp nfull = flist.length();
 
         // ----------- FULL NODES -------------
         for (size_t i = 0; i < flist.length(); i++) {
@@ -259,80 +1949,260 @@ PyObject* HTMC::cmatch(
         }
 
 
-        // these are temporary vectors to hold matches to this point
-
-        std::vector<PAIR_INFO> pair_info;
+        // the candidate matches to this point, by bucket position
+        pair_info.clear();
 
         for (npy_intp j = 0; j < nfound; j++) {
 
-            int64_t leafid = idlist[j];
+            int64_t htmid = idlist[j];
+            bool full = j < nfull;
+
+            // test one candidate
+            auto consider = [&](int64_t ileaf, int64_t index, const double* xyz) {
+                if (index < min_partner || (is_removed && is_removed[index])) {
+                    return;
+                }
+                if (index_only) {
+                    if (full || xyz_chord2(xyz_input, xyz) <= chord2max) {
+                        m1.push_back(i_input);
+                        m2.push_back(index);
+                    }
+                    return;
+                }
+                double chord2 = xyz_chord2(xyz_input, xyz);
+                if (chord2 <= chord2max) {
+                    add_pair(pair_info, ileaf, chord2, maxmatch);
+                } // Within max distance
+            };
+
+            const int64_t* iter = std::lower_bound(ids_begin, ids_end, htmid);
+            if (iter != ids_end && *iter == htmid) {
+
+                npy_intp ibucket = iter - ids_begin;
+
+                for (int64_t ileaf = offsets[ibucket];
+                        ileaf < offsets[ibucket + 1]; ileaf++) {
+                    consider(ileaf, perm[ileaf], xyz_sorted + 3 * ileaf);
+                } // loop over objects in leaf
+
+            } // any in leaf?
+
+            if (any_added) {
+                std::unordered_map<int64_t, std::vector<int64_t> >::const_iterator
+                added = added_ids.find(htmid);
+                if (added != added_ids.end()) {
+                    const std::vector<int64_t>& slots = added->second;
+                    for (size_t k = 0; k < slots.size(); k++) {
+                        consider(nbucketed + slots[k], added_base + slots[k],
+                                 xyz_added + 3 * slots[k]);
+                    }
+                }
+            }
+
+        } // loop over input ra,dec
+
+        // setting maxmatch to zero is same as "keep all matches"
+        size_t nkeep = select_closest(pair_info, maxmatch);
+        for (size_t ci = 0; ci < nkeep; ci++) {
+            int64_t ileaf = pair_info[ci].i2;
+            m1.push_back(i_input);
+            if (ileaf < nbucketed) {
+                m2.push_back(perm[ileaf]);
+            }
+            else {
+                m2.push_back(added_base + ileaf - nbucketed);
+            }
+            if (separations) {
+                const double* xyz = ileaf < nbucketed ?
+                                    xyz_sorted + 3 * ileaf :
+                                    xyz_added + 3 * (ileaf - nbucketed);
+                // distance in degrees
+                d12.push_back(xyz_angle(xyz_input, xyz) / D2R);
+            }
+        }
+
+    } // loop over list 1
+
+} // Matcher::match_range
+
+PyObject* Matcher::match(
+    PyObject* ra_array, // all in degrees
+    PyObject* dec_array,
+    PyObject* radius_array, // degrees
+    PyObject* maxmatch_obj,
+    PyObject* filename_obj,
+    int nthreads,
+    int separations,
+    int binary) throw (const char *)
+{
+
+    // no copies made if already double vectors
+
+    NumpyVector<double> ra(ra_array);
+    NumpyVector<double> dec(dec_array);
+
+    // get as NumpyVectors even though they are only length 1
+    // because it does a good job with conversions
+    NumpyVector<int64_t> maxmatchVec(maxmatch_obj);
 
-            // Make sure leaf is in list for ra2,dec2
-            if (leafid >= minid && leafid <= maxid) {
+    ReadWriteLock::Shared reading(rwlock);
+    return match_points(ra, dec, NULL, radius_array, maxmatchVec[0],
+                        filename_obj, nthreads, separations, binary);
+}
 
-                int64_t leafbin = idlist[j] - minid;
+PyObject* Matcher::self_match(
+    PyObject* radius_array, // degrees
+    int include_self,
+    int nthreads,
+    int separations) throw (const char *)
+{
+    // the input is every point, so the added ones must be in ra, dec
+    lock_shared_compacted();
+    ReadWriteLock::Shared reading(rwlock, true);
 
-                // Any found in this leaf?
-                if (htmrev2[leafbin] != htmrev2[leafbin + 1]) {
+    return match_points(ra, dec, NULL, radius_array, 0, Py_None, nthreads,
+                        separations, 0, include_self ? 2 : 1);
+}
 
-                    // Now loop over the sources
-                    int64_t nLeafBin = htmrev2[leafbin + 1] - htmrev2[leafbin];
+PyObject* Matcher::match_xyz(
+    PyObject* x_array,
+    PyObject* y_array,
+    PyObject* z_array,
+    PyObject* radius_array, // degrees
+    PyObject* maxmatch_obj,
+    PyObject* filename_obj,
+    int nthreads,
+    int separations,
+    int binary) throw (const char *)
+{
+    NumpyVector<double> x(x_array);
+    NumpyVector<double> y(y_array);
+    NumpyVector<double> z(z_array);
+    check_xyz(x, y, z);
 
-                    for (int64_t ileaf = 0; ileaf < nLeafBin; ileaf++) {
+    NumpyVector<int64_t> maxmatchVec(maxmatch_obj);
 
-                        npy_intp i2 = htmrev2[ htmrev2[leafbin] + ileaf ];
+    ReadWriteLock::Shared reading(rwlock);
+    return match_points(x, y, &z, radius_array, maxmatchVec[0],
+                        filename_obj, nthreads, separations, binary);
+}
 
-                        // Returns distance in degrees
-                        double dis = gcirc(ra1[i1], dec1[i1], ra2[i2], dec2[i2], true);
+PyObject* Matcher::match_points(
+    NumpyVector<double>& ra, // degrees, or x when z is given
+    NumpyVector<double>& dec, // degrees, or y when z is given
+    NumpyVector<double>* z,
+    PyObject* radius_array, // degrees
+    int64_t maxmatch,
+    PyObject* filename_obj,
+    int nthreads,
+    int separations,
+    int binary,
+    int self_pairs) throw (const char *)
+{
 
-                        // Turns out, this pushing is not a bottleneck!
-                        // Time is negligible compared to the leaf finding
-                        // and the gcirc.
-                        if (dis <= rad) {
-                            PAIR_INFO pi;
-                            pi.i1 = i1;
-                            pi.i2 = i2;
-                            pi.d12 = dis;
-                            pair_info.push_back(pi);
-                        } // Within max distance
+    NumpyVector<double> radius(radius_array);
 
-                    } // loop over objects in leaf
+    nthreads = resolve_nthreads(nthreads);
 
-                } // any in leaf?
+    // The results, handed over to numpy arrays at the end
+    ResultBuffer<int64_t> m1;
+    ResultBuffer<int64_t> m2;
+    ResultBuffer<double> d12;
 
-            } // leaf id in list 2?
-        } // loop over leaves
+    // total number of pairs
+    int64_t ntotal = 0;
 
-        npy_intp nkeep = pair_info.size();
-        if (nkeep > 0) {
+    OutputFile output;
+    output.open(filename_obj);
+    FILE* fptr = output.get();
+    MatchWriter writer(fptr, binary, separations);
 
-            // Sort the result by distance
-            std::sort(pair_info.begin(), pair_info.end(), PAIR_INFO_ORDERING());
+    {
+        GILRelease nogil;
 
-            if ((maxmatch > 0)) {
-                // setting maxmatch to zero is same as "keep all matches"
-                if (nkeep > maxmatch) {
-                    nkeep = maxmatch;
+        npy_intp ninput = ra.size();
+        if (nthreads == 1 && fptr == NULL) {
+            // a single thread returning arrays fills the output directly
+            match_range(ra, dec, z, radius, maxmatch, 0, ninput,
+                        m1, m2, d12, separations, self_pairs);
+            ntotal = m1.size();
+        }
+        else {
+            // The input is matched in blocks taken in turn by the
+            // threads, each block into the result buffers of a slot.  The
+            // slots are appended (or written) strictly in block order, so
+            // the output is in exactly the order a single thread
+            // produces.  A block only starts once the block nslots before
+            // it has been appended, which keeps the results waiting in the
+            // slots a small fraction of the output.
+            static const npy_intp blocksize = 8192;
+            int nslots = 4 * nthreads;
+            std::vector<ResultBuffer<int64_t> > bm1(nslots);
+            std::vector<ResultBuffer<int64_t> > bm2(nslots);
+            std::vector<ResultBuffer<double> > bd12(nslots);
+            std::vector<char> ready(nslots, 0);
+
+            // the number of blocks appended so far, and whether any block
+            // failed, guarded by merge_mutex
+            npy_intp nmerged = 0;
+            bool failed = false;
+            std::mutex merge_mutex;
+            std::condition_variable merged;
+
+            run_blocks(nthreads, ninput, blocksize,
+            [&](int ithread, npy_intp iblock, npy_intp begin, npy_intp end) {
+                int islot = iblock % nslots;
+                {
+                    std::unique_lock<std::mutex> lock(merge_mutex);
+                    merged.wait(lock, [&]() {
+                        return failed || iblock < nmerged + nslots;
+                    });
+                    if (failed) {
+                        return;
+                    }
                 }
-            }
-            for (npy_intp ci = 0; ci < nkeep; ci++) {
-                if (fptr) {
-                    fprintf(fptr, "%lld %lld %.16g\n",
-                            pair_info[ci].i1,
-                            pair_info[ci].i2,
-                            pair_info[ci].d12);
+
+                try {
+                    bm1[islot].clear();
+                    bm2[islot].clear();
+                    bd12[islot].clear();
+                    match_range(ra, dec, z, radius, maxmatch, begin, end,
+                                bm1[islot], bm2[islot], bd12[islot],
+                                separations, self_pairs);
+
+                    // append every block that is now next in line
+                    std::lock_guard<std::mutex> lock(merge_mutex);
+                    ready[islot] = 1;
+                    while (ready[nmerged % nslots]) {
+                        int jslot = nmerged % nslots;
+                        size_t nkeep = bm1[jslot].size();
+                        if (fptr == NULL) {
+                            m1.append(bm1[jslot]);
+                            m2.append(bm2[jslot]);
+                            d12.append(bd12[jslot]);
+                        }
+                        for (size_t ci = 0; fptr && ci < nkeep; ci++) {
+                            writer.write(bm1[jslot][ci], bm2[jslot][ci],
+                                         separations ? bd12[jslot][ci] : 0.0);
+                        }
+                        // keep track of the total number actually saved or
+                        // written
+                        ntotal += nkeep;
+                        ready[jslot] = 0;
+                        nmerged++;
+                    }
+                    merged.notify_all();
                 }
-                else {
-                    m1.push_back(pair_info[ci].i1);
-                    m2.push_back(pair_info[ci].i2);
-                    d12.push_back(pair_info[ci].d12);
+                catch (...) {
+                    // release the threads waiting for this block
+                    std::lock_guard<std::mutex> lock(merge_mutex);
+                    failed = true;
+                    merged.notify_all();
+                    throw;
                 }
-                // keep track of the total number actually saved or written
-                ntotal += 1;
-            }
+            });
         }
-
-    } // loop over list 1
+    }
 
 
     // This will hold the tuple of match1 and match2 and possibly
@@ -342,463 +2212,619 @@ PyObject* HTMC::cmatch(
     if (fptr == NULL) {
 
         // If we are not writing to a file, we *always* return arrays, even if
-        // they are zero size
-
-        PyObject* output_tuple = PyTuple_New(3);
+        // they are zero size.  Without separations only the two index
+        // arrays are returned
 
-        NumpyVector<int64_t> m1out(ntotal);
-        NumpyVector<int64_t> m2out(ntotal);
-        NumpyVector<double> d12out(ntotal);
+        PyObject* output_tuple = PyTuple_New(separations ? 3 : 2);
 
-        for (npy_intp i = 0; i < ntotal; i++) {
-            m1out[i] = m1[i];
-            m2out[i] = m2[i];
-            d12out[i] = d12[i];
+        PyTuple_SetItem(output_tuple, 0, m1.release(NPY_INT64));
+        PyTuple_SetItem(output_tuple, 1, m2.release(NPY_INT64));
+        if (separations) {
+            PyTuple_SetItem(output_tuple, 2, d12.release(NPY_FLOAT64));
         }
 
-        PyTuple_SetItem(output_tuple, 0, m1out.getref());
-        PyTuple_SetItem(output_tuple, 1, m2out.getref());
-        PyTuple_SetItem(output_tuple, 2, d12out.getref());
-
         return output_tuple;
 
     }
     else {
-        fflush(fptr);
-        fclose(fptr);
+        if (!writer.finish() || !output.close()) {
+            throw "Error writing the output file";
+        }
         return PyLong_FromLongLong((long long) ntotal);
     }
 
 
 
 
-}
-
-
+} // Matcher::match_points
 
-
-PyObject* HTMC::cbincount(
-    PyObject* rmin_object, // units of scale*angle in radians
-    PyObject* rmax_object, // units of scale*angle in radians
-    PyObject* nbin_object,
-    PyObject* ra1_array, // all in degrees
-    PyObject* dec1_array,
-    PyObject* ra2_array,
-    PyObject* dec2_array,
-    PyObject* htmrev2_array,
-    PyObject* minid_obj,
-    PyObject* maxid_obj,
-    PyObject* scale_object) throw (const char *)
+PyObject* Matcher::bincount(
+    double rmin,
+    double rmax,
+    int nbin,
+    PyObject* ra_array, // all in degrees
+    PyObject* dec_array,
+    PyObject* scale_object,
+    long long begin_index,
+    long long end_index,
+    int nthreads) throw (const char *)
 {
 
+    if (!(rmin > 0) || !(rmax > rmin)) {
+        throw "rmin must be positive and less than rmax";
+    }
+    if (nbin < 1) {
+        throw "nbin must be at least 1";
+    }
 
-    double scale = 1, logscale = 0;
-
-    // get these as numpyvectors even though they are only length 1
-    // because it does a good job with conversions
-    NumpyVector<double> rminvec(rmin_object);
-    NumpyVector<double> rmaxvec(rmax_object);
-    NumpyVector<int64_t> nbinvec(nbin_object);
-
-    double rmin = rminvec[0];
-    double rmax = rmaxvec[0];
-    int64_t nbin = nbinvec[0];
-
-
-    double logrmin = log10(rmin);
-    double logrmax = log10(rmax);
-
-
-    NumpyVector<double> ra1(ra1_array);
-    NumpyVector<double> dec1(dec1_array);
-    NumpyVector<double> ra2(ra2_array);
-    NumpyVector<double> dec2(dec2_array);
-    NumpyVector<int64_t> htmrev2(htmrev2_array);
+    // the pairs are counted straight from the buckets
+    lock_shared_compacted();
+    ReadWriteLock::Shared reading(rwlock, true);
+
+    bool self_pairs = (ra_array == Py_None);
+    NumpyVector<double> ra;
+    NumpyVector<double> dec;
+    npy_intp ninput = hmap_perm.size();
+    if (!self_pairs) {
+        ra.init(ra_array);
+        dec.init(dec_array);
+        if (dec.size() != ra.size()) {
+            throw "ra and dec must be the same size";
+        }
+        ninput = ra.size();
+    }
 
-    NumpyVector<int64_t> minid_array(minid_obj);
-    NumpyVector<int64_t> maxid_array(maxid_obj);
-    int64_t minid = minid_array[0];
-    int64_t maxid = maxid_array[0];
-
-    // ensure scale is an array if input
-    NumpyVector<double> scale_array;
-    npy_intp nscale = 0;
-    bool degrees = true;
-    if (scale_object != NULL && scale_object != Py_None) {
-        scale_array.init(scale_object);
-        nscale = scale_array.size();
-        degrees = false;
-        if (nscale > 1) {
-            if (ra1.size() != scale_array.size()
-                    || dec1.size() != scale_array.size()) {
-                throw ("scale must be scalar or same size as ra1/dec1");
-            }
+    NumpyVector<double> scale;
+    if (scale_object != Py_None) {
+        scale.init(scale_object);
+        if (scale.size() != 1 && scale.size() != ninput) {
+            throw "scale must be a single value or one per input point";
         }
-        else {
-            scale = scale_array[0];
-            logscale = log10(scale);
+        if (self_pairs && scale.size() > 1) {
+            throw "scale must be a single value when counting self pairs";
         }
     }
 
-    std::cout << "rmin: " << rmin << "\n";
-    std::cout << "rmax: " << rmax << "\n";
-    std::cout << "degrees?: " << (degrees ? "True" : "False") << "\n";
-    std::cout << "nbin: " << nbin << "\n";
-    std::cout << "logrmin: " << logrmin << "\n";
-    std::cout << "logrmax: " << logrmax << "\n";
-
-    double log_binsize = (logrmax - logrmin) / nbin;
-    if (log_binsize < 0) {
-        throw ("found log_binsize < 0");
+    npy_intp begin = begin_index;
+    npy_intp end = end_index;
+    if (end < 0 || end > ninput) {
+        end = ninput;
+    }
+    if (begin < 0) {
+        begin = 0;
+    }
+    if (begin > end) {
+        begin = end;
     }
 
+    nthreads = resolve_nthreads(nthreads);
 
-    std::cout << "log binsize: " << log_binsize << "\n";
-    std::cout << "len(scale_array) = " << scale_array.size() << "\n";
+    // one set of counts per thread, summed at the end
+    std::vector<std::vector<int64_t> > bcounts(
+        nthreads, std::vector<int64_t>(nbin, 0));
+
+    {
+        GILRelease nogil;
+
+        // the number of pairs varies a lot from point to point, so the
+        // input is shared out in small blocks
+        static const npy_intp blocksize = 1024;
+        run_blocks(nthreads, end - begin, blocksize,
+        [&](int ithread, npy_intp iblock, npy_intp bbegin, npy_intp bend) {
+            bincount_range(ra, dec, self_pairs, scale, rmin, rmax, nbin,
+                           begin + bbegin, begin + bend, &bcounts[ithread][0]);
+        });
+    }
 
-    // Output counts in bins
     NumpyVector<int64_t> counts(nbin);
+    for (int ibin = 0; ibin < nbin; ibin++) {
+        int64_t total = 0;
+        for (int ithread = 0; ithread < nthreads; ithread++) {
+            total += bcounts[ithread][ibin];
+        }
+        counts[ibin] = total;
+    }
+    return counts.getref();
+} // Matcher::bincount
+
+void Matcher::bincount_range(
+    NumpyVector<double>& ra, // degrees, unused for self pairs
+    NumpyVector<double>& dec,
+    bool self_pairs,
+    NumpyVector<double>& scale,
+    double rmin,
+    double rmax,
+    int nbin,
+    npy_intp begin,
+    npy_intp end,
+    int64_t* counts)
+{
+
+    static const double
+    D2R = 0.0174532925199433;
 
     // This is used in the basic calculations
-    const SpatialIndex &index = mHtmInterface.index();
+    const SpatialIndex &index = this->htm_interface.index();
 
-    static const double D2R = 0.0174532925199433;
-    int step = 500;
-    int linelen = 70 * step;
-    npy_intp totcount = 0;
+    // the bucket index (see init_hmap)
+    npy_intp nids = hmap_ids.size();
+    const int64_t* ids_begin = nids > 0 ? hmap_ids.ptr() : NULL;
+    const int64_t* ids_end = ids_begin + nids;
+    const int64_t* offsets = nids > 0 ? hmap_offsets.ptr() : NULL;
+    const int64_t* perm = nids > 0 ? hmap_perm.ptr() : NULL;
+    const double* xyz_sorted = nids > 0 ? hmap_xyz.ptr() : NULL;
+
+    // without a scale the radii are in degrees
+    npy_intp nscale = scale.size();
+    bool degrees = (nscale == 0);
+    double scl = 1, logscale = 0;
+    if (nscale == 1) {
+        scl = scale[0];
+        logscale = log10(scl);
+    }
 
-    std::cout << "\n" <<
-              "Each dot is " << step << " points" << std::endl;
+    double logrmin = log10(rmin);
+    double log_binsize = (log10(rmax) - logrmin) / nbin;
 
-    npy_intp n1 = ra1.size();
-    for (npy_intp i1 = 0; i1 < n1; i1++) {
+    for (npy_intp i_input = begin; i_input < end; i_input++) {
         // Declare the domain and the lists
         SpatialDomain domain;    // initialize empty domain
         ValVec<uint64> plist, flist;	// List results
 
         if (nscale > 1) {
-            scale = scale_array[i1];
-            logscale = log10(scale);
+            scl = scale[i_input];
+            logscale = log10(scl);
         }
 
-        // get actual max search radius in radians for this point
-        double d = 0;
-        double maxangle = rmax / scale;
+        // max search radius in radians for this point
+        double maxangle = rmax / scl;
         if (degrees) {
-            d = cos(maxangle * D2R);
+            maxangle *= D2R;
+        }
+        double d = cos(maxangle);
+        double chord2max = angle_to_chord2(maxangle);
+
+        // for self pairs only the partners with a larger index are
+        // counted, so each pair is counted once
+        double xyz_input[3];
+        int64_t i_self = -1;
+        if (self_pairs) {
+            memcpy(xyz_input, xyz_sorted + 3 * i_input, sizeof(xyz_input));
+            i_self = perm[i_input];
+            set_circle_xyz(domain, xyz_input, d);
         }
         else {
-            d = cos(maxangle);
+            radec_to_xyz(ra[i_input], dec[i_input], xyz_input);
+            domain.setRaDecD(ra[i_input], dec[i_input], d);
         }
-
-        // Find the triangles around this point
-        domain.setRaDecD(ra1[i1], dec1[i1], d); //put in ra,dec,d E.S.S.
         domain.intersect(&index, plist, flist);	 // intersect with list
 
-        // number of triangles found
-        npy_intp nfound = flist.length() + plist.length();
-        std::vector<int64_t> idlist(nfound);
-        npy_intp idcount = 0;
-
-        // ----------- FULL NODES -------------
-        for (size_t i = 0; i < flist.length(); i++) {
-            idlist[idcount] = flist(i);
-            idcount++;
-        }
-        // ----------- Partial Nodes ----------
-        for (size_t i = 0; i < plist.length(); i++) {
-            idlist[idcount] = plist(i);
-            idcount++;
-        }
-
-        for (npy_intp j = 0; j < nfound; j++) {
-            int64_t leafid = idlist[j];
-
-            // Make sure leaf is in list for ra2,dec2
-            if (leafid >= minid && leafid <= maxid) {
-                int64_t leafbin = idlist[j] - minid;
-
-                // Any found in this leaf?
-                if (htmrev2[leafbin] != htmrev2[leafbin + 1]) {
-
-                    // Now loop over the sources in this leaf node
-                    int64_t nLeafBin = htmrev2[leafbin + 1] - htmrev2[leafbin];
-
-                    for (int64_t ileaf = 0; ileaf < nLeafBin; ileaf++) {
-
-                        npy_intp i2 = htmrev2[ htmrev2[leafbin] + ileaf ];
-
-                        double dis = gcirc(ra1[i1], dec1[i1], ra2[i2], dec2[i2], degrees);
-                        //std::cout<<"dis = "<<dis<<"\n";
-                        if (dis <= maxangle) {
-                            double logr = logscale + log10(dis);
-
-                            int radbin = (int)((logr - logrmin) / log_binsize);
-                            if (radbin >= 0 && radbin < nbin) {
-                                //std::cout<<"keeping in bin: "<<radbin<<"\n";
-                                counts[radbin] += 1;
-                                totcount += 1;
-                            } // in one of our radial bins
-                        } // Within max angle
-                    } // loop over objects in leaf
-                } // points exist in this leafbin
-            } // leafid in range of list 2
-        } // loop over HTM leaves
+        size_t nfull = flist.length();
+        size_t nfound = nfull + plist.length();
+        for (size_t j = 0; j < nfound; j++) {
 
+            int64_t htmid = j < nfull ? flist(j) : plist(j - nfull);
 
-        if ((((i1 + 1) % step) == 0 && (i1 > 0))
-                || (i1 == (n1 - 1))) {
-            std::cout << ".";
-            if (((i1 + 1) % linelen) == 0 || (i1 == (n1 - 1))) {
-                std::cout << "\n" << (i1 + 1) << "/" << n1 << "  pair count: " << totcount << "\n";
+            const int64_t* iter = std::lower_bound(ids_begin, ids_end, htmid);
+            if (iter == ids_end || *iter != htmid) {
+                continue;
             }
-            fflush(stdout);
-        }
+            npy_intp ibucket = iter - ids_begin;
 
-    } // loop over list 1
+            for (int64_t ileaf = offsets[ibucket];
+                    ileaf < offsets[ibucket + 1]; ileaf++) {
+                if (self_pairs && perm[ileaf] <= i_self) {
+                    continue;
+                }
+                const double* xyz = xyz_sorted + 3 * ileaf;
+                if (xyz_chord2(xyz_input, xyz) > chord2max) {
+                    continue;
+                }
+                double dis = xyz_angle(xyz_input, xyz);
+                if (degrees) {
+                    dis /= D2R;
+                }
+                if (!(dis > 0)) {
+                    continue;
+                }
+                double bin = (logscale + log10(dis) - logrmin) / log_binsize;
+                if (bin >= 0 && bin < nbin) {
+                    counts[(int64_t) bin] += 1;
+                }
+            } // loop over objects in leaf
 
-    std::cout << "\n";
-    fflush(stdout);
+        } // loop over HTM leaves
 
-    PyObject* countsPyObject = counts.getref();
-    return countsPyObject;
+    } // loop over input points
+
+} // Matcher::bincount_range
+
+// a trixel waiting on the best-first queue of Matcher::nearest_range
+typedef struct {
+    // lower bound on the squared chord from the input point
+    double bound;
+    int64_t htmid;
+    int level;
+    // the buckets inside the trixel
+    npy_intp ibegin;
+    npy_intp iend;
+    // unit vertices, counterclockwise
+    double v[9];
+} NEAREST_NODE;
+
+struct NEAREST_NODE_ORDERING {
+	bool operator()(NEAREST_NODE const& n1, NEAREST_NODE const& n2) const {
+		return n1.bound > n2.bound;
+	}
+};
+
+static inline void xyz_cross(const double* a, const double* b, double* c)
+{
+    c[0] = a[1] * b[2] - a[2] * b[1];
+    c[1] = a[2] * b[0] - a[0] * b[2];
+    c[2] = a[0] * b[1] - a[1] * b[0];
 }
 
-Matcher::Matcher(int depth,
-                 PyObject* ra_input,
-                 PyObject* dec_input) throw (const char *)
+static inline double xyz_dot(const double* a, const double* b)
 {
-    this->depth = depth;
-    this->htm_interface.init(depth);
-
-    // wrap the input ra,dec objects, making sure they are doubles
-    // no copy is made if the are already double arrays
-    this->ra.init(ra_input);
-    this->dec.init(dec_input);
-
-    init_hmap();
+    return a[0] * b[0] + a[1] * b[1] + a[2] * b[2];
 }
-void Matcher::init_hmap(void)
-{
-    std::map<int64_t, std::vector<int64_t> >::iterator iter;
-    int64_t htmid = 0;
-    int64_t num = ra.size();
-    for (int64_t i = 0; i < num; i++) {
-        htmid = htm_interface.lookupID(ra[i], dec[i]);
-
-        iter = hmap.find(htmid);
 
-        if (iter == hmap.end()) {
-            std::vector<int64_t> v;
-            v.push_back(i);
-            hmap[htmid] = v;
+// squared chord from the unit vector p to the nearest point of the
+// spherical triangle with counterclockwise unit vertices v, or zero
+// when p is inside it.  Outside, the nearest point is on an edge: the
+// foot of p on the edge's great circle if it falls between the end
+// vertices, otherwise the closer vertex.
+static double triangle_chord2(const double* p, const double* v)
+{
+    bool inside = true;
+    double best = 4.0;
+    for (int i = 0; i < 3; i++) {
+        const double* a = v + 3 * i;
+        const double* b = v + 3 * ((i + 1) % 3);
+        double n[3], na[3], bn[3];
+        xyz_cross(a, b, n);
+        double pn = xyz_dot(p, n);
+        if (pn < 0) {
+            inside = false;
+        }
+        xyz_cross(n, a, na);
+        xyz_cross(b, n, bn);
+        double chord2;
+        if (xyz_dot(p, na) >= 0 && xyz_dot(p, bn) >= 0) {
+            // sin^2 of the angle to the great circle, turned into a
+            // chord without the cancellation of 2 - 2 cos
+            double s2 = pn * pn / xyz_dot(n, n);
+            if (s2 > 1) {
+                s2 = 1;
+            }
+            chord2 = 2 * s2 / (1 + sqrt(1 - s2));
         }
         else {
-            iter->second.push_back(i);
+            chord2 = std::min(xyz_chord2(p, a), xyz_chord2(p, b));
         }
+        best = std::min(best, chord2);
+    }
+    if (inside) {
+        return 0;
     }
+    // points are binned by htm id with the same arithmetic, but may
+    // still sit a rounding error outside their trixel
+    double chord = sqrt(best) - 1e-12;
+    return chord > 0 ? chord * chord : 0;
 }
 
-PyObject* Matcher::match(
-    PyObject* ra_array, // all in degrees
+// the unit vector midway between unit vectors a and b
+static inline void xyz_midpoint(const double* a, const double* b, double* m)
+{
+    normalize_xyz(a[0] + b[0], a[1] + b[1], a[2] + b[2], m);
+}
+
+PyObject* Matcher::nearest(
+    PyObject* ra_array, // degrees
     PyObject* dec_array,
-    PyObject* radius_array, // degrees
-    PyObject* maxmatch_obj,
-    PyObject* filename_obj) throw (const char *)
+    long long k,
+    double max_radius, // degrees
+    int nthreads) throw (const char *)
 {
 
-    std::map<int64_t, std::vector<int64_t> >::iterator iter;
+    static const double
+    D2R = 0.0174532925199433;
 
-    // no copies made if already double vectors
+    if (k < 1) {
+        throw "k must be at least 1";
+    }
 
     NumpyVector<double> ra(ra_array);
     NumpyVector<double> dec(dec_array);
+    if (dec.size() != ra.size()) {
+        throw "ra and dec must be the same size";
+    }
 
-    NumpyVector<double> radius(radius_array);
-    npy_intp nrad = radius.size();
-
-    // get as NumpyVectors even though they are only length 1
-    // because it does a good job with conversions
-    NumpyVector<int64_t> maxmatchVec(maxmatch_obj);
-    int64_t maxmatch = maxmatchVec[0];
+    // the search walks the buckets only
+    lock_shared_compacted();
+    ReadWriteLock::Shared reading(rwlock, true);
 
-    // These will temporarily hold the results
-    std::vector<int64_t> m1;
-    std::vector<int64_t> m2;
-    std::vector<double> d12;
+    double chord2max = max_radius > 0 ? angle_to_chord2(max_radius * D2R) : 4.0;
 
-    // total number of pairs
-    int64_t ntotal = 0;
+    nthreads = resolve_nthreads(nthreads);
 
-    FILE* fptr = NULL;
-    if (PyBytes_Check(filename_obj)) {
-        char* filename = PyBytes_AsString(filename_obj);
-        fptr = fopen(filename, "w");
-        if (fptr == NULL) {
-            std::stringstream err;
-            err << "Cannot open file: " << filename << " : " << strerror(errno);
-            throw err.str().c_str();
-        }
+    npy_intp ninput = ra.size();
+    NumpyVector<int64_t> indices(ninput * k);
+    NumpyVector<double> seps(ninput * k);
+    int64_t* indices_ptr = ninput > 0 ? indices.ptr() : NULL;
+    double* seps_ptr = ninput > 0 ? seps.ptr() : NULL;
+
+    {
+        GILRelease nogil;
+
+        // each block writes its own part of the output
+        static const npy_intp blocksize = 1024;
+        run_blocks(nthreads, ninput, blocksize,
+        [&](int ithread, npy_intp iblock, npy_intp begin, npy_intp end) {
+            nearest_range(ra, dec, k, chord2max, begin, end,
+                          indices_ptr, seps_ptr);
+        });
     }
 
-
+    PyObject* output_tuple = PyTuple_New(2);
+    PyTuple_SetItem(output_tuple, 0, indices.getref());
+    PyTuple_SetItem(output_tuple, 1, seps.getref());
+    return output_tuple;
+} // Matcher::nearest
+
+void Matcher::nearest_range(
+    NumpyVector<double>& ra, // degrees
+    NumpyVector<double>& dec,
+    int64_t k,
+    double chord2max,
+    npy_intp begin,
+    npy_intp end,
+    int64_t* indices,
+    double* seps)
+{
 
     static const double
     D2R = 0.0174532925199433;
 
-    // This is used in the basic calculations
-    const SpatialIndex &index = this->htm_interface.index();
-
-
-    double rad = 0, d = 0;
-    if (nrad == 1) {
-        rad = radius[0];
-        d = cos(rad * D2R);
-    }
-
-    npy_intp ninput = ra.size();
-    for (npy_intp i_input = 0; i_input < ninput; i_input++) {
-        // Declare the domain and the lists
-        SpatialDomain domain;    // initialize empty domain
-        ValVec<uint64> plist, flist;	// List results
-
-        if (nrad > 1) {
-            rad = radius[i_input];
-            d = cos(rad * D2R);
+    // the root trixels, as in SpatialIndex
+    static const double corners[6][3] = {
+        {0, 0, 1}, {1, 0, 0}, {0, 1, 0}, {-1, 0, 0}, {0, -1, 0}, {0, 0, -1}
+    };
+    static const int roots[8][3] = {
+        {1, 5, 2}, {2, 5, 3}, {3, 5, 4}, {4, 5, 1},
+        {1, 0, 4}, {4, 0, 3}, {3, 0, 2}, {2, 0, 1}
+    };
+
+    // the bucket index (see init_hmap)
+    npy_intp nids = hmap_ids.size();
+    const int64_t* ids_begin = nids > 0 ? hmap_ids.ptr() : NULL;
+    const int64_t* offsets = nids > 0 ? hmap_offsets.ptr() : NULL;
+    const int64_t* perm = nids > 0 ? hmap_perm.ptr() : NULL;
+    const double* xyz_sorted = nids > 0 ? hmap_xyz.ptr() : NULL;
+
+    // reused for every input point
+    std::vector<NEAREST_NODE> queue;
+    std::vector<PAIR_INFO> best;
+
+    for (npy_intp i_input = begin; i_input < end; i_input++) {
+
+        double xyz_input[3];
+        radec_to_xyz(ra[i_input], dec[i_input], xyz_input);
+
+        // the k best so far by bucket position, as a heap with the
+        // worst on top
+        best.clear();
+        queue.clear();
+
+        // nothing further than this can still make the k best
+        auto limit = [&]() {
+            if ((int64_t) best.size() < k) {
+                return chord2max;
+            }
+            return std::min(chord2max, best.front().chord2);
+        };
+
+        // queue a trixel if it holds any points that could be kept
+        auto push = [&](int64_t htmid, int level, npy_intp ibegin,
+                        npy_intp iend, const double* v0, const double* v1,
+                        const double* v2) {
+            int shift = 2 * (depth - level);
+            const int64_t* lo = std::lower_bound(
+                ids_begin + ibegin, ids_begin + iend, htmid << shift);
+            const int64_t* hi = std::lower_bound(
+                lo, ids_begin + iend, (htmid + 1) << shift);
+            if (lo == hi) {
+                return;
+            }
+            NEAREST_NODE node;
+            for (int j = 0; j < 3; j++) {
+                node.v[j] = v0[j];
+                node.v[3 + j] = v1[j];
+                node.v[6 + j] = v2[j];
+            }
+            node.bound = triangle_chord2(xyz_input, node.v);
+            if (node.bound > limit()) {
+                return;
+            }
+            node.htmid = htmid;
+            node.level = level;
+            node.ibegin = lo - ids_begin;
+            node.iend = hi - ids_begin;
+            queue.push_back(node);
+            std::push_heap(queue.begin(), queue.end(), NEAREST_NODE_ORDERING());
+        };
+
+        for (int iroot = 0; iroot < 8; iroot++) {
+            push(8 + iroot, 0, 0, nids, corners[roots[iroot][0]],
+                 corners[roots[iroot][1]], corners[roots[iroot][2]]);
         }
 
-        // Find the triangles around this point
-        domain.setRaDecD(ra[i_input], dec[i_input], d); //put in ra,dec,d E.S.S.
-        domain.intersect(&index, plist, flist);	 // intersect with list
+        while (!queue.empty()) {
+            std::pop_heap(queue.begin(), queue.end(), NEAREST_NODE_ORDERING());
+            NEAREST_NODE node = queue.back();
+            queue.pop_back();
 
+            // the queue is ordered on the bound, so once it passes the
+            // k-th best distance nothing left can improve on it
+            if (node.bound > limit()) {
+                break;
+            }
 
-        // number of triangles found
-        npy_intp nfound = flist.length() + plist.length();
-        std::vector<int64_t> idlist(nfound);
-        npy_intp idcount = 0;
-
-        // We could speed this up when no distance is needed by
-        // just keeping everything in the full nodes without
-        // doing a distance calculation
+            if (node.level == depth) {
+                // a single bucket
+                npy_intp ibucket = node.ibegin;
+                for (int64_t ileaf = offsets[ibucket];
+                        ileaf < offsets[ibucket + 1]; ileaf++) {
+                    PAIR_INFO pi;
+                    pi.i2 = ileaf;
+                    pi.chord2 = xyz_chord2(xyz_input, xyz_sorted + 3 * ileaf);
+                    if (pi.chord2 > chord2max) {
+                        continue;
+                    }
+                    if ((int64_t) best.size() < k) {
+                        best.push_back(pi);
+                        std::push_heap(best.begin(), best.end(),
+                                       PAIR_INFO_ORDERING());
+                    }
+                    else if (PAIR_INFO_ORDERING()(pi, best.front())) {
+                        std::pop_heap(best.begin(), best.end(),
+                                      PAIR_INFO_ORDERING());
+                        best.back() = pi;
+                        std::push_heap(best.begin(), best.end(),
+                                       PAIR_INFO_ORDERING());
+                    }
+                }
+                continue;
+            }
 
-        // ----------- FULL NODES -------------
-        for (size_t i = 0; i < flist.length(); i++) {
-            idlist[idcount] = flist(i);
-            idcount++;
-        }
-        // ----------- Partial Nodes ----------
-        for (size_t i = 0; i < plist.length(); i++) {
-            idlist[idcount] = plist(i);
-            idcount++;
+            // the four children, numbered as in SpatialIndex
+            const double* v0 = node.v;
+            const double* v1 = node.v + 3;
+            const double* v2 = node.v + 6;
+            double w0[3], w1[3], w2[3];
+            xyz_midpoint(v1, v2, w0);
+            xyz_midpoint(v0, v2, w1);
+            xyz_midpoint(v1, v0, w2);
+            int64_t child = node.htmid << 2;
+            int level = node.level + 1;
+            push(child, level, node.ibegin, node.iend, v0, w2, w1);
+            push(child + 1, level, node.ibegin, node.iend, v1, w0, w2);
+            push(child + 2, level, node.ibegin, node.iend, v2, w1, w0);
+            push(child + 3, level, node.ibegin, node.iend, w0, w1, w2);
         }
 
+        // nearest first, with the missing neighbours at the end
+        std::sort_heap(best.begin(), best.end(), PAIR_INFO_ORDERING());
+        for (int64_t j = 0; j < k; j++) {
+            npy_intp iout = i_input * k + j;
+            if (j < (int64_t) best.size()) {
+                int64_t ileaf = best[j].i2;
+                indices[iout] = perm[ileaf];
+                seps[iout] = xyz_angle(xyz_input, xyz_sorted + 3 * ileaf) / D2R;
+            }
+            else {
+                indices[iout] = -1;
+                seps[iout] = std::numeric_limits<double>::infinity();
+            }
+        }
+    }
 
-        // these are temporary vectors to hold matches to this point
-
-        std::vector<PAIR_INFO> pair_info;
-
-        for (npy_intp j = 0; j < nfound; j++) {
+} // Matcher::nearest_range
 
-            int64_t htmid = idlist[j];
+PyObject* Matcher::within_polygons(
+    PyObject* ra_array, // all in degrees
+    PyObject* dec_array,
+    PyObject* vertex_offsets_array) throw (const char *)
+{
 
-            iter = this->hmap.find(htmid);
-            if (iter != this->hmap.end()) {
-
-                int64_t nleaf = iter->second.size();
-                for (int64_t ileaf = 0; ileaf < nleaf; ileaf++) {
-                    int64_t i_this = iter->second[ileaf];
-
-                    // Returns distance in degrees
-                    double dis = gcirc(ra[i_input],
-                                       dec[i_input],
-                                       this->ra[i_this],
-                                       this->dec[i_this], true);
-
-                    // Turns out, this pushing is not a bottleneck!
-                    // Time is negligible compared to the leaf finding
-                    // and the gcirc.
-                    if (dis <= rad) {
-                        PAIR_INFO pi;
-                        pi.i1 = i_input;
-                        pi.i2 = i_this;
-                        pi.d12 = dis;
-                        pair_info.push_back(pi);
-                    } // Within max distance
+    // the points are read straight from the buckets
+    lock_shared_compacted();
+    ReadWriteLock::Shared reading(rwlock, true);
 
-                } // loop over objects in leaf
+    NumpyVector<double> ra(ra_array);
+    NumpyVector<double> dec(dec_array);
+    NumpyVector<int64_t> vertex_offsets(vertex_offsets_array);
+    if (dec.size() != ra.size()) {
+        throw "ra and dec must be the same size";
+    }
 
-            } // any in leaf?
+    std::vector<double> normals;
+    std::vector<size_t> nstart;
+    polygon_normals(ra, dec, vertex_offsets, normals, nstart);
 
-        } // loop over input ra,dec
+    // This is used in the basic calculations
+    const SpatialIndex &index = this->htm_interface.index();
 
-        npy_intp nkeep = pair_info.size();
-        if (nkeep > 0) {
+    // the bucket index (see init_hmap)
+    npy_intp nids = hmap_ids.size();
+    const int64_t* ids_begin = nids > 0 ? hmap_ids.ptr() : NULL;
+    const int64_t* ids_end = ids_begin + nids;
+    const int64_t* offsets = nids > 0 ? hmap_offsets.ptr() : NULL;
+    const int64_t* perm = nids > 0 ? hmap_perm.ptr() : NULL;
+    const double* xyz_sorted = nids > 0 ? hmap_xyz.ptr() : NULL;
 
-            // Sort the result by distance
-            std::sort(pair_info.begin(), pair_info.end(), PAIR_INFO_ORDERING());
+    npy_intp npoly = vertex_offsets.size() - 1;
+    ResultBuffer<int64_t> indices;
+    NumpyVector<int64_t> poly_offsets(npoly + 1);
 
-            if ((maxmatch > 0)) {
-                // setting maxmatch to zero is same as "keep all matches"
-                if (nkeep > maxmatch) {
-                    nkeep = maxmatch;
-                }
-            }
-            for (npy_intp ci = 0; ci < nkeep; ci++) {
-                if (fptr) {
-                    fprintf(fptr, "%lld %lld %.16g\n",
-                            pair_info[ci].i1,
-                            pair_info[ci].i2,
-                            pair_info[ci].d12);
-                }
-                else {
-                    m1.push_back(pair_info[ci].i1);
-                    m2.push_back(pair_info[ci].i2);
-                    d12.push_back(pair_info[ci].d12);
-                }
-                // keep track of the total number actually saved or written
-                ntotal += 1;
-            }
-        }
+    {
+        GILRelease nogil;
 
-    } // loop over list 1
+        for (npy_intp p = 0; p < npoly; p++) {
+            size_t first = indices.size();
+            poly_offsets[p] = first;
 
+            const double* pnormals = &normals[3 * nstart[p]];
+            size_t nnormals = nstart[p + 1] - nstart[p];
 
-    // This will hold the tuple of match1 and match2 and possibly
-    // d12
+            // Declare the domain and the lists
+            SpatialDomain domain;    // initialize empty domain
+            ValVec<uint64> plist, flist;	// List results
 
+            set_polygon(domain, pnormals, nnormals);
+            domain.intersect(&index, plist, flist);
 
-    if (fptr == NULL) {
+            // points in the full trixels are inside by construction, only
+            // those in the partial trixels are tested against the edges
+            size_t nfull = flist.length();
+            size_t nfound = nfull + plist.length();
+            for (size_t j = 0; j < nfound; j++) {
 
-        // If we are not writing to a file, we *always* return arrays, even if
-        // they are zero size
+                int64_t htmid = j < nfull ? flist(j) : plist(j - nfull);
 
-        PyObject* output_tuple = PyTuple_New(3);
+                const int64_t* iter = std::lower_bound(ids_begin, ids_end, htmid);
+                if (iter == ids_end || *iter != htmid) {
+                    continue;
+                }
+                npy_intp ibucket = iter - ids_begin;
+
+                for (int64_t ileaf = offsets[ibucket];
+                        ileaf < offsets[ibucket + 1]; ileaf++) {
+                    bool inside = true;
+                    const double* xyz = xyz_sorted + 3 * ileaf;
+                    for (size_t m = 0; j >= nfull && m < nnormals && inside; m++) {
+                        inside = pnormals[3 * m] * xyz[0]
+                                 + pnormals[3 * m + 1] * xyz[1]
+                                 + pnormals[3 * m + 2] * xyz[2] >= 0;
+                    }
+                    if (inside) {
+                        indices.push_back(perm[ileaf]);
+                    }
+                } // loop over objects in leaf
 
-        NumpyVector<int64_t> m1out(ntotal);
-        NumpyVector<int64_t> m2out(ntotal);
-        NumpyVector<double> d12out(ntotal);
+            } // loop over HTM leaves
 
-        for (npy_intp i = 0; i < ntotal; i++) {
-            m1out[i] = m1[i];
-            m2out[i] = m2[i];
-            d12out[i] = d12[i];
+            if (indices.size() > first) {
+                std::sort(&indices[first], &indices[first] + (indices.size() - first));
+            }
         }
-
-        PyTuple_SetItem(output_tuple, 0, m1out.getref());
-        PyTuple_SetItem(output_tuple, 1, m2out.getref());
-        PyTuple_SetItem(output_tuple, 2, d12out.getref());
-
-        return output_tuple;
-
-    }
-    else {
-        fflush(fptr);
-        fclose(fptr);
-        return PyLong_FromLongLong((long long) ntotal);
+        poly_offsets[npoly] = indices.size();
     }
 
-
-
-
-} // Matcher::match
+    PyObject* output_tuple = PyTuple_New(2);
+    PyTuple_SetItem(output_tuple, 0, poly_offsets.getref());
+    PyTuple_SetItem(output_tuple, 1, indices.release(NPY_INT64));
+    return output_tuple;
+} // Matcher::within_polygons
 
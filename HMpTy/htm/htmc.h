@@ -4,35 +4,262 @@
 #include <Python.h>
 #include "SpatialInterface.h"
 #include <stdint.h>
+#include <stdlib.h>
+#include <string.h>
+#include <algorithm>
 #include <vector>
 #include <map>
+#include <unordered_map>
+#include <memory>
+#include <mutex>
+#include <condition_variable>
 #include <numpy/arrayobject.h>
 
 
 #define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
 
+// a candidate match to the current input point.  The squared chord
+// length orders candidates exactly as the separation does, so the
+// separation itself is only calculated for the pairs that are kept.
 typedef struct {
-	int64_t i1;	
-	int64_t i2;	
-	double d12;
+	int64_t i2;	// index into list 2, or the Matcher bucket position
+	double chord2;
 } PAIR_INFO;
 
+// ties are broken on i2 so the kept pairs never depend on the
+// selection algorithm
 struct PAIR_INFO_ORDERING {
-	bool operator()(PAIR_INFO const& pi1, PAIR_INFO const& pi2) {
-		return pi1.d12 < pi2.d12;
+	bool operator()(PAIR_INFO const& pi1, PAIR_INFO const& pi2) const {
+		if (pi1.chord2 != pi2.chord2) {
+			return pi1.chord2 < pi2.chord2;
+		}
+		return pi1.i2 < pi2.i2;
 	}
 };
 
 // doesn't seem to work to include it here with swig...
 #include "../include/NumpyVector.h"
 
+// Releases the GIL for its lifetime so that the long C++ loops can run
+// alongside other python threads.  The loops in htmc.cc are wrapped in
+// a block holding one of these, and no python objects (or NumpyVector
+// allocations) may be touched while it is in scope.
+class GILRelease {
+    public:
+        GILRelease() {
+            mState = PyEval_SaveThread();
+        }
+        ~GILRelease() {
+            PyEval_RestoreThread(mState);
+        }
+
+    private:
+        PyThreadState* mState;
+};
+
+// A reader/writer lock.  The Matcher's buckets are read with the GIL
+// released, so the methods that change them must wait for the reads in
+// flight to finish, and reads must wait for a change.  The lock is only
+// ever taken with the GIL held, and the GIL is released while waiting
+// for it, so a thread holding the lock can always take the GIL back.
+// Waiting writers hold off new readers, so a stream of matches cannot
+// starve a change.  The lock is not recursive.
+class ReadWriteLock {
+    public:
+        ReadWriteLock() : mReaders(0), mWriting(false), mWaiting(0) {}
+
+        void lock_shared() {
+            GILRelease nogil;
+            std::unique_lock<std::mutex> guard(mMutex);
+            mCond.wait(guard, [this]() {
+                return !mWriting && mWaiting == 0;
+            });
+            mReaders++;
+        }
+        void unlock_shared() {
+            std::lock_guard<std::mutex> guard(mMutex);
+            mReaders--;
+            if (mReaders == 0) {
+                mCond.notify_all();
+            }
+        }
+        void lock() {
+            GILRelease nogil;
+            std::unique_lock<std::mutex> guard(mMutex);
+            mWaiting++;
+            mCond.wait(guard, [this]() {
+                return !mWriting && mReaders == 0;
+            });
+            mWaiting--;
+            mWriting = true;
+        }
+        void unlock() {
+            std::lock_guard<std::mutex> guard(mMutex);
+            mWriting = false;
+            mCond.notify_all();
+        }
+
+        // hold the lock for the lifetime of the guard.  With adopt the
+        // lock has already been taken by the caller
+        class Shared {
+            public:
+                Shared(ReadWriteLock& lock, bool adopt=false) : mLock(lock) {
+                    if (!adopt) {
+                        mLock.lock_shared();
+                    }
+                }
+                ~Shared() {
+                    mLock.unlock_shared();
+                }
+            private:
+                ReadWriteLock& mLock;
+        };
+        class Exclusive {
+            public:
+                Exclusive(ReadWriteLock& lock) : mLock(lock) {
+                    mLock.lock();
+                }
+                ~Exclusive() {
+                    mLock.unlock();
+                }
+            private:
+                ReadWriteLock& mLock;
+        };
+
+    private:
+        std::mutex mMutex;
+        std::condition_variable mCond;
+        npy_intp mReaders;
+        bool mWriting;
+        npy_intp mWaiting;
+};
+
+inline void free_result_buffer(PyObject* capsule)
+{
+    free(PyCapsule_GetPointer(capsule, NULL));
+}
+
+// A growable 1-d result array in malloc'd memory.  It can be filled while
+// the GIL is released and is then handed to numpy without a copy, so the
+// match results are never held twice.  Large buffers are grown with
+// realloc, which remaps the pages rather than copying them.
+template <class T> class ResultBuffer {
+    public:
+        ResultBuffer() : mData(NULL), mSize(0), mCapacity(0) {}
+        ~ResultBuffer() {
+            free(mData);
+        }
+
+        size_t size() const {
+            return mSize;
+        }
+        T& operator[](size_t i) {
+            return mData[i];
+        }
+
+        void push_back(const T& value) {
+            if (mSize == mCapacity) {
+                reserve(mCapacity < 1024 ? 1024 : 2 * mCapacity);
+            }
+            mData[mSize++] = value;
+        }
+
+        void append(const ResultBuffer<T>& other) {
+            if (mSize + other.mSize > mCapacity) {
+                reserve(std::max(mSize + other.mSize, 2 * mCapacity));
+            }
+            if (other.mSize > 0) {
+                memcpy(mData + mSize, other.mData, other.mSize * sizeof(T));
+            }
+            mSize += other.mSize;
+        }
+
+        // empty the buffer but keep the memory for reuse
+        void clear() {
+            mSize = 0;
+        }
+
+        void reserve(size_t capacity) throw (const char *) {
+            T* data = (T*) realloc(mData, capacity * sizeof(T));
+            if (data == NULL) {
+                // a const char * like every other error, so it is raised
+                // in python rather than aborting through the throw specs
+                throw "not enough memory for the match results";
+            }
+            mData = data;
+            mCapacity = capacity;
+        }
+
+        // a new numpy array of type typenum that takes over the buffer,
+        // leaving this one empty.  Needs the GIL.
+        PyObject* release(int typenum) throw (const char *) {
+            // trim the unused capacity; always keep at least one element
+            // so there is a pointer to hand over
+            reserve(mSize > 0 ? mSize : 1);
+
+            npy_intp dims[1] = {(npy_intp) mSize};
+            PyObject* array = PyArray_SimpleNewFromData(1, dims, typenum, mData);
+            if (array == NULL) {
+                throw "Could not create the output array";
+            }
+            PyObject* base = PyCapsule_New(mData, NULL, free_result_buffer);
+            if (base == NULL) {
+                Py_DECREF(array);
+                throw "Could not create the output array";
+            }
+
+            // from here the capsule owns the memory, whatever happens
+            mData = NULL;
+            mSize = 0;
+            mCapacity = 0;
+
+            // steals the reference to base, even on failure
+            if (PyArray_SetBaseObject((PyArrayObject*) array, base) < 0) {
+                Py_DECREF(array);
+                throw "Could not create the output array";
+            }
+            return array;
+        }
+
+    private:
+        // not copyable, the buffer has a single owner
+        ResultBuffer(const ResultBuffer&);
+        ResultBuffer& operator=(const ResultBuffer&);
+
+        T* mData;
+        size_t mSize;
+        size_t mCapacity;
+};
+
+// Process-wide cache of SpatialIndex objects keyed by (depth, buildlevel).
+// An index is never modified once built, so a single copy is shared by
+// every HTMC and Matcher (and thread) asking for the same mesh.
+class IndexRegistry {
+    public:
+        // the index for this depth/buildlevel, building it on first use
+        static std::shared_ptr<const SpatialIndex> get(
+                int depth,
+                int buildlevel) throw (const char *);
+
+        // list of {depth, buildlevel, bytes} dicts, one per cached index
+        static PyObject* info();
+
+        // drop the cached indexes; objects still using them keep them alive
+        static void clear();
+
+    private:
+        static std::mutex mLock;
+        static std::map<std::pair<int, int>,
+                        std::shared_ptr<const SpatialIndex> > mIndexes;
+};
+
 // called HTMC because we will have another python-only class that
 // inherits from this one.
 class HTMC {
 	public:
 
-		HTMC(int depth=10) throw (const char *);
-        void init(int depth=10) throw (const char *);
+		HTMC(int depth=10, int buildlevel=2) throw (const char *);
+        void init(int depth=10, int buildlevel=2) throw (const char *);
 		~HTMC() {};
 
 
@@ -41,6 +268,13 @@ class HTMC {
                 PyObject* ra_array, 
                 PyObject* dec_array) throw (const char *);
 
+        // as lookup_id, for points given as cartesian vectors.  The
+        // vectors need not be of unit length.
+        PyObject* lookup_id_xyz(
+                PyObject* x_array,
+                PyObject* y_array,
+                PyObject* z_array) throw (const char *);
+
         PyObject* intersect(
                             double ra, // all in degrees
                             double dec,
@@ -48,6 +282,48 @@ class HTMC {
                             int inclusive
                            ) throw (const char *);
 
+        // the trixel cover of many circles in one call.  With unique=1 a
+        // sorted array of the distinct ids, otherwise an (offsets, ids)
+        // tuple where the ids of circle i are ids[offsets[i]:offsets[i+1]]
+        PyObject* intersect_many(
+                PyObject* ra_array, // degrees
+                PyObject* dec_array,
+                PyObject* radius_array, // degrees, one or one per circle
+                int inclusive,
+                int unique) throw (const char *);
+
+        // as intersect_many, for circles centred on cartesian vectors
+        PyObject* intersect_many_xyz(
+                PyObject* x_array,
+                PyObject* y_array,
+                PyObject* z_array,
+                PyObject* radius_array, // degrees, one or one per circle
+                int inclusive,
+                int unique) throw (const char *);
+
+        // the trixel cover of convex polygons, each the convex hull of
+        // its ra, dec vertices [vertex_offsets[p], vertex_offsets[p+1]).
+        // Returns an (offsets, ids) tuple with the ids of polygon p at
+        // ids[offsets[p]:offsets[p+1]], full trixels first
+        PyObject* intersect_polygons(
+                PyObject* ra_array, // degrees
+                PyObject* dec_array,
+                PyObject* vertex_offsets_array,
+                int inclusive) throw (const char *);
+
+        // the trixel cover of the circles as merged [lo, hi] id ranges at
+        // the target depth, flattened to lo0, hi0, lo1, hi1, ...  With
+        // unique=1 the ranges of all the circles are merged together,
+        // otherwise an (offsets, ranges) tuple with the ranges of circle i
+        // at ranges[2 * offsets[i]:2 * offsets[i + 1]]
+        PyObject* intersect_ranges(
+                PyObject* ra_array, // degrees
+                PyObject* dec_array,
+                PyObject* radius_array, // degrees, one or one per circle
+                int depth,
+                int inclusive,
+                int unique) throw (const char *);
+
 
         // this requires the reverse indices must already be created,
         // and other obscure inputs. The python wrapper takes care of
@@ -62,22 +338,9 @@ class HTMC {
                 PyObject* minid_obj,
                 PyObject* maxid_obj,
 				PyObject* maxmatch_obj,
-				PyObject* filename_obj) throw (const char *);
+				PyObject* filename_obj,
+				int binary=0) throw (const char *);
 
-        PyObject* cbincount(
-                PyObject* rmin_object, // units of scale*angle in radians
-                PyObject* rmax_object, // units of scale*angle in radians
-				PyObject* nbin_object, 
-                PyObject* ra1_array, // all in degrees
-                PyObject* dec1_array,
-                PyObject* ra2_array, 
-                PyObject* dec2_array,
-                PyObject* htmrev2_array,
-                PyObject* minid_obj,
-                PyObject* maxid_obj,
-				PyObject* scale_object=NULL) // will bin in radians*scale.  
-                                            // Same length as ra1.
-                              throw (const char *);
 
 
 
@@ -86,9 +349,21 @@ class HTMC {
             return mDepth;
         }
 
-    private:
+        int buildlevel() {
+            return mHtmInterface.index().buildlevel();
+        }
 
+    private:
 
+        // intersect_many for circles centred on ra, dec or, when z is
+        // given, on the cartesian vectors (ra, dec, z)
+        PyObject* intersect_circles(
+                NumpyVector<double>& ra,
+                NumpyVector<double>& dec,
+                NumpyVector<double>* z,
+                PyObject* radius_array,
+                int inclusive,
+                int unique) throw (const char *);
 
         htmInterface mHtmInterface;
         int mDepth;
@@ -99,23 +374,200 @@ class Matcher {
 
         Matcher(int depth,
                 PyObject* ra,
-                PyObject* dec) throw (const char *);
+                PyObject* dec,
+                int buildlevel=2) throw (const char *);
+
+        // rebuild a matcher from the coordinates and bucket arrays
+        // returned by get_coordinates and get_buckets (e.g. memory
+        // mapped from a saved matcher file). No htm lookups are made and
+        // no copies taken of arrays of the right type, so they must not
+        // be changed in place afterwards.
+        Matcher(int depth,
+                PyObject* ra,
+                PyObject* dec,
+                PyObject* hmap_ids,
+                PyObject* hmap_offsets,
+                PyObject* hmap_perm,
+                PyObject* hmap_xyz,
+                int buildlevel=2) throw (const char *);
         ~Matcher() {};
 
         int get_depth() {
             return depth;
         }
 
-        PyObject* match(PyObject* radius_array, // degrees
-                        PyObject* ra_array, // degrees
+        int get_buildlevel() {
+            return htm_interface.index().buildlevel();
+        }
+
+        // tuple of the (ra, dec) arrays of all the points, removed ones
+        // included
+        PyObject* get_coordinates() throw (const char *);
+
+        // tuple of the (hmap_ids, hmap_offsets, hmap_perm, hmap_xyz)
+        // bucket arrays
+        PyObject* get_buckets() throw (const char *);
+
+        // nthreads <= 0 uses all the available cores.  With separations=0
+        // only the index pairs are returned (or written).  A bytes
+        // filename_obj writes the pairs to that file instead, as text
+        // lines or, with binary=1, as a .npy array of records
+        PyObject* match(PyObject* ra_array, // degrees
                         PyObject* dec_array,
+                        PyObject* radius_array, // degrees
                         PyObject* maxmatch_obj,
-                        PyObject* filename_obj) throw (const char *);
+                        PyObject* filename_obj,
+                        int nthreads=1,
+                        int separations=1,
+                        int binary=0) throw (const char *);
+
+        // as match, for input points given as cartesian vectors
+        PyObject* match_xyz(PyObject* x_array,
+                            PyObject* y_array,
+                            PyObject* z_array,
+                            PyObject* radius_array, // degrees
+                            PyObject* maxmatch_obj,
+                            PyObject* filename_obj,
+                            int nthreads=1,
+                            int separations=1,
+                            int binary=0) throw (const char *);
+
+        // log-binned counts of the pairs between the input points
+        // [begin, end) and this matcher's points that are separated by
+        // rmin to rmax, in degrees or, with a scale, in units of
+        // scale * radians.  With ra_array None the input is this
+        // matcher's own points, in bucket order, and each unordered pair
+        // is counted once.  end < 0 runs to the end of the input.
+        PyObject* bincount(double rmin,
+                           double rmax,
+                           int nbin,
+                           PyObject* ra_array, // degrees
+                           PyObject* dec_array,
+                           PyObject* scale_object,
+                           long long begin=0,
+                           long long end=-1,
+                           int nthreads=1) throw (const char *);
+
+        // all the pairs of this matcher's points within radius of each
+        // other, as (i, j) with i < j (or i <= j with include_self=1),
+        // ordered by i and then by separation.  Arguments as for match.
+        PyObject* self_match(PyObject* radius_array, // degrees
+                             int include_self=0,
+                             int nthreads=1,
+                             int separations=1) throw (const char *);
+
+        // the points inside convex polygons, as for
+        // HTMC::intersect_polygons.  Returns an (offsets, indices) tuple
+        // with the sorted indices of the points inside polygon p at
+        // indices[offsets[p]:offsets[p+1]]
+        PyObject* within_polygons(
+                PyObject* ra_array, // degrees
+                PyObject* dec_array,
+                PyObject* vertex_offsets_array) throw (const char *);
+
+        // the k nearest points to each input point, nearest first, as
+        // flat (indices, separations) arrays of k entries per input
+        // point.  Only points within max_radius degrees are found, with
+        // max_radius <= 0 for no limit; missing neighbours have index -1
+        // and separation inf.  The trixel tree is searched best-first, so
+        // no search radius needs guessing.  Pending additions and
+        // removals are compacted first.
+        PyObject* nearest(PyObject* ra_array, // degrees
+                          PyObject* dec_array,
+                          long long k,
+                          double max_radius=0, // degrees
+                          int nthreads=1) throw (const char *);
+
+        // append points to the catalogue, returning their indices (which
+        // follow on from the existing points, in input order).  The
+        // points go in a side index keyed by htm id until compact merges
+        // them into the buckets, so the cost is that of the batch
+        PyObject* add(PyObject* ra_array, // degrees
+                      PyObject* dec_array) throw (const char *);
+
+        // flag points as removed.  They are no longer matched but keep
+        // their indices and coordinates, and are only dropped from the
+        // buckets by compact
+        void remove(PyObject* indices_array) throw (const char *);
+
+        // merge the added points into the buckets and drop the removed
+        // points from them; indices are unchanged.  Done automatically
+        // once the pending changes outgrow a quarter of the buckets, and
+        // before any method that walks the whole catalogue
+        void compact() throw (const char *);
+
+        // the number of points, removed ones included
+        long long get_npoints() {
+            ReadWriteLock::Shared reading(rwlock);
+            return count_points();
+        }
+
+        long long get_nremoved() {
+            ReadWriteLock::Shared reading(rwlock);
+            return nremoved;
+        }
 
 
     private:
 
         void init_hmap(void);
+        void init_xyz(void);
+
+        // match for input points at ra, dec or, when z is given, at the
+        // cartesian vectors (ra, dec, z).  With self_pairs the input is
+        // this matcher's own points and only the partners j of point i
+        // with j > i (self_pairs=1) or j >= i (self_pairs=2) are kept.
+        // The caller holds rwlock shared.
+        PyObject* match_points(NumpyVector<double>& ra,
+                               NumpyVector<double>& dec,
+                               NumpyVector<double>* z,
+                               PyObject* radius_array,
+                               int64_t maxmatch,
+                               PyObject* filename_obj,
+                               int nthreads,
+                               int separations,
+                               int binary,
+                               int self_pairs=0) throw (const char *);
+
+        // match input points [begin, end), appending the kept pairs to
+        // m1, m2 and d12 in input order.  Safe to call from any thread.
+        void match_range(NumpyVector<double>& ra,
+                         NumpyVector<double>& dec,
+                         NumpyVector<double>* z,
+                         NumpyVector<double>& radius,
+                         int64_t maxmatch,
+                         npy_intp begin,
+                         npy_intp end,
+                         ResultBuffer<int64_t>& m1,
+                         ResultBuffer<int64_t>& m2,
+                         ResultBuffer<double>& d12,
+                         bool separations,
+                         int self_pairs);
+
+        // the nearest of input points [begin, end), written to the
+        // indices and seps arrays at k entries per point.  Safe to call
+        // from any thread.
+        void nearest_range(NumpyVector<double>& ra,
+                           NumpyVector<double>& dec,
+                           int64_t k,
+                           double chord2max,
+                           npy_intp begin,
+                           npy_intp end,
+                           int64_t* indices,
+                           double* seps);
+
+        // the bincount of input points [begin, end), added to counts.
+        // Safe to call from any thread.
+        void bincount_range(NumpyVector<double>& ra,
+                            NumpyVector<double>& dec,
+                            bool self_pairs,
+                            NumpyVector<double>& scale,
+                            double rmin,
+                            double rmax,
+                            int nbin,
+                            npy_intp begin,
+                            npy_intp end,
+                            int64_t* counts);
 
         int depth;
         htmInterface htm_interface;
@@ -123,9 +575,59 @@ class Matcher {
         NumpyVector<double> ra;
         NumpyVector<double> dec;
 
-        std::map<int64_t, std::vector<int64_t> > hmap;
+        // catalogue bucketed by htm id, see init_hmap
+        NumpyVector<int64_t> hmap_ids;
+        NumpyVector<int64_t> hmap_offsets;
+        NumpyVector<int64_t> hmap_perm;
+        NumpyVector<double> hmap_xyz;
+
+        // points added since the buckets were built.  Added point k has
+        // index ra.size() + k, and added_ids maps an htm id to the k of
+        // the added points in that trixel.
+        std::vector<double> added_ra;
+        std::vector<double> added_dec;
+        std::vector<double> added_xyz;
+        std::unordered_map<int64_t, std::vector<int64_t> > added_ids;
+
+        // removal flags by index, empty until the first removal
+        std::vector<char> removed;
+        npy_intp nremoved;
+        // removed points not yet dropped from the buckets
+        npy_intp nremoved_pending;
+
+        // held shared by the methods that read the points and exclusive
+        // by those that change them.  Only the public methods take it
+        ReadWriteLock rwlock;
+
+        npy_intp count_points() {
+            return ra.size() + added_ra.size();
+        }
+
+        // compact, for a caller holding rwlock exclusive
+        void compact_locked() throw (const char *);
+        void compact_if_needed() throw (const char *);
+
+        // take rwlock shared with no changes pending, compacting first
+        // if there are any, for the methods that walk the buckets only
+        void lock_shared_compacted() throw (const char *);
 
 };
 
+// python access to the IndexRegistry
+PyObject* cached_indexes();
+void clear_cached_indexes();
+
+// set labels for npoints points linked by the (m1, m2) pairs of
+// Matcher::self_match, as a (labels, order) tuple.  Sets are numbered
+// by their first point and order lists the points set by set.  With
+// transitive=1 the sets are the connected components of the pairs
+// (friends-of-friends), ordered by index within a set.  Otherwise
+// each point not yet in a set starts a new one, taking its unassigned
+// partners, in the order the pairs are given.
+PyObject* group_labels(long long npoints,
+                       PyObject* m1_array,
+                       PyObject* m2_array,
+                       int transitive=0) throw (const char *);
+
 
 #endif
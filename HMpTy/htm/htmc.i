@@ -17,8 +17,8 @@
 class HTMC {
     public:
 
-        HTMC(int depth=10) throw (const char *);
-        void init(int depth=10) throw (const char *);
+        HTMC(int depth=10, int buildlevel=2) throw (const char *);
+        void init(int depth=10, int buildlevel=2) throw (const char *);
         ~HTMC() {};
 
         // take in ra/dec and output the htm index for each
@@ -63,6 +63,13 @@ Revision History:
                 PyObject* ra_array, 
                 PyObject* dec_array) throw (const char *);
 
+        // as lookup_id, for points given as cartesian vectors.  The
+        // vectors need not be of unit length.
+        PyObject* lookup_id_xyz(
+                PyObject* x_array,
+                PyObject* y_array,
+                PyObject* z_array) throw (const char *);
+
         PyObject* intersect(
                             double ra, // all in degrees
                             double dec,
@@ -70,6 +77,48 @@ Revision History:
                             int inclusive
                            ) throw (const char *);
 
+        // the trixel cover of many circles in one call.  With unique=1 a
+        // sorted array of the distinct ids, otherwise an (offsets, ids)
+        // tuple where the ids of circle i are ids[offsets[i]:offsets[i+1]]
+        PyObject* intersect_many(
+                PyObject* ra_array, // degrees
+                PyObject* dec_array,
+                PyObject* radius_array, // degrees, one or one per circle
+                int inclusive,
+                int unique) throw (const char *);
+
+        // as intersect_many, for circles centred on cartesian vectors
+        PyObject* intersect_many_xyz(
+                PyObject* x_array,
+                PyObject* y_array,
+                PyObject* z_array,
+                PyObject* radius_array, // degrees, one or one per circle
+                int inclusive,
+                int unique) throw (const char *);
+
+        // the trixel cover of convex polygons, each the convex hull of
+        // its ra, dec vertices [vertex_offsets[p], vertex_offsets[p+1]).
+        // Returns an (offsets, ids) tuple with the ids of polygon p at
+        // ids[offsets[p]:offsets[p+1]], full trixels first
+        PyObject* intersect_polygons(
+                PyObject* ra_array, // degrees
+                PyObject* dec_array,
+                PyObject* vertex_offsets_array,
+                int inclusive) throw (const char *);
+
+        // the trixel cover of the circles as merged [lo, hi] id ranges at
+        // the target depth, flattened to lo0, hi0, lo1, hi1, ...  With
+        // unique=1 the ranges of all the circles are merged together,
+        // otherwise an (offsets, ranges) tuple with the ranges of circle i
+        // at ranges[2 * offsets[i]:2 * offsets[i + 1]]
+        PyObject* intersect_ranges(
+                PyObject* ra_array, // degrees
+                PyObject* dec_array,
+                PyObject* radius_array, // degrees, one or one per circle
+                int depth,
+                int inclusive,
+                int unique) throw (const char *);
+
 
         // this requires the reverse indices must already be created,
         // and other obscure inputs. The python wrapper takes care of
@@ -84,22 +133,9 @@ Revision History:
                 PyObject* minid_obj,
                 PyObject* maxid_obj, 
                 PyObject* maxmatch_obj,
-                PyObject* filename_obj) throw (const char *);
+                PyObject* filename_obj,
+                int binary=0) throw (const char *);
 
-        PyObject* cbincount(
-                PyObject* rmin_object, // units of scale*angle in radians
-                PyObject* rmax_object, // units of scale*angle in radians
-                PyObject* nbin_object, 
-                PyObject* ra1_array, // all in degrees
-                PyObject* dec1_array,
-                PyObject* ra2_array, 
-                PyObject* dec2_array,
-                PyObject* htmrev2_array,
-                PyObject* minid_obj,
-                PyObject* maxid_obj,
-                PyObject* scale_object=NULL) // will bin in radians*scale.  
-                                            // Same length as ra1.
-                              throw (const char *);
 
 
 
@@ -107,6 +143,8 @@ Revision History:
             return mDepth;
         }
 
+        int buildlevel();
+
     private:
 
         htmInterface mHtmInterface;
@@ -118,7 +156,17 @@ class Matcher {
 
         Matcher(int depth,
                 PyObject* ra,
-                PyObject* dec) throw (const char *);
+                PyObject* dec,
+                int buildlevel=2) throw (const char *);
+
+        Matcher(int depth,
+                PyObject* ra,
+                PyObject* dec,
+                PyObject* hmap_ids,
+                PyObject* hmap_offsets,
+                PyObject* hmap_perm,
+                PyObject* hmap_xyz,
+                int buildlevel=2) throw (const char *);
         ~Matcher() {};
 
 
@@ -126,13 +174,120 @@ class Matcher {
             return depth;
         }
 
-        PyObject* match(PyObject* radius_array, // degrees
-                        PyObject* ra_array, // degrees
+        int get_buildlevel();
+
+        PyObject* get_coordinates() throw (const char *);
+
+        PyObject* get_buckets() throw (const char *);
+
+        // nthreads <= 0 uses all the available cores.  With separations=0
+        // only the index pairs are returned (or written).  A bytes
+        // filename_obj writes the pairs to that file instead, as text
+        // lines or, with binary=1, as a .npy array of records
+        PyObject* match(PyObject* ra_array, // degrees
                         PyObject* dec_array,
+                        PyObject* radius_array, // degrees
                         PyObject* maxmatch_obj,
-                        PyObject* filename_obj) throw (const char *);
+                        PyObject* filename_obj,
+                        int nthreads=1,
+                        int separations=1,
+                        int binary=0) throw (const char *);
+
+        // as match, for input points given as cartesian vectors
+        PyObject* match_xyz(PyObject* x_array,
+                            PyObject* y_array,
+                            PyObject* z_array,
+                            PyObject* radius_array, // degrees
+                            PyObject* maxmatch_obj,
+                            PyObject* filename_obj,
+                            int nthreads=1,
+                            int separations=1,
+                            int binary=0) throw (const char *);
+
+        // log-binned counts of the pairs between the input points
+        // [begin, end) and this matcher's points that are separated by
+        // rmin to rmax, in degrees or, with a scale, in units of
+        // scale * radians.  With ra_array None the input is this
+        // matcher's own points, in bucket order, and each unordered pair
+        // is counted once.  end < 0 runs to the end of the input.
+        PyObject* bincount(double rmin,
+                           double rmax,
+                           int nbin,
+                           PyObject* ra_array, // degrees
+                           PyObject* dec_array,
+                           PyObject* scale_object,
+                           long long begin=0,
+                           long long end=-1,
+                           int nthreads=1) throw (const char *);
+
+        // all the pairs of this matcher's points within radius of each
+        // other, as (i, j) with i < j (or i <= j with include_self=1),
+        // ordered by i and then by separation.  Arguments as for match.
+        PyObject* self_match(PyObject* radius_array, // degrees
+                             int include_self=0,
+                             int nthreads=1,
+                             int separations=1) throw (const char *);
+
+        // the points inside convex polygons, as for
+        // HTMC::intersect_polygons.  Returns an (offsets, indices) tuple
+        // with the sorted indices of the points inside polygon p at
+        // indices[offsets[p]:offsets[p+1]]
+        PyObject* within_polygons(
+                PyObject* ra_array, // degrees
+                PyObject* dec_array,
+                PyObject* vertex_offsets_array) throw (const char *);
+
+        // the k nearest points to each input point, nearest first, as
+        // flat (indices, separations) arrays of k entries per input
+        // point.  Only points within max_radius degrees are found, with
+        // max_radius <= 0 for no limit; missing neighbours have index -1
+        // and separation inf.  The trixel tree is searched best-first, so
+        // no search radius needs guessing.  Pending additions and
+        // removals are compacted first.
+        PyObject* nearest(PyObject* ra_array, // degrees
+                          PyObject* dec_array,
+                          long long k,
+                          double max_radius=0, // degrees
+                          int nthreads=1) throw (const char *);
+
+        // append points to the catalogue, returning their indices (which
+        // follow on from the existing points, in input order).  The
+        // points go in a side index keyed by htm id until compact merges
+        // them into the buckets, so the cost is that of the batch
+        PyObject* add(PyObject* ra_array, // degrees
+                      PyObject* dec_array) throw (const char *);
+
+        // flag points as removed.  They are no longer matched but keep
+        // their indices and coordinates, and are only dropped from the
+        // buckets by compact
+        void remove(PyObject* indices_array) throw (const char *);
+
+        // merge the added points into the buckets and drop the removed
+        // points from them; indices are unchanged.  Done automatically
+        // once the pending changes outgrow a quarter of the buckets, and
+        // before any method that walks the whole catalogue
+        void compact() throw (const char *);
+
+        // the number of points, removed ones included
+        long long get_npoints();
+
+        long long get_nremoved();
 
 
 };
 
-
+// process-wide cache of the SpatialIndex objects used by HTMC and Matcher
+PyObject* cached_indexes();
+void clear_cached_indexes();
+
+// set labels for npoints points linked by the (m1, m2) pairs of
+// Matcher::self_match, as a (labels, order) tuple.  Sets are numbered
+// by their first point and order lists the points set by set.  With
+// transitive=1 the sets are the connected components of the pairs
+// (friends-of-friends), ordered by index within a set.  Otherwise
+// each point not yet in a set starts a new one, taking its unassigned
+// partners, in the order the pairs are given.
+PyObject* group_labels(long long npoints,
+                       PyObject* m1_array,
+                       PyObject* m2_array,
+                       int transitive=0) throw (const char *);
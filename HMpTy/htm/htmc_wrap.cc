@@ -1,41 +1,17 @@
 /* ----------------------------------------------------------------------------
- * This file was automatically generated by SWIG (http://www.swig.org).
- * Version 2.0.11
+ * This file was automatically generated by SWIG (https://www.swig.org).
+ * Version 4.5.1
  *
- * This file is not intended to be easily readable and contains a number of
- * coding conventions designed to improve portability and efficiency. Do not make
- * changes to this file unless you know what you are doing--modify the SWIG
- * interface file instead.
+ * Do not make changes to this file unless you know what you are doing - modify
+ * the SWIG interface file instead.
  * ----------------------------------------------------------------------------- */
 
+
+#define SWIG_VERSION 0x040501
 #define SWIGPYTHON
 #define SWIG_PYTHON_DIRECTOR_NO_VTABLE
 
-
-#ifdef __cplusplus
-/* SwigValueWrapper is described in swig.swg */
-template<typename T> class SwigValueWrapper {
-    struct SwigMovePointer {
-        T *ptr;
-        SwigMovePointer(T *p) : ptr(p) { }
-        ~SwigMovePointer() { delete ptr; }
-        SwigMovePointer& operator=(SwigMovePointer& rhs) { T* oldptr = ptr; ptr = 0; delete oldptr; ptr = rhs.ptr; rhs.ptr = 0; return *this; }
-    } pointer;
-    SwigValueWrapper& operator=(const SwigValueWrapper<T>& rhs);
-    SwigValueWrapper(const SwigValueWrapper<T>& rhs);
-public:
-    SwigValueWrapper() : pointer(0) { }
-    SwigValueWrapper& operator=(const T& t) { SwigMovePointer tmp(new T(t)); pointer = tmp; return *this; }
-    operator T&() const { return *pointer.ptr; }
-    T *operator&() { return pointer.ptr; }
-};
-
-template <typename T> T SwigValueInit()
-{
-    return T();
-}
-#endif
-
+#define SWIG_name    "_htmc"
 /* -----------------------------------------------------------------------------
  *  This section contains generic SWIG labels for method/variable
  *  declarations/attributes, and other compiler dependent labels.
@@ -71,7 +47,7 @@ template <typename T> T SwigValueInit()
 #   else
 #     define SWIGUNUSED
 #   endif
-# elif defined(__ICC)
+# elif defined(__ICC) || defined (__clang__)
 #   define SWIGUNUSED __attribute__ ((__unused__))
 # else
 #   define SWIGUNUSED
@@ -103,9 +79,11 @@ template <typename T> T SwigValueInit()
 #endif
 
 /* exporting methods */
-#if (__GNUC__ >= 4) || (__GNUC__ == 3 && __GNUC_MINOR__ >= 4)
-#  ifndef GCC_HASCLASSVISIBILITY
-#    define GCC_HASCLASSVISIBILITY
+#if defined(__GNUC__)
+#  if (__GNUC__ >= 4) || (__GNUC__ == 3 && __GNUC_MINOR__ >= 4)
+#    ifndef GCC_HASCLASSVISIBILITY
+#      define GCC_HASCLASSVISIBILITY
+#    endif
 #  endif
 #endif
 
@@ -144,17 +122,98 @@ template <typename T> T SwigValueInit()
 # define _SCL_SECURE_NO_DEPRECATE
 #endif
 
+/* Deal with Apple's deprecated 'AssertMacros.h' from Carbon-framework */
+#if defined(__APPLE__) && !defined(__ASSERT_MACROS_DEFINE_VERSIONS_WITHOUT_UNDERSCORES)
+# define __ASSERT_MACROS_DEFINE_VERSIONS_WITHOUT_UNDERSCORES 0
+#endif
+
+/* Intel's compiler complains if a variable which was never initialised is
+ * cast to void, which is a common idiom which we use to indicate that we
+ * are aware a variable isn't used.  So we just silence that warning.
+ * See: https://github.com/swig/swig/issues/192 for more discussion.
+ */
+#ifdef __INTEL_COMPILER
+# pragma warning disable 592
+#endif
+
+#if defined(__cplusplus) && __cplusplus >= 201103L
+# define SWIG_NOEXCEPT noexcept
+#else
+# define SWIG_NOEXCEPT throw()
+#endif 
+
+#define SWIG_QUOTE_STRING(x) #x
+#define SWIG_STRINGIFY(x) SWIG_QUOTE_STRING(x)
+
+/* -----------------------------------------------------------------------------
+ * swigcompat.swg
+ *
+ * Macros to provide support compatibility with older C and C++ standards.
+ *
+ * Note that SWIG expects __cplusplus to be defined to the appropriate C++ standard.
+ * MSVC users are urged to check and examine the /Zc:__cplusplus compiler option.
+ * See https://learn.microsoft.com/en-us/cpp/build/reference/zc-cplusplus.
+ * ----------------------------------------------------------------------------- */
+
+/* C99 and C++11 should provide snprintf, but define SWIG_NO_SNPRINTF
+ * if you're missing it.
+ */
+#if ((defined __STDC_VERSION__ && __STDC_VERSION__ >= 199901L) || \
+     (defined __cplusplus && __cplusplus >= 201103L) || \
+     defined SWIG_HAVE_SNPRINTF) && \
+    !defined SWIG_NO_SNPRINTF
+# define SWIG_snprintf(O,S,F,A) snprintf(O,S,F,A)
+# define SWIG_snprintf2(O,S,F,A,B) snprintf(O,S,F,A,B)
+#else
+/* Fallback versions ignore the buffer size, but most of our uses either have a
+ * fixed maximum possible size or dynamically allocate a buffer that's large
+ * enough.
+ */
+# define SWIG_snprintf(O,S,F,A) sprintf(O,F,A)
+# define SWIG_snprintf2(O,S,F,A,B) sprintf(O,F,A,B)
+#endif
+
 
+#if defined(__GNUC__) && defined(_WIN32) && !defined(SWIG_PYTHON_NO_HYPOT_WORKAROUND)
+/* Workaround for '::hypot' has not been declared', see https://bugs.python.org/issue11566 */
+# include <math.h>
+#endif
+
+#if !defined(PY_SSIZE_T_CLEAN) && !defined(SWIG_NO_PY_SSIZE_T_CLEAN)
+#define PY_SSIZE_T_CLEAN
+#endif
+
+#if __GNUC__ >= 7
+#pragma GCC diagnostic push
+#if defined(__cplusplus) && __cplusplus >= 201703L
+#pragma GCC diagnostic ignored "-Wregister" /* For python-2.7 headers that use register */
+#endif
+#endif
 
 #if defined(_DEBUG) && defined(SWIG_PYTHON_INTERPRETER_NO_DEBUG)
 /* Use debug wrappers with the Python release dll */
+
+#if defined(_MSC_VER) && _MSC_VER >= 1929
+/* Workaround compilation errors when redefining _DEBUG in MSVC 2019 version 16.10 and later
+ * See https://github.com/swig/swig/issues/2090 */
+# include <corecrt.h>
+#endif
+
 # undef _DEBUG
 # include <Python.h>
-# define _DEBUG
+# define _DEBUG 1
 #else
 # include <Python.h>
 #endif
 
+
+#if __GNUC__ >= 7
+#pragma GCC diagnostic pop
+#endif
+
+#include <stdio.h>
+#include <stdlib.h>
+
 /* -----------------------------------------------------------------------------
  * swigrun.swg
  *
@@ -164,13 +223,11 @@ template <typename T> T SwigValueInit()
 
 /* This should only be incremented when either the layout of swig_type_info changes,
    or for whatever reason, the runtime changes incompatibly */
-#define SWIG_RUNTIME_VERSION "4"
+#define SWIG_RUNTIME_VERSION "5"
 
 /* define SWIG_TYPE_TABLE_NAME as "SWIG_TYPE_TABLE" */
 #ifdef SWIG_TYPE_TABLE
-# define SWIG_QUOTE_STRING(x) #x
-# define SWIG_EXPAND_AND_QUOTE_STRING(x) SWIG_QUOTE_STRING(x)
-# define SWIG_TYPE_TABLE_NAME SWIG_EXPAND_AND_QUOTE_STRING(SWIG_TYPE_TABLE)
+# define SWIG_TYPE_TABLE_NAME SWIG_STRINGIFY(SWIG_TYPE_TABLE)
 #else
 # define SWIG_TYPE_TABLE_NAME
 #endif
@@ -200,6 +257,9 @@ template <typename T> T SwigValueInit()
 /* Flags for pointer conversions */
 #define SWIG_POINTER_DISOWN        0x1
 #define SWIG_CAST_NEW_MEMORY       0x2
+#define SWIG_POINTER_NO_NULL       0x4
+#define SWIG_POINTER_CLEAR         0x8
+#define SWIG_POINTER_RELEASE       (SWIG_POINTER_CLEAR | SWIG_POINTER_DISOWN)
 
 /* Flags for new pointer objects */
 #define SWIG_POINTER_OWN           0x1
@@ -240,7 +300,7 @@ template <typename T> T SwigValueInit()
       // success code
       if (SWIG_IsNewObj(res) {
         ...
-    delete *ptr;
+	delete *ptr;
       } else {
         ...
       }
@@ -271,7 +331,7 @@ template <typename T> T SwigValueInit()
    SWIG errors code.
 
    Finally, if the SWIG_CASTRANK_MODE is enabled, the result code
-   allows to return the 'cast rank', for example, if you have this
+   allows returning the 'cast rank', for example, if you have this
 
        int food(double)
        int fooi(int);
@@ -285,7 +345,13 @@ template <typename T> T SwigValueInit()
 */
 
 #define SWIG_OK                    (0)
+/* Runtime errors are < 0 */
 #define SWIG_ERROR                 (-1)
+/* Errors in range -1 to -99 are in swigerrors.swg (errors for all languages including those not using the runtime) */
+/* Errors in range -100 to -199 are language specific errors defined in *errors.swg */
+/* Errors < -200 are generic runtime specific errors */
+#define SWIG_ERROR_RELEASE_NOT_OWNED (-200)
+
 #define SWIG_IsOK(r)               (r >= 0)
 #define SWIG_ArgError(r)           ((r != SWIG_ERROR) ? r : SWIG_TypeError)
 
@@ -293,20 +359,26 @@ template <typename T> T SwigValueInit()
 #define SWIG_CASTRANKLIMIT         (1 << 8)
 /* The NewMask denotes the object was created (using new/malloc) */
 #define SWIG_NEWOBJMASK            (SWIG_CASTRANKLIMIT  << 1)
-/* The TmpMask is for in/out typemaps that use temporal objects */
+/* The TmpMask is for in/out typemaps that use temporary objects */
 #define SWIG_TMPOBJMASK            (SWIG_NEWOBJMASK << 1)
+/* The binary string mask denotes using string without unicode */
+#define SWIG_BINARYSTRMASK         (SWIG_TMPOBJMASK << 1)
 /* Simple returning values */
 #define SWIG_BADOBJ                (SWIG_ERROR)
 #define SWIG_OLDOBJ                (SWIG_OK)
 #define SWIG_NEWOBJ                (SWIG_OK | SWIG_NEWOBJMASK)
 #define SWIG_TMPOBJ                (SWIG_OK | SWIG_TMPOBJMASK)
-/* Check, add and del mask methods */
+#define SWIG_BINARYSTR             (SWIG_OK | SWIG_BINARYSTRMASK)
+/* Check, add and del object mask methods */
 #define SWIG_AddNewMask(r)         (SWIG_IsOK(r) ? (r | SWIG_NEWOBJMASK) : r)
 #define SWIG_DelNewMask(r)         (SWIG_IsOK(r) ? (r & ~SWIG_NEWOBJMASK) : r)
 #define SWIG_IsNewObj(r)           (SWIG_IsOK(r) && (r & SWIG_NEWOBJMASK))
 #define SWIG_AddTmpMask(r)         (SWIG_IsOK(r) ? (r | SWIG_TMPOBJMASK) : r)
 #define SWIG_DelTmpMask(r)         (SWIG_IsOK(r) ? (r & ~SWIG_TMPOBJMASK) : r)
 #define SWIG_IsTmpObj(r)           (SWIG_IsOK(r) && (r & SWIG_TMPOBJMASK))
+#define SWIG_AddBinaryStrMask(r)   (SWIG_IsOK(r) ? (r | SWIG_BINARYSTRMASK) : r)
+#define SWIG_DelBinaryStrMask(r)   (SWIG_IsOK(r) ? (r & ~SWIG_BINARYSTRMASK) : r)
+#define SWIG_IsBinaryStr(r)        (SWIG_IsOK(r) && (r & SWIG_BINARYSTRMASK))
 
 /* Cast-Rank Mode */
 #if defined(SWIG_CASTRANK_MODE)
@@ -318,13 +390,11 @@ template <typename T> T SwigValueInit()
 #  endif
 #  define SWIG_CASTRANKMASK          ((SWIG_CASTRANKLIMIT) -1)
 #  define SWIG_CastRank(r)           (r & SWIG_CASTRANKMASK)
-SWIGINTERNINLINE int SWIG_AddCast(int r)
-{
-    return SWIG_IsOK(r) ? ((SWIG_CastRank(r) < SWIG_MAXCASTRANK) ? (r + 1) : SWIG_ERROR) : r;
+SWIGINTERNINLINE int SWIG_AddCast(int r) {
+  return SWIG_IsOK(r) ? ((SWIG_CastRank(r) < SWIG_MAXCASTRANK) ? (r + 1) : SWIG_ERROR) : r;
 }
-SWIGINTERNINLINE int SWIG_CheckState(int r)
-{
-    return SWIG_IsOK(r) ? SWIG_CastRank(r) + 1 : 0;
+SWIGINTERNINLINE int SWIG_CheckState(int r) {
+  return SWIG_IsOK(r) ? SWIG_CastRank(r) + 1 : 0;
 }
 #else /* no cast-rank mode */
 #  define SWIG_AddCast(r) (r)
@@ -343,32 +413,32 @@ typedef struct swig_type_info *(*swig_dycast_func)(void **);
 
 /* Structure to store information on one type */
 typedef struct swig_type_info {
-    const char             *name;         /* mangled name of this type */
-    const char             *str;          /* human readable name of this type */
-    swig_dycast_func        dcast;        /* dynamic cast function down a hierarchy */
-    struct swig_cast_info  *cast;         /* linked list of types that can cast into this type */
-    void                   *clientdata;       /* language specific type data */
-    int                    owndata;       /* flag if the structure owns the clientdata */
+  const char             *name;			/* mangled name of this type */
+  const char             *str;			/* human readable name of this type */
+  swig_dycast_func        dcast;		/* dynamic cast function down a hierarchy */
+  struct swig_cast_info  *cast;			/* linked list of types that can cast into this type */
+  void                   *clientdata;		/* language specific type data */
+  int                    owndata;		/* flag if the structure owns the clientdata */
 } swig_type_info;
 
 /* Structure to store a type and conversion function used for casting */
 typedef struct swig_cast_info {
-    swig_type_info         *type;         /* pointer to type that is equivalent to this type */
-    swig_converter_func     converter;        /* function to cast the void pointers */
-    struct swig_cast_info  *next;         /* pointer to next cast in linked list */
-    struct swig_cast_info  *prev;         /* pointer to the previous cast */
+  swig_type_info         *type;			/* pointer to type that is equivalent to this type */
+  swig_converter_func     converter;		/* function to cast the void pointers */
+  struct swig_cast_info  *next;			/* pointer to next array of casts | pointer to cast hashed by value */
+  unsigned int            value;		/* index of the last valid element in the array | typename hash value */
 } swig_cast_info;
 
 /* Structure used to store module information
  * Each module generates one structure like this, and the runtime collects
  * all of these structures and stores them in a circularly linked list.*/
 typedef struct swig_module_info {
-    swig_type_info         **types;       /* Array of pointers to swig_type_info structures that are in this module */
-    size_t                 size;              /* Number of types in this module */
-    struct swig_module_info *next;        /* Pointer to next element in circularly linked list */
-    swig_type_info         **type_initial;    /* Array of initially generated type structures */
-    swig_cast_info         **cast_initial;    /* Array of initially generated casting structures */
-    void                    *clientdata;      /* Language specific module data */
+  swig_type_info         **types;		/* Array of pointers to swig_type_info structures that are in this module */
+  size_t                 size;		        /* Number of types in this module */
+  struct swig_module_info *next;		/* Pointer to next element in circularly linked list */
+  swig_type_info         **type_initial;	/* Array of initially generated type structures */
+  swig_cast_info         **cast_initial;	/* Array of initially generated casting structures */
+  void                    *clientdata;		/* Language specific module data */
 } swig_module_info;
 
 /*
@@ -380,14 +450,13 @@ typedef struct swig_module_info {
 */
 SWIGRUNTIME int
 SWIG_TypeNameComp(const char *f1, const char *l1,
-                  const char *f2, const char *l2)
-{
-    for (; (f1 != l1) && (f2 != l2); ++f1, ++f2) {
-        while ((*f1 == ' ') && (f1 != l1)) { ++f1; }
-        while ((*f2 == ' ') && (f2 != l2)) { ++f2; }
-        if (*f1 != *f2) { return (*f1 > *f2) ? 1 : -1; }
-    }
-    return (int)((l1 - f1) - (l2 - f2));
+		  const char *f2, const char *l2) {
+  for (;(f1 != l1) && (f2 != l2); ++f1, ++f2) {
+    while ((*f1 == ' ') && (f1 != l1)) ++f1;
+    while ((*f2 == ' ') && (f2 != l2)) ++f2;
+    if (*f1 != *f2) return (*f1 > *f2) ? 1 : -1;
+  }
+  return (int)((l1 - f1) - (l2 - f2));
 }
 
 /*
@@ -395,19 +464,18 @@ SWIG_TypeNameComp(const char *f1, const char *l1,
   Return 0 if equal, -1 if nb < tb, 1 if nb > tb
 */
 SWIGRUNTIME int
-SWIG_TypeCmp(const char *nb, const char *tb)
-{
-    int equiv = 1;
-    const char* te = tb + strlen(tb);
-    const char* ne = nb;
-    while (equiv != 0 && *ne) {
-        for (nb = ne; *ne; ++ne) {
-            if (*ne == '|') { break; }
-        }
-        equiv = SWIG_TypeNameComp(nb, ne, tb, te);
-        if (*ne) { ++ne; }
+SWIG_TypeCmp(const char *nb, const char *tb) {
+  int equiv = 1;
+  const char* te = tb + strlen(tb);
+  const char* ne = nb;
+  while (equiv != 0 && *ne) {
+    for (nb = ne; *ne; ++ne) {
+      if (*ne == '|') break;
     }
-    return equiv;
+    equiv = SWIG_TypeNameComp(nb, ne, tb, te);
+    if (*ne) ++ne;
+  }
+  return equiv;
 }
 
 /*
@@ -415,102 +483,184 @@ SWIG_TypeCmp(const char *nb, const char *tb)
   Return 0 if not equal, 1 if equal
 */
 SWIGRUNTIME int
-SWIG_TypeEquiv(const char *nb, const char *tb)
-{
-    return SWIG_TypeCmp(nb, tb) == 0 ? 1 : 0;
+SWIG_TypeEquiv(const char *nb, const char *tb) {
+  return SWIG_TypeCmp(nb, tb) == 0 ? 1 : 0;
+}
+
+/*
+ * Hash function for type name strings, based on maRushPrime1Hash (http://amsoftware.narod.ru/algo2.html)
+ */
+SWIGRUNTIME unsigned int SWIG_Hash(const char *str, unsigned int len) {
+  const unsigned char *data = (const unsigned char *)str;
+  unsigned int hash = len, i = 0, k;
+  int rem = (int)len;
+
+  while (rem >= (int)sizeof(unsigned int)) {
+    memcpy(&k, data, sizeof(unsigned int));
+    k += i++;
+    hash ^= k;
+    hash *= 171717;
+    data += sizeof(unsigned int);
+    rem -= (int)sizeof(unsigned int);
+  }
+
+  switch (rem) {
+    case 3: k = (unsigned int)(data[2]) << 16;
+            k |= (unsigned int)(data[1]) << 8;
+            k |= (unsigned int)(data[0]);
+            k += i++;
+            hash ^= k;
+            hash *= 171717;
+            break;
+    case 2: k = (unsigned int)(data[1]) << 8;
+            k |= (unsigned int)(data[0]);
+            k += i++;
+            hash ^= k;
+            hash *= 171717;
+            break;
+    case 1: k = (unsigned int)(data[0]);
+            k += i++;
+            hash ^= k;
+            hash *= 171717;
+            break;
+  }
+  return hash;
 }
 
 /*
   Check the typename
 */
 SWIGRUNTIME swig_cast_info *
-SWIG_TypeCheck(const char *c, swig_type_info *ty)
-{
-    if (ty) {
-        swig_cast_info *iter = ty->cast;
-        while (iter) {
-            if (strcmp(iter->type->name, c) == 0) {
-                if (iter == ty->cast) {
-                    return iter;
-                }
-                /* Move iter to the top of the linked list */
-                iter->prev->next = iter->next;
-                if (iter->next) {
-                    iter->next->prev = iter->prev;
-                }
-                iter->next = ty->cast;
-                iter->prev = 0;
-                if (ty->cast) { ty->cast->prev = iter; }
-                ty->cast = iter;
+SWIG_TypeCheck(const char *c, swig_type_info *ty) {
+  static const unsigned int scan_threshold = 4;
+  if (ty) {
+    swig_cast_info *head = ty->cast;
+    unsigned int hash_value = 0;
+    int hashed = 0;
+
+    while (head) {
+
+      if (strcmp(head->type->name, c) == 0) {
+        return head;
+      }
+
+      if (head->value) {
+        swig_cast_info *iter;
+        swig_cast_info *last = head + head->value;
+        swig_cast_info *first = head + 1;
+        int search = 1;
+
+        if (!hashed) {
+          if (head->value < scan_threshold) {
+            for (iter = first; iter <= last; iter++) {
+              if (strcmp(iter->type->name, c) == 0) {
                 return iter;
+              }
             }
-            iter = iter->next;
+            search = 0;
+          } else {
+            hashed = 1;
+            hash_value = SWIG_Hash(c, (unsigned int)strlen(c));
+          }
+        }
+
+        if (search) {
+          /* Binary search over sorted <'next'|'value'> pairs */
+          do {
+            iter = first + ((last - first) >> 1);
+            if (iter->value < hash_value) {
+              first = iter + 1;
+            } else if (iter->value == hash_value) {
+
+              if (strcmp(iter->next->type->name, c) == 0) {
+                return iter->next;
+              }
+
+              /* Hash collision check */
+              for (last = iter + 1; last->next && last->value == hash_value; last++) {
+                if (strcmp(last->next->type->name, c) == 0) {
+                  return last->next;
+                }
+              }
+              for (first = iter - 1; first != head && first->value == hash_value; first--) {
+                if (strcmp(first->next->type->name, c) == 0) {
+                  return first->next;
+                }
+              }
+              break;
+            } else
+              last = iter - 1;
+          } while (first <= last);
         }
+      }
+      head = head->next;
     }
-    return 0;
+  }
+  return 0;
 }
 
 /*
-  Identical to SWIG_TypeCheck, except strcmp is replaced with a pointer comparison
+  Check the type by type address
 */
 SWIGRUNTIME swig_cast_info *
-SWIG_TypeCheckStruct(swig_type_info *from, swig_type_info *ty)
-{
-    if (ty) {
-        swig_cast_info *iter = ty->cast;
-        while (iter) {
-            if (iter->type == from) {
-                if (iter == ty->cast) {
-                    return iter;
-                }
-                /* Move iter to the top of the linked list */
-                iter->prev->next = iter->next;
-                if (iter->next) {
-                    iter->next->prev = iter->prev;
-                }
-                iter->next = ty->cast;
-                iter->prev = 0;
-                if (ty->cast) { ty->cast->prev = iter; }
-                ty->cast = iter;
-                return iter;
-            }
-            iter = iter->next;
-        }
+SWIG_TypeCheckStruct(const swig_type_info *from, swig_type_info *ty) {
+  if (ty) {
+    swig_cast_info *head = ty->cast;
+    while (head) {
+      if (head->type == from) {
+        return head;
+      }
+
+      if (head->value) {
+        swig_cast_info *iter;
+        swig_cast_info *last = head + head->value;
+        swig_cast_info *first = head + 1;
+
+        /* Binary search over sorted array of casts */
+        do {
+          iter = first + ((last - first) >> 1);
+          if (iter->type < from) {
+            first = iter + 1;
+          } else if (iter->type == from) {
+            return iter;
+          } else
+            last = iter - 1;
+        } while (first <= last);
+      }
+      head = head->next;
     }
-    return 0;
+  }
+  return 0;
 }
 
 /*
   Cast a pointer up an inheritance hierarchy
 */
 SWIGRUNTIMEINLINE void *
-SWIG_TypeCast(swig_cast_info *ty, void *ptr, int *newmemory)
-{
-    return ((!ty) || (!ty->converter)) ? ptr : (*ty->converter)(ptr, newmemory);
+SWIG_TypeCast(swig_cast_info *ty, void *ptr, int *newmemory) {
+  return ((!ty) || (!ty->converter)) ? ptr : (*ty->converter)(ptr, newmemory);
 }
 
 /*
    Dynamic pointer casting. Down an inheritance hierarchy
 */
 SWIGRUNTIME swig_type_info *
-SWIG_TypeDynamicCast(swig_type_info *ty, void **ptr)
-{
-    swig_type_info *lastty = ty;
-    if (!ty || !ty->dcast) { return ty; }
-    while (ty && (ty->dcast)) {
-        ty = (*ty->dcast)(ptr);
-        if (ty) { lastty = ty; }
-    }
-    return lastty;
+SWIG_TypeDynamicCast(swig_type_info *ty, void **ptr) {
+  swig_type_info *lastty = ty;
+  if (!ty || !ty->dcast) return ty;
+  while (ty && (ty->dcast)) {
+    ty = (*ty->dcast)(ptr);
+    if (ty) lastty = ty;
+  }
+  return lastty;
 }
 
 /*
   Return the name associated with this type
 */
 SWIGRUNTIMEINLINE const char *
-SWIG_TypeName(const swig_type_info *ty)
-{
-    return ty->name;
+SWIG_TypeName(const swig_type_info *ty) {
+  return ty->name;
 }
 
 /*
@@ -518,50 +668,50 @@ SWIG_TypeName(const swig_type_info *ty)
   that is an unmangled type name in a form presentable to the user.
 */
 SWIGRUNTIME const char *
-SWIG_TypePrettyName(const swig_type_info *type)
-{
-    /* The "str" field contains the equivalent pretty names of the
-       type, separated by vertical-bar characters.  We choose
-       to print the last name, as it is often (?) the most
-       specific. */
-    if (!type) { return NULL; }
-    if (type->str != NULL) {
-        const char *last_name = type->str;
-        const char *s;
-        for (s = type->str; *s; s++)
-            if (*s == '|') { last_name = s + 1; }
-        return last_name;
-    }
-    else {
-        return type->name;
-    }
+SWIG_TypePrettyName(const swig_type_info *type) {
+  /* The "str" field contains the equivalent pretty names of the
+     type, separated by vertical-bar characters.  Choose the last
+     name. It should be the most specific; a fully resolved name
+     but not necessarily with default template parameters expanded. */
+  if (!type) return NULL;
+  if (type->str != NULL) {
+    const char *last_name = type->str;
+    const char *s;
+    for (s = type->str; *s; s++)
+      if (*s == '|') last_name = s+1;
+    return last_name;
+  }
+  else
+    return type->name;
 }
 
 /*
    Set the clientdata field for a type
 */
 SWIGRUNTIME void
-SWIG_TypeClientData(swig_type_info *ti, void *clientdata)
-{
-    swig_cast_info *cast = ti->cast;
-    /* if (ti->clientdata == clientdata) return; */
-    ti->clientdata = clientdata;
-
-    while (cast) {
-        if (!cast->converter) {
-            swig_type_info *tc = cast->type;
-            if (!tc->clientdata) {
-                SWIG_TypeClientData(tc, clientdata);
-            }
+SWIG_TypeClientData(swig_type_info *ti, void *clientdata) {
+  swig_cast_info *head = ti->cast;
+  /* if (ti->clientdata == clientdata) return; */
+  ti->clientdata = clientdata;
+
+  while (head) {
+    swig_cast_info *cast;
+    for (cast = head; (unsigned int)(cast - head) <= head->value; cast++) {
+      if (!cast->converter) {
+        swig_type_info *tc = cast->type;
+        if (!tc->clientdata) {
+          SWIG_TypeClientData(tc, clientdata);
         }
-        cast = cast->next;
+      }
     }
+    head = head->next;
+  }
 }
+
 SWIGRUNTIME void
-SWIG_TypeNewClientData(swig_type_info *ti, void *clientdata)
-{
-    SWIG_TypeClientData(ti, clientdata);
-    ti->owndata = 1;
+SWIG_TypeNewClientData(swig_type_info *ti, void *clientdata) {
+  SWIG_TypeClientData(ti, clientdata);
+  ti->owndata = 1;
 }
 
 /*
@@ -575,44 +725,37 @@ SWIG_TypeNewClientData(swig_type_info *ti, void *clientdata)
 SWIGRUNTIME swig_type_info *
 SWIG_MangledTypeQueryModule(swig_module_info *start,
                             swig_module_info *end,
-                            const char *name)
-{
-    swig_module_info *iter = start;
-    do {
-        if (iter->size) {
-            register size_t l = 0;
-            register size_t r = iter->size - 1;
-            do {
-                /* since l+r >= 0, we can (>> 1) instead (/ 2) */
-                register size_t i = (l + r) >> 1;
-                const char *iname = iter->types[i]->name;
-                if (iname) {
-                    register int compare = strcmp(name, iname);
-                    if (compare == 0) {
-                        return iter->types[i];
-                    }
-                    else if (compare < 0) {
-                        if (i) {
-                            r = i - 1;
-                        }
-                        else {
-                            break;
-                        }
-                    }
-                    else if (compare > 0) {
-                        l = i + 1;
-                    }
-                }
-                else {
-                    break; /* should never happen */
-                }
-            }
-            while (l <= r);
-        }
-        iter = iter->next;
-    }
-    while (iter != end);
-    return 0;
+		            const char *name) {
+  swig_module_info *iter = start;
+  do {
+    if (iter->size) {
+      size_t l = 0;
+      size_t r = iter->size - 1;
+      do {
+	/* since l+r >= 0, we can (>> 1) instead (/ 2) */
+	size_t i = (l + r) >> 1;
+	const char *iname = iter->types[i]->name;
+	if (iname) {
+	  int compare = strcmp(name, iname);
+	  if (compare == 0) {
+	    return iter->types[i];
+	  } else if (compare < 0) {
+	    if (i) {
+	      r = i - 1;
+	    } else {
+	      break;
+	    }
+	  } else if (compare > 0) {
+	    l = i + 1;
+	  }
+	} else {
+	  break; /* should never happen */
+	}
+      } while (l <= r);
+    }
+    iter = iter->next;
+  } while (iter != end);
+  return 0;
 }
 
 /*
@@ -627,386 +770,292 @@ SWIG_MangledTypeQueryModule(swig_module_info *start,
 SWIGRUNTIME swig_type_info *
 SWIG_TypeQueryModule(swig_module_info *start,
                      swig_module_info *end,
-                     const char *name)
-{
-    /* STEP 1: Search the name field using binary search */
-    swig_type_info *ret = SWIG_MangledTypeQueryModule(start, end, name);
-    if (ret) {
-        return ret;
-    }
-    else {
-        /* STEP 2: If the type hasn't been found, do a complete search
-           of the str field (the human readable name) */
-        swig_module_info *iter = start;
-        do {
-            register size_t i = 0;
-            for (; i < iter->size; ++i) {
-                if (iter->types[i]->str && (SWIG_TypeEquiv(iter->types[i]->str, name))) {
-                    return iter->types[i];
-                }
-            }
-            iter = iter->next;
-        }
-        while (iter != end);
-    }
+		     const char *name) {
+  /* STEP 1: Search the name field using binary search */
+  swig_type_info *ret = SWIG_MangledTypeQueryModule(start, end, name);
+  if (ret) {
+    return ret;
+  } else {
+    /* STEP 2: If the type hasn't been found, do a complete search
+       of the str field (the human readable name) */
+    swig_module_info *iter = start;
+    do {
+      size_t i = 0;
+      for (; i < iter->size; ++i) {
+	if (iter->types[i]->str && (SWIG_TypeEquiv(iter->types[i]->str, name)))
+	  return iter->types[i];
+      }
+      iter = iter->next;
+    } while (iter != end);
+  }
 
-    /* neither found a match */
-    return 0;
+  /* neither found a match */
+  return 0;
 }
 
 /*
    Pack binary data into a string
 */
 SWIGRUNTIME char *
-SWIG_PackData(char *c, void *ptr, size_t sz)
-{
-    static const char hex[17] = "0123456789abcdef";
-    register const unsigned char *u = (unsigned char *) ptr;
-    register const unsigned char *eu =  u + sz;
-    for (; u != eu; ++u) {
-        register unsigned char uu = *u;
-        *(c++) = hex[(uu & 0xf0) >> 4];
-        *(c++) = hex[uu & 0xf];
-    }
-    return c;
+SWIG_PackData(char *c, void *ptr, size_t sz) {
+  static const char hex[17] = "0123456789abcdef";
+  const unsigned char *u = (unsigned char *) ptr;
+  const unsigned char *eu =  u + sz;
+  for (; u != eu; ++u) {
+    unsigned char uu = *u;
+    *(c++) = hex[(uu & 0xf0) >> 4];
+    *(c++) = hex[uu & 0xf];
+  }
+  return c;
 }
 
 /*
    Unpack binary data from a string
 */
 SWIGRUNTIME const char *
-SWIG_UnpackData(const char *c, void *ptr, size_t sz)
-{
-    register unsigned char *u = (unsigned char *) ptr;
-    register const unsigned char *eu = u + sz;
-    for (; u != eu; ++u) {
-        register char d = *(c++);
-        register unsigned char uu;
-        if ((d >= '0') && (d <= '9')) {
-            uu = ((d - '0') << 4);
-        }
-        else if ((d >= 'a') && (d <= 'f')) {
-            uu = ((d - ('a' - 10)) << 4);
-        }
-        else {
-            return (char *) 0;
-        }
-        d = *(c++);
-        if ((d >= '0') && (d <= '9')) {
-            uu |= (d - '0');
-        }
-        else if ((d >= 'a') && (d <= 'f')) {
-            uu |= (d - ('a' - 10));
-        }
-        else {
-            return (char *) 0;
-        }
-        *u = uu;
-    }
-    return c;
+SWIG_UnpackData(const char *c, void *ptr, size_t sz) {
+  unsigned char *u = (unsigned char *) ptr;
+  const unsigned char *eu = u + sz;
+  for (; u != eu; ++u) {
+    char d = *(c++);
+    unsigned char uu;
+    if ((d >= '0') && (d <= '9'))
+      uu = (unsigned char)((d - '0') << 4);
+    else if ((d >= 'a') && (d <= 'f'))
+      uu = (unsigned char)((d - ('a'-10)) << 4);
+    else
+      return (char *) 0;
+    d = *(c++);
+    if ((d >= '0') && (d <= '9'))
+      uu |= (unsigned char)(d - '0');
+    else if ((d >= 'a') && (d <= 'f'))
+      uu |= (unsigned char)(d - ('a'-10));
+    else
+      return (char *) 0;
+    *u = uu;
+  }
+  return c;
 }
 
 /*
    Pack 'void *' into a string buffer.
 */
 SWIGRUNTIME char *
-SWIG_PackVoidPtr(char *buff, void *ptr, const char *name, size_t bsz)
-{
-    char *r = buff;
-    if ((2 * sizeof(void *) + 2) > bsz) { return 0; }
-    *(r++) = '_';
-    r = SWIG_PackData(r, &ptr, sizeof(void *));
-    if (strlen(name) + 1 > (bsz - (r - buff))) { return 0; }
-    strcpy(r, name);
-    return buff;
+SWIG_PackVoidPtr(char *buff, void *ptr, const char *name, size_t bsz) {
+  char *r = buff;
+  if ((2*sizeof(void *) + 2) > bsz) return 0;
+  *(r++) = '_';
+  r = SWIG_PackData(r,&ptr,sizeof(void *));
+  if (strlen(name) + 1 > (bsz - (size_t)(r - buff))) return 0;
+  strcpy(r,name);
+  return buff;
 }
 
 SWIGRUNTIME const char *
-SWIG_UnpackVoidPtr(const char *c, void **ptr, const char *name)
-{
-    if (*c != '_') {
-        if (strcmp(c, "NULL") == 0) {
-            *ptr = (void *) 0;
-            return name;
-        }
-        else {
-            return 0;
-        }
+SWIG_UnpackVoidPtr(const char *c, void **ptr, const char *name) {
+  if (*c != '_') {
+    if (strcmp(c,"NULL") == 0) {
+      *ptr = (void *) 0;
+      return name;
+    } else {
+      return 0;
     }
-    return SWIG_UnpackData(++c, ptr, sizeof(void *));
+  }
+  return SWIG_UnpackData(++c,ptr,sizeof(void *));
 }
 
 SWIGRUNTIME char *
-SWIG_PackDataName(char *buff, void *ptr, size_t sz, const char *name, size_t bsz)
-{
-    char *r = buff;
-    size_t lname = (name ? strlen(name) : 0);
-    if ((2 * sz + 2 + lname) > bsz) { return 0; }
-    *(r++) = '_';
-    r = SWIG_PackData(r, ptr, sz);
-    if (lname) {
-        strncpy(r, name, lname + 1);
-    }
-    else {
-        *r = 0;
-    }
-    return buff;
+SWIG_PackDataName(char *buff, void *ptr, size_t sz, const char *name, size_t bsz) {
+  char *r = buff;
+  size_t lname = (name ? strlen(name) : 0);
+  if ((2*sz + 2 + lname) > bsz) return 0;
+  *(r++) = '_';
+  r = SWIG_PackData(r,ptr,sz);
+  if (lname) {
+    strncpy(r,name,lname+1);
+  } else {
+    *r = 0;
+  }
+  return buff;
 }
 
 SWIGRUNTIME const char *
-SWIG_UnpackDataName(const char *c, void *ptr, size_t sz, const char *name)
-{
-    if (*c != '_') {
-        if (strcmp(c, "NULL") == 0) {
-            memset(ptr, 0, sz);
-            return name;
-        }
-        else {
-            return 0;
-        }
+SWIG_UnpackDataName(const char *c, void *ptr, size_t sz, const char *name) {
+  if (*c != '_') {
+    if (strcmp(c,"NULL") == 0) {
+      memset(ptr,0,sz);
+      return name;
+    } else {
+      return 0;
     }
-    return SWIG_UnpackData(++c, ptr, sz);
+  }
+  return SWIG_UnpackData(++c,ptr,sz);
 }
 
 #ifdef __cplusplus
 }
 #endif
 
-/*  Errors in SWIG */
-#define  SWIG_UnknownError         -1
-#define  SWIG_IOError              -2
-#define  SWIG_RuntimeError         -3
-#define  SWIG_IndexError           -4
-#define  SWIG_TypeError            -5
-#define  SWIG_DivisionByZero       -6
-#define  SWIG_OverflowError        -7
-#define  SWIG_SyntaxError          -8
-#define  SWIG_ValueError           -9
-#define  SWIG_SystemError          -10
-#define  SWIG_AttributeError       -11
-#define  SWIG_MemoryError          -12
+/* SWIG Errors applicable to all language modules, values are reserved from -1 to -99 */
+#define  SWIG_UnknownError    	   -1
+#define  SWIG_IOError        	   -2
+#define  SWIG_RuntimeError   	   -3
+#define  SWIG_IndexError     	   -4
+#define  SWIG_TypeError      	   -5
+#define  SWIG_DivisionByZero 	   -6
+#define  SWIG_OverflowError  	   -7
+#define  SWIG_SyntaxError    	   -8
+#define  SWIG_ValueError     	   -9
+#define  SWIG_SystemError    	   -10
+#define  SWIG_AttributeError 	   -11
+#define  SWIG_MemoryError    	   -12
 #define  SWIG_NullReferenceError   -13
 
 
-
-/* Compatibility macros for Python 3 */
-#if PY_VERSION_HEX >= 0x03000000
-
-#define PyClass_Check(obj) PyObject_IsInstance(obj, (PyObject *)&PyType_Type)
-#define PyInt_Check(x) PyLong_Check(x)
-#define PyInt_AsLong(x) PyLong_AsLong(x)
-#define PyInt_FromLong(x) PyLong_FromLong(x)
-#define PyInt_FromSize_t(x) PyLong_FromSize_t(x)
-#define PyBytes_Check(name) PyBytes_Check(name)
-#define PyBytes_FromString(x) PyUnicode_FromString(x)
-#define PyBytes_Format(fmt, args)  PyUnicode_Format(fmt, args)
-#define PyBytes_AsString(str) PyBytes_AsString(str)
-#define PyBytes_Size(str) PyBytes_Size(str)
-#define PyBytes_InternFromString(key) PyUnicode_InternFromString(key)
-#define Py_TPFLAGS_HAVE_CLASS Py_TPFLAGS_BASETYPE
-#define PyBytes_AS_STRING(x) PyUnicode_AS_STRING(x)
-#define _PyLong_FromSsize_t(x) PyLong_FromSsize_t(x)
-
+#if !defined(SWIG_NO_HEAPTYPES)
+#if !defined(SWIG_HEAPTYPES)
+#define SWIG_HEAPTYPES
 #endif
-
-#ifndef Py_TYPE
-#  define Py_TYPE(op) ((op)->ob_type)
 #endif
 
-/* SWIG APIs for compatibility of both Python 2 & 3 */
-
-#if PY_VERSION_HEX >= 0x03000000
-#  define SWIG_Python_str_FromFormat PyUnicode_FromFormat
-#else
-#  define SWIG_Python_str_FromFormat PyBytes_FromFormat
+#if defined(SWIG_HEAPTYPES)
+#if PY_VERSION_HEX < 0x030c0000
+#include <structmember.h>
+#define Py_READONLY READONLY
+#define Py_T_PYSSIZET T_PYSSIZET
 #endif
-
-
-/* Warning: This function will allocate a new string in Python 3,
- * so please call SWIG_Python_str_DelForPy3(x) to free the space.
- */
-SWIGINTERN char*
-SWIG_Python_str_AsChar(PyObject *str)
-{
-#if PY_VERSION_HEX >= 0x03000000
-    char *cstr;
-    char *newstr;
-    Py_ssize_t len;
-    str = PyUnicode_AsUTF8String(str);
-    PyBytes_AsStringAndSize(str, &cstr, &len);
-    newstr = (char *) malloc(len + 1);
-    memcpy(newstr, cstr, len + 1);
-    Py_XDECREF(str);
-    return newstr;
-#else
-    return PyBytes_AsString(str);
 #endif
-}
 
-#if PY_VERSION_HEX >= 0x03000000
-#  define SWIG_Python_str_DelForPy3(x) free( (void*) (x) )
-#else
-#  define SWIG_Python_str_DelForPy3(x)
-#endif
+#include <stddef.h> /* For offsetof */
 
 
-SWIGINTERN PyObject*
-SWIG_Python_str_FromChar(const char *c)
+/* Wrapper around PyUnicode_AsUTF8AndSize - call Py_XDECREF on the returned pbytes when finished with the returned string */
+SWIGINTERN const char *
+SWIG_PyUnicode_AsUTF8AndSize(PyObject *str, Py_ssize_t *psize, PyObject **pbytes)
 {
-#if PY_VERSION_HEX >= 0x03000000
-    return PyUnicode_FromString(c);
+#if !defined(Py_LIMITED_API) || Py_LIMITED_API+0 >= 0x030A0000
+  *pbytes = NULL;
+  return PyUnicode_AsUTF8AndSize(str, psize);
 #else
-    return PyBytes_FromString(c);
-#endif
-}
-
-/* Add PyOS_snprintf for old Pythons */
-#if PY_VERSION_HEX < 0x02020000
-# if defined(_MSC_VER) || defined(__BORLANDC__) || defined(_WATCOM)
-#  define PyOS_snprintf _snprintf
-# else
-#  define PyOS_snprintf snprintf
-# endif
+  const char *chars;
+  *pbytes = PyUnicode_AsUTF8String(str);
+  chars = *pbytes ? PyBytes_AsString(*pbytes) : NULL;
+  if (chars && psize)
+    *psize = PyBytes_Size(*pbytes);
+  return chars;
 #endif
-
-/* A crude PyBytes_FromFormat implementation for old Pythons */
-#if PY_VERSION_HEX < 0x02020000
-
-#ifndef SWIG_PYBUFFER_SIZE
-# define SWIG_PYBUFFER_SIZE 1024
-#endif
-
-static PyObject *
-PyBytes_FromFormat(const char *fmt, ...)
-{
-    va_list ap;
-    char buf[SWIG_PYBUFFER_SIZE * 2];
-    int res;
-    va_start(ap, fmt);
-    res = vsnprintf(buf, sizeof(buf), fmt, ap);
-    va_end(ap);
-    return (res < 0 || res >= (int)sizeof(buf)) ? 0 : PyBytes_FromString(buf);
 }
-#endif
-
-/* Add PyObject_Del for old Pythons */
-#if PY_VERSION_HEX < 0x01060000
-# define PyObject_Del(op) PyMem_DEL((op))
-#endif
-#ifndef PyObject_DEL
-# define PyObject_DEL PyObject_Del
-#endif
-
-/* A crude PyExc_StopIteration exception for old Pythons */
-#if PY_VERSION_HEX < 0x02020000
-# ifndef PyExc_StopIteration
-#  define PyExc_StopIteration PyExc_RuntimeError
-# endif
-# ifndef PyObject_GenericGetAttr
-#  define PyObject_GenericGetAttr 0
-# endif
-#endif
-
-/* Py_NotImplemented is defined in 2.1 and up. */
-#if PY_VERSION_HEX < 0x02010000
-# ifndef Py_NotImplemented
-#  define Py_NotImplemented PyExc_RuntimeError
-# endif
-#endif
 
-/* A crude PyBytes_AsStringAndSize implementation for old Pythons */
-#if PY_VERSION_HEX < 0x02010000
-# ifndef PyBytes_AsStringAndSize
-#  define PyBytes_AsStringAndSize(obj, s, len) {*s = PyBytes_AsString(obj); *len = *s ? strlen(*s) : 0;}
-# endif
-#endif
+#define SWIG_RUNTIME_MODULE "swig_runtime_data" SWIG_RUNTIME_VERSION
 
-/* PySequence_Size for old Pythons */
-#if PY_VERSION_HEX < 0x02000000
-# ifndef PySequence_Size
-#  define PySequence_Size PySequence_Length
-# endif
+/* SWIGPY_USE_CAPSULE is no longer used within SWIG itself, but some user interface files check for it. */
+# define SWIGPY_USE_CAPSULE
+#ifdef SWIGPYTHON_BUILTIN
+# define SWIGPY_CAPSULE_ATTR_NAME "type_pointer_capsule_builtin" SWIG_TYPE_TABLE_NAME
+#else
+# define SWIGPY_CAPSULE_ATTR_NAME "type_pointer_capsule" SWIG_TYPE_TABLE_NAME
+#endif
+#define SWIGPY_CAPSULE_NAME SWIG_RUNTIME_MODULE "." SWIGPY_CAPSULE_ATTR_NAME
+
+#if defined(Py_LIMITED_API)
+# define PyTuple_GET_ITEM PyTuple_GetItem
+/* Note that PyTuple_SetItem() has different semantics from PyTuple_SET_ITEM as it decref's the original tuple item, so in general they cannot be used
+  interchangeably. However in SWIG-generated code PyTuple_SET_ITEM is only used with newly initialized tuples without any items and for them this does work. */
+# define PyTuple_SET_ITEM PyTuple_SetItem
+# define PyTuple_GET_SIZE PyTuple_Size
+# define PyCFunction_GET_FLAGS PyCFunction_GetFlags
+# define PyCFunction_GET_FUNCTION PyCFunction_GetFunction
+# define PyCFunction_GET_SELF PyCFunction_GetSelf
+# define PyList_GET_ITEM PyList_GetItem
+# define PyList_SET_ITEM PyList_SetItem
+# define PySliceObject PyObject
+#endif
+
+/* Increment and Decrement wrappers - for portability when using the stable abi and for performance otherwise */
+#ifdef Py_LIMITED_API
+# define SWIG_Py_INCREF Py_IncRef
+# define SWIG_Py_XINCREF Py_IncRef
+# define SWIG_Py_DECREF Py_DecRef
+# define SWIG_Py_XDECREF Py_DecRef
+#else
+# define SWIG_Py_INCREF Py_INCREF
+# define SWIG_Py_XINCREF Py_XINCREF
+# define SWIG_Py_DECREF Py_DECREF
+# define SWIG_Py_XDECREF Py_XDECREF
 #endif
 
-/* PyBool_FromLong for old Pythons */
-#if PY_VERSION_HEX < 0x02030000
-static
-PyObject *PyBool_FromLong(long ok)
-{
-    PyObject *result = ok ? Py_True : Py_False;
-    Py_INCREF(result);
-    return result;
-}
-#endif
-
-/* Py_ssize_t for old Pythons */
-/* This code is as recommended by: */
-/* http://www.python.org/dev/peps/pep-0353/#conversion-guidelines */
-#if PY_VERSION_HEX < 0x02050000 && !defined(PY_SSIZE_T_MIN)
-typedef int Py_ssize_t;
-# define PY_SSIZE_T_MAX INT_MAX
-# define PY_SSIZE_T_MIN INT_MIN
-typedef inquiry lenfunc;
-typedef intargfunc ssizeargfunc;
-typedef intintargfunc ssizessizeargfunc;
-typedef intobjargproc ssizeobjargproc;
-typedef intintobjargproc ssizessizeobjargproc;
-typedef getreadbufferproc readbufferproc;
-typedef getwritebufferproc writebufferproc;
-typedef getsegcountproc segcountproc;
-typedef getcharbufferproc charbufferproc;
-static long PyNumber_AsSsize_t (PyObject *x, void *SWIGUNUSEDPARM(exc))
-{
-    long result = 0;
-    PyObject *i = PyNumber_Int(x);
-    if (i) {
-        result = PyInt_AsLong(i);
-        Py_DECREF(i);
+#if (PY_VERSION_HEX >= 0x030d00a6) && (!defined(Py_LIMITED_API) || Py_LIMITED_API+0 >= 0x030d00a6)
+# define SWIG_PyType_GetFullyQualifiedName PyType_GetFullyQualifiedName
+#else
+SWIGINTERN PyObject *
+SWIG_PyType_GetFullyQualifiedName(PyTypeObject *type) {
+  PyObject *result = NULL;
+  PyObject *qualname = PyObject_GetAttrString((PyObject *)type, "__qualname__");
+  if (qualname) {
+    PyObject *mod = PyObject_GetAttrString((PyObject *)type, "__module__");
+    if (mod) {
+      if (PyUnicode_Check(mod) && PyUnicode_CompareWithASCIIString(mod, "builtins") && PyUnicode_CompareWithASCIIString(mod, "__main__")) {
+        result = PyUnicode_FromFormat("%U%c%U", mod, '.', qualname);
+        SWIG_Py_DECREF(qualname);
+      } else {
+        result = qualname;
+      }
+      SWIG_Py_DECREF(mod);
+    } else {
+      result = qualname;
     }
-    return result;
-}
-#endif
-
-#if PY_VERSION_HEX < 0x02050000
-#define PyInt_FromSize_t(x) PyInt_FromLong((long)x)
-#endif
-
-#if PY_VERSION_HEX < 0x02040000
-#define Py_VISIT(op)                \
-  do {                      \
-    if (op) {                   \
-      int vret = visit((op), arg);      \
-      if (vret)                 \
-        return vret;                \
-    }                       \
-  } while (0)
-#endif
+  }
 
-#if PY_VERSION_HEX < 0x02030000
-typedef struct {
-    PyTypeObject type;
-    PyNumberMethods as_number;
-    PyMappingMethods as_mapping;
-    PySequenceMethods as_sequence;
-    PyBufferProcs as_buffer;
-    PyObject *name, *slots;
-} PyHeapTypeObject;
+  return result;
+}
 #endif
 
-#if PY_VERSION_HEX < 0x02030000
-typedef destructor freefunc;
+/* gh-114329 added PyList_GetItemRef() to Python 3.13.0a4 */
+#if (PY_VERSION_HEX >= 0x030d00a4) && (!defined(Py_LIMITED_API) || Py_LIMITED_API+0 >= 0x030d00a4)
+# define SWIG_PyList_GetItemRef PyList_GetItemRef
+#else
+SWIGINTERN PyObject *
+SWIG_PyList_GetItemRef(PyObject *op, Py_ssize_t index) {
+  PyObject *item = PyList_GetItem(op, index);
+  Py_XINCREF(item);
+  return item;
+}
 #endif
 
-#if ((PY_MAJOR_VERSION == 2 && PY_MINOR_VERSION > 6) || \
-     (PY_MAJOR_VERSION == 3 && PY_MINOR_VERSION > 0) || \
-     (PY_MAJOR_VERSION > 3))
-# define SWIGPY_USE_CAPSULE
-# define SWIGPY_CAPSULE_NAME ((char*)"swig_runtime_data" SWIG_RUNTIME_VERSION ".type_pointer_capsule" SWIG_TYPE_TABLE_NAME)
-#endif
+/* gh-106004 added PyDict_GetItemRef() and PyDict_GetItemStringRef() to Python 3.13.0a1
+   functions are renamed here for compatibility with abi3audit */
+#if (PY_VERSION_HEX >= 0x030d00a1) && (!defined(Py_LIMITED_API) || Py_LIMITED_API+0 >= 0x030d00a1)
+# define SWIG_PyDict_GetItemRef PyDict_GetItemRef
+# define SWIG_PyDict_GetItemStringRef PyDict_GetItemStringRef
+#else
+SWIGINTERN int
+SWIG_PyDict_GetItemRef(PyObject *mp, PyObject *key, PyObject **result) {
+  PyObject *item = PyDict_GetItemWithError(mp, key);
+  if (item != NULL) {
+    *result = (PyObject *)(item);
+    SWIG_Py_INCREF(*result);
+    return 1;
+  }
+  if (!PyErr_Occurred()) {
+    *result = NULL;
+    return 0;
+  }
+  *result = NULL;
+  return -1;
+}
 
-#if PY_VERSION_HEX < 0x03020000
-#define PyDescr_TYPE(x) (((PyDescrObject *)(x))->d_type)
-#define PyDescr_NAME(x) (((PyDescrObject *)(x))->d_name)
+SWIGINTERN int
+SWIG_PyDict_GetItemStringRef(PyObject *mp, const char *key, PyObject **result) {
+  int res;
+  PyObject *key_obj = PyUnicode_FromString(key);
+  if (key_obj == NULL) {
+    *result = NULL;
+    return -1;
+  }
+  res = SWIG_PyDict_GetItemRef(mp, key_obj, result);
+  Py_DECREF(key_obj);
+  return res;
+}
 #endif
 
 /* -----------------------------------------------------------------------------
@@ -1014,72 +1063,108 @@ typedef destructor freefunc;
  * ----------------------------------------------------------------------------- */
 
 SWIGRUNTIME PyObject*
-SWIG_Python_ErrorType(int code)
-{
-    PyObject* type = 0;
-    switch (code) {
-    case SWIG_MemoryError:
-        type = PyExc_MemoryError;
-        break;
-    case SWIG_IOError:
-        type = PyExc_IOError;
-        break;
-    case SWIG_RuntimeError:
-        type = PyExc_RuntimeError;
-        break;
-    case SWIG_IndexError:
-        type = PyExc_IndexError;
-        break;
-    case SWIG_TypeError:
-        type = PyExc_TypeError;
-        break;
-    case SWIG_DivisionByZero:
-        type = PyExc_ZeroDivisionError;
-        break;
-    case SWIG_OverflowError:
-        type = PyExc_OverflowError;
-        break;
-    case SWIG_SyntaxError:
-        type = PyExc_SyntaxError;
-        break;
-    case SWIG_ValueError:
-        type = PyExc_ValueError;
-        break;
-    case SWIG_SystemError:
-        type = PyExc_SystemError;
-        break;
-    case SWIG_AttributeError:
-        type = PyExc_AttributeError;
-        break;
-    default:
-        type = PyExc_RuntimeError;
-    }
-    return type;
+SWIG_Python_ErrorType(int code) {
+  PyObject* type = 0;
+  switch(code) {
+  case SWIG_MemoryError:
+    type = PyExc_MemoryError;
+    break;
+  case SWIG_IOError:
+    type = PyExc_IOError;
+    break;
+  case SWIG_RuntimeError:
+    type = PyExc_RuntimeError;
+    break;
+  case SWIG_IndexError:
+    type = PyExc_IndexError;
+    break;
+  case SWIG_TypeError:
+    type = PyExc_TypeError;
+    break;
+  case SWIG_DivisionByZero:
+    type = PyExc_ZeroDivisionError;
+    break;
+  case SWIG_OverflowError:
+    type = PyExc_OverflowError;
+    break;
+  case SWIG_SyntaxError:
+    type = PyExc_SyntaxError;
+    break;
+  case SWIG_ValueError:
+    type = PyExc_ValueError;
+    break;
+  case SWIG_SystemError:
+    type = PyExc_SystemError;
+    break;
+  case SWIG_AttributeError:
+    type = PyExc_AttributeError;
+    break;
+  case SWIG_NullReferenceError:
+    type = PyExc_TypeError;
+    break;
+  default:
+    type = PyExc_RuntimeError;
+  }
+  return type;
 }
 
 
 SWIGRUNTIME void
 SWIG_Python_AddErrorMsg(const char* mesg)
 {
-    PyObject *type = 0;
-    PyObject *value = 0;
-    PyObject *traceback = 0;
+  PyObject *type = 0;
+  PyObject *value = 0;
+  PyObject *traceback = 0;
+
+  if (PyErr_Occurred())
+    PyErr_Fetch(&type, &value, &traceback);
+  if (value) {
+    PyObject *old_str = PyObject_Str(value);
+    PyObject *bytes = NULL;
+    const char *tmp = SWIG_PyUnicode_AsUTF8AndSize(old_str, NULL, &bytes);
+    PyErr_Clear();
+    SWIG_Py_XINCREF(type);
+    if (tmp)
+      PyErr_Format(type, "%s %s", tmp, mesg);
+    else
+      PyErr_Format(type, "%s", mesg);
+    SWIG_Py_XDECREF(bytes);
+    SWIG_Py_DECREF(old_str);
+    SWIG_Py_DECREF(value);
+  } else {
+    PyErr_SetString(PyExc_RuntimeError, mesg);
+  }
+}
 
-    if (PyErr_Occurred()) { PyErr_Fetch(&type, &value, &traceback); }
-    if (value) {
-        char *tmp;
-        PyObject *old_str = PyObject_Str(value);
-        PyErr_Clear();
-        Py_XINCREF(type);
-
-        PyErr_Format(type, "%s %s", tmp = SWIG_Python_str_AsChar(old_str), mesg);
-        SWIG_Python_str_DelForPy3(tmp);
-        Py_DECREF(old_str);
-        Py_DECREF(value);
-    }
-    else {
-        PyErr_SetString(PyExc_RuntimeError, mesg);
+SWIGRUNTIME int
+SWIG_Python_TypeErrorOccurred(PyObject *obj)
+{
+  PyObject *error;
+  if (obj)
+    return 0;
+  error = PyErr_Occurred();
+  return error && PyErr_GivenExceptionMatches(error, PyExc_TypeError);
+}
+
+SWIGRUNTIME void
+SWIG_Python_RaiseOrModifyTypeError(const char *message)
+{
+  if (SWIG_Python_TypeErrorOccurred(NULL)) {
+    /* Use existing TypeError to preserve stacktrace and enhance with given message */
+    PyObject *newvalue;
+    PyObject *type = NULL, *value = NULL, *traceback = NULL;
+    PyErr_Fetch(&type, &value, &traceback);
+    newvalue = PyUnicode_FromFormat("%S\nAdditional information:\n%s", value, message);
+    if (newvalue) {
+      SWIG_Py_XDECREF(value);
+      PyErr_Restore(type, newvalue, traceback);
+    } else {
+      PyErr_Restore(type, value, traceback);
     }
+  } else {
+    /* Raise TypeError using given message */
+    PyErr_SetString(PyExc_TypeError, message);
+  }
 }
 
 #if defined(SWIG_PYTHON_NO_THREADS)
@@ -1089,31 +1174,33 @@ SWIG_Python_AddErrorMsg(const char* mesg)
 #endif
 #if defined(SWIG_PYTHON_THREADS) /* Threading support is enabled */
 #  if !defined(SWIG_PYTHON_USE_GIL) && !defined(SWIG_PYTHON_NO_USE_GIL)
-#    if (PY_VERSION_HEX >= 0x02030000) /* For 2.3 or later, use the PyGILState calls */
-#      define SWIG_PYTHON_USE_GIL
-#    endif
+#    define SWIG_PYTHON_USE_GIL
 #  endif
 #  if defined(SWIG_PYTHON_USE_GIL) /* Use PyGILState threads calls */
-#    ifndef SWIG_PYTHON_INITIALIZE_THREADS
-#     define SWIG_PYTHON_INITIALIZE_THREADS  PyEval_InitThreads()
+#    if !defined(SWIG_PYTHON_INITIALIZE_THREADS)
+#      if PY_VERSION_HEX < 0x03070000
+#        define SWIG_PYTHON_INITIALIZE_THREADS PyEval_InitThreads()
+#      else
+#        define SWIG_PYTHON_INITIALIZE_THREADS
+#      endif
 #    endif
 #    ifdef __cplusplus /* C++ code */
-class SWIG_Python_Thread_Block {
-    bool status;
-    PyGILState_STATE state;
-public:
-    void end() { if (status) { PyGILState_Release(state); status = false;} }
-    SWIG_Python_Thread_Block() : status(true), state(PyGILState_Ensure()) {}
-    ~SWIG_Python_Thread_Block() { end(); }
-};
-class SWIG_Python_Thread_Allow {
-    bool status;
-    PyThreadState *save;
-public:
-    void end() { if (status) { PyEval_RestoreThread(save); status = false; }}
-    SWIG_Python_Thread_Allow() : status(true), save(PyEval_SaveThread()) {}
-    ~SWIG_Python_Thread_Allow() { end(); }
-};
+       class SWIG_Python_Thread_Block {
+         bool status;
+         PyGILState_STATE state;
+       public:
+         void end() { if (status) { PyGILState_Release(state); status = false;} }
+         SWIG_Python_Thread_Block() : status(true), state(PyGILState_Ensure()) {}
+         ~SWIG_Python_Thread_Block() { end(); }
+       };
+       class SWIG_Python_Thread_Allow {
+         bool status;
+         PyThreadState *save;
+       public:
+         void end() { if (status) { status = false; PyEval_RestoreThread(save); }}
+         SWIG_Python_Thread_Allow() : status(true), save(PyEval_SaveThread()) {}
+         ~SWIG_Python_Thread_Allow() { end(); }
+       };
 #      define SWIG_PYTHON_THREAD_BEGIN_BLOCK   SWIG_Python_Thread_Block _swig_thread_block
 #      define SWIG_PYTHON_THREAD_END_BLOCK     _swig_thread_block.end()
 #      define SWIG_PYTHON_THREAD_BEGIN_ALLOW   SWIG_Python_Thread_Allow _swig_thread_allow
@@ -1167,31 +1254,14 @@ extern "C" {
 
 /* Constant information structure */
 typedef struct swig_const_info {
-    int type;
-    char *name;
-    long lvalue;
-    double dvalue;
-    void   *pvalue;
-    swig_type_info **ptype;
+  int type;
+  const char *name;
+  long lvalue;
+  double dvalue;
+  void   *pvalue;
+  swig_type_info **ptype;
 } swig_const_info;
 
-
-/* -----------------------------------------------------------------------------
- * Wrapper of PyInstanceMethod_New() used in Python 3
- * It is exported to the generated module, used for -fastproxy
- * ----------------------------------------------------------------------------- */
-#if PY_VERSION_HEX >= 0x03000000
-SWIGRUNTIME PyObject* SWIG_PyInstanceMethod_New(PyObject *SWIGUNUSEDPARM(self), PyObject *func)
-{
-    return PyInstanceMethod_New(func);
-}
-#else
-SWIGRUNTIME PyObject* SWIG_PyInstanceMethod_New(PyObject *SWIGUNUSEDPARM(self), PyObject *SWIGUNUSEDPARM(func))
-{
-    return NULL;
-}
-#endif
-
 #ifdef __cplusplus
 }
 #endif
@@ -1206,6 +1276,10 @@ SWIGRUNTIME PyObject* SWIG_PyInstanceMethod_New(PyObject *SWIGUNUSEDPARM(self),
  *
  * ----------------------------------------------------------------------------- */
 
+#if PY_VERSION_HEX < 0x03050000
+# error "This version of SWIG only supports Python >= 3.5"
+#endif
+
 /* Common SWIG API */
 
 /* for raw pointers */
@@ -1219,9 +1293,9 @@ SWIGRUNTIME PyObject* SWIG_PyInstanceMethod_New(PyObject *SWIGUNUSEDPARM(self),
 #define SWIG_NewPointerObj(ptr, type, flags)            SWIG_Python_NewPointerObj(NULL, ptr, type, flags)
 #endif
 
-#define SWIG_InternalNewPointerObj(ptr, type, flags)    SWIG_Python_NewPointerObj(NULL, ptr, type, flags)
+#define SWIG_InternalNewPointerObj(ptr, type, flags)	SWIG_Python_NewPointerObj(NULL, ptr, type, flags)
 
-#define SWIG_CheckImplicit(ty)                          SWIG_Python_CheckImplicit(ty)
+#define SWIG_CheckImplicit(ty)                          SWIG_Python_CheckImplicit(ty) 
 #define SWIG_AcquirePtr(ptr, src)                       SWIG_Python_AcquirePtr(ptr, src)
 #define swig_owntype                                    int
 
@@ -1248,32 +1322,29 @@ SWIGRUNTIME PyObject* SWIG_PyInstanceMethod_New(PyObject *SWIGUNUSEDPARM(self),
 #define SWIG_SetModule(clientdata, pointer)             SWIG_Python_SetModule(pointer)
 #define SWIG_NewClientData(obj)                         SwigPyClientData_New(obj)
 
-#define SWIG_SetErrorObj                                SWIG_Python_SetErrorObj
-#define SWIG_SetErrorMsg                            SWIG_Python_SetErrorMsg
-#define SWIG_ErrorType(code)                        SWIG_Python_ErrorType(code)
-#define SWIG_Error(code, msg)                   SWIG_Python_SetErrorMsg(SWIG_ErrorType(code), msg)
-#define SWIG_fail                               goto fail
-
+#define SWIG_SetErrorObj                                SWIG_Python_SetErrorObj                            
+#define SWIG_SetErrorMsg                        	SWIG_Python_SetErrorMsg				   
+#define SWIG_ErrorType(code)                    	SWIG_Python_ErrorType(code)                        
+#define SWIG_Error(code, msg)            		SWIG_Python_SetErrorMsg(SWIG_ErrorType(code), msg) 
+#define SWIG_fail                        		goto fail					   
 
 /* Runtime API implementation */
 
 /* Error manipulation */
 
-SWIGINTERN void
-SWIG_Python_SetErrorObj(PyObject *errtype, PyObject *obj)
-{
-    SWIG_PYTHON_THREAD_BEGIN_BLOCK;
-    PyErr_SetObject(errtype, obj);
-    Py_DECREF(obj);
-    SWIG_PYTHON_THREAD_END_BLOCK;
+SWIGINTERN void 
+SWIG_Python_SetErrorObj(PyObject *errtype, PyObject *obj) {
+  SWIG_PYTHON_THREAD_BEGIN_BLOCK; 
+  PyErr_SetObject(errtype, obj);
+  SWIG_Py_DECREF(obj);
+  SWIG_PYTHON_THREAD_END_BLOCK;
 }
 
-SWIGINTERN void
-SWIG_Python_SetErrorMsg(PyObject *errtype, const char *msg)
-{
-    SWIG_PYTHON_THREAD_BEGIN_BLOCK;
-    PyErr_SetString(errtype, msg);
-    SWIG_PYTHON_THREAD_END_BLOCK;
+SWIGINTERN void 
+SWIG_Python_SetErrorMsg(PyObject *errtype, const char *msg) {
+  SWIG_PYTHON_THREAD_BEGIN_BLOCK;
+  PyErr_SetString(errtype, msg);
+  SWIG_PYTHON_THREAD_END_BLOCK;
 }
 
 #define SWIG_Python_Raise(obj, type, desc)  SWIG_Python_SetErrorObj(SWIG_Python_ExceptionType(desc), obj)
@@ -1283,150 +1354,138 @@ SWIG_Python_SetErrorMsg(PyObject *errtype, const char *msg)
 #if defined(SWIGPYTHON_BUILTIN)
 
 SWIGINTERN void
-SwigPyBuiltin_AddPublicSymbol(PyObject *seq, const char *key)
-{
-    PyObject *s = PyBytes_InternFromString(key);
-    PyList_Append(seq, s);
-    Py_DECREF(s);
+SwigPyBuiltin_AddPublicSymbol(PyObject *seq, const char *key) {
+  PyObject *s = PyUnicode_InternFromString(key);
+  PyList_Append(seq, s);
+  SWIG_Py_DECREF(s);
 }
 
 SWIGINTERN void
-SWIG_Python_SetConstant(PyObject *d, PyObject *public_interface, const char *name, PyObject *obj)
-{
-#if PY_VERSION_HEX < 0x02030000
-    PyDict_SetItemString(d, (char *)name, obj);
-#else
-    PyDict_SetItemString(d, name, obj);
-#endif
-    Py_DECREF(obj);
-    if (public_interface) {
-        SwigPyBuiltin_AddPublicSymbol(public_interface, name);
-    }
+SWIG_Python_SetConstant(PyObject *d, PyObject *public_interface, const char *name, PyObject *obj) {   
+  PyDict_SetItemString(d, name, obj);
+  SWIG_Py_DECREF(obj);
+  if (public_interface)
+    SwigPyBuiltin_AddPublicSymbol(public_interface, name);
 }
 
 #else
 
 SWIGINTERN void
-SWIG_Python_SetConstant(PyObject *d, const char *name, PyObject *obj)
-{
-#if PY_VERSION_HEX < 0x02030000
-    PyDict_SetItemString(d, (char *)name, obj);
-#else
-    PyDict_SetItemString(d, name, obj);
-#endif
-    Py_DECREF(obj);
+SWIG_Python_SetConstant(PyObject *d, const char *name, PyObject *obj) {   
+  PyDict_SetItemString(d, name, obj);
+  SWIG_Py_DECREF(obj);
 }
 
 #endif
 
-/* Append a value to the result obj */
+/* SWIG runtime data Python module */
+static PyObject *Swig_runtime_data_module_global = NULL;
 
-SWIGINTERN PyObject*
-SWIG_Python_AppendOutput(PyObject* result, PyObject* obj)
-{
-#if !defined(SWIG_PYTHON_OUTPUT_TUPLE)
-    if (!result) {
-        result = obj;
-    }
-    else if (result == Py_None) {
-        Py_DECREF(result);
-        result = obj;
-    }
-    else {
-        if (!PyList_Check(result)) {
-            PyObject *o2 = result;
-            result = PyList_New(1);
-            PyList_SetItem(result, 0, o2);
-        }
-        PyList_Append(result, obj);
-        Py_DECREF(obj);
-    }
-    return result;
+/* Create/obtain the single swig_runtime_data module which is used across different SWIG generated modules */
+SWIGINTERN PyObject *
+SWIG_runtime_data_module(void) {
+  if (!Swig_runtime_data_module_global) {
+#if (PY_VERSION_HEX >= 0x030d0000) && (!defined(Py_LIMITED_API) || Py_LIMITED_API+0 >= 0x030d0000)
+    /* free-threading note: the GIL is always enabled when this function is first called
+       by SWIG_init, so there's no risk of race conditions */
+    Swig_runtime_data_module_global = PyImport_AddModuleRef(SWIG_RUNTIME_MODULE);
 #else
-    PyObject*   o2;
-    PyObject*   o3;
-    if (!result) {
-        result = obj;
-    }
-    else if (result == Py_None) {
-        Py_DECREF(result);
-        result = obj;
-    }
-    else {
-        if (!PyTuple_Check(result)) {
-            o2 = result;
-            result = PyTuple_New(1);
-            PyTuple_SET_ITEM(result, 0, o2);
-        }
-        o3 = PyTuple_New(1);
-        PyTuple_SET_ITEM(o3, 0, obj);
-        o2 = result;
-        result = PySequence_Concat(o2, o3);
-        Py_DECREF(o2);
-        Py_DECREF(o3);
-    }
-    return result;
+    Swig_runtime_data_module_global = PyImport_AddModule(SWIG_RUNTIME_MODULE);
+    SWIG_Py_XINCREF(Swig_runtime_data_module_global);
 #endif
+  }
+  assert(Swig_runtime_data_module_global);
+  return Swig_runtime_data_module_global;
+}
+
+/* Append a value to the result obj */
+SWIGINTERN PyObject*
+SWIG_Python_AppendOutput(PyObject* result, PyObject* obj, int is_void) {
+  if (!result) {
+    result = obj;
+  } else if (result == Py_None && is_void) {
+    SWIG_Py_DECREF(result);
+    result = obj;
+  } else {
+    if (!PyList_Check(result)) {
+      PyObject *o2 = result;
+      result = PyList_New(1);
+      if (result) {
+        PyList_SET_ITEM(result, 0, o2);
+      } else {
+        SWIG_Py_DECREF(obj);
+        return o2;
+      }
+    }
+    PyList_Append(result,obj);
+    SWIG_Py_DECREF(obj);
+  }
+  return result;
 }
 
 /* Unpack the argument tuple */
 
-SWIGINTERN int
+SWIGINTERN Py_ssize_t
 SWIG_Python_UnpackTuple(PyObject *args, const char *name, Py_ssize_t min, Py_ssize_t max, PyObject **objs)
 {
-    if (!args) {
-        if (!min && !max) {
-            return 1;
-        }
-        else {
-            PyErr_Format(PyExc_TypeError, "%s expected %s%d arguments, got none",
-                         name, (min == max ? "" : "at least "), (int)min);
-            return 0;
-        }
-    }
-    if (!PyTuple_Check(args)) {
-        if (min <= 1 && max >= 1) {
-            register int i;
-            objs[0] = args;
-            for (i = 1; i < max; ++i) {
-                objs[i] = 0;
-            }
-            return 2;
-        }
-        PyErr_SetString(PyExc_SystemError, "UnpackTuple() argument list is not a tuple");
-        return 0;
+  if (!args) {
+    if (!min && !max) {
+      return 1;
+    } else {
+      PyErr_Format(PyExc_TypeError, "%s expected %s%d arguments, got none", 
+		   name, (min == max ? "" : "at least "), (int)min);
+      return 0;
+    }
+  }  
+  if (!PyTuple_Check(args)) {
+    if (min <= 1 && max >= 1) {
+      Py_ssize_t i;
+      objs[0] = args;
+      for (i = 1; i < max; ++i) {
+	objs[i] = 0;
+      }
+      return 2;
     }
-    else {
-        register Py_ssize_t l = PyTuple_GET_SIZE(args);
-        if (l < min) {
-            PyErr_Format(PyExc_TypeError, "%s expected %s%d arguments, got %d",
-                         name, (min == max ? "" : "at least "), (int)min, (int)l);
-            return 0;
-        }
-        else if (l > max) {
-            PyErr_Format(PyExc_TypeError, "%s expected %s%d arguments, got %d",
-                         name, (min == max ? "" : "at most "), (int)max, (int)l);
-            return 0;
-        }
-        else {
-            register int i;
-            for (i = 0; i < l; ++i) {
-                objs[i] = PyTuple_GET_ITEM(args, i);
-            }
-            for (; l < max; ++l) {
-                objs[l] = 0;
-            }
-            return i + 1;
-        }
+    PyErr_SetString(PyExc_SystemError, "UnpackTuple() argument list is not a tuple");
+    return 0;
+  } else {
+    Py_ssize_t l = PyTuple_GET_SIZE(args);
+    if (l < min) {
+      PyErr_Format(PyExc_TypeError, "%s expected %s%d arguments, got %d", 
+		   name, (min == max ? "" : "at least "), (int)min, (int)l);
+      return 0;
+    } else if (l > max) {
+      PyErr_Format(PyExc_TypeError, "%s expected %s%d arguments, got %d", 
+		   name, (min == max ? "" : "at most "), (int)max, (int)l);
+      return 0;
+    } else {
+      Py_ssize_t i;
+      for (i = 0; i < l; ++i) {
+	objs[i] = PyTuple_GET_ITEM(args, i);
+      }
+      for (; l < max; ++l) {
+	objs[l] = 0;
+      }
+      return i + 1;
+    }    
+  }
+}
+
+SWIGINTERN int
+SWIG_Python_CheckNoKeywords(PyObject *kwargs, const char *name) {
+  int no_kwargs = 1;
+  if (kwargs) {
+    assert(PyDict_Check(kwargs));
+    if (PyDict_Size(kwargs) > 0) {
+      PyErr_Format(PyExc_TypeError, "%s() does not take keyword arguments", name);
+      no_kwargs = 0;
     }
+  }
+  return no_kwargs;
 }
 
 /* A functor is a function object with one single object argument */
-#if PY_VERSION_HEX >= 0x02020000
-#define SWIG_Python_CallFunctor(functor, obj)           PyObject_CallFunctionObjArgs(functor, obj, NULL);
-#else
-#define SWIG_Python_CallFunctor(functor, obj)           PyObject_CallFunction(functor, "O", obj);
-#endif
+#define SWIG_Python_CallFunctor(functor, obj)	        PyObject_CallFunctionObjArgs(functor, obj, NULL);
 
 /*
   Helper for static pointer initialization for both C and C++ code, for example
@@ -1438,6 +1497,256 @@ SWIG_Python_UnpackTuple(PyObject *args, const char *name, Py_ssize_t min, Py_ssi
 #define SWIG_STATIC_POINTER(var)  var = 0; if (!var) var
 #endif
 
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+/* Python-specific SWIG API */
+#define SWIG_newvarlink()                             SWIG_Python_newvarlink()
+#define SWIG_addvarlink(p, name, get_attr, set_attr)  SWIG_Python_addvarlink(p, name, get_attr, set_attr)
+#define SWIG_InstallConstants(d, constants)           SWIG_Python_InstallConstants(d, constants)
+ 
+/* -----------------------------------------------------------------------------
+ * global variable support code.
+ * ----------------------------------------------------------------------------- */
+ 
+typedef struct swig_globalvar {   
+  char       *name;                  /* Name of global variable */
+  PyObject *(*get_attr)(void);       /* Return the current value */
+  int       (*set_attr)(PyObject *); /* Set the value */
+  struct swig_globalvar *next;
+} swig_globalvar;
+
+typedef struct swig_varlinkobject {
+  PyObject_HEAD
+  swig_globalvar *vars;
+} swig_varlinkobject;
+
+SWIGINTERN PyObject *
+SwigVarLink_repr(PyObject *SWIGUNUSEDPARM(v)) {
+  return PyUnicode_InternFromString("<Swig global variables>");
+}
+
+SWIGINTERN PyObject *
+SwigVarLink_str(PyObject *o) {
+  swig_varlinkobject *v = (swig_varlinkobject *) o;
+  PyObject *str = PyUnicode_InternFromString("(");
+  PyObject *tail;
+  PyObject *joined;
+  swig_globalvar *var;
+  for (var = v->vars; var; var=var->next) {
+    tail = PyUnicode_FromString(var->name);
+    joined = PyUnicode_Concat(str, tail);
+    SWIG_Py_DECREF(str);
+    SWIG_Py_DECREF(tail);
+    str = joined;
+    if (var->next) {
+        tail = PyUnicode_InternFromString(", ");
+        joined = PyUnicode_Concat(str, tail);
+        SWIG_Py_DECREF(str);
+        SWIG_Py_DECREF(tail);
+        str = joined;
+    }
+  }
+  tail = PyUnicode_InternFromString(")");
+  joined = PyUnicode_Concat(str, tail);
+  SWIG_Py_DECREF(str);
+  SWIG_Py_DECREF(tail);
+  str = joined;
+  return str;
+}
+
+SWIGINTERN void
+SwigVarLink_dealloc(PyObject *o) {
+  swig_varlinkobject *v = (swig_varlinkobject *) o;
+  swig_globalvar *var = v->vars;
+  while (var) {
+    swig_globalvar *n = var->next;
+    free(var->name);
+    free(var);
+    var = n;
+  }
+}
+
+SWIGINTERN PyObject *
+SwigVarLink_getattr(PyObject *o, char *n) {
+  swig_varlinkobject *v = (swig_varlinkobject *) o;
+  PyObject *res = NULL;
+  swig_globalvar *var = v->vars;
+  while (var) {
+    if (strcmp(var->name,n) == 0) {
+      res = (*var->get_attr)();
+      break;
+    }
+    var = var->next;
+  }
+  if (res == NULL && !PyErr_Occurred()) {
+    PyErr_Format(PyExc_AttributeError, "Unknown C global variable '%s'", n);
+  }
+  return res;
+}
+
+SWIGINTERN int
+SwigVarLink_setattr(PyObject *o, char *n, PyObject *p) {
+  swig_varlinkobject *v = (swig_varlinkobject *) o;
+  int res = 1;
+  swig_globalvar *var = v->vars;
+  while (var) {
+    if (strcmp(var->name,n) == 0) {
+      res = (*var->set_attr)(p);
+      break;
+    }
+    var = var->next;
+  }
+  if (res == 1 && !PyErr_Occurred()) {
+    PyErr_Format(PyExc_AttributeError, "Unknown C global variable '%s'", n);
+  }
+  return res;
+}
+
+SWIGINTERN PyTypeObject*
+SwigVarLink_TypeOnce(void) {
+  static char SwigVarLink_doc[] = "Swig variable link object";
+#ifndef SWIG_HEAPTYPES
+  static PyTypeObject varlink_type;
+  static int type_init = 0;
+  if (!type_init) {
+    const PyTypeObject tmp = {
+      PyVarObject_HEAD_INIT(NULL, 0)
+      SWIG_RUNTIME_MODULE ".SwigVarLink", /* tp_name */
+      sizeof(swig_varlinkobject),         /* tp_basicsize */
+      0,                                  /* tp_itemsize */
+      (destructor) SwigVarLink_dealloc,   /* tp_dealloc */
+#if PY_VERSION_HEX < 0x030800b4
+      (printfunc)0,                       /* tp_print */
+#else
+      (Py_ssize_t)0,                      /* tp_vectorcall_offset */
+#endif
+      (getattrfunc) SwigVarLink_getattr,  /* tp_getattr */
+      (setattrfunc) SwigVarLink_setattr,  /* tp_setattr */
+      0,                                  /* tp_compare */
+      (reprfunc) SwigVarLink_repr,        /* tp_repr */
+      0,                                  /* tp_as_number */
+      0,                                  /* tp_as_sequence */
+      0,                                  /* tp_as_mapping */
+      0,                                  /* tp_hash */
+      0,                                  /* tp_call */
+      (reprfunc) SwigVarLink_str,         /* tp_str */
+      0,                                  /* tp_getattro */
+      0,                                  /* tp_setattro */
+      0,                                  /* tp_as_buffer */
+      0,                                  /* tp_flags */
+      SwigVarLink_doc,                    /* tp_doc */
+      0,                                  /* tp_traverse */
+      0,                                  /* tp_clear */
+      0,                                  /* tp_richcompare */
+      0,                                  /* tp_weaklistoffset */
+      0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0, /* tp_iter -> tp_weaklist */
+      0,                                  /* tp_del */
+      0,                                  /* tp_version_tag */
+      0,                                  /* tp_finalize */
+#if PY_VERSION_HEX >= 0x03080000
+      0,                                  /* tp_vectorcall */
+#endif
+#if (PY_VERSION_HEX >= 0x03080000) && (PY_VERSION_HEX < 0x03090000)
+      0,                                  /* tp_print */
+#endif
+#if PY_VERSION_HEX >= 0x030c0000
+      0,                                  /* tp_watched */
+#endif
+#if PY_VERSION_HEX >= 0x030d00a4
+      0,                                  /* tp_versions_used */
+#endif
+#ifdef COUNT_ALLOCS
+      0,                                  /* tp_allocs */
+      0,                                  /* tp_frees */
+      0,                                  /* tp_maxalloc */
+      0,                                  /* tp_prev */
+      0                                   /* tp_next */
+#endif
+    };
+    PyObject *runtime_data_module = SWIG_runtime_data_module();
+    varlink_type = tmp;
+    type_init = 1;
+    if (PyType_Ready(&varlink_type) < 0)
+      return NULL;
+    if (PyModule_AddObject(runtime_data_module, "SwigVarLink", (PyObject *)&varlink_type) == 0)
+      SWIG_Py_INCREF((PyObject *)&varlink_type);
+  }
+  return &varlink_type;
+#else
+  PyType_Slot slots[] = {
+    { Py_tp_dealloc, (void *)SwigVarLink_dealloc },
+    { Py_tp_repr, (void *)SwigVarLink_repr },
+    { Py_tp_getattr, (void *)SwigVarLink_getattr },
+    { Py_tp_setattr, (void *)SwigVarLink_setattr },
+    { Py_tp_str, (void *)SwigVarLink_str },
+    { Py_tp_doc, (void *)SwigVarLink_doc },
+    { 0, NULL }
+  };
+  PyType_Spec spec = {
+    SWIG_RUNTIME_MODULE ".SwigVarLink",
+    sizeof(swig_varlinkobject),
+    0,
+    Py_TPFLAGS_DEFAULT,
+    slots
+  };
+  PyObject *pytype = PyType_FromSpec(&spec);
+  PyObject *runtime_data_module = SWIG_runtime_data_module();
+  if (pytype && PyModule_AddObject(runtime_data_module, "SwigVarLink", pytype) == 0)
+    SWIG_Py_INCREF(pytype);
+  return (PyTypeObject *)pytype;
+#endif
+}
+
+SWIGRUNTIME PyTypeObject*
+SwigVarLink_Type(void) {
+  static PyTypeObject *SWIG_STATIC_POINTER(type) = SwigVarLink_TypeOnce();
+  return type;
+}
+
+/* Create a variable linking object for use later */
+SWIGINTERN PyObject *
+SWIG_Python_newvarlink(void) {
+  swig_varlinkobject *result = PyObject_New(swig_varlinkobject, SwigVarLink_Type());
+  if (result) {
+    result->vars = 0;
+  }
+  return ((PyObject*) result);
+}
+
+SWIGINTERN void 
+SWIG_Python_addvarlink(PyObject *p, const char *name, PyObject *(*get_attr)(void), int (*set_attr)(PyObject *p)) {
+  swig_varlinkobject *v = (swig_varlinkobject *) p;
+  swig_globalvar *gv = (swig_globalvar *) malloc(sizeof(swig_globalvar));
+  if (gv) {
+    size_t size = strlen(name)+1;
+    gv->name = (char *)malloc(size);
+    if (gv->name) {
+      memcpy(gv->name, name, size);
+      gv->get_attr = get_attr;
+      gv->set_attr = set_attr;
+      gv->next = v->vars;
+    }
+  }
+  v->vars = gv;
+}
+
+
+static PyObject *Swig_Globals_global = NULL;
+  
+SWIGINTERN PyObject *
+SWIG_globals(void) {
+  if (Swig_Globals_global == NULL) {
+    Swig_Globals_global = SWIG_newvarlink();
+  }
+  return Swig_Globals_global;
+}
+
+#ifdef __cplusplus
+}
+#endif
+
 /* -----------------------------------------------------------------------------
  * Pointer declarations
  * ----------------------------------------------------------------------------- */
@@ -1448,245 +1757,237 @@ SWIG_Python_UnpackTuple(PyObject *args, const char *name, Py_ssize_t min, Py_ssi
 
 #define SWIG_POINTER_IMPLICIT_CONV  (SWIG_POINTER_DISOWN   << 1)
 
-#define SWIG_BUILTIN_TP_INIT        (SWIG_POINTER_OWN << 2)
-#define SWIG_BUILTIN_INIT       (SWIG_BUILTIN_TP_INIT | SWIG_POINTER_OWN)
+#define SWIG_BUILTIN_TP_INIT	    (SWIG_POINTER_OWN << 2)
+#define SWIG_BUILTIN_INIT	    (SWIG_BUILTIN_TP_INIT | SWIG_POINTER_OWN)
 
 #ifdef __cplusplus
 extern "C" {
 #endif
 
-/*  How to access Py_None */
-#if defined(_WIN32) || defined(__WIN32__) || defined(__CYGWIN__)
-#  ifndef SWIG_PYTHON_NO_BUILD_NONE
-#    ifndef SWIG_PYTHON_BUILD_NONE
-#      define SWIG_PYTHON_BUILD_NONE
-#    endif
-#  endif
-#endif
-
-#ifdef SWIG_PYTHON_BUILD_NONE
-#  ifdef Py_None
-#   undef Py_None
-#   define Py_None SWIG_Py_None()
-#  endif
-SWIGRUNTIMEINLINE PyObject *
-_SWIG_Py_None(void)
-{
-    PyObject *none = Py_BuildValue((char*)"");
-    Py_DECREF(none);
-    return none;
-}
-SWIGRUNTIME PyObject *
-SWIG_Py_None(void)
-{
-    static PyObject *SWIG_STATIC_POINTER(none) = _SWIG_Py_None();
-    return none;
-}
-#endif
-
 /* The python void return value */
 
-SWIGRUNTIMEINLINE PyObject *
+SWIGRUNTIMEINLINE PyObject * 
 SWIG_Py_Void(void)
 {
-    PyObject *none = Py_None;
-    Py_INCREF(none);
-    return none;
+  PyObject *none = Py_None;
+  SWIG_Py_INCREF(none);
+  return none;
 }
 
 /* SwigPyClientData */
 
 typedef struct {
-    PyObject *klass;
-    PyObject *newraw;
-    PyObject *newargs;
-    PyObject *destroy;
-    int delargs;
-    int implicitconv;
-    PyTypeObject *pytype;
+  PyObject *klass;
+  PyObject *newraw;
+  PyObject *newargs;
+  PyObject *destroy;
+  int delargs;
+  int implicitconv;
+  PyTypeObject *pytype;
 } SwigPyClientData;
 
-SWIGRUNTIMEINLINE int
+SWIGRUNTIMEINLINE int 
 SWIG_Python_CheckImplicit(swig_type_info *ty)
 {
-    SwigPyClientData *data = (SwigPyClientData *)ty->clientdata;
-    return data ? data->implicitconv : 0;
+  SwigPyClientData *data = (SwigPyClientData *)ty->clientdata;
+  int fail = data ? data->implicitconv : 0;
+  if (fail)
+    PyErr_SetString(PyExc_TypeError, "Implicit conversion is prohibited for explicit constructors.");
+  return fail;
 }
 
 SWIGRUNTIMEINLINE PyObject *
-SWIG_Python_ExceptionType(swig_type_info *desc)
-{
-    SwigPyClientData *data = desc ? (SwigPyClientData *) desc->clientdata : 0;
-    PyObject *klass = data ? data->klass : 0;
-    return (klass ? klass : PyExc_RuntimeError);
+SWIG_Python_ExceptionType(swig_type_info *desc) {
+  SwigPyClientData *data = desc ? (SwigPyClientData *) desc->clientdata : 0;
+  PyObject *klass = data ? data->klass : 0;
+  return (klass ? klass : PyExc_RuntimeError);
 }
 
 
-SWIGRUNTIME SwigPyClientData *
+SWIGRUNTIME SwigPyClientData * 
 SwigPyClientData_New(PyObject* obj)
 {
-    if (!obj) {
-        return 0;
-    }
-    else {
-        SwigPyClientData *data = (SwigPyClientData *)malloc(sizeof(SwigPyClientData));
-        /* the klass element */
-        data->klass = obj;
-        Py_INCREF(data->klass);
-        /* the newraw method and newargs arguments used to create a new raw instance */
-        if (PyClass_Check(obj)) {
-            data->newraw = 0;
-            data->newargs = obj;
-            Py_INCREF(obj);
-        }
-        else {
-#if (PY_VERSION_HEX < 0x02020000)
-            data->newraw = 0;
-#else
-            data->newraw = PyObject_GetAttrString(data->klass, (char *)"__new__");
-#endif
-            if (data->newraw) {
-                Py_INCREF(data->newraw);
-                data->newargs = PyTuple_New(1);
-                PyTuple_SetItem(data->newargs, 0, obj);
-            }
-            else {
-                data->newargs = obj;
-            }
-            Py_INCREF(data->newargs);
-        }
-        /* the destroy method, aka as the C++ delete method */
-        data->destroy = PyObject_GetAttrString(data->klass, (char *)"__swig_destroy__");
-        if (PyErr_Occurred()) {
-            PyErr_Clear();
-            data->destroy = 0;
-        }
-        if (data->destroy) {
-            int flags;
-            Py_INCREF(data->destroy);
-            flags = PyCFunction_GET_FLAGS(data->destroy);
-#ifdef METH_O
-            data->delargs = !(flags & (METH_O));
-#else
-            data->delargs = 0;
-#endif
-        }
-        else {
-            data->delargs = 0;
+  if (!obj) {
+    return 0;
+  } else {
+    SwigPyClientData *data = (SwigPyClientData *)malloc(sizeof(SwigPyClientData));
+    /* the klass element */
+    data->klass = obj;
+    SWIG_Py_INCREF(data->klass);
+    /* the newraw method and newargs arguments used to create a new raw instance */
+    if (PyObject_IsInstance(obj, (PyObject *)&PyType_Type)) {
+      data->newraw = 0;
+      SWIG_Py_INCREF(obj);
+      data->newargs = obj;
+    } else {
+      data->newraw = PyObject_GetAttrString(data->klass, "__new__");
+      if (data->newraw) {
+        data->newargs = PyTuple_New(1);
+        if (data->newargs) {
+          SWIG_Py_INCREF(obj);
+          PyTuple_SET_ITEM(data->newargs, 0, obj);
+        } else {
+          SWIG_Py_DECREF(data->newraw);
+          SWIG_Py_DECREF(data->klass);
+          free(data);
+          return 0;
         }
-        data->implicitconv = 0;
-        data->pytype = 0;
-        return data;
+      } else {
+        SWIG_Py_INCREF(obj);
+        data->newargs = obj;
+      }
     }
+    /* the destroy method, aka as the C++ delete method */
+    data->destroy = PyObject_GetAttrString(data->klass, "__swig_destroy__");
+    if (PyErr_Occurred()) {
+      PyErr_Clear();
+      data->destroy = 0;
+    }
+    if (data->destroy) {
+      data->delargs = !(PyCFunction_GET_FLAGS(data->destroy) & METH_O);
+    } else {
+      data->delargs = 0;
+    }
+    data->implicitconv = 0;
+    data->pytype = 0;
+    return data;
+  }
 }
 
-SWIGRUNTIME void
+SWIGRUNTIME void 
 SwigPyClientData_Del(SwigPyClientData *data)
 {
-    Py_XDECREF(data->newraw);
-    Py_XDECREF(data->newargs);
-    Py_XDECREF(data->destroy);
+  SWIG_Py_XDECREF(data->klass);
+  SWIG_Py_XDECREF(data->newraw);
+  SWIG_Py_XDECREF(data->newargs);
+  SWIG_Py_XDECREF(data->destroy);
+  free(data);
 }
 
 /* =============== SwigPyObject =====================*/
 
 typedef struct {
-    PyObject_HEAD
-    void *ptr;
-    swig_type_info *ty;
-    int own;
-    PyObject *next;
+  PyObject_HEAD
+  void *ptr;
+  swig_type_info *ty;
+  int own;
+  PyObject *next;
+  PyObject *swigdict;
+  PyObject *weakreflist;
+} SwigPyObject;
+
+
 #ifdef SWIGPYTHON_BUILTIN
-    PyObject *dict;
+
+SWIGRUNTIME PyObject *
+SwigPyObject_get___dict__(PyObject *v, PyObject *SWIGUNUSEDPARM(args))
+{
+  SwigPyObject *sobj = (SwigPyObject *)v;
+
+  if (!sobj->swigdict)
+    sobj->swigdict = PyDict_New();
+
+  SWIG_Py_XINCREF(sobj->swigdict);
+  return sobj->swigdict;
+}
+
 #endif
-} SwigPyObject;
 
 SWIGRUNTIME PyObject *
 SwigPyObject_long(SwigPyObject *v)
 {
-    return PyLong_FromVoidPtr(v->ptr);
+  return PyLong_FromVoidPtr(v->ptr);
 }
 
 SWIGRUNTIME PyObject *
 SwigPyObject_format(const char* fmt, SwigPyObject *v)
 {
-    PyObject *res = NULL;
-    PyObject *args = PyTuple_New(1);
-    if (args) {
-        if (PyTuple_SetItem(args, 0, SwigPyObject_long(v)) == 0) {
-            PyObject *ofmt = SWIG_Python_str_FromChar(fmt);
-            if (ofmt) {
-#if PY_VERSION_HEX >= 0x03000000
-                res = PyUnicode_Format(ofmt, args);
-#else
-                res = PyBytes_Format(ofmt, args);
-#endif
-                Py_DECREF(ofmt);
-            }
-            Py_DECREF(args);
-        }
+  PyObject *res = NULL;
+  PyObject *args = PyTuple_New(1);
+  if (args) {
+    PyObject *val = SwigPyObject_long(v);
+    if (val) {
+      PyObject *ofmt;
+      PyTuple_SET_ITEM(args, 0, val);
+      ofmt = PyUnicode_FromString(fmt);
+      if (ofmt) {
+        res = PyUnicode_Format(ofmt,args);
+        SWIG_Py_DECREF(ofmt);
+      }
     }
-    return res;
+    SWIG_Py_DECREF(args);
+  }
+  return res;
 }
 
 SWIGRUNTIME PyObject *
 SwigPyObject_oct(SwigPyObject *v)
 {
-    return SwigPyObject_format("%o", v);
+  return SwigPyObject_format("%o",v);
 }
 
 SWIGRUNTIME PyObject *
 SwigPyObject_hex(SwigPyObject *v)
 {
-    return SwigPyObject_format("%x", v);
+  return SwigPyObject_format("%x",v);
 }
 
 SWIGRUNTIME PyObject *
-#ifdef METH_NOARGS
 SwigPyObject_repr(SwigPyObject *v)
-#else
-SwigPyObject_repr(SwigPyObject *v, PyObject *args)
-#endif
 {
-    const char *name = SWIG_TypePrettyName(v->ty);
-    PyObject *repr = SWIG_Python_str_FromFormat("<Swig Object of type '%s' at %p>", (name ? name : "unknown"), (void *)v);
-    if (v->next) {
-# ifdef METH_NOARGS
-        PyObject *nrep = SwigPyObject_repr((SwigPyObject *)v->next);
-# else
-        PyObject *nrep = SwigPyObject_repr((SwigPyObject *)v->next, args);
-# endif
-# if PY_VERSION_HEX >= 0x03000000
-        PyObject *joined = PyUnicode_Concat(repr, nrep);
-        Py_DecRef(repr);
-        Py_DecRef(nrep);
-        repr = joined;
-# else
-        PyBytes_ConcatAndDel(&repr, nrep);
-# endif
+  const char *name = SWIG_TypePrettyName(v->ty);
+  PyObject *repr = PyUnicode_FromFormat("<Swig Object of type '%s' at %p>", (name ? name : "unknown"), (void *)v);
+  if (repr && v->next) {
+    PyObject *nrep = SwigPyObject_repr((SwigPyObject *)v->next);
+    if (nrep) {
+      PyObject *joined = PyUnicode_Concat(repr, nrep);
+      SWIG_Py_DECREF(repr);
+      SWIG_Py_DECREF(nrep);
+      repr = joined;
+    } else {
+      SWIG_Py_DECREF(repr);
+      repr = NULL;
     }
-    return repr;
+  }
+  return repr;
+}
+
+/* We need a version taking two PyObject* parameters so it's a valid
+ * PyCFunction to use in SwigPyObject_methods[]. */
+SWIGRUNTIME PyObject *
+SwigPyObject_repr2(PyObject *v, PyObject *SWIGUNUSEDPARM(args))
+{
+  return SwigPyObject_repr((SwigPyObject*)v);
 }
 
 SWIGRUNTIME int
-SwigPyObject_compare(SwigPyObject *v, SwigPyObject *w)
+SwigPyObject_compare(PyObject *v, PyObject *w)
 {
-    void *i = v->ptr;
-    void *j = w->ptr;
-    return (i < j) ? -1 : ((i > j) ? 1 : 0);
+  /* tp_compare is only called when both objects have the same type, so
+   * the casts are guaranteed to be ok. */
+  void *i = ((SwigPyObject *)v)->ptr;
+  void *j = ((SwigPyObject *)w)->ptr;
+  return (i < j) ? -1 : ((i > j) ? 1 : 0);
 }
 
-/* Added for Python 3.x, would it also be useful for Python 2.x? */
+SWIGRUNTIMEINLINE int SwigPyObject_Check(PyObject *);
+
+/* Rich comparison support */
 SWIGRUNTIME PyObject*
-SwigPyObject_richcompare(SwigPyObject *v, SwigPyObject *w, int op)
+SwigPyObject_richcompare(PyObject *v, PyObject *w, int op)
 {
-    PyObject* res;
-    if (op != Py_EQ && op != Py_NE) {
-        Py_INCREF(Py_NotImplemented);
-        return Py_NotImplemented;
+  PyObject* res = NULL;
+  if (!PyErr_Occurred()) {
+    /* Per https://docs.python.org/3/c-api/typeobj.html#c.PyTypeObject.tp_richcompare
+     * the first argument is guaranteed to be an instance of SwigPyObject, but the
+     * second is not, so we typecheck that one. */
+    if ((op != Py_EQ && op != Py_NE) || !SwigPyObject_Check(w)) {
+      SWIG_Py_INCREF(Py_NotImplemented);
+      return Py_NotImplemented;
     }
-    res = PyBool_FromLong((SwigPyObject_compare(v, w) == 0) == (op == Py_EQ) ? 1 : 0);
-    return res;
+    res = PyBool_FromLong( (SwigPyObject_compare(v, w)==0) == (op == Py_EQ) ? 1 : 0);
+  }
+  return res;
 }
 
 
@@ -1695,8 +1996,7 @@ SWIGRUNTIME PyTypeObject* SwigPyObject_TypeOnce(void);
 #ifdef SWIGPYTHON_BUILTIN
 static swig_type_info *SwigPyObject_stype = 0;
 SWIGRUNTIME PyTypeObject*
-SwigPyObject_type(void)
-{
+SwigPyObject_Type(void) {
     SwigPyClientData *cd;
     assert(SwigPyObject_stype);
     cd = (SwigPyClientData*) SwigPyObject_stype->clientdata;
@@ -1706,345 +2006,345 @@ SwigPyObject_type(void)
 }
 #else
 SWIGRUNTIME PyTypeObject*
-SwigPyObject_type(void)
-{
-    static PyTypeObject *SWIG_STATIC_POINTER(type) = SwigPyObject_TypeOnce();
-    return type;
+SwigPyObject_Type(void) {
+  static PyTypeObject *SWIG_STATIC_POINTER(type) = SwigPyObject_TypeOnce();
+  return type;
 }
 #endif
 
 SWIGRUNTIMEINLINE int
-SwigPyObject_Check(PyObject *op)
-{
+SwigPyObject_Check(PyObject *op) {
+  PyTypeObject *target_tp = SwigPyObject_Type();
+  PyTypeObject *op_type = Py_TYPE(op);
 #ifdef SWIGPYTHON_BUILTIN
-    PyTypeObject *target_tp = SwigPyObject_type();
-    if (PyType_IsSubtype(op->ob_type, target_tp)) {
-        return 1;
-    }
-    return (strcmp(op->ob_type->tp_name, "SwigPyObject") == 0);
+  /* Only builtin types have SwigPyObject as a base type */
+  return PyType_IsSubtype(op_type, target_tp);
 #else
-    return (Py_TYPE(op) == SwigPyObject_type())
-           || (strcmp(Py_TYPE(op)->tp_name, "SwigPyObject") == 0);
+  /* Check for an exact match to SwigPyObject */
+  if (op_type == target_tp) {
+    return 1;
+  } else {
+    /* Fallback for multiple modules */
+    int cmp;
+    PyObject *tpname = SWIG_PyType_GetFullyQualifiedName(op_type);
+    if (!tpname)
+      return 0;
+    cmp = PyUnicode_CompareWithASCIIString(tpname, SWIG_RUNTIME_MODULE ".SwigPyObject");
+    SWIG_Py_DECREF(tpname);
+    return cmp == 0;
+  }
 #endif
 }
 
 SWIGRUNTIME PyObject *
 SwigPyObject_New(void *ptr, swig_type_info *ty, int own);
 
+static PyObject* Swig_Capsule_global = NULL;
+
 SWIGRUNTIME void
 SwigPyObject_dealloc(PyObject *v)
 {
-    SwigPyObject *sobj = (SwigPyObject *) v;
-    PyObject *next = sobj->next;
-    if (sobj->own == SWIG_POINTER_OWN) {
-        swig_type_info *ty = sobj->ty;
-        SwigPyClientData *data = ty ? (SwigPyClientData *) ty->clientdata : 0;
-        PyObject *destroy = data ? data->destroy : 0;
-        if (destroy) {
-            /* destroy is always a VARARGS method */
-            PyObject *res;
-            if (data->delargs) {
-                /* we need to create a temporary object to carry the destroy operation */
-                PyObject *tmp = SwigPyObject_New(sobj->ptr, ty, 0);
-                res = SWIG_Python_CallFunctor(destroy, tmp);
-                Py_DECREF(tmp);
-            }
-            else {
-                PyCFunction meth = PyCFunction_GET_FUNCTION(destroy);
-                PyObject *mself = PyCFunction_GET_SELF(destroy);
-                res = ((*meth)(mself, v));
-            }
-            Py_XDECREF(res);
+  SwigPyObject *sobj = (SwigPyObject *) v;
+  PyObject *next = sobj->next;
+  if (sobj->own == SWIG_POINTER_OWN) {
+    swig_type_info *ty = sobj->ty;
+    SwigPyClientData *data = ty ? (SwigPyClientData *) ty->clientdata : 0;
+    PyObject *destroy = data ? data->destroy : 0;
+    if (destroy) {
+      /* destroy is always a VARARGS method */
+      PyObject *res;
+
+      /* PyObject_CallFunction() has the potential to silently drop
+         the active exception.  In cases of unnamed temporary
+         variable or where we just finished iterating over a generator
+         StopIteration will be active right now, and this needs to
+         remain true upon return from SwigPyObject_dealloc.  So save
+         and restore. */
+      
+      PyObject *type = NULL, *value = NULL, *traceback = NULL;
+      PyErr_Fetch(&type, &value, &traceback);
+
+      if (data->delargs) {
+        /* we need to create a temporary object to carry the destroy operation */
+        PyObject *tmp = SwigPyObject_New(sobj->ptr, ty, 0);
+        if (tmp) {
+          res = SWIG_Python_CallFunctor(destroy, tmp);
+        } else {
+          res = 0;
         }
+        SWIG_Py_XDECREF(tmp);
+      } else {
+        PyCFunction meth = PyCFunction_GET_FUNCTION(destroy);
+        PyObject *mself = PyCFunction_GET_SELF(destroy);
+        res = ((*meth)(mself, v));
+      }
+      if (!res)
+        PyErr_WriteUnraisable(destroy);
+
+      PyErr_Restore(type, value, traceback);
+
+      SWIG_Py_XDECREF(res);
+    } 
 #if !defined(SWIG_PYTHON_SILENT_MEMLEAK)
-        else {
-            const char *name = SWIG_TypePrettyName(ty);
-            printf("swig/python detected a memory leak of type '%s', no destructor found.\n", (name ? name : "unknown"));
-        }
-#endif
+    else {
+      const char *name = SWIG_TypePrettyName(ty);
+      printf("swig/python detected a memory leak of type '%s', no destructor found.\n", (name ? name : "unknown"));
     }
-    Py_XDECREF(next);
-    PyObject_DEL(v);
+#endif
+    SWIG_Py_XDECREF(Swig_Capsule_global);
+  }
+  SWIG_Py_XDECREF(next);
+  SWIG_Py_XDECREF(sobj->swigdict);
+  PyObject_Free(v);
 }
 
-SWIGRUNTIME PyObject*
+SWIGRUNTIME PyObject* 
 SwigPyObject_append(PyObject* v, PyObject* next)
 {
-    SwigPyObject *sobj = (SwigPyObject *) v;
-#ifndef METH_O
-    PyObject *tmp = 0;
-    if (!PyArg_ParseTuple(next, (char *)"O:append", &tmp)) { return NULL; }
-    next = tmp;
-#endif
-    if (!SwigPyObject_Check(next)) {
-        return NULL;
-    }
-    sobj->next = next;
-    Py_INCREF(next);
-    return SWIG_Py_Void();
+  SwigPyObject *sobj = (SwigPyObject *) v;
+  if (!SwigPyObject_Check(next)) {
+    PyErr_SetString(PyExc_TypeError, "Attempt to append a non SwigPyObject");
+    return NULL;
+  }
+  ((SwigPyObject *)next)->next = sobj->next;
+  sobj->next = next;
+  SWIG_Py_INCREF(next);
+  return SWIG_Py_Void();
 }
 
-SWIGRUNTIME PyObject*
-#ifdef METH_NOARGS
-SwigPyObject_next(PyObject* v)
-#else
+SWIGRUNTIME PyObject* 
 SwigPyObject_next(PyObject* v, PyObject *SWIGUNUSEDPARM(args))
-#endif
 {
-    SwigPyObject *sobj = (SwigPyObject *) v;
-    if (sobj->next) {
-        Py_INCREF(sobj->next);
-        return sobj->next;
-    }
-    else {
-        return SWIG_Py_Void();
-    }
+  SwigPyObject *sobj = (SwigPyObject *) v;
+  if (sobj->next) {    
+    SWIG_Py_INCREF(sobj->next);
+    return sobj->next;
+  } else {
+    return SWIG_Py_Void();
+  }
 }
 
 SWIGINTERN PyObject*
-#ifdef METH_NOARGS
-SwigPyObject_disown(PyObject *v)
-#else
 SwigPyObject_disown(PyObject* v, PyObject *SWIGUNUSEDPARM(args))
-#endif
 {
-    SwigPyObject *sobj = (SwigPyObject *)v;
-    sobj->own = 0;
-    return SWIG_Py_Void();
+  SwigPyObject *sobj = (SwigPyObject *)v;
+  sobj->own = 0;
+  return SWIG_Py_Void();
 }
 
 SWIGINTERN PyObject*
-#ifdef METH_NOARGS
-SwigPyObject_acquire(PyObject *v)
-#else
 SwigPyObject_acquire(PyObject* v, PyObject *SWIGUNUSEDPARM(args))
-#endif
 {
-    SwigPyObject *sobj = (SwigPyObject *)v;
-    sobj->own = SWIG_POINTER_OWN;
-    return SWIG_Py_Void();
+  SwigPyObject *sobj = (SwigPyObject *)v;
+  sobj->own = SWIG_POINTER_OWN;
+  return SWIG_Py_Void();
 }
 
 SWIGINTERN PyObject*
 SwigPyObject_own(PyObject *v, PyObject *args)
 {
-    PyObject *val = 0;
-#if (PY_VERSION_HEX < 0x02020000)
-    if (!PyArg_ParseTuple(args, (char *)"|O:own", &val))
-#elif (PY_VERSION_HEX < 0x02050000)
-    if (!PyArg_UnpackTuple(args, (char *)"own", 0, 1, &val))
-#else
-    if (!PyArg_UnpackTuple(args, "own", 0, 1, &val))
-#endif
-    {
-        return NULL;
-    }
-    else {
-        SwigPyObject *sobj = (SwigPyObject *)v;
-        PyObject *obj = PyBool_FromLong(sobj->own);
-        if (val) {
-#ifdef METH_NOARGS
-            if (PyObject_IsTrue(val)) {
-                SwigPyObject_acquire(v);
-            }
-            else {
-                SwigPyObject_disown(v);
-            }
-#else
-            if (PyObject_IsTrue(val)) {
-                SwigPyObject_acquire(v, args);
-            }
-            else {
-                SwigPyObject_disown(v, args);
-            }
-#endif
-        }
-        return obj;
-    }
+  PyObject *val = 0;
+  if (!PyArg_UnpackTuple(args, "own", 0, 1, &val)) {
+    return NULL;
+  } else {
+    SwigPyObject *sobj = (SwigPyObject *)v;
+    PyObject *obj = PyBool_FromLong(sobj->own);
+    if (val) {
+      if (PyObject_IsTrue(val)) {
+        SWIG_Py_DECREF(SwigPyObject_acquire(v,args));
+      } else {
+        SWIG_Py_DECREF(SwigPyObject_disown(v,args));
+      }
+    } 
+    return obj;
+  }
 }
 
-#ifdef METH_O
 static PyMethodDef
-swigobject_methods[] = {
-    {(char *)"disown", (PyCFunction)SwigPyObject_disown,  METH_NOARGS, (char *)"releases ownership of the pointer"},
-    {(char *)"acquire", (PyCFunction)SwigPyObject_acquire, METH_NOARGS, (char *)"acquires ownership of the pointer"},
-    {(char *)"own", (PyCFunction)SwigPyObject_own,     METH_VARARGS, (char *)"returns/sets ownership of the pointer"},
-    {(char *)"append", (PyCFunction)SwigPyObject_append,  METH_O, (char *)"appends another 'this' object"},
-    {(char *)"next", (PyCFunction)SwigPyObject_next,    METH_NOARGS, (char *)"returns the next 'this' object"},
-    {(char *)"__repr__", (PyCFunction)SwigPyObject_repr,    METH_NOARGS, (char *)"returns object representation"},
-    {0, 0, 0, 0}
+SwigPyObject_methods[] = {
+  {"disown",  SwigPyObject_disown,  METH_NOARGS,  "releases ownership of the pointer"},
+  {"acquire", SwigPyObject_acquire, METH_NOARGS,  "acquires ownership of the pointer"},
+  {"own",     SwigPyObject_own,     METH_VARARGS, "returns/sets ownership of the pointer"},
+  {"append",  SwigPyObject_append,  METH_O,       "appends another 'this' object"},
+  {"next",    SwigPyObject_next,    METH_NOARGS,  "returns the next 'this' object"},
+  {"__repr__",SwigPyObject_repr2,   METH_NOARGS,  "returns object representation"},
+  {0, 0, 0, 0}  
 };
+
+SWIGRUNTIME PyTypeObject*
+SwigPyObject_TypeOnce(void) {
+  static char SwigPyObject_doc[] = "Swig object holding a C/C++ pointer";
+#ifndef SWIG_HEAPTYPES
+  static PyNumberMethods SwigPyObject_as_number = {
+    (binaryfunc)0, /*nb_add*/
+    (binaryfunc)0, /*nb_subtract*/
+    (binaryfunc)0, /*nb_multiply*/
+    (binaryfunc)0, /*nb_remainder*/
+    (binaryfunc)0, /*nb_divmod*/
+    (ternaryfunc)0,/*nb_power*/
+    (unaryfunc)0,  /*nb_negative*/
+    (unaryfunc)0,  /*nb_positive*/
+    (unaryfunc)0,  /*nb_absolute*/
+    (inquiry)0,    /*nb_bool*/
+    0,		   /*nb_invert*/
+    0,		   /*nb_lshift*/
+    0,		   /*nb_rshift*/
+    0,		   /*nb_and*/
+    0,		   /*nb_xor*/
+    0,		   /*nb_or*/
+    (unaryfunc)SwigPyObject_long, /*nb_int*/
+    0, /*nb_reserved*/
+    (unaryfunc)0,                 /*nb_float*/
+    0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0 /* nb_inplace_add -> nb_inplace_matrix_multiply */
+  };
+
+  static PyTypeObject swigpyobject_type;
+  static int type_init = 0;
+  if (!type_init) {
+    const PyTypeObject tmp = {
+      PyVarObject_HEAD_INIT(NULL, 0)
+      SWIG_RUNTIME_MODULE ".SwigPyObject",  /* tp_name */
+      sizeof(SwigPyObject),                 /* tp_basicsize */
+      0,                                    /* tp_itemsize */
+      (destructor)SwigPyObject_dealloc,     /* tp_dealloc */
+#if PY_VERSION_HEX < 0x030800b4
+      (printfunc)0,                         /* tp_print */
 #else
-static PyMethodDef
-swigobject_methods[] = {
-    {(char *)"disown", (PyCFunction)SwigPyObject_disown,  METH_VARARGS, (char *)"releases ownership of the pointer"},
-    {(char *)"acquire", (PyCFunction)SwigPyObject_acquire, METH_VARARGS, (char *)"aquires ownership of the pointer"},
-    {(char *)"own", (PyCFunction)SwigPyObject_own,     METH_VARARGS, (char *)"returns/sets ownership of the pointer"},
-    {(char *)"append", (PyCFunction)SwigPyObject_append,  METH_VARARGS, (char *)"appends another 'this' object"},
-    {(char *)"next", (PyCFunction)SwigPyObject_next,    METH_VARARGS, (char *)"returns the next 'this' object"},
-    {(char *)"__repr__", (PyCFunction)SwigPyObject_repr,   METH_VARARGS, (char *)"returns object representation"},
-    {0, 0, 0, 0}
-};
-#endif
-
-#if PY_VERSION_HEX < 0x02020000
-SWIGINTERN PyObject *
-SwigPyObject_getattr(SwigPyObject *sobj, char *name)
-{
-    return Py_FindMethod(swigobject_methods, (PyObject *)sobj, name);
-}
-#endif
-
-SWIGRUNTIME PyTypeObject*
-SwigPyObject_TypeOnce(void)
-{
-    static char swigobject_doc[] = "Swig object carries a C/C++ instance pointer";
-
-    static PyNumberMethods SwigPyObject_as_number = {
-        (binaryfunc)0, /*nb_add*/
-        (binaryfunc)0, /*nb_subtract*/
-        (binaryfunc)0, /*nb_multiply*/
-        /* nb_divide removed in Python 3 */
-#if PY_VERSION_HEX < 0x03000000
-        (binaryfunc)0, /*nb_divide*/
-#endif
-        (binaryfunc)0, /*nb_remainder*/
-        (binaryfunc)0, /*nb_divmod*/
-        (ternaryfunc)0,/*nb_power*/
-        (unaryfunc)0,  /*nb_negative*/
-        (unaryfunc)0,  /*nb_positive*/
-        (unaryfunc)0,  /*nb_absolute*/
-        (inquiry)0,    /*nb_nonzero*/
-        0,         /*nb_invert*/
-        0,         /*nb_lshift*/
-        0,         /*nb_rshift*/
-        0,         /*nb_and*/
-        0,         /*nb_xor*/
-        0,         /*nb_or*/
-#if PY_VERSION_HEX < 0x03000000
-        0,   /*nb_coerce*/
-#endif
-        (unaryfunc)SwigPyObject_long, /*nb_int*/
-#if PY_VERSION_HEX < 0x03000000
-        (unaryfunc)SwigPyObject_long, /*nb_long*/
-#else
-        0, /*nb_reserved*/
-#endif
-        (unaryfunc)0,                 /*nb_float*/
-#if PY_VERSION_HEX < 0x03000000
-        (unaryfunc)SwigPyObject_oct,  /*nb_oct*/
-        (unaryfunc)SwigPyObject_hex,  /*nb_hex*/
-#endif
-#if PY_VERSION_HEX >= 0x03000000 /* 3.0 */
-        0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0 /* nb_inplace_add -> nb_index, nb_inplace_divide removed */
-#elif PY_VERSION_HEX >= 0x02050000 /* 2.5.0 */
-        0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0 /* nb_inplace_add -> nb_index */
-#elif PY_VERSION_HEX >= 0x02020000 /* 2.2.0 */
-        0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0 /* nb_inplace_add -> nb_inplace_true_divide */
-#elif PY_VERSION_HEX >= 0x02000000 /* 2.0.0 */
-        0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0 /* nb_inplace_add -> nb_inplace_or */
-#endif
-    };
-
-    static PyTypeObject swigpyobject_type;
-    static int type_init = 0;
-    if (!type_init) {
-        const PyTypeObject tmp = {
-            /* PyObject header changed in Python 3 */
-#if PY_VERSION_HEX >= 0x03000000
-            PyVarObject_HEAD_INIT(NULL, 0)
-#else
-            PyObject_HEAD_INIT(NULL)
-            0,                                    /* ob_size */
-#endif
-            (char *)"SwigPyObject",               /* tp_name */
-            sizeof(SwigPyObject),                 /* tp_basicsize */
-            0,                                    /* tp_itemsize */
-            (destructor)SwigPyObject_dealloc,     /* tp_dealloc */
-            0,                    /* tp_print */
-#if PY_VERSION_HEX < 0x02020000
-            (getattrfunc)SwigPyObject_getattr,    /* tp_getattr */
-#else
-            (getattrfunc)0,                       /* tp_getattr */
-#endif
-            (setattrfunc)0,                       /* tp_setattr */
-#if PY_VERSION_HEX >= 0x03000000
-            0, /* tp_reserved in 3.0.1, tp_compare in 3.0.0 but not used */
-#else
-            (cmpfunc)SwigPyObject_compare,        /* tp_compare */
-#endif
-            (reprfunc)SwigPyObject_repr,          /* tp_repr */
-            &SwigPyObject_as_number,              /* tp_as_number */
-            0,                                    /* tp_as_sequence */
-            0,                                    /* tp_as_mapping */
-            (hashfunc)0,                          /* tp_hash */
-            (ternaryfunc)0,                       /* tp_call */
-            0,                    /* tp_str */
-            PyObject_GenericGetAttr,              /* tp_getattro */
-            0,                                    /* tp_setattro */
-            0,                                    /* tp_as_buffer */
-            Py_TPFLAGS_DEFAULT,                   /* tp_flags */
-            swigobject_doc,                       /* tp_doc */
-            0,                                    /* tp_traverse */
-            0,                                    /* tp_clear */
-            (richcmpfunc)SwigPyObject_richcompare,/* tp_richcompare */
-            0,                                    /* tp_weaklistoffset */
-#if PY_VERSION_HEX >= 0x02020000
-            0,                                    /* tp_iter */
-            0,                                    /* tp_iternext */
-            swigobject_methods,                   /* tp_methods */
-            0,                                    /* tp_members */
-            0,                                    /* tp_getset */
-            0,                                    /* tp_base */
-            0,                                    /* tp_dict */
-            0,                                    /* tp_descr_get */
-            0,                                    /* tp_descr_set */
-            0,                                    /* tp_dictoffset */
-            0,                                    /* tp_init */
-            0,                                    /* tp_alloc */
-            0,                                    /* tp_new */
-            0,                                    /* tp_free */
-            0,                                    /* tp_is_gc */
-            0,                                    /* tp_bases */
-            0,                                    /* tp_mro */
-            0,                                    /* tp_cache */
-            0,                                    /* tp_subclasses */
-            0,                                    /* tp_weaklist */
-#endif
-#if PY_VERSION_HEX >= 0x02030000
-            0,                                    /* tp_del */
-#endif
-#if PY_VERSION_HEX >= 0x02060000
-            0,                                    /* tp_version */
+      (Py_ssize_t)0,                        /* tp_vectorcall_offset */
+#endif
+      (getattrfunc)0,                       /* tp_getattr */
+      (setattrfunc)0,                       /* tp_setattr */
+      0, /* tp_reserved in 3.0.1, tp_compare in 3.0.0 but not used */
+      (reprfunc)SwigPyObject_repr,          /* tp_repr */
+      &SwigPyObject_as_number,              /* tp_as_number */
+      0,                                    /* tp_as_sequence */
+      0,                                    /* tp_as_mapping */
+      (hashfunc)0,                          /* tp_hash */
+      (ternaryfunc)0,                       /* tp_call */
+      0,                                    /* tp_str */
+      PyObject_GenericGetAttr,              /* tp_getattro */
+      0,                                    /* tp_setattro */
+      0,                                    /* tp_as_buffer */
+      Py_TPFLAGS_DEFAULT,                   /* tp_flags */
+      SwigPyObject_doc,                     /* tp_doc */
+      0,                                    /* tp_traverse */
+      0,                                    /* tp_clear */
+      (richcmpfunc)SwigPyObject_richcompare,/* tp_richcompare */
+      offsetof(SwigPyObject, weakreflist),  /* tp_weaklistoffset */
+      0,                                    /* tp_iter */
+      0,                                    /* tp_iternext */
+      SwigPyObject_methods,                 /* tp_methods */
+      0,                                    /* tp_members */
+      0,                                    /* tp_getset */
+      0,                                    /* tp_base */
+      0,                                    /* tp_dict */
+      0,                                    /* tp_descr_get */
+      0,                                    /* tp_descr_set */
+      0,                                    /* tp_dictoffset */
+      0,                                    /* tp_init */
+      0,                                    /* tp_alloc */
+      0,                                    /* tp_new */
+      0,                                    /* tp_free */
+      0,                                    /* tp_is_gc */
+      0,                                    /* tp_bases */
+      0,                                    /* tp_mro */
+      0,                                    /* tp_cache */
+      0,                                    /* tp_subclasses */
+      0,                                    /* tp_weaklist */
+      0,                                    /* tp_del */
+      0,                                    /* tp_version_tag */
+      0,                                    /* tp_finalize */
+#if PY_VERSION_HEX >= 0x03080000
+      0,                                    /* tp_vectorcall */
+#endif
+#if (PY_VERSION_HEX >= 0x03080000) && (PY_VERSION_HEX < 0x03090000)
+      0,                                    /* tp_print */
+#endif
+#if PY_VERSION_HEX >= 0x030c0000
+      0,                                    /* tp_watched */
+#endif
+#if PY_VERSION_HEX >= 0x030d00a4
+      0,                                    /* tp_versions_used */
 #endif
 #ifdef COUNT_ALLOCS
-            0, 0, 0, 0                            /* tp_alloc -> tp_next */
+      0,                                    /* tp_allocs */
+      0,                                    /* tp_frees */
+      0,                                    /* tp_maxalloc */
+      0,                                    /* tp_prev */
+      0                                     /* tp_next */
 #endif
-        };
-        swigpyobject_type = tmp;
-        type_init = 1;
-#if PY_VERSION_HEX < 0x02020000
-        swigpyobject_type.ob_type = &PyType_Type;
+    };
+    PyObject *runtime_data_module = SWIG_runtime_data_module();
+    swigpyobject_type = tmp;
+    type_init = 1;
+    if (PyType_Ready(&swigpyobject_type) != 0)
+      return NULL;
+    if (PyModule_AddObject(runtime_data_module, "SwigPyObject", (PyObject *)&swigpyobject_type) == 0)
+      SWIG_Py_INCREF((PyObject *)&swigpyobject_type);
+  }
+  return &swigpyobject_type;
 #else
-        if (PyType_Ready(&swigpyobject_type) < 0) {
-            return NULL;
-        }
+  static PyMemberDef SwigPyObject_members[] = {
+      { (char *)"__dictoffset__", Py_T_PYSSIZET, offsetof(SwigPyObject, swigdict), Py_READONLY, NULL },
+      { (char *)"__weaklistoffset__", Py_T_PYSSIZET, offsetof(SwigPyObject, weakreflist), Py_READONLY, NULL },
+      { NULL, 0, 0, 0, NULL }
+  };
+  PyType_Slot slots[] = {
+    { Py_tp_dealloc, (void *)SwigPyObject_dealloc },
+    { Py_tp_repr, (void *)SwigPyObject_repr },
+    { Py_tp_getattro, (void *)PyObject_GenericGetAttr },
+    { Py_tp_doc, (void *)SwigPyObject_doc },
+    { Py_tp_richcompare, (void *)SwigPyObject_richcompare },
+    { Py_tp_methods, (void *)SwigPyObject_methods },
+    { Py_nb_int, (void *)SwigPyObject_long },
+    { Py_tp_members, (void *)SwigPyObject_members },
+    { 0, NULL }
+  };
+  PyType_Spec spec = {
+    SWIG_RUNTIME_MODULE ".SwigPyObject",
+    sizeof(SwigPyObject),
+    0,
+    Py_TPFLAGS_DEFAULT|Py_TPFLAGS_BASETYPE,
+    slots
+  };
+  PyObject *pytype = PyType_FromSpec(&spec);
+  PyObject *runtime_data_module = SWIG_runtime_data_module();
+#if !defined(Py_LIMITED_API)
+/* While this __dictoffset__ is only used with the builtin wrappers, SwigPyObject ought to be
+   identical when created for use by proxy class wrappers in case it is shared across multiple modules. */
+#if PY_VERSION_HEX < 0x03090000
+    /* Workaround as __dictoffset__ and __weaklistoffset__ above are only supported from python-3.9 */
+  if (pytype) {
+    ((PyTypeObject *)pytype)->tp_dictoffset = offsetof(SwigPyObject, swigdict);
+    ((PyTypeObject *)pytype)->tp_weaklistoffset = offsetof(SwigPyObject, weakreflist);
+  }
+#endif
+#endif
+  if (pytype && PyModule_AddObject(runtime_data_module, "SwigPyObject", pytype) == 0)
+    SWIG_Py_INCREF(pytype);
+  return (PyTypeObject *)pytype;
 #endif
-    }
-    return &swigpyobject_type;
 }
 
 SWIGRUNTIME PyObject *
 SwigPyObject_New(void *ptr, swig_type_info *ty, int own)
 {
-    SwigPyObject *sobj = PyObject_NEW(SwigPyObject, SwigPyObject_type());
-    if (sobj) {
-        sobj->ptr  = ptr;
-        sobj->ty   = ty;
-        sobj->own  = own;
-        sobj->next = 0;
+  SwigPyObject *sobj = PyObject_New(SwigPyObject, SwigPyObject_Type());
+  if (sobj) {
+    sobj->ptr  = ptr;
+    sobj->ty   = ty;
+    sobj->own  = own;
+    sobj->next = 0;
+    sobj->swigdict = 0;
+    sobj->weakreflist = 0;
+    if (own == SWIG_POINTER_OWN) {
+      /* Obtain a reference to the Python capsule wrapping the module information, so that the
+       * module information is correctly destroyed after all SWIG python objects have been freed
+       * by the GC (and corresponding destructors invoked) */
+      SWIG_Py_XINCREF(Swig_Capsule_global);
     }
-    return (PyObject *)sobj;
+  }
+  return (PyObject *)sobj;
 }
 
 /* -----------------------------------------------------------------------------
@@ -2052,493 +2352,464 @@ SwigPyObject_New(void *ptr, swig_type_info *ty, int own)
  * ----------------------------------------------------------------------------- */
 
 typedef struct {
-    PyObject_HEAD
-    void *pack;
-    swig_type_info *ty;
-    size_t size;
+  PyObject_HEAD
+  void *pack;
+  swig_type_info *ty;
+  size_t size;
 } SwigPyPacked;
 
-SWIGRUNTIME int
-SwigPyPacked_print(SwigPyPacked *v, FILE *fp, int SWIGUNUSEDPARM(flags))
-{
-    char result[SWIG_BUFFER_SIZE];
-    fputs("<Swig Packed ", fp);
-    if (SWIG_PackDataName(result, v->pack, v->size, 0, sizeof(result))) {
-        fputs("at ", fp);
-        fputs(result, fp);
-    }
-    fputs(v->ty->name, fp);
-    fputs(">", fp);
-    return 0;
-}
-
 SWIGRUNTIME PyObject *
 SwigPyPacked_repr(SwigPyPacked *v)
 {
-    char result[SWIG_BUFFER_SIZE];
-    if (SWIG_PackDataName(result, v->pack, v->size, 0, sizeof(result))) {
-        return SWIG_Python_str_FromFormat("<Swig Packed at %s%s>", result, v->ty->name);
-    }
-    else {
-        return SWIG_Python_str_FromFormat("<Swig Packed %s>", v->ty->name);
-    }
+  char result[SWIG_BUFFER_SIZE];
+  if (SWIG_PackDataName(result, v->pack, v->size, 0, sizeof(result))) {
+    return PyUnicode_FromFormat("<Swig Packed at %s%s>", result, v->ty->name);
+  } else {
+    return PyUnicode_FromFormat("<Swig Packed %s>", v->ty->name);
+  }  
 }
 
 SWIGRUNTIME PyObject *
 SwigPyPacked_str(SwigPyPacked *v)
 {
-    char result[SWIG_BUFFER_SIZE];
-    if (SWIG_PackDataName(result, v->pack, v->size, 0, sizeof(result))) {
-        return SWIG_Python_str_FromFormat("%s%s", result, v->ty->name);
-    }
-    else {
-        return SWIG_Python_str_FromChar(v->ty->name);
-    }
+  char result[SWIG_BUFFER_SIZE];
+  if (SWIG_PackDataName(result, v->pack, v->size, 0, sizeof(result))){
+    return PyUnicode_FromFormat("%s%s", result, v->ty->name);
+  } else {
+    return PyUnicode_FromString(v->ty->name);
+  }
 }
 
 SWIGRUNTIME int
 SwigPyPacked_compare(SwigPyPacked *v, SwigPyPacked *w)
 {
-    size_t i = v->size;
-    size_t j = w->size;
-    int s = (i < j) ? -1 : ((i > j) ? 1 : 0);
-    return s ? s : strncmp((char *)v->pack, (char *)w->pack, 2 * v->size);
+  size_t i = v->size;
+  size_t j = w->size;
+  int s = (i < j) ? -1 : ((i > j) ? 1 : 0);
+  return s ? s : strncmp((const char *)v->pack, (const char *)w->pack, 2*v->size);
 }
 
 SWIGRUNTIME PyTypeObject* SwigPyPacked_TypeOnce(void);
 
 SWIGRUNTIME PyTypeObject*
-SwigPyPacked_type(void)
-{
-    static PyTypeObject *SWIG_STATIC_POINTER(type) = SwigPyPacked_TypeOnce();
-    return type;
+SwigPyPacked_Type(void) {
+  static PyTypeObject *SWIG_STATIC_POINTER(type) = SwigPyPacked_TypeOnce();
+  return type;
 }
 
 SWIGRUNTIMEINLINE int
-SwigPyPacked_Check(PyObject *op)
-{
-    return ((op)->ob_type == SwigPyPacked_TypeOnce())
-           || (strcmp((op)->ob_type->tp_name, "SwigPyPacked") == 0);
+SwigPyPacked_Check(PyObject *op) {
+  PyTypeObject *target_tp = SwigPyPacked_Type();
+  PyTypeObject *op_type = Py_TYPE(op);
+  /* Check for an exact match to SwigPyPacked */
+  if (op_type == target_tp) {
+    return 1;
+  } else {
+    /* Fallback for multiple modules */
+    int cmp;
+    PyObject *tpname = SWIG_PyType_GetFullyQualifiedName(op_type);
+    if (!tpname)
+      return 0;
+    cmp = PyUnicode_CompareWithASCIIString(tpname, SWIG_RUNTIME_MODULE ".SwigPyPacked");
+    SWIG_Py_DECREF(tpname);
+    return cmp == 0;
+  }
 }
 
 SWIGRUNTIME void
 SwigPyPacked_dealloc(PyObject *v)
 {
-    if (SwigPyPacked_Check(v)) {
-        SwigPyPacked *sobj = (SwigPyPacked *) v;
-        free(sobj->pack);
-    }
-    PyObject_DEL(v);
+  if (SwigPyPacked_Check(v)) {
+    SwigPyPacked *sobj = (SwigPyPacked *) v;
+    free(sobj->pack);
+  }
+  PyObject_Free(v);
 }
 
 SWIGRUNTIME PyTypeObject*
-SwigPyPacked_TypeOnce(void)
-{
-    static char swigpacked_doc[] = "Swig object carries a C/C++ instance pointer";
-    static PyTypeObject swigpypacked_type;
-    static int type_init = 0;
-    if (!type_init) {
-        const PyTypeObject tmp = {
-            /* PyObject header changed in Python 3 */
-#if PY_VERSION_HEX>=0x03000000
-            PyVarObject_HEAD_INIT(NULL, 0)
+SwigPyPacked_TypeOnce(void) {
+  static char SwigPyPacked_doc[] = "Swig object holding a C/C++ function pointer";
+#ifndef SWIG_HEAPTYPES
+  static PyTypeObject swigpypacked_type;
+  static int type_init = 0;
+  if (!type_init) {
+    const PyTypeObject tmp = {
+      PyVarObject_HEAD_INIT(NULL, 0)
+      SWIG_RUNTIME_MODULE ".SwigPyPacked",  /* tp_name */
+      sizeof(SwigPyPacked),                 /* tp_basicsize */
+      0,                                    /* tp_itemsize */
+      (destructor)SwigPyPacked_dealloc,     /* tp_dealloc */
+#if PY_VERSION_HEX < 0x030800b4
+      (printfunc)0,                         /* tp_print */
 #else
-            PyObject_HEAD_INIT(NULL)
-            0,                                    /* ob_size */
-#endif
-            (char *)"SwigPyPacked",               /* tp_name */
-            sizeof(SwigPyPacked),                 /* tp_basicsize */
-            0,                                    /* tp_itemsize */
-            (destructor)SwigPyPacked_dealloc,     /* tp_dealloc */
-            (printfunc)SwigPyPacked_print,        /* tp_print */
-            (getattrfunc)0,                       /* tp_getattr */
-            (setattrfunc)0,                       /* tp_setattr */
-#if PY_VERSION_HEX>=0x03000000
-            0, /* tp_reserved in 3.0.1 */
-#else
-            (cmpfunc)SwigPyPacked_compare,        /* tp_compare */
-#endif
-            (reprfunc)SwigPyPacked_repr,          /* tp_repr */
-            0,                                    /* tp_as_number */
-            0,                                    /* tp_as_sequence */
-            0,                                    /* tp_as_mapping */
-            (hashfunc)0,                          /* tp_hash */
-            (ternaryfunc)0,                       /* tp_call */
-            (reprfunc)SwigPyPacked_str,           /* tp_str */
-            PyObject_GenericGetAttr,              /* tp_getattro */
-            0,                                    /* tp_setattro */
-            0,                                    /* tp_as_buffer */
-            Py_TPFLAGS_DEFAULT,                   /* tp_flags */
-            swigpacked_doc,                       /* tp_doc */
-            0,                                    /* tp_traverse */
-            0,                                    /* tp_clear */
-            0,                                    /* tp_richcompare */
-            0,                                    /* tp_weaklistoffset */
-#if PY_VERSION_HEX >= 0x02020000
-            0,                                    /* tp_iter */
-            0,                                    /* tp_iternext */
-            0,                                    /* tp_methods */
-            0,                                    /* tp_members */
-            0,                                    /* tp_getset */
-            0,                                    /* tp_base */
-            0,                                    /* tp_dict */
-            0,                                    /* tp_descr_get */
-            0,                                    /* tp_descr_set */
-            0,                                    /* tp_dictoffset */
-            0,                                    /* tp_init */
-            0,                                    /* tp_alloc */
-            0,                                    /* tp_new */
-            0,                                    /* tp_free */
-            0,                                    /* tp_is_gc */
-            0,                                    /* tp_bases */
-            0,                                    /* tp_mro */
-            0,                                    /* tp_cache */
-            0,                                    /* tp_subclasses */
-            0,                                    /* tp_weaklist */
-#endif
-#if PY_VERSION_HEX >= 0x02030000
-            0,                                    /* tp_del */
-#endif
-#if PY_VERSION_HEX >= 0x02060000
-            0,                                    /* tp_version */
+      (Py_ssize_t)0,                        /* tp_vectorcall_offset */
+#endif
+      (getattrfunc)0,                       /* tp_getattr */
+      (setattrfunc)0,                       /* tp_setattr */
+      0, /* tp_reserved in 3.0.1 */
+      (reprfunc)SwigPyPacked_repr,          /* tp_repr */
+      0,                                    /* tp_as_number */
+      0,                                    /* tp_as_sequence */
+      0,                                    /* tp_as_mapping */
+      (hashfunc)0,                          /* tp_hash */
+      (ternaryfunc)0,                       /* tp_call */
+      (reprfunc)SwigPyPacked_str,           /* tp_str */
+      PyObject_GenericGetAttr,              /* tp_getattro */
+      0,                                    /* tp_setattro */
+      0,                                    /* tp_as_buffer */
+      Py_TPFLAGS_DEFAULT,                   /* tp_flags */
+      SwigPyPacked_doc,                     /* tp_doc */
+      0,                                    /* tp_traverse */
+      0,                                    /* tp_clear */
+      0,                                    /* tp_richcompare */
+      0,                                    /* tp_weaklistoffset */
+      0,                                    /* tp_iter */
+      0,                                    /* tp_iternext */
+      0,                                    /* tp_methods */
+      0,                                    /* tp_members */
+      0,                                    /* tp_getset */
+      0,                                    /* tp_base */
+      0,                                    /* tp_dict */
+      0,                                    /* tp_descr_get */
+      0,                                    /* tp_descr_set */
+      0,                                    /* tp_dictoffset */
+      0,                                    /* tp_init */
+      0,                                    /* tp_alloc */
+      0,                                    /* tp_new */
+      0,                                    /* tp_free */
+      0,                                    /* tp_is_gc */
+      0,                                    /* tp_bases */
+      0,                                    /* tp_mro */
+      0,                                    /* tp_cache */
+      0,                                    /* tp_subclasses */
+      0,                                    /* tp_weaklist */
+      0,                                    /* tp_del */
+      0,                                    /* tp_version_tag */
+      0,                                    /* tp_finalize */
+#if PY_VERSION_HEX >= 0x03080000
+      0,                                    /* tp_vectorcall */
+#endif
+#if (PY_VERSION_HEX >= 0x03080000) && (PY_VERSION_HEX < 0x03090000)
+      0,                                    /* tp_print */
+#endif
+#if PY_VERSION_HEX >= 0x030c0000
+      0,                                    /* tp_watched */
+#endif
+#if PY_VERSION_HEX >= 0x030d00a4
+      0,                                    /* tp_versions_used */
 #endif
 #ifdef COUNT_ALLOCS
-            0, 0, 0, 0                            /* tp_alloc -> tp_next */
+      0,                                    /* tp_allocs */
+      0,                                    /* tp_frees */
+      0,                                    /* tp_maxalloc */
+      0,                                    /* tp_prev */
+      0                                     /* tp_next */
 #endif
-        };
-        swigpypacked_type = tmp;
-        type_init = 1;
-#if PY_VERSION_HEX < 0x02020000
-        swigpypacked_type.ob_type = &PyType_Type;
+    };
+    PyObject *runtime_data_module = SWIG_runtime_data_module();
+    swigpypacked_type = tmp;
+    type_init = 1;
+    if (PyType_Ready(&swigpypacked_type) != 0)
+      return NULL;
+    if (PyModule_AddObject(runtime_data_module, "SwigPyPacked", (PyObject *)&swigpypacked_type) == 0)
+      SWIG_Py_INCREF((PyObject *)&swigpypacked_type);
+  }
+  return &swigpypacked_type;
 #else
-        if (PyType_Ready(&swigpypacked_type) < 0) {
-            return NULL;
-        }
+  PyType_Slot slots[] = {
+    { Py_tp_dealloc, (void *)SwigPyPacked_dealloc },
+    { Py_tp_repr, (void *)SwigPyPacked_repr },
+    { Py_tp_str, (void *)SwigPyPacked_str },
+    { Py_tp_getattro, (void *)PyObject_GenericGetAttr },
+    { Py_tp_doc, (void *)SwigPyPacked_doc },
+    { 0, NULL }
+  };
+  PyType_Spec spec = {
+    SWIG_RUNTIME_MODULE ".SwigPyPacked",
+    sizeof(SwigPyPacked),
+    0,
+    Py_TPFLAGS_DEFAULT,
+    slots
+  };
+  PyObject *pytype = PyType_FromSpec(&spec);
+  PyObject *runtime_data_module = SWIG_runtime_data_module();
+  if (pytype && PyModule_AddObject(runtime_data_module, "SwigPyPacked", pytype) == 0)
+    SWIG_Py_INCREF(pytype);
+  return (PyTypeObject *)pytype;
 #endif
-    }
-    return &swigpypacked_type;
 }
 
 SWIGRUNTIME PyObject *
 SwigPyPacked_New(void *ptr, size_t size, swig_type_info *ty)
 {
-    SwigPyPacked *sobj = PyObject_NEW(SwigPyPacked, SwigPyPacked_type());
-    if (sobj) {
-        void *pack = malloc(size);
-        if (pack) {
-            memcpy(pack, ptr, size);
-            sobj->pack = pack;
-            sobj->ty   = ty;
-            sobj->size = size;
-        }
-        else {
-            PyObject_DEL((PyObject *) sobj);
-            sobj = 0;
-        }
+  SwigPyPacked *sobj = PyObject_New(SwigPyPacked, SwigPyPacked_Type());
+  if (sobj) {
+    void *pack = malloc(size);
+    if (pack) {
+      memcpy(pack, ptr, size);
+      sobj->pack = pack;
+      sobj->ty   = ty;
+      sobj->size = size;
+    } else {
+      PyObject_Free((PyObject *)sobj);
+      sobj = 0;
     }
-    return (PyObject *) sobj;
+  }
+  return (PyObject *) sobj;
 }
 
 SWIGRUNTIME swig_type_info *
 SwigPyPacked_UnpackData(PyObject *obj, void *ptr, size_t size)
 {
-    if (SwigPyPacked_Check(obj)) {
-        SwigPyPacked *sobj = (SwigPyPacked *)obj;
-        if (sobj->size != size) { return 0; }
-        memcpy(ptr, sobj->pack, size);
-        return sobj->ty;
-    }
-    else {
-        return 0;
-    }
+  if (SwigPyPacked_Check(obj)) {
+    SwigPyPacked *sobj = (SwigPyPacked *)obj;
+    if (sobj->size != size) return 0;
+    memcpy(ptr, sobj->pack, size);
+    return sobj->ty;
+  } else {
+    return 0;
+  }
 }
 
 /* -----------------------------------------------------------------------------
  * pointers/data manipulation
  * ----------------------------------------------------------------------------- */
 
-SWIGRUNTIMEINLINE PyObject *
-_SWIG_This(void)
-{
-    return SWIG_Python_str_FromChar("this");
-}
-
-static PyObject *swig_this = NULL;
+static PyObject *Swig_This_global = NULL;
 
 SWIGRUNTIME PyObject *
 SWIG_This(void)
 {
-    if (swig_this == NULL) {
-        swig_this = _SWIG_This();
-    }
-    return swig_this;
+  if (Swig_This_global == NULL)
+    Swig_This_global = PyUnicode_FromString("this");
+  return Swig_This_global;
 }
 
-/* #define SWIG_PYTHON_SLOW_GETSET_THIS */
-
-/* TODO: I don't know how to implement the fast getset in Python 3 right now */
-#if PY_VERSION_HEX>=0x03000000
-#define SWIG_PYTHON_SLOW_GETSET_THIS
-#endif
-
+/* Returns a borrowed reference to the 'this' object */
 SWIGRUNTIME SwigPyObject *
-SWIG_Python_GetSwigThis(PyObject *pyobj)
+SWIG_Python_GetSwigThis(PyObject *pyobj) 
 {
-    PyObject *obj;
+  PyObject *obj;
 
-    if (SwigPyObject_Check(pyobj)) {
-        return (SwigPyObject *) pyobj;
-    }
+  if (SwigPyObject_Check(pyobj))
+    return (SwigPyObject *) pyobj;
 
 #ifdef SWIGPYTHON_BUILTIN
-    (void)obj;
-# ifdef PyWeakref_CheckProxy
-    if (PyWeakref_CheckProxy(pyobj)) {
-        pyobj = PyWeakref_GET_OBJECT(pyobj);
-        if (pyobj && SwigPyObject_Check(pyobj)) {
-            return (SwigPyObject*) pyobj;
-        }
-    }
-# endif
-    return NULL;
+  (void)obj;
+  if (PyWeakref_CheckProxy(pyobj)) {
+#if PY_VERSION_HEX >= 0x030d0000
+    if (PyWeakref_GetRef(pyobj, &pyobj) > 0)
+      Py_DECREF(pyobj);
+    else
+      pyobj = NULL;
 #else
-
-    obj = 0;
-
-#if (!defined(SWIG_PYTHON_SLOW_GETSET_THIS) && (PY_VERSION_HEX >= 0x02030000))
-    if (PyInstance_Check(pyobj)) {
-        obj = _PyInstance_Lookup(pyobj, SWIG_This());
-    }
-    else {
-        PyObject **dictptr = _PyObject_GetDictPtr(pyobj);
-        if (dictptr != NULL) {
-            PyObject *dict = *dictptr;
-            obj = dict ? PyDict_GetItem(dict, SWIG_This()) : 0;
-        }
-        else {
-#ifdef PyWeakref_CheckProxy
-            if (PyWeakref_CheckProxy(pyobj)) {
-                PyObject *wobj = PyWeakref_GET_OBJECT(pyobj);
-                return wobj ? SWIG_Python_GetSwigThis(wobj) : 0;
-            }
+    pyobj = PyWeakref_GetObject(pyobj);
 #endif
-            obj = PyObject_GetAttr(pyobj, SWIG_This());
-            if (obj) {
-                Py_DECREF(obj);
-            }
-            else {
-                if (PyErr_Occurred()) { PyErr_Clear(); }
-                return 0;
-            }
-        }
-    }
+    if (pyobj && SwigPyObject_Check(pyobj))
+      return (SwigPyObject*) pyobj;
+  }
+  return NULL;
 #else
-    obj = PyObject_GetAttr(pyobj, SWIG_This());
-    if (obj) {
-        Py_DECREF(obj);
-    }
-    else {
-        if (PyErr_Occurred()) { PyErr_Clear(); }
-        return 0;
-    }
-#endif
-    if (obj && !SwigPyObject_Check(obj)) {
-        /* a PyObject is called 'this', try to get the 'real this'
-           SwigPyObject from it */
-        return SWIG_Python_GetSwigThis(obj);
-    }
-    return (SwigPyObject *)obj;
+
+  obj = 0;
+
+  obj = PyObject_GetAttr(pyobj, SWIG_This());
+  if (obj) {
+    SWIG_Py_DECREF(obj);
+  } else {
+    if (PyErr_Occurred()) PyErr_Clear();
+    return 0;
+  }
+  if (obj && !SwigPyObject_Check(obj)) {
+    /* a PyObject is called 'this', try to get the 'real this'
+       SwigPyObject from it */ 
+    return SWIG_Python_GetSwigThis(obj);
+  }
+  return (SwigPyObject *)obj;
 #endif
 }
 
 /* Acquire a pointer value */
 
 SWIGRUNTIME int
-SWIG_Python_AcquirePtr(PyObject *obj, int own)
-{
-    if (own == SWIG_POINTER_OWN) {
-        SwigPyObject *sobj = SWIG_Python_GetSwigThis(obj);
-        if (sobj) {
-            int oldown = sobj->own;
-            sobj->own = own;
-            return oldown;
-        }
+SWIG_Python_AcquirePtr(PyObject *obj, int own) {
+  if (own == SWIG_POINTER_OWN) {
+    SwigPyObject *sobj = SWIG_Python_GetSwigThis(obj);
+    if (sobj) {
+      int oldown = sobj->own;
+      sobj->own = own;
+      return oldown;
     }
-    return 0;
+  }
+  return 0;
 }
 
 /* Convert a pointer value */
 
 SWIGRUNTIME int
-SWIG_Python_ConvertPtrAndOwn(PyObject *obj, void **ptr, swig_type_info *ty, int flags, int *own)
-{
-    int res;
-    SwigPyObject *sobj;
-    int implicit_conv = (flags & SWIG_POINTER_IMPLICIT_CONV) != 0;
-
-    if (!obj) {
-        return SWIG_ERROR;
-    }
-    if (obj == Py_None && !implicit_conv) {
-        if (ptr) {
-            *ptr = 0;
-        }
-        return SWIG_OK;
-    }
-
-    res = SWIG_ERROR;
-
-    sobj = SWIG_Python_GetSwigThis(obj);
-    if (own) {
-        *own = 0;
-    }
-    while (sobj) {
-        void *vptr = sobj->ptr;
-        if (ty) {
-            swig_type_info *to = sobj->ty;
-            if (to == ty) {
-                /* no type cast needed */
-                if (ptr) { *ptr = vptr; }
-                break;
-            }
-            else {
-                swig_cast_info *tc = SWIG_TypeCheck(to->name, ty);
-                if (!tc) {
-                    sobj = (SwigPyObject *)sobj->next;
-                }
-                else {
-                    if (ptr) {
-                        int newmemory = 0;
-                        *ptr = SWIG_TypeCast(tc, vptr, &newmemory);
-                        if (newmemory == SWIG_CAST_NEW_MEMORY) {
-                            assert(own); /* badly formed typemap which will lead to a memory leak - it must set and use own to delete *ptr */
-                            if (own) {
-                                *own = *own | SWIG_CAST_NEW_MEMORY;
-                            }
-                        }
-                    }
-                    break;
-                }
+SWIG_Python_ConvertPtrAndOwn(PyObject *obj, void **ptr, swig_type_info *ty, int flags, int *own) {
+  int res;
+  SwigPyObject *sobj;
+  int implicit_conv = (flags & SWIG_POINTER_IMPLICIT_CONV) != 0;
+
+  if (!obj)
+    return SWIG_ERROR;
+  if (obj == Py_None && !implicit_conv) {
+    if (ptr)
+      *ptr = 0;
+    return (flags & SWIG_POINTER_NO_NULL) ? SWIG_NullReferenceError : SWIG_OK;
+  }
+
+  res = SWIG_ERROR;
+
+  sobj = SWIG_Python_GetSwigThis(obj);
+  if (own)
+    *own = 0;
+  while (sobj) {
+    void *vptr = sobj->ptr;
+    if (ty) {
+      swig_type_info *to = sobj->ty;
+      if (to == ty) {
+        /* no type cast needed */
+        if (ptr) *ptr = vptr;
+        break;
+      } else {
+        swig_cast_info *tc = SWIG_TypeCheck(to->name,ty);
+        if (!tc) {
+          sobj = (SwigPyObject *)sobj->next;
+        } else {
+          if (ptr) {
+            int newmemory = 0;
+            *ptr = SWIG_TypeCast(tc,vptr,&newmemory);
+            if (newmemory == SWIG_CAST_NEW_MEMORY) {
+              assert(own); /* badly formed typemap which will lead to a memory leak - it must set and use own to delete *ptr */
+              if (own)
+                *own = *own | SWIG_CAST_NEW_MEMORY;
             }
+          }
+          break;
         }
-        else {
-            if (ptr) { *ptr = vptr; }
-            break;
-        }
-    }
-    if (sobj) {
-        if (own) {
-            *own = *own | sobj->own;
-        }
-        if (flags & SWIG_POINTER_DISOWN) {
-            sobj->own = 0;
-        }
-        res = SWIG_OK;
+      }
+    } else {
+      if (ptr) *ptr = vptr;
+      break;
     }
-    else {
-        if (implicit_conv) {
-            SwigPyClientData *data = ty ? (SwigPyClientData *) ty->clientdata : 0;
-            if (data && !data->implicitconv) {
-                PyObject *klass = data->klass;
-                if (klass) {
-                    PyObject *impconv;
-                    data->implicitconv = 1; /* avoid recursion and call 'explicit' constructors*/
-                    impconv = SWIG_Python_CallFunctor(klass, obj);
-                    data->implicitconv = 0;
-                    if (PyErr_Occurred()) {
-                        PyErr_Clear();
-                        impconv = 0;
-                    }
-                    if (impconv) {
-                        SwigPyObject *iobj = SWIG_Python_GetSwigThis(impconv);
-                        if (iobj) {
-                            void *vptr;
-                            res = SWIG_Python_ConvertPtrAndOwn((PyObject*)iobj, &vptr, ty, 0, 0);
-                            if (SWIG_IsOK(res)) {
-                                if (ptr) {
-                                    *ptr = vptr;
-                                    /* transfer the ownership to 'ptr' */
-                                    iobj->own = 0;
-                                    res = SWIG_AddCast(res);
-                                    res = SWIG_AddNewMask(res);
-                                }
-                                else {
-                                    res = SWIG_AddCast(res);
-                                }
-                            }
-                        }
-                        Py_DECREF(impconv);
-                    }
+  }
+  if (sobj) {
+    if (((flags & SWIG_POINTER_RELEASE) == SWIG_POINTER_RELEASE) && !sobj->own) {
+      res = SWIG_ERROR_RELEASE_NOT_OWNED;
+    } else {
+      if (own)
+        *own = *own | sobj->own;
+      if (flags & SWIG_POINTER_DISOWN) {
+        sobj->own = 0;
+      }
+      if (flags & SWIG_POINTER_CLEAR) {
+        sobj->ptr = 0;
+      }
+      res = SWIG_OK;
+    }
+  } else {
+    if (implicit_conv) {
+      SwigPyClientData *data = ty ? (SwigPyClientData *) ty->clientdata : 0;
+      if (data && !data->implicitconv) {
+        PyObject *klass = data->klass;
+        if (klass) {
+          PyObject *impconv;
+          data->implicitconv = 1; /* avoid recursion and call 'explicit' constructors*/
+          impconv = SWIG_Python_CallFunctor(klass, obj);
+          data->implicitconv = 0;
+          if (PyErr_Occurred()) {
+            PyErr_Clear();
+            impconv = 0;
+          }
+          if (impconv) {
+            SwigPyObject *iobj = SWIG_Python_GetSwigThis(impconv);
+            if (iobj) {
+              void *vptr;
+              res = SWIG_Python_ConvertPtrAndOwn((PyObject*)iobj, &vptr, ty, 0, 0);
+              if (SWIG_IsOK(res)) {
+                if (ptr) {
+                  *ptr = vptr;
+                  /* transfer the ownership to 'ptr' */
+                  iobj->own = 0;
+                  res = SWIG_AddCast(res);
+                  res = SWIG_AddNewMask(res);
+                } else {
+                  res = SWIG_AddCast(res);		    
                 }
+              }
             }
+            SWIG_Py_DECREF(impconv);
+          }
         }
-        if (!SWIG_IsOK(res) && obj == Py_None) {
-            if (ptr) {
-                *ptr = 0;
-            }
-            if (PyErr_Occurred()) {
-                PyErr_Clear();
-            }
-            res = SWIG_OK;
-        }
+      }
+      if (!SWIG_IsOK(res) && obj == Py_None) {
+        if (ptr)
+          *ptr = 0;
+        if (PyErr_Occurred())
+          PyErr_Clear();
+        res = SWIG_OK;
+      }
     }
-    return res;
+  }
+  return res;
 }
 
 /* Convert a function ptr value */
 
 SWIGRUNTIME int
-SWIG_Python_ConvertFunctionPtr(PyObject *obj, void **ptr, swig_type_info *ty)
-{
-    if (!PyCFunction_Check(obj)) {
-        return SWIG_ConvertPtr(obj, ptr, ty, 0);
-    }
-    else {
-        void *vptr = 0;
-
-        /* here we get the method pointer for callbacks */
-        const char *doc = (((PyCFunctionObject *)obj) -> m_ml -> ml_doc);
-        const char *desc = doc ? strstr(doc, "swig_ptr: ") : 0;
-        if (desc) {
-            desc = ty ? SWIG_UnpackVoidPtr(desc + 10, &vptr, ty->name) : 0;
-        }
-        if (!desc) {
-            return SWIG_ERROR;
-        }
-        if (ty) {
-            swig_cast_info *tc = SWIG_TypeCheck(desc, ty);
-            if (tc) {
-                int newmemory = 0;
-                *ptr = SWIG_TypeCast(tc, vptr, &newmemory);
-                assert(!newmemory); /* newmemory handling not yet implemented */
-            }
-            else {
-                return SWIG_ERROR;
-            }
-        }
-        else {
-            *ptr = vptr;
-        }
-        return SWIG_OK;
+SWIG_Python_ConvertFunctionPtr(PyObject *obj, void **ptr, swig_type_info *ty) {
+  if (!PyCFunction_Check(obj)) {
+    return SWIG_ConvertPtr(obj, ptr, ty, 0);
+  } else {
+    void *vptr = 0;
+    swig_cast_info *tc;
+
+    /* here we get the method pointer for callbacks */
+#ifndef Py_LIMITED_API
+    const char *doc = (((PyCFunctionObject *)obj) -> m_ml -> ml_doc);
+#else
+    PyObject* pystr_doc = PyObject_GetAttrString(obj, "__doc__");
+    PyObject *bytes = NULL;
+    const char *doc = pystr_doc ? SWIG_PyUnicode_AsUTF8AndSize(pystr_doc, NULL, &bytes) : 0;
+#endif
+    const char *desc = doc ? strstr(doc, "swig_ptr: ") : 0;
+    if (desc)
+      desc = ty ? SWIG_UnpackVoidPtr(desc + 10, &vptr, ty->name) : 0;
+#ifdef Py_LIMITED_API
+    SWIG_Py_XDECREF(bytes);
+    SWIG_Py_XDECREF(pystr_doc);
+#endif
+    if (!desc)
+      return SWIG_ERROR;
+    tc = SWIG_TypeCheck(desc,ty);
+    if (tc) {
+      int newmemory = 0;
+      *ptr = SWIG_TypeCast(tc,vptr,&newmemory);
+      assert(!newmemory); /* newmemory handling not yet implemented */
+    } else {
+      return SWIG_ERROR;
     }
+    return SWIG_OK;
+  }
 }
 
-/* Convert a packed value value */
+/* Convert a packed pointer value */
 
 SWIGRUNTIME int
-SWIG_Python_ConvertPacked(PyObject *obj, void *ptr, size_t sz, swig_type_info *ty)
-{
-    swig_type_info *to = SwigPyPacked_UnpackData(obj, ptr, sz);
-    if (!to) { return SWIG_ERROR; }
-    if (ty) {
-        if (to != ty) {
-            /* check type cast? */
-            swig_cast_info *tc = SWIG_TypeCheck(to->name, ty);
-            if (!tc) { return SWIG_ERROR; }
-        }
-    }
-    return SWIG_OK;
-}
+SWIG_Python_ConvertPacked(PyObject *obj, void *ptr, size_t sz, swig_type_info *ty) {
+  swig_type_info *to = SwigPyPacked_UnpackData(obj, ptr, sz);
+  if (!to) return SWIG_ERROR;
+  if (ty) {
+    if (to != ty) {
+      /* check type cast? */
+      swig_cast_info *tc = SWIG_TypeCheck(to->name,ty);
+      if (!tc) return SWIG_ERROR;
+    }
+  }
+  return SWIG_OK;
+}  
 
 /* -----------------------------------------------------------------------------
  * Create a new pointer object
@@ -2549,345 +2820,256 @@ SWIG_Python_ConvertPacked(PyObject *obj, void *ptr, size_t sz, swig_type_info *t
   'this' attribute.
 */
 
-SWIGRUNTIME PyObject*
+SWIGRUNTIME PyObject* 
 SWIG_Python_NewShadowInstance(SwigPyClientData *data, PyObject *swig_this)
 {
-#if (PY_VERSION_HEX >= 0x02020000)
-    PyObject *inst = 0;
-    PyObject *newraw = data->newraw;
-    if (newraw) {
-        inst = PyObject_Call(newraw, data->newargs, NULL);
-        if (inst) {
-#if !defined(SWIG_PYTHON_SLOW_GETSET_THIS)
-            PyObject **dictptr = _PyObject_GetDictPtr(inst);
-            if (dictptr != NULL) {
-                PyObject *dict = *dictptr;
-                if (dict == NULL) {
-                    dict = PyDict_New();
-                    *dictptr = dict;
-                    PyDict_SetItem(dict, SWIG_This(), swig_this);
-                }
-            }
+  PyObject *inst = 0;
+  PyObject *newraw = data->newraw;
+  if (newraw) {
+    inst = PyObject_Call(newraw, data->newargs, NULL);
+    if (inst) {
+      if (PyObject_SetAttr(inst, SWIG_This(), swig_this) == -1) {
+        SWIG_Py_DECREF(inst);
+        inst = 0;
+      }
+    }
+  } else {
+    PyObject *empty_args = PyTuple_New(0);
+    if (empty_args) {
+      PyObject *empty_kwargs = PyDict_New();
+      if (empty_kwargs) {
+#ifndef Py_LIMITED_API
+        newfunc newfn = ((PyTypeObject *)data->newargs)->tp_new;
 #else
-            PyObject *key = SWIG_This();
-            PyObject_SetAttr(inst, key, swig_this);
+        newfunc newfn = (newfunc)PyType_GetSlot((PyTypeObject *)data->newargs, Py_tp_new);
 #endif
-        }
-    }
-    else {
-#if PY_VERSION_HEX >= 0x03000000
-        inst = PyBaseObject_Type.tp_new((PyTypeObject*) data->newargs, Py_None, Py_None);
+        inst = newfn((PyTypeObject *)data->newargs, empty_args, empty_kwargs);
+        SWIG_Py_DECREF(empty_kwargs);
         if (inst) {
-            PyObject_SetAttr(inst, SWIG_This(), swig_this);
-            Py_TYPE(inst)->tp_flags &= ~Py_TPFLAGS_VALID_VERSION_TAG;
-        }
-#else
-        PyObject *dict = PyDict_New();
-        if (dict) {
-            PyDict_SetItem(dict, SWIG_This(), swig_this);
-            inst = PyInstance_NewRaw(data->newargs, dict);
-            Py_DECREF(dict);
+          if (PyObject_SetAttr(inst, SWIG_This(), swig_this) == -1) {
+            SWIG_Py_DECREF(inst);
+            inst = 0;
+          } else {
+            PyType_Modified(Py_TYPE(inst));
+          }
         }
-#endif
-    }
-    return inst;
-#else
-#if (PY_VERSION_HEX >= 0x02010000)
-    PyObject *inst = 0;
-    PyObject *dict = PyDict_New();
-    if (dict) {
-        PyDict_SetItem(dict, SWIG_This(), swig_this);
-        inst = PyInstance_NewRaw(data->newargs, dict);
-        Py_DECREF(dict);
-    }
-    return (PyObject *) inst;
-#else
-    PyInstanceObject *inst = PyObject_NEW(PyInstanceObject, &PyInstance_Type);
-    if (inst == NULL) {
-        return NULL;
-    }
-    inst->in_class = (PyClassObject *)data->newargs;
-    Py_INCREF(inst->in_class);
-    inst->in_dict = PyDict_New();
-    if (inst->in_dict == NULL) {
-        Py_DECREF(inst);
-        return NULL;
+      }
+      SWIG_Py_DECREF(empty_args);
     }
-#ifdef Py_TPFLAGS_HAVE_WEAKREFS
-    inst->in_weakreflist = NULL;
-#endif
-#ifdef Py_TPFLAGS_GC
-    PyObject_GC_Init(inst);
-#endif
-    PyDict_SetItem(inst->in_dict, SWIG_This(), swig_this);
-    return (PyObject *) inst;
-#endif
-#endif
+  }
+  return inst;
 }
 
-SWIGRUNTIME void
+SWIGRUNTIME int
 SWIG_Python_SetSwigThis(PyObject *inst, PyObject *swig_this)
 {
-    PyObject *dict;
-#if (PY_VERSION_HEX >= 0x02020000) && !defined(SWIG_PYTHON_SLOW_GETSET_THIS)
-    PyObject **dictptr = _PyObject_GetDictPtr(inst);
-    if (dictptr != NULL) {
-        dict = *dictptr;
-        if (dict == NULL) {
-            dict = PyDict_New();
-            *dictptr = dict;
-        }
-        PyDict_SetItem(dict, SWIG_This(), swig_this);
-        return;
-    }
-#endif
-    dict = PyObject_GetAttrString(inst, (char*)"__dict__");
-    PyDict_SetItem(dict, SWIG_This(), swig_this);
-    Py_DECREF(dict);
-}
+  return PyObject_SetAttr(inst, SWIG_This(), swig_this);
+} 
 
 
 SWIGINTERN PyObject *
-SWIG_Python_InitShadowInstance(PyObject *args)
-{
-    PyObject *obj[2];
-    if (!SWIG_Python_UnpackTuple(args, "swiginit", 2, 2, obj)) {
+SWIG_Python_InitShadowInstance(PyObject *args) {
+  PyObject *obj[2];
+  if (!SWIG_Python_UnpackTuple(args, "swiginit", 2, 2, obj)) {
+    return NULL;
+  } else {
+    SwigPyObject *sthis = SWIG_Python_GetSwigThis(obj[0]);
+    if (sthis) {
+      SWIG_Py_DECREF(SwigPyObject_append((PyObject*) sthis, obj[1]));
+    } else {
+      if (SWIG_Python_SetSwigThis(obj[0], obj[1]) != 0)
         return NULL;
     }
-    else {
-        SwigPyObject *sthis = SWIG_Python_GetSwigThis(obj[0]);
-        if (sthis) {
-            SwigPyObject_append((PyObject*) sthis, obj[1]);
-        }
-        else {
-            SWIG_Python_SetSwigThis(obj[0], obj[1]);
-        }
-        return SWIG_Py_Void();
-    }
+    return SWIG_Py_Void();
+  }
 }
 
 /* Create a new pointer object */
 
 SWIGRUNTIME PyObject *
-SWIG_Python_NewPointerObj(PyObject *self, void *ptr, swig_type_info *type, int flags)
-{
-    SwigPyClientData *clientdata;
-    PyObject * robj;
-    int own;
+SWIG_Python_NewPointerObj(PyObject *self, void *ptr, swig_type_info *type, int flags) {
+  SwigPyClientData *clientdata;
+  PyObject * robj;
+  int own;
 
-    if (!ptr) {
-        return SWIG_Py_Void();
-    }
+  if (!ptr)
+    return SWIG_Py_Void();
 
-    clientdata = type ? (SwigPyClientData *)(type->clientdata) : 0;
-    own = (flags & SWIG_POINTER_OWN) ? SWIG_POINTER_OWN : 0;
-    if (clientdata && clientdata->pytype) {
-        SwigPyObject *newobj;
-        if (flags & SWIG_BUILTIN_TP_INIT) {
-            newobj = (SwigPyObject*) self;
-            if (newobj->ptr) {
-                PyObject *next_self = clientdata->pytype->tp_alloc(clientdata->pytype, 0);
-                while (newobj->next) {
-                    newobj = (SwigPyObject *) newobj->next;
-                }
-                newobj->next = next_self;
-                newobj = (SwigPyObject *)next_self;
-            }
-        }
-        else {
-            newobj = PyObject_New(SwigPyObject, clientdata->pytype);
-        }
-        if (newobj) {
-            newobj->ptr = ptr;
-            newobj->ty = type;
-            newobj->own = own;
-            newobj->next = 0;
-#ifdef SWIGPYTHON_BUILTIN
-            newobj->dict = 0;
-#endif
-            return (PyObject*) newobj;
-        }
-        return SWIG_Py_Void();
+  clientdata = type ? (SwigPyClientData *)(type->clientdata) : 0;
+  own = (flags & SWIG_POINTER_OWN) ? SWIG_POINTER_OWN : 0;
+  if (clientdata && clientdata->pytype) {
+    SwigPyObject *newobj;
+    if (flags & SWIG_BUILTIN_TP_INIT) {
+      newobj = (SwigPyObject*) self;
+      if (newobj->ptr) {
+#ifndef Py_LIMITED_API
+        allocfunc alloc = clientdata->pytype->tp_alloc;
+#else
+        allocfunc alloc = (allocfunc)PyType_GetSlot(clientdata->pytype, Py_tp_alloc);
+#endif
+        PyObject *next_self = alloc(clientdata->pytype, 0);
+        while (newobj->next)
+	  newobj = (SwigPyObject *) newobj->next;
+        newobj->next = next_self;
+        newobj = (SwigPyObject *)next_self;
+        newobj->swigdict = 0;
+        newobj->weakreflist = 0;
+      }
+    } else {
+      newobj = PyObject_New(SwigPyObject, clientdata->pytype);
+      if (newobj) {
+        newobj->swigdict = 0;
+        newobj->weakreflist = 0;
+      }
     }
+    if (newobj) {
+      newobj->ptr = ptr;
+      newobj->ty = type;
+      newobj->own = own;
+      newobj->next = 0;
+      return (PyObject*) newobj;
+    }
+    return SWIG_Py_Void();
+  }
 
-    assert(!(flags & SWIG_BUILTIN_TP_INIT));
+  assert(!(flags & SWIG_BUILTIN_TP_INIT));
 
-    robj = SwigPyObject_New(ptr, type, own);
-    if (robj && clientdata && !(flags & SWIG_POINTER_NOSHADOW)) {
-        PyObject *inst = SWIG_Python_NewShadowInstance(clientdata, robj);
-        Py_DECREF(robj);
-        robj = inst;
-    }
-    return robj;
+  robj = SwigPyObject_New(ptr, type, own);
+  if (robj && clientdata && !(flags & SWIG_POINTER_NOSHADOW)) {
+    PyObject *inst = SWIG_Python_NewShadowInstance(clientdata, robj);
+    SWIG_Py_DECREF(robj);
+    robj = inst;
+  }
+  return robj;
 }
 
 /* Create a new packed object */
 
 SWIGRUNTIMEINLINE PyObject *
-SWIG_Python_NewPackedObj(void *ptr, size_t sz, swig_type_info *type)
-{
-    return ptr ? SwigPyPacked_New((void *) ptr, sz, type) : SWIG_Py_Void();
+SWIG_Python_NewPackedObj(void *ptr, size_t sz, swig_type_info *type) {
+  return ptr ? SwigPyPacked_New((void *) ptr, sz, type) : SWIG_Py_Void();
 }
 
 /* -----------------------------------------------------------------------------*
- *  Get type list
+ *  Get type list 
  * -----------------------------------------------------------------------------*/
 
 #ifdef SWIG_LINK_RUNTIME
 void *SWIG_ReturnGlobalTypeList(void *);
 #endif
 
+static PyObject *Swig_TypeCache_global = NULL;
+
+/* The python cached type query */
+SWIGRUNTIME PyObject *
+SWIG_Python_TypeCache(void) {
+  if (Swig_TypeCache_global == NULL) {
+    Swig_TypeCache_global = PyDict_New();
+  }
+  return Swig_TypeCache_global;
+}
+
 SWIGRUNTIME swig_module_info *
-SWIG_Python_GetModule(void *SWIGUNUSEDPARM(clientdata))
-{
-    static void *type_pointer = (void *)0;
-    /* first check if module already created */
-    if (!type_pointer) {
+SWIG_Python_GetModule(void *SWIGUNUSEDPARM(clientdata)) {
 #ifdef SWIG_LINK_RUNTIME
-        type_pointer = SWIG_ReturnGlobalTypeList((void *)0);
+  static void *type_pointer = (void *)0;
+  /* first check if module already created */
+  if (!type_pointer) {
+    type_pointer = SWIG_ReturnGlobalTypeList((void *)0);
+  }
 #else
-# ifdef SWIGPY_USE_CAPSULE
-        type_pointer = PyCapsule_Import(SWIGPY_CAPSULE_NAME, 0);
-# else
-        type_pointer = PyCObject_Import((char*)"swig_runtime_data" SWIG_RUNTIME_VERSION,
-                                        (char*)"type_pointer" SWIG_TYPE_TABLE_NAME);
-# endif
-        if (PyErr_Occurred()) {
-            PyErr_Clear();
-            type_pointer = (void *)0;
-        }
+  void *type_pointer = PyCapsule_Import(SWIGPY_CAPSULE_NAME, 0);
+  if (PyErr_Occurred()) {
+    PyErr_Clear();
+    type_pointer = (void *)0;
+  }
 #endif
-    }
-    return (swig_module_info *) type_pointer;
+  return (swig_module_info *) type_pointer;
 }
 
-#if PY_MAJOR_VERSION < 2
-/* PyModule_AddObject function was introduced in Python 2.0.  The following function
-   is copied out of Python/modsupport.c in python version 2.3.4 */
-SWIGINTERN int
-PyModule_AddObject(PyObject *m, char *name, PyObject *o)
-{
-    PyObject *dict;
-    if (!PyModule_Check(m)) {
-        PyErr_SetString(PyExc_TypeError,
-                        "PyModule_AddObject() needs module as first arg");
-        return SWIG_ERROR;
-    }
-    if (!o) {
-        PyErr_SetString(PyExc_TypeError,
-                        "PyModule_AddObject() needs non-NULL value");
-        return SWIG_ERROR;
-    }
 
-    dict = PyModule_GetDict(m);
-    if (dict == NULL) {
-        /* Internal error -- modules must have a dict! */
-        PyErr_Format(PyExc_SystemError, "module '%s' has no __dict__",
-                     PyModule_GetName(m));
-        return SWIG_ERROR;
-    }
-    if (PyDict_SetItemString(dict, name, o)) {
-        return SWIG_ERROR;
-    }
-    Py_DECREF(o);
-    return SWIG_OK;
-}
+#if defined(SWIG_REFCNT_DEBUG)
+#define SWIG_PYOBJ_REFCNT(OBJ) fprintf(stdout, "" #OBJ " count %ld\n", (OBJ ? Py_REFCNT(OBJ) : 0))
+#else
+#define SWIG_PYOBJ_REFCNT(OBJ)
 #endif
 
+static int interpreter_counter = 0; /* how many (sub-)interpreters are using swig_module's types */
+
 SWIGRUNTIME void
-#ifdef SWIGPY_USE_CAPSULE
 SWIG_Python_DestroyModule(PyObject *obj)
-#else
-SWIG_Python_DestroyModule(void *vptr)
-#endif
 {
-#ifdef SWIGPY_USE_CAPSULE
-    swig_module_info *swig_module = (swig_module_info *) PyCapsule_GetPointer(obj, SWIGPY_CAPSULE_NAME);
-#else
-    swig_module_info *swig_module = (swig_module_info *) vptr;
-#endif
-    swig_type_info **types = swig_module->types;
-    size_t i;
-    for (i = 0; i < swig_module->size; ++i) {
-        swig_type_info *ty = types[i];
-        if (ty->owndata) {
-            SwigPyClientData *data = (SwigPyClientData *) ty->clientdata;
-            if (data) { SwigPyClientData_Del(data); }
-        }
+  swig_module_info *swig_module = (swig_module_info *) PyCapsule_GetPointer(obj, SWIGPY_CAPSULE_NAME);
+  swig_type_info **types = swig_module->types;
+  size_t i;
+  if (--interpreter_counter != 0) /* another sub-interpreter may still be using the swig_module's types */
+    return;
+  for (i = 0; i < swig_module->size; ++i) {
+    swig_type_info *ty = types[i];
+    if (ty->owndata) {
+      SwigPyClientData *data = (SwigPyClientData *) ty->clientdata;
+      ty->clientdata = 0;
+      if (data) SwigPyClientData_Del(data);
     }
-    Py_DECREF(SWIG_This());
-    swig_this = NULL;
+  }
+  SWIG_PYOBJ_REFCNT(Swig_This_global);
+  SWIG_Py_XDECREF(Swig_This_global);
+  Swig_This_global = NULL;
+
+  SWIG_PYOBJ_REFCNT(Swig_Globals_global);
+  SWIG_Py_XDECREF(Swig_Globals_global);
+  Swig_Globals_global = NULL;
+
+  SWIG_PYOBJ_REFCNT(Swig_TypeCache_global);
+  SWIG_Py_XDECREF(Swig_TypeCache_global);
+  Swig_TypeCache_global = NULL;
+
+  SWIG_PYOBJ_REFCNT(Swig_Capsule_global);
+  Swig_Capsule_global = NULL;
+
+  SWIG_PYOBJ_REFCNT(Swig_runtime_data_module_global);
+  SWIG_Py_XDECREF(Swig_runtime_data_module_global);
+  Swig_runtime_data_module_global = NULL;
 }
 
 SWIGRUNTIME void
-SWIG_Python_SetModule(swig_module_info *swig_module)
-{
-#if PY_VERSION_HEX >= 0x03000000
-    /* Add a dummy module object into sys.modules */
-    PyObject *module = PyImport_AddModule((char*)"swig_runtime_data" SWIG_RUNTIME_VERSION);
-#else
-    static PyMethodDef swig_empty_runtime_method_table[] = { {NULL, NULL, 0, NULL} }; /* Sentinel */
-    PyObject *module = Py_InitModule((char*)"swig_runtime_data" SWIG_RUNTIME_VERSION, swig_empty_runtime_method_table);
-#endif
-#ifdef SWIGPY_USE_CAPSULE
-    PyObject *pointer = PyCapsule_New((void *) swig_module, SWIGPY_CAPSULE_NAME, SWIG_Python_DestroyModule);
-    if (pointer && module) {
-        PyModule_AddObject(module, (char*)"type_pointer_capsule" SWIG_TYPE_TABLE_NAME, pointer);
-    }
-    else {
-        Py_XDECREF(pointer);
-    }
-#else
-    PyObject *pointer = PyCObject_FromVoidPtr((void *) swig_module, SWIG_Python_DestroyModule);
-    if (pointer && module) {
-        PyModule_AddObject(module, (char*)"type_pointer" SWIG_TYPE_TABLE_NAME, pointer);
-    }
-    else {
-        Py_XDECREF(pointer);
+SWIG_Python_SetModule(swig_module_info *swig_module) {
+  PyObject *runtime_data_module = SWIG_runtime_data_module();
+  PyObject *pointer = PyCapsule_New((void *) swig_module, SWIGPY_CAPSULE_NAME, SWIG_Python_DestroyModule);
+  if (pointer && runtime_data_module) {
+    if (PyModule_AddObject(runtime_data_module, SWIGPY_CAPSULE_ATTR_NAME, pointer) == 0) {
+      ++interpreter_counter;
+      Swig_Capsule_global = pointer;
+    } else {
+      SWIG_Py_DECREF(pointer);
     }
-#endif
-}
-
-/* The python cached type query */
-SWIGRUNTIME PyObject *
-SWIG_Python_TypeCache(void)
-{
-    static PyObject *SWIG_STATIC_POINTER(cache) = PyDict_New();
-    return cache;
+  } else {
+    SWIG_Py_XDECREF(pointer);
+  }
 }
 
 SWIGRUNTIME swig_type_info *
 SWIG_Python_TypeQuery(const char *type)
 {
-    PyObject *cache = SWIG_Python_TypeCache();
-    PyObject *key = SWIG_Python_str_FromChar(type);
-    PyObject *obj = PyDict_GetItem(cache, key);
-    swig_type_info *descriptor;
-    if (obj) {
-#ifdef SWIGPY_USE_CAPSULE
-        descriptor = (swig_type_info *) PyCapsule_GetPointer(obj, NULL);
-#else
-        descriptor = (swig_type_info *) PyCObject_AsVoidPtr(obj);
-#endif
-    }
-    else {
-        swig_module_info *swig_module = SWIG_GetModule(0);
-        descriptor = SWIG_TypeQueryModule(swig_module, swig_module, type);
-        if (descriptor) {
-#ifdef SWIGPY_USE_CAPSULE
-            obj = PyCapsule_New((void*) descriptor, NULL, NULL);
-#else
-            obj = PyCObject_FromVoidPtr(descriptor, NULL);
-#endif
-            PyDict_SetItem(cache, key, obj);
-            Py_DECREF(obj);
-        }
-    }
-    Py_DECREF(key);
-    return descriptor;
-}
-
-/*
+  swig_type_info *descriptor;
+  PyObject *cache = SWIG_Python_TypeCache();
+  PyObject *obj;
+  SWIG_PyDict_GetItemStringRef(cache, type, &obj);
+  if (obj) {
+    descriptor = (swig_type_info *) PyCapsule_GetPointer(obj, NULL);
+  } else {
+    swig_module_info *swig_module = SWIG_GetModule(0);
+    descriptor = SWIG_TypeQueryModule(swig_module, swig_module, type);
+    if (descriptor) {
+      obj = PyCapsule_New((void*) descriptor, NULL, NULL);
+      if (obj) PyDict_SetItemString(cache, type, obj);
+    }
+  }
+  SWIG_Py_XDECREF(obj);
+  return descriptor;
+}
+
+/* 
    For backward compatibility only
 */
 #define SWIG_POINTER_EXCEPTION  0
@@ -2896,171 +3078,118 @@ SWIG_Python_TypeQuery(const char *type)
 
 SWIGRUNTIME int
 SWIG_Python_AddErrMesg(const char* mesg, int infront)
-{
-    if (PyErr_Occurred()) {
-        PyObject *type = 0;
-        PyObject *value = 0;
-        PyObject *traceback = 0;
-        PyErr_Fetch(&type, &value, &traceback);
-        if (value) {
-            char *tmp;
-            PyObject *old_str = PyObject_Str(value);
-            Py_XINCREF(type);
-            PyErr_Clear();
-            if (infront) {
-                PyErr_Format(type, "%s %s", mesg, tmp = SWIG_Python_str_AsChar(old_str));
-            }
-            else {
-                PyErr_Format(type, "%s %s", tmp = SWIG_Python_str_AsChar(old_str), mesg);
-            }
-            SWIG_Python_str_DelForPy3(tmp);
-            Py_DECREF(old_str);
-        }
-        return 1;
-    }
-    else {
-        return 0;
+{  
+  if (PyErr_Occurred()) {
+    PyObject *type = 0;
+    PyObject *value = 0;
+    PyObject *traceback = 0;
+    PyErr_Fetch(&type, &value, &traceback);
+    if (value) {
+      PyObject *old_str = PyObject_Str(value);
+      PyObject *bytes = NULL;
+      const char *tmp = SWIG_PyUnicode_AsUTF8AndSize(old_str, NULL, &bytes);
+      const char *errmesg = tmp ? tmp : "Invalid error message";
+      SWIG_Py_XINCREF(type);
+      PyErr_Clear();
+      if (infront) {
+	PyErr_Format(type, "%s %s", mesg, errmesg);
+      } else {
+	PyErr_Format(type, "%s %s", errmesg, mesg);
+      }
+      SWIG_Py_XDECREF(bytes);
+      SWIG_Py_DECREF(old_str);
     }
+    return 1;
+  } else {
+    return 0;
+  }
 }
-
+  
 SWIGRUNTIME int
 SWIG_Python_ArgFail(int argnum)
 {
-    if (PyErr_Occurred()) {
-        /* add information about failing argument */
-        char mesg[256];
-        PyOS_snprintf(mesg, sizeof(mesg), "argument number %d:", argnum);
-        return SWIG_Python_AddErrMesg(mesg, 1);
-    }
-    else {
-        return 0;
-    }
+  if (PyErr_Occurred()) {
+    /* add information about failing argument */
+    char mesg[256];
+    PyOS_snprintf(mesg, sizeof(mesg), "argument number %d:", argnum);
+    return SWIG_Python_AddErrMesg(mesg, 1);
+  } else {
+    return 0;
+  }
 }
 
 SWIGRUNTIMEINLINE const char *
 SwigPyObject_GetDesc(PyObject *self)
 {
-    SwigPyObject *v = (SwigPyObject *)self;
-    swig_type_info *ty = v ? v->ty : 0;
-    return ty ? ty->str : "";
-}
-
-SWIGRUNTIME void
-SWIG_Python_TypeError(const char *type, PyObject *obj)
-{
-    if (type) {
-#if defined(SWIG_COBJECT_TYPES)
-        if (obj && SwigPyObject_Check(obj)) {
-            const char *otype = (const char *) SwigPyObject_GetDesc(obj);
-            if (otype) {
-                PyErr_Format(PyExc_TypeError, "a '%s' is expected, 'SwigPyObject(%s)' is received",
-                             type, otype);
-                return;
-            }
-        }
-        else
-#endif
-        {
-            const char *otype = (obj ? obj->ob_type->tp_name : 0);
-            if (otype) {
-                PyObject *str = PyObject_Str(obj);
-                const char *cstr = str ? SWIG_Python_str_AsChar(str) : 0;
-                if (cstr) {
-                    PyErr_Format(PyExc_TypeError, "a '%s' is expected, '%s(%s)' is received",
-                                 type, otype, cstr);
-                    SWIG_Python_str_DelForPy3(cstr);
-                }
-                else {
-                    PyErr_Format(PyExc_TypeError, "a '%s' is expected, '%s' is received",
-                                 type, otype);
-                }
-                Py_XDECREF(str);
-                return;
-            }
-        }
-        PyErr_Format(PyExc_TypeError, "a '%s' is expected", type);
-    }
-    else {
-        PyErr_Format(PyExc_TypeError, "unexpected type is received");
-    }
+  SwigPyObject *v = (SwigPyObject *)self;
+  swig_type_info *ty = v ? v->ty : 0;
+  return ty ? ty->str : "";
 }
 
-
 /* Convert a pointer value, signal an exception on a type mismatch */
 SWIGRUNTIME void *
-SWIG_Python_MustGetPtr(PyObject *obj, swig_type_info *ty, int SWIGUNUSEDPARM(argnum), int flags)
-{
-    void *result;
-    if (SWIG_Python_ConvertPtr(obj, &result, ty, flags) == -1) {
-        PyErr_Clear();
-#if SWIG_POINTER_EXCEPTION
-        if (flags) {
-            SWIG_Python_TypeError(SWIG_TypePrettyName(ty), obj);
-            SWIG_Python_ArgFail(argnum);
-        }
-#endif
-    }
-    return result;
+SWIG_Python_MustGetPtr(PyObject *obj, swig_type_info *ty, int SWIGUNUSEDPARM(argnum), int flags) {
+  void *result;
+  if (SWIG_Python_ConvertPtr(obj, &result, ty, flags) == -1) {
+    PyErr_Clear();
+  }
+  return result;
 }
 
 #ifdef SWIGPYTHON_BUILTIN
 SWIGRUNTIME int
-SWIG_Python_NonDynamicSetAttr(PyObject *obj, PyObject *name, PyObject *value)
-{
-    PyTypeObject *tp = obj->ob_type;
-    PyObject *descr;
-    PyObject *encoded_name;
-    descrsetfunc f;
-    int res = -1;
+SWIG_Python_NonDynamicSetAttr(PyObject *obj, PyObject *name, PyObject *value) {
+  PyTypeObject *tp = Py_TYPE(obj);
+  PyObject *descr;
+  PyObject *encoded_name;
+  descrsetfunc f;
+  int res = -1;
 
 # ifdef Py_USING_UNICODE
-    if (PyBytes_Check(name)) {
-        name = PyUnicode_Decode(PyBytes_AsString(name), PyBytes_Size(name), NULL, NULL);
-        if (!name) {
-            return -1;
-        }
-    }
-    else if (!PyUnicode_Check(name))
+  if (PyBytes_Check(name)) {
+    name = PyUnicode_Decode(PyBytes_AsString(name), PyBytes_Size(name), NULL, NULL);
+    if (!name)
+      return -1;
+  } else if (!PyUnicode_Check(name))
 # else
-    if (!PyBytes_Check(name))
+  if (!PyBytes_Check(name))
 # endif
-    {
-        PyErr_Format(PyExc_TypeError, "attribute name must be string, not '%.200s'", name->ob_type->tp_name);
-        return -1;
-    }
-    else {
-        Py_INCREF(name);
-    }
-
-    if (!tp->tp_dict) {
-        if (PyType_Ready(tp) < 0) {
-            goto done;
-        }
-    }
-
-    descr = _PyType_Lookup(tp, name);
-    f = NULL;
-    if (descr != NULL) {
-        f = descr->ob_type->tp_descr_set;
-    }
-    if (!f) {
-        if (PyBytes_Check(name)) {
-            encoded_name = name;
-            Py_INCREF(name);
-        }
-        else {
-            encoded_name = PyUnicode_AsUTF8String(name);
-        }
-        PyErr_Format(PyExc_AttributeError, "'%.100s' object has no attribute '%.200s'", tp->tp_name, PyBytes_AsString(encoded_name));
-        Py_DECREF(encoded_name);
-    }
-    else {
-        res = f(descr, obj, value);
+  {
+    PyObject *tpname = SWIG_PyType_GetFullyQualifiedName(Py_TYPE(name));
+    PyErr_Format(PyExc_TypeError, "attribute name must be string, not '%S'", tpname);
+    SWIG_Py_DECREF(tpname);
+    return -1;
+  } else {
+    SWIG_Py_INCREF(name);
+  }
+
+  if (!tp->tp_dict) {
+    if (PyType_Ready(tp) != 0)
+      goto done;
+  }
+
+  descr = _PyType_Lookup(tp, name);
+  f = NULL;
+  if (descr != NULL)
+    f = Py_TYPE(descr)->tp_descr_set;
+  if (!f) {
+    if (PyBytes_Check(name)) {
+      encoded_name = name;
+      SWIG_Py_INCREF(name);
+    } else {
+      encoded_name = PyUnicode_AsUTF8String(name);
+      if (!encoded_name)
+        goto done;
     }
-
-done:
-    Py_DECREF(name);
-    return res;
+    PyErr_Format(PyExc_AttributeError, "'%s' object has no attribute '%s'", tp->tp_name, PyBytes_AsString(encoded_name));
+    SWIG_Py_DECREF(encoded_name);
+  } else {
+    res = f(descr, obj, value);
+  }
+  
+  done:
+  SWIG_Py_DECREF(name);
+  return res;
 }
 #endif
 
@@ -3071,9 +3200,9 @@ done:
 
 
 
-#define SWIG_exception_fail(code, msg) do { SWIG_Error(code, msg); SWIG_fail; } while(0)
+#define SWIG_exception_fail(code, msg) do { SWIG_Error(code, msg); SWIG_fail; } while(0) 
 
-#define SWIG_contract_assert(expr, msg) if (!(expr)) { SWIG_Error(SWIG_RuntimeError, msg); SWIG_fail; } else
+#define SWIG_contract_assert(expr, msg) do { if (!(expr)) { SWIG_Error(SWIG_RuntimeError, msg); SWIG_fail; } } while (0) 
 
 
 
@@ -3089,94 +3218,145 @@ static swig_module_info swig_module = {swig_types, 3, 0, 0, 0, 0};
 
 /* -------- TYPES TABLE (END) -------- */
 
-#if (PY_VERSION_HEX <= 0x02000000)
-# if !defined(SWIG_PYTHON_CLASSIC)
-#  error "This python version requires swig to be run with the '-classic' option"
-# endif
+#ifdef SWIG_TypeQuery
+# undef SWIG_TypeQuery
 #endif
+#define SWIG_TypeQuery SWIG_Python_TypeQuery
 
 /*-----------------------------------------------
               @(target):= _htmc.so
   ------------------------------------------------*/
-#if PY_VERSION_HEX >= 0x03000000
-#  define SWIG_init    PyInit__htmc
+#define SWIG_init    PyInit__htmc
+
+
+#ifdef __cplusplus
+#include <utility>
+/* SwigValueWrapper is described in swig.swg */
+template<typename T> class SwigValueWrapper {
+  struct SwigSmartPointer {
+    T *ptr;
+    SwigSmartPointer(T *p) : ptr(p) { }
+    ~SwigSmartPointer() { delete ptr; }
+    SwigSmartPointer& operator=(SwigSmartPointer& rhs) { T* oldptr = ptr; ptr = 0; delete oldptr; ptr = rhs.ptr; rhs.ptr = 0; return *this; }
+    void reset(T *p) { T* oldptr = ptr; ptr = 0; delete oldptr; ptr = p; }
+  } pointer;
+  SwigValueWrapper& operator=(const SwigValueWrapper<T>& rhs);
+  SwigValueWrapper(const SwigValueWrapper<T>& rhs);
+public:
+  SwigValueWrapper() : pointer(0) { }
+  SwigValueWrapper& operator=(const T& t) { SwigSmartPointer tmp(new T(t)); pointer = tmp; return *this; }
+#if __cplusplus >= 201103L
+  SwigValueWrapper& operator=(T&& t) { SwigSmartPointer tmp(new T(std::move(t))); pointer = tmp; return *this; }
+  operator T&&() const { return std::move(*pointer.ptr); }
+#else
+  operator T&() const { return *pointer.ptr; }
+#endif
+  T *operator&() const { return pointer.ptr; }
+  static void reset(SwigValueWrapper& t, T *p) { t.pointer.reset(p); }
+};
+
+/*
+ * SwigValueInit() is a generic initialisation solution as the following approach:
+ * 
+ *       T c_result = T();
+ * 
+ * doesn't compile for all types for example:
+ * 
+ *       unsigned int c_result = unsigned int();
+ */
+template <typename T> T SwigValueInit() {
+  return T();
+}
 
+#if __cplusplus >= 201103L
+# define SWIG_STD_MOVE(OBJ) std::move(OBJ)
 #else
-#  define SWIG_init    init_htmc
+# define SWIG_STD_MOVE(OBJ) OBJ
+#endif
 
+#if __cplusplus >= 201103L
+# define SWIG_OVERRIDE override
+#else
+# define SWIG_OVERRIDE
 #endif
-#define SWIG_name    "_htmc"
 
-#define SWIGVERSION 0x020011
-#define SWIG_VERSION SWIGVERSION
+#endif
 
 
-#define SWIG_as_voidptr(a) const_cast< void * >(static_cast< const void * >(a))
-#define SWIG_as_voidptrptr(a) ((void)SWIG_as_voidptr(*a),reinterpret_cast< void** >(a))
+#define SWIG_as_voidptr(a) const_cast< void * >(static_cast< const void * >(a)) 
+#define SWIG_as_voidptrptr(a) ((void)SWIG_as_voidptr(*a),reinterpret_cast< void** >(a)) 
 
 
 #include <stdexcept>
 
 
 namespace swig {
-class SwigPtr_PyObject {
-protected:
+  class SwigPtr_PyObject {
+  protected:
     PyObject *_obj;
 
-public:
-    SwigPtr_PyObject() : _obj(0)
+  public:
+    SwigPtr_PyObject() :_obj(0)
     {
     }
 
     SwigPtr_PyObject(const SwigPtr_PyObject& item) : _obj(item._obj)
     {
-        Py_XINCREF(_obj);
+      SWIG_PYTHON_THREAD_BEGIN_BLOCK;
+      SWIG_Py_XINCREF(_obj);
+      SWIG_PYTHON_THREAD_END_BLOCK;
     }
-
-    SwigPtr_PyObject(PyObject *obj, bool initial_ref = true) : _obj(obj)
+    
+    SwigPtr_PyObject(PyObject *obj, bool initial_ref = true) :_obj(obj)
     {
-        if (initial_ref) {
-            Py_XINCREF(_obj);
-        }
+      if (initial_ref) {
+        SWIG_PYTHON_THREAD_BEGIN_BLOCK;
+        SWIG_Py_XINCREF(_obj);
+        SWIG_PYTHON_THREAD_END_BLOCK;
+      }
     }
-
-    SwigPtr_PyObject & operator=(const SwigPtr_PyObject& item)
+    
+    SwigPtr_PyObject & operator=(const SwigPtr_PyObject& item) 
     {
-        Py_XINCREF(item._obj);
-        Py_XDECREF(_obj);
-        _obj = item._obj;
-        return *this;
-    }
-
-    ~SwigPtr_PyObject()
+      SWIG_PYTHON_THREAD_BEGIN_BLOCK;
+      SWIG_Py_XINCREF(item._obj);
+      SWIG_Py_XDECREF(_obj);
+      _obj = item._obj;
+      SWIG_PYTHON_THREAD_END_BLOCK;
+      return *this;      
+    }
+    
+    ~SwigPtr_PyObject() 
     {
-        Py_XDECREF(_obj);
+      SWIG_PYTHON_THREAD_BEGIN_BLOCK;
+      SWIG_Py_XDECREF(_obj);
+      SWIG_PYTHON_THREAD_END_BLOCK;
     }
-
+    
     operator PyObject *() const
     {
-        return _obj;
+      return _obj;
     }
 
     PyObject *operator->() const
     {
-        return _obj;
+      return _obj;
     }
-};
+  };
 }
 
 
 namespace swig {
-struct SwigVar_PyObject : SwigPtr_PyObject {
+  struct SwigVar_PyObject : SwigPtr_PyObject {
     SwigVar_PyObject(PyObject* obj = 0) : SwigPtr_PyObject(obj, false) { }
-
+    
     SwigVar_PyObject & operator = (PyObject* obj)
     {
-        Py_XDECREF(_obj);
-        _obj = obj;
-        return *this;
+      SWIG_Py_XDECREF(_obj);
+      _obj = obj;
+      return *this;      
     }
-};
+  };
 }
 
 
@@ -3194,54 +3374,49 @@ struct SwigVar_PyObject : SwigPtr_PyObject {
 
 
 SWIGINTERN int
-SWIG_AsVal_double(PyObject *obj, double *val)
+SWIG_AsVal_double (PyObject *obj, double *val)
 {
-    int res = SWIG_TypeError;
-    if (PyFloat_Check(obj)) {
-        if (val) { *val = PyFloat_AsDouble(obj); }
-        return SWIG_OK;
-    }
-    else if (PyInt_Check(obj)) {
-        if (val) { *val = PyInt_AsLong(obj); }
-        return SWIG_OK;
-    }
-    else if (PyLong_Check(obj)) {
-        double v = PyLong_AsDouble(obj);
-        if (!PyErr_Occurred()) {
-            if (val) { *val = v; }
-            return SWIG_OK;
-        }
-        else {
-            PyErr_Clear();
-        }
+  int res = SWIG_TypeError;
+  if (PyFloat_Check(obj)) {
+    if (val) *val = PyFloat_AsDouble(obj);
+    return SWIG_OK;
+  } else if (PyLong_Check(obj)) {
+    double v = PyLong_AsDouble(obj);
+    if (!PyErr_Occurred()) {
+      if (val) *val = v;
+      return SWIG_OK;
+    } else {
+      PyErr_Clear();
     }
+  }
 #ifdef SWIG_PYTHON_CAST_MODE
-    {
-        int dispatch = 0;
-        double d = PyFloat_AsDouble(obj);
-        if (!PyErr_Occurred()) {
-            if (val) { *val = d; }
-            return SWIG_AddCast(SWIG_OK);
-        }
-        else {
-            PyErr_Clear();
-        }
-        if (!dispatch) {
-            long v = PyLong_AsLong(obj);
-            if (!PyErr_Occurred()) {
-                if (val) { *val = v; }
-                return SWIG_AddCast(SWIG_AddCast(SWIG_OK));
-            }
-            else {
-                PyErr_Clear();
-            }
-        }
+  {
+    int dispatch = 0;
+    double d = PyFloat_AsDouble(obj);
+    if (!PyErr_Occurred()) {
+      if (val) *val = d;
+      return SWIG_AddCast(SWIG_OK);
+    } else {
+      PyErr_Clear();
+    }
+    if (!dispatch) {
+      long v = PyLong_AsLong(obj);
+      if (!PyErr_Occurred()) {
+	if (val) *val = v;
+	return SWIG_AddCast(SWIG_AddCast(SWIG_OK));
+      } else {
+	PyErr_Clear();
+      }
     }
+  }
 #endif
-    return res;
+  return res;
 }
 
 
+#include <errno.h>
+
+
 #include <float.h>
 
 
@@ -3249,1081 +3424,3971 @@ SWIG_AsVal_double(PyObject *obj, double *val)
 
 
 SWIGINTERNINLINE int
-SWIG_CanCastAsInteger(double *d, double min, double max)
-{
-    double x = *d;
-    if ((min <= x && x <= max)) {
-        double fx = floor(x);
-        double cx = ceil(x);
-        double rd = ((x - fx) < 0.5) ? fx : cx;  /* simple rint */
-        if ((errno == EDOM) || (errno == ERANGE)) {
-            errno = 0;
-        }
-        else {
-            double summ, reps, diff;
-            if (rd < x) {
-                diff = x - rd;
-            }
-            else if (rd > x) {
-                diff = rd - x;
-            }
-            else {
-                return 1;
-            }
-            summ = rd + x;
-            reps = diff / summ;
-            if (reps < 8 * DBL_EPSILON) {
-                *d = rd;
-                return 1;
-            }
-        }
-    }
-    return 0;
+SWIG_CanCastAsInteger(double *d, double min, double max) {
+  double x = *d;
+  if ((min <= x && x <= max)) {
+   double fx, cx, rd;
+   errno = 0;
+   fx = floor(x);
+   cx = ceil(x);
+   rd =  ((x - fx) < 0.5) ? fx : cx; /* simple rint */
+   if ((errno == EDOM) || (errno == ERANGE)) {
+     errno = 0;
+   } else {
+     double summ, reps, diff;
+     if (rd < x) {
+       diff = x - rd;
+     } else if (rd > x) {
+       diff = rd - x;
+     } else {
+       return 1;
+     }
+     summ = rd + x;
+     reps = diff/summ;
+     if (reps < 8*DBL_EPSILON) {
+       *d = rd;
+       return 1;
+     }
+   }
+  }
+  return 0;
 }
 
 
 SWIGINTERN int
-SWIG_AsVal_long(PyObject *obj, long* val)
+SWIG_AsVal_long (PyObject *obj, long* val)
 {
-    if (PyInt_Check(obj)) {
-        if (val) { *val = PyInt_AsLong(obj); }
-        return SWIG_OK;
-    }
-    else if (PyLong_Check(obj)) {
-        long v = PyLong_AsLong(obj);
-        if (!PyErr_Occurred()) {
-            if (val) { *val = v; }
-            return SWIG_OK;
-        }
-        else {
-            PyErr_Clear();
-        }
+  if (PyLong_Check(obj)) {
+    long v = PyLong_AsLong(obj);
+    if (!PyErr_Occurred()) {
+      if (val) *val = v;
+      return SWIG_OK;
+    } else {
+      PyErr_Clear();
+      return SWIG_OverflowError;
     }
+  }
 #ifdef SWIG_PYTHON_CAST_MODE
-    {
-        int dispatch = 0;
-        long v = PyInt_AsLong(obj);
-        if (!PyErr_Occurred()) {
-            if (val) { *val = v; }
-            return SWIG_AddCast(SWIG_OK);
-        }
-        else {
-            PyErr_Clear();
-        }
-        if (!dispatch) {
-            double d;
-            int res = SWIG_AddCast(SWIG_AsVal_double(obj, &d));
-            if (SWIG_IsOK(res) && SWIG_CanCastAsInteger(&d, LONG_MIN, LONG_MAX)) {
-                if (val) { *val = (long)(d); }
-                return res;
-            }
-        }
+  {
+    int dispatch = 0;
+    long v = PyLong_AsLong(obj);
+    if (!PyErr_Occurred()) {
+      if (val) *val = v;
+      return SWIG_AddCast(SWIG_OK);
+    } else {
+      PyErr_Clear();
+    }
+    if (!dispatch) {
+      double d;
+      int res = SWIG_AddCast(SWIG_AsVal_double (obj,&d));
+      // Largest double not larger than LONG_MAX (not portably calculated easily)
+      // Note that double(LONG_MAX) is stored in a double rounded up by one (for 64-bit long)
+      // 0x7ffffffffffffc00LL == (int64_t)std::nextafter(double(__uint128_t(LONG_MAX)+1), double(0))
+      const double long_max = sizeof(long) == 8 ? 0x7ffffffffffffc00LL : LONG_MAX;
+      // No equivalent needed for 64-bit double(LONG_MIN) is exactly LONG_MIN
+      if (SWIG_IsOK(res) && SWIG_CanCastAsInteger(&d, LONG_MIN, long_max)) {
+	if (val) *val = (long)(d);
+	return res;
+      }
     }
+  }
 #endif
-    return SWIG_TypeError;
+  return SWIG_TypeError;
 }
 
 
 SWIGINTERN int
-SWIG_AsVal_int(PyObject * obj, int *val)
+SWIG_AsVal_int (PyObject * obj, int *val)
 {
-    long v;
-    int res = SWIG_AsVal_long(obj, &v);
-    if (SWIG_IsOK(res)) {
-        if ((v < INT_MIN || v > INT_MAX)) {
-            return SWIG_OverflowError;
-        }
-        else {
-            if (val) { *val = static_cast< int >(v); }
-        }
+  long v;
+  int res = SWIG_AsVal_long (obj, &v);
+  if (SWIG_IsOK(res)) {
+    if ((v < INT_MIN || v > INT_MAX)) {
+      return SWIG_OverflowError;
+    } else {
+      if (val) *val = static_cast< int >(v);
     }
-    return res;
+  }  
+  return res;
 }
 
 
 SWIGINTERNINLINE PyObject*
-SWIG_From_int(int value)
+  SWIG_From_int  (int value)
 {
-    return PyInt_FromLong((long) value);
+  return PyLong_FromLong((long) value);
 }
 
-#ifdef __cplusplus
-extern "C" {
+
+#if defined(LLONG_MAX) && !defined(SWIG_LONG_LONG_AVAILABLE)
+#  define SWIG_LONG_LONG_AVAILABLE
 #endif
-SWIGINTERN PyObject *_wrap_new_HTMC__SWIG_0(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *resultobj = 0;
-    int arg1 ;
-    int val1 ;
-    int ecode1 = 0 ;
-    PyObject * obj0 = 0 ;
-    HTMC *result = 0 ;
-
-    if (!PyArg_ParseTuple(args, (char *)"O:new_HTMC", &obj0)) { SWIG_fail; }
-    ecode1 = SWIG_AsVal_int(obj0, &val1);
-    if (!SWIG_IsOK(ecode1)) {
-        SWIG_exception_fail(SWIG_ArgError(ecode1), "in method '" "new_HTMC" "', argument " "1"" of type '" "int""'");
+
+
+#ifdef SWIG_LONG_LONG_AVAILABLE
+SWIGINTERN int
+SWIG_AsVal_long_SS_long (PyObject *obj, long long *val)
+{
+  int res = SWIG_TypeError;
+  if (PyLong_Check(obj)) {
+    long long v = PyLong_AsLongLong(obj);
+    if (!PyErr_Occurred()) {
+      if (val) *val = v;
+      return SWIG_OK;
+    } else {
+      PyErr_Clear();
+      res = SWIG_OverflowError;
     }
-    arg1 = static_cast< int >(val1);
-    try {
-        result = (HTMC *)new HTMC(arg1);
+  } else {
+    long v;
+    res = SWIG_AsVal_long (obj,&v);
+    if (SWIG_IsOK(res)) {
+      if (val) *val = v;
+      return res;
     }
-    catch (char const *_e) {
-        PyErr_SetString(PyExc_RuntimeError, _e);
-        SWIG_fail;
-
+  }
+#ifdef SWIG_PYTHON_CAST_MODE
+  {
+    const double mant_max = 1LL << DBL_MANT_DIG;
+    const double mant_min = -mant_max;
+    double d;
+    res = SWIG_AsVal_double (obj,&d);
+    if (SWIG_IsOK(res) && !SWIG_CanCastAsInteger(&d, mant_min, mant_max))
+      return SWIG_OverflowError;
+    if (SWIG_IsOK(res) && SWIG_CanCastAsInteger(&d, mant_min, mant_max)) {
+      if (val) *val = (long long)(d);
+      return SWIG_AddCast(res);
     }
-
-    resultobj = SWIG_NewPointerObj(SWIG_as_voidptr(result), SWIGTYPE_p_HTMC, SWIG_POINTER_NEW |  0);
-    return resultobj;
-fail:
-    return NULL;
+    res = SWIG_TypeError;
+  }
+#endif
+  return res;
 }
+#endif
 
 
-SWIGINTERN PyObject *_wrap_new_HTMC__SWIG_1(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
+#ifdef SWIG_LONG_LONG_AVAILABLE
+SWIGINTERNINLINE PyObject* 
+SWIG_From_long_SS_long  (long long value)
 {
-    PyObject *resultobj = 0;
-    HTMC *result = 0 ;
+  return ((value < LONG_MIN) || (value > LONG_MAX)) ?
+    PyLong_FromLongLong(value) : PyLong_FromLong(static_cast< long >(value));
+}
+#endif
 
-    if (!PyArg_ParseTuple(args, (char *)":new_HTMC")) { SWIG_fail; }
-    try {
-        result = (HTMC *)new HTMC();
+#ifdef __cplusplus
+extern "C" {
+#endif
+SWIGINTERN PyObject *_wrap_new_HTMC__SWIG_0(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  int arg1 ;
+  int arg2 ;
+  int val1 ;
+  int ecode1 = 0 ;
+  int val2 ;
+  int ecode2 = 0 ;
+  HTMC *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 2) || (nobjs > 2)) SWIG_fail;
+  ecode1 = SWIG_AsVal_int(swig_obj[0], &val1);
+  if (!SWIG_IsOK(ecode1)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode1), "in method '" "new_HTMC" "', argument " "1"" of type '" "int""'");
+  } 
+  arg1 = static_cast< int >(val1);
+  ecode2 = SWIG_AsVal_int(swig_obj[1], &val2);
+  if (!SWIG_IsOK(ecode2)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode2), "in method '" "new_HTMC" "', argument " "2"" of type '" "int""'");
+  } 
+  arg2 = static_cast< int >(val2);
+  try {
+    result = (HTMC *)new HTMC(arg1,arg2);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = SWIG_NewPointerObj(SWIG_as_voidptr(result), SWIGTYPE_p_HTMC, SWIG_POINTER_NEW |  0 );
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_new_HTMC__SWIG_1(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  int arg1 ;
+  int val1 ;
+  int ecode1 = 0 ;
+  HTMC *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 1) || (nobjs > 1)) SWIG_fail;
+  ecode1 = SWIG_AsVal_int(swig_obj[0], &val1);
+  if (!SWIG_IsOK(ecode1)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode1), "in method '" "new_HTMC" "', argument " "1"" of type '" "int""'");
+  } 
+  arg1 = static_cast< int >(val1);
+  try {
+    result = (HTMC *)new HTMC(arg1);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = SWIG_NewPointerObj(SWIG_as_voidptr(result), SWIGTYPE_p_HTMC, SWIG_POINTER_NEW |  0 );
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_new_HTMC__SWIG_2(PyObject *self, Py_ssize_t nobjs, PyObject **SWIGUNUSEDPARM(swig_obj)) {
+  PyObject *resultobj = 0;
+  HTMC *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 0) || (nobjs > 0)) SWIG_fail;
+  try {
+    result = (HTMC *)new HTMC();
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = SWIG_NewPointerObj(SWIG_as_voidptr(result), SWIGTYPE_p_HTMC, SWIG_POINTER_NEW |  0 );
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_new_HTMC(PyObject *self, PyObject *args) {
+  Py_ssize_t argc;
+  PyObject *argv[3] = {
+    0
+  };
+  
+  if (!(argc = SWIG_Python_UnpackTuple(args, "new_HTMC", 0, 2, argv))) SWIG_fail;
+  --argc;
+  if (argc == 0) {
+    return _wrap_new_HTMC__SWIG_2(self, argc, argv);
+  }
+  if (argc == 1) {
+    int _v = 0;
+    {
+      int res = SWIG_AsVal_int(argv[0], NULL);
+      _v = SWIG_CheckState(res);
     }
-    catch (char const *_e) {
-        PyErr_SetString(PyExc_RuntimeError, _e);
-        SWIG_fail;
-
+    if (_v) {
+      return _wrap_new_HTMC__SWIG_1(self, argc, argv);
     }
-
-    resultobj = SWIG_NewPointerObj(SWIG_as_voidptr(result), SWIGTYPE_p_HTMC, SWIG_POINTER_NEW |  0);
-    return resultobj;
-fail:
-    return NULL;
-}
-
-
-SWIGINTERN PyObject *_wrap_new_HTMC(PyObject *self, PyObject *args)
-{
-    int argc;
-    PyObject *argv[2];
-    int ii;
-
-    if (!PyTuple_Check(args)) { SWIG_fail; }
-    argc = args ? (int)PyObject_Length(args) : 0;
-    for (ii = 0; (ii < 1) && (ii < argc); ii++) {
-        argv[ii] = PyTuple_GET_ITEM(args, ii);
+  }
+  if (argc == 2) {
+    int _v = 0;
+    {
+      int res = SWIG_AsVal_int(argv[0], NULL);
+      _v = SWIG_CheckState(res);
+    }
+    if (_v) {
+      {
+        int res = SWIG_AsVal_int(argv[1], NULL);
+        _v = SWIG_CheckState(res);
+      }
+      if (_v) {
+        return _wrap_new_HTMC__SWIG_0(self, argc, argv);
+      }
     }
-    if (argc == 0) {
-        return _wrap_new_HTMC__SWIG_1(self, args);
+  }
+  
+fail:
+  SWIG_Python_RaiseOrModifyTypeError("Wrong number or type of arguments for overloaded function 'new_HTMC'.\n"
+    "  Possible C/C++ prototypes are:\n"
+    "    HTMC::HTMC(int,int)\n"
+    "    HTMC::HTMC(int)\n"
+    "    HTMC::HTMC()\n");
+  return 0;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_init__SWIG_0(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  HTMC *arg1 = 0 ;
+  int arg2 ;
+  int arg3 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val2 ;
+  int ecode2 = 0 ;
+  int val3 ;
+  int ecode3 = 0 ;
+  
+  (void)self;
+  if ((nobjs < 3) || (nobjs > 3)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_HTMC, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_init" "', argument " "1"" of type '" "HTMC *""'"); 
+  }
+  arg1 = reinterpret_cast< HTMC * >(argp1);
+  ecode2 = SWIG_AsVal_int(swig_obj[1], &val2);
+  if (!SWIG_IsOK(ecode2)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode2), "in method '" "HTMC_init" "', argument " "2"" of type '" "int""'");
+  } 
+  arg2 = static_cast< int >(val2);
+  ecode3 = SWIG_AsVal_int(swig_obj[2], &val3);
+  if (!SWIG_IsOK(ecode3)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode3), "in method '" "HTMC_init" "', argument " "3"" of type '" "int""'");
+  } 
+  arg3 = static_cast< int >(val3);
+  try {
+    (arg1)->init(arg2,arg3);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = SWIG_Py_Void();
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_init__SWIG_1(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  HTMC *arg1 = 0 ;
+  int arg2 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val2 ;
+  int ecode2 = 0 ;
+  
+  (void)self;
+  if ((nobjs < 2) || (nobjs > 2)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_HTMC, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_init" "', argument " "1"" of type '" "HTMC *""'"); 
+  }
+  arg1 = reinterpret_cast< HTMC * >(argp1);
+  ecode2 = SWIG_AsVal_int(swig_obj[1], &val2);
+  if (!SWIG_IsOK(ecode2)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode2), "in method '" "HTMC_init" "', argument " "2"" of type '" "int""'");
+  } 
+  arg2 = static_cast< int >(val2);
+  try {
+    (arg1)->init(arg2);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = SWIG_Py_Void();
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_init__SWIG_2(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  HTMC *arg1 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  
+  (void)self;
+  if ((nobjs < 1) || (nobjs > 1)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_HTMC, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_init" "', argument " "1"" of type '" "HTMC *""'"); 
+  }
+  arg1 = reinterpret_cast< HTMC * >(argp1);
+  try {
+    (arg1)->init();
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = SWIG_Py_Void();
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_init(PyObject *self, PyObject *args) {
+  Py_ssize_t argc;
+  PyObject *argv[4] = {
+    0
+  };
+  
+  if (!(argc = SWIG_Python_UnpackTuple(args, "HTMC_init", 0, 3, argv))) SWIG_fail;
+  --argc;
+  if (argc == 1) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_HTMC, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      return _wrap_HTMC_init__SWIG_2(self, argc, argv);
+    }
+  }
+  if (argc == 2) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_HTMC, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      {
+        int res = SWIG_AsVal_int(argv[1], NULL);
+        _v = SWIG_CheckState(res);
+      }
+      if (_v) {
+        return _wrap_HTMC_init__SWIG_1(self, argc, argv);
+      }
     }
-    if (argc == 1) {
-        int _v;
+  }
+  if (argc == 3) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_HTMC, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      {
+        int res = SWIG_AsVal_int(argv[1], NULL);
+        _v = SWIG_CheckState(res);
+      }
+      if (_v) {
         {
-            int res = SWIG_AsVal_int(argv[0], NULL);
-            _v = SWIG_CheckState(res);
+          int res = SWIG_AsVal_int(argv[2], NULL);
+          _v = SWIG_CheckState(res);
         }
         if (_v) {
-            return _wrap_new_HTMC__SWIG_0(self, args);
+          return _wrap_HTMC_init__SWIG_0(self, argc, argv);
         }
+      }
     }
-
+  }
+  
 fail:
-    SWIG_SetErrorMsg(PyExc_NotImplementedError, "Wrong number or type of arguments for overloaded function 'new_HTMC'.\n"
-                     "  Possible C/C++ prototypes are:\n"
-                     "    HTMC::HTMC(int)\n"
-                     "    HTMC::HTMC()\n");
-    return 0;
-}
-
-
-SWIGINTERN PyObject *_wrap_HTMC_init__SWIG_0(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *resultobj = 0;
-    HTMC *arg1 = (HTMC *) 0 ;
-    int arg2 ;
-    void *argp1 = 0 ;
-    int res1 = 0 ;
-    int val2 ;
-    int ecode2 = 0 ;
-    PyObject * obj0 = 0 ;
-    PyObject * obj1 = 0 ;
-
-    if (!PyArg_ParseTuple(args, (char *)"OO:HTMC_init", &obj0, &obj1)) { SWIG_fail; }
-    res1 = SWIG_ConvertPtr(obj0, &argp1, SWIGTYPE_p_HTMC, 0 |  0);
-    if (!SWIG_IsOK(res1)) {
-        SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_init" "', argument " "1"" of type '" "HTMC *""'");
-    }
-    arg1 = reinterpret_cast< HTMC * >(argp1);
-    ecode2 = SWIG_AsVal_int(obj1, &val2);
-    if (!SWIG_IsOK(ecode2)) {
-        SWIG_exception_fail(SWIG_ArgError(ecode2), "in method '" "HTMC_init" "', argument " "2"" of type '" "int""'");
-    }
-    arg2 = static_cast< int >(val2);
-    try {
-        (arg1)->init(arg2);
-    }
-    catch (char const *_e) {
-        PyErr_SetString(PyExc_RuntimeError, _e);
-        SWIG_fail;
-
-    }
-
-    resultobj = SWIG_Py_Void();
-    return resultobj;
+  SWIG_Python_RaiseOrModifyTypeError("Wrong number or type of arguments for overloaded function 'HTMC_init'.\n"
+    "  Possible C/C++ prototypes are:\n"
+    "    HTMC::init(int,int)\n"
+    "    HTMC::init(int)\n"
+    "    HTMC::init()\n");
+  return 0;
+}
+
+
+SWIGINTERN PyObject *_wrap_delete_HTMC(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  HTMC *arg1 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[1] ;
+  
+  (void)self;
+  if (!args) SWIG_fail;
+  swig_obj[0] = args;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_HTMC, SWIG_POINTER_DISOWN |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "delete_HTMC" "', argument " "1"" of type '" "HTMC *""'"); 
+  }
+  arg1 = reinterpret_cast< HTMC * >(argp1);
+  delete arg1;
+  resultobj = SWIG_Py_Void();
+  return resultobj;
 fail:
-    return NULL;
-}
-
-
-SWIGINTERN PyObject *_wrap_HTMC_init__SWIG_1(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *resultobj = 0;
-    HTMC *arg1 = (HTMC *) 0 ;
-    void *argp1 = 0 ;
-    int res1 = 0 ;
-    PyObject * obj0 = 0 ;
-
-    if (!PyArg_ParseTuple(args, (char *)"O:HTMC_init", &obj0)) { SWIG_fail; }
-    res1 = SWIG_ConvertPtr(obj0, &argp1, SWIGTYPE_p_HTMC, 0 |  0);
-    if (!SWIG_IsOK(res1)) {
-        SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_init" "', argument " "1"" of type '" "HTMC *""'");
-    }
-    arg1 = reinterpret_cast< HTMC * >(argp1);
-    try {
-        (arg1)->init();
-    }
-    catch (char const *_e) {
-        PyErr_SetString(PyExc_RuntimeError, _e);
-        SWIG_fail;
-
-    }
-
-    resultobj = SWIG_Py_Void();
-    return resultobj;
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_lookup_id(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  HTMC *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[3] ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if (!SWIG_Python_UnpackTuple(args, "HTMC_lookup_id", 3, 3, swig_obj)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_HTMC, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_lookup_id" "', argument " "1"" of type '" "HTMC *""'"); 
+  }
+  arg1 = reinterpret_cast< HTMC * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  try {
+    result = (PyObject *)(arg1)->lookup_id(arg2,arg3);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
 fail:
-    return NULL;
-}
-
-
-SWIGINTERN PyObject *_wrap_HTMC_init(PyObject *self, PyObject *args)
-{
-    int argc;
-    PyObject *argv[3];
-    int ii;
-
-    if (!PyTuple_Check(args)) { SWIG_fail; }
-    argc = args ? (int)PyObject_Length(args) : 0;
-    for (ii = 0; (ii < 2) && (ii < argc); ii++) {
-        argv[ii] = PyTuple_GET_ITEM(args, ii);
-    }
-    if (argc == 1) {
-        int _v;
-        void *vptr = 0;
-        int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_HTMC, 0);
-        _v = SWIG_CheckState(res);
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_lookup_id_xyz(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  HTMC *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[4] ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if (!SWIG_Python_UnpackTuple(args, "HTMC_lookup_id_xyz", 4, 4, swig_obj)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_HTMC, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_lookup_id_xyz" "', argument " "1"" of type '" "HTMC *""'"); 
+  }
+  arg1 = reinterpret_cast< HTMC * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  try {
+    result = (PyObject *)(arg1)->lookup_id_xyz(arg2,arg3,arg4);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_intersect(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  HTMC *arg1 = 0 ;
+  double arg2 ;
+  double arg3 ;
+  double arg4 ;
+  int arg5 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  double val2 ;
+  int ecode2 = 0 ;
+  double val3 ;
+  int ecode3 = 0 ;
+  double val4 ;
+  int ecode4 = 0 ;
+  int val5 ;
+  int ecode5 = 0 ;
+  PyObject *swig_obj[5] ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if (!SWIG_Python_UnpackTuple(args, "HTMC_intersect", 5, 5, swig_obj)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_HTMC, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_intersect" "', argument " "1"" of type '" "HTMC *""'"); 
+  }
+  arg1 = reinterpret_cast< HTMC * >(argp1);
+  ecode2 = SWIG_AsVal_double(swig_obj[1], &val2);
+  if (!SWIG_IsOK(ecode2)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode2), "in method '" "HTMC_intersect" "', argument " "2"" of type '" "double""'");
+  } 
+  arg2 = static_cast< double >(val2);
+  ecode3 = SWIG_AsVal_double(swig_obj[2], &val3);
+  if (!SWIG_IsOK(ecode3)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode3), "in method '" "HTMC_intersect" "', argument " "3"" of type '" "double""'");
+  } 
+  arg3 = static_cast< double >(val3);
+  ecode4 = SWIG_AsVal_double(swig_obj[3], &val4);
+  if (!SWIG_IsOK(ecode4)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode4), "in method '" "HTMC_intersect" "', argument " "4"" of type '" "double""'");
+  } 
+  arg4 = static_cast< double >(val4);
+  ecode5 = SWIG_AsVal_int(swig_obj[4], &val5);
+  if (!SWIG_IsOK(ecode5)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode5), "in method '" "HTMC_intersect" "', argument " "5"" of type '" "int""'");
+  } 
+  arg5 = static_cast< int >(val5);
+  try {
+    result = (PyObject *)(arg1)->intersect(arg2,arg3,arg4,arg5);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_intersect_many(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  HTMC *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  int arg5 ;
+  int arg6 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val5 ;
+  int ecode5 = 0 ;
+  int val6 ;
+  int ecode6 = 0 ;
+  PyObject *swig_obj[6] ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if (!SWIG_Python_UnpackTuple(args, "HTMC_intersect_many", 6, 6, swig_obj)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_HTMC, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_intersect_many" "', argument " "1"" of type '" "HTMC *""'"); 
+  }
+  arg1 = reinterpret_cast< HTMC * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  ecode5 = SWIG_AsVal_int(swig_obj[4], &val5);
+  if (!SWIG_IsOK(ecode5)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode5), "in method '" "HTMC_intersect_many" "', argument " "5"" of type '" "int""'");
+  } 
+  arg5 = static_cast< int >(val5);
+  ecode6 = SWIG_AsVal_int(swig_obj[5], &val6);
+  if (!SWIG_IsOK(ecode6)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode6), "in method '" "HTMC_intersect_many" "', argument " "6"" of type '" "int""'");
+  } 
+  arg6 = static_cast< int >(val6);
+  try {
+    result = (PyObject *)(arg1)->intersect_many(arg2,arg3,arg4,arg5,arg6);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_intersect_many_xyz(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  HTMC *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  PyObject *arg5 = 0 ;
+  int arg6 ;
+  int arg7 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val6 ;
+  int ecode6 = 0 ;
+  int val7 ;
+  int ecode7 = 0 ;
+  PyObject *swig_obj[7] ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if (!SWIG_Python_UnpackTuple(args, "HTMC_intersect_many_xyz", 7, 7, swig_obj)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_HTMC, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_intersect_many_xyz" "', argument " "1"" of type '" "HTMC *""'"); 
+  }
+  arg1 = reinterpret_cast< HTMC * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  arg5 = swig_obj[4];
+  ecode6 = SWIG_AsVal_int(swig_obj[5], &val6);
+  if (!SWIG_IsOK(ecode6)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode6), "in method '" "HTMC_intersect_many_xyz" "', argument " "6"" of type '" "int""'");
+  } 
+  arg6 = static_cast< int >(val6);
+  ecode7 = SWIG_AsVal_int(swig_obj[6], &val7);
+  if (!SWIG_IsOK(ecode7)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode7), "in method '" "HTMC_intersect_many_xyz" "', argument " "7"" of type '" "int""'");
+  } 
+  arg7 = static_cast< int >(val7);
+  try {
+    result = (PyObject *)(arg1)->intersect_many_xyz(arg2,arg3,arg4,arg5,arg6,arg7);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_intersect_polygons(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  HTMC *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  int arg5 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val5 ;
+  int ecode5 = 0 ;
+  PyObject *swig_obj[5] ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if (!SWIG_Python_UnpackTuple(args, "HTMC_intersect_polygons", 5, 5, swig_obj)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_HTMC, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_intersect_polygons" "', argument " "1"" of type '" "HTMC *""'"); 
+  }
+  arg1 = reinterpret_cast< HTMC * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  ecode5 = SWIG_AsVal_int(swig_obj[4], &val5);
+  if (!SWIG_IsOK(ecode5)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode5), "in method '" "HTMC_intersect_polygons" "', argument " "5"" of type '" "int""'");
+  } 
+  arg5 = static_cast< int >(val5);
+  try {
+    result = (PyObject *)(arg1)->intersect_polygons(arg2,arg3,arg4,arg5);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_intersect_ranges(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  HTMC *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  int arg5 ;
+  int arg6 ;
+  int arg7 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val5 ;
+  int ecode5 = 0 ;
+  int val6 ;
+  int ecode6 = 0 ;
+  int val7 ;
+  int ecode7 = 0 ;
+  PyObject *swig_obj[7] ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if (!SWIG_Python_UnpackTuple(args, "HTMC_intersect_ranges", 7, 7, swig_obj)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_HTMC, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_intersect_ranges" "', argument " "1"" of type '" "HTMC *""'"); 
+  }
+  arg1 = reinterpret_cast< HTMC * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  ecode5 = SWIG_AsVal_int(swig_obj[4], &val5);
+  if (!SWIG_IsOK(ecode5)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode5), "in method '" "HTMC_intersect_ranges" "', argument " "5"" of type '" "int""'");
+  } 
+  arg5 = static_cast< int >(val5);
+  ecode6 = SWIG_AsVal_int(swig_obj[5], &val6);
+  if (!SWIG_IsOK(ecode6)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode6), "in method '" "HTMC_intersect_ranges" "', argument " "6"" of type '" "int""'");
+  } 
+  arg6 = static_cast< int >(val6);
+  ecode7 = SWIG_AsVal_int(swig_obj[6], &val7);
+  if (!SWIG_IsOK(ecode7)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode7), "in method '" "HTMC_intersect_ranges" "', argument " "7"" of type '" "int""'");
+  } 
+  arg7 = static_cast< int >(val7);
+  try {
+    result = (PyObject *)(arg1)->intersect_ranges(arg2,arg3,arg4,arg5,arg6,arg7);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_cmatch__SWIG_0(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  HTMC *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  PyObject *arg7 = 0 ;
+  PyObject *arg8 = 0 ;
+  PyObject *arg9 = 0 ;
+  PyObject *arg10 = 0 ;
+  PyObject *arg11 = 0 ;
+  int arg12 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val12 ;
+  int ecode12 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 12) || (nobjs > 12)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_HTMC, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_cmatch" "', argument " "1"" of type '" "HTMC *""'"); 
+  }
+  arg1 = reinterpret_cast< HTMC * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  arg7 = swig_obj[6];
+  arg8 = swig_obj[7];
+  arg9 = swig_obj[8];
+  arg10 = swig_obj[9];
+  arg11 = swig_obj[10];
+  ecode12 = SWIG_AsVal_int(swig_obj[11], &val12);
+  if (!SWIG_IsOK(ecode12)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode12), "in method '" "HTMC_cmatch" "', argument " "12"" of type '" "int""'");
+  } 
+  arg12 = static_cast< int >(val12);
+  try {
+    result = (PyObject *)(arg1)->cmatch(arg2,arg3,arg4,arg5,arg6,arg7,arg8,arg9,arg10,arg11,arg12);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_cmatch__SWIG_1(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  HTMC *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  PyObject *arg7 = 0 ;
+  PyObject *arg8 = 0 ;
+  PyObject *arg9 = 0 ;
+  PyObject *arg10 = 0 ;
+  PyObject *arg11 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 11) || (nobjs > 11)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_HTMC, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_cmatch" "', argument " "1"" of type '" "HTMC *""'"); 
+  }
+  arg1 = reinterpret_cast< HTMC * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  arg7 = swig_obj[6];
+  arg8 = swig_obj[7];
+  arg9 = swig_obj[8];
+  arg10 = swig_obj[9];
+  arg11 = swig_obj[10];
+  try {
+    result = (PyObject *)(arg1)->cmatch(arg2,arg3,arg4,arg5,arg6,arg7,arg8,arg9,arg10,arg11);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_cmatch(PyObject *self, PyObject *args) {
+  Py_ssize_t argc;
+  PyObject *argv[13] = {
+    0
+  };
+  
+  if (!(argc = SWIG_Python_UnpackTuple(args, "HTMC_cmatch", 0, 12, argv))) SWIG_fail;
+  --argc;
+  if (argc == 11) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_HTMC, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
         if (_v) {
-            return _wrap_HTMC_init__SWIG_1(self, args);
+          _v = (argv[3] != 0);
+          if (_v) {
+            _v = (argv[4] != 0);
+            if (_v) {
+              _v = (argv[5] != 0);
+              if (_v) {
+                _v = (argv[6] != 0);
+                if (_v) {
+                  _v = (argv[7] != 0);
+                  if (_v) {
+                    _v = (argv[8] != 0);
+                    if (_v) {
+                      _v = (argv[9] != 0);
+                      if (_v) {
+                        _v = (argv[10] != 0);
+                        if (_v) {
+                          return _wrap_HTMC_cmatch__SWIG_1(self, argc, argv);
+                        }
+                      }
+                    }
+                  }
+                }
+              }
+            }
+          }
         }
+      }
     }
-    if (argc == 2) {
-        int _v;
-        void *vptr = 0;
-        int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_HTMC, 0);
-        _v = SWIG_CheckState(res);
+  }
+  if (argc == 12) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_HTMC, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
         if (_v) {
-            {
-                int res = SWIG_AsVal_int(argv[1], NULL);
-                _v = SWIG_CheckState(res);
-            }
+          _v = (argv[3] != 0);
+          if (_v) {
+            _v = (argv[4] != 0);
             if (_v) {
-                return _wrap_HTMC_init__SWIG_0(self, args);
+              _v = (argv[5] != 0);
+              if (_v) {
+                _v = (argv[6] != 0);
+                if (_v) {
+                  _v = (argv[7] != 0);
+                  if (_v) {
+                    _v = (argv[8] != 0);
+                    if (_v) {
+                      _v = (argv[9] != 0);
+                      if (_v) {
+                        _v = (argv[10] != 0);
+                        if (_v) {
+                          {
+                            int res = SWIG_AsVal_int(argv[11], NULL);
+                            _v = SWIG_CheckState(res);
+                          }
+                          if (_v) {
+                            return _wrap_HTMC_cmatch__SWIG_0(self, argc, argv);
+                          }
+                        }
+                      }
+                    }
+                  }
+                }
+              }
             }
+          }
         }
+      }
     }
-
+  }
+  
 fail:
-    SWIG_SetErrorMsg(PyExc_NotImplementedError, "Wrong number or type of arguments for overloaded function 'HTMC_init'.\n"
-                     "  Possible C/C++ prototypes are:\n"
-                     "    HTMC::init(int)\n"
-                     "    HTMC::init()\n");
-    return 0;
-}
-
-
-SWIGINTERN PyObject *_wrap_delete_HTMC(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *resultobj = 0;
-    HTMC *arg1 = (HTMC *) 0 ;
-    void *argp1 = 0 ;
-    int res1 = 0 ;
-    PyObject * obj0 = 0 ;
-
-    if (!PyArg_ParseTuple(args, (char *)"O:delete_HTMC", &obj0)) { SWIG_fail; }
-    res1 = SWIG_ConvertPtr(obj0, &argp1, SWIGTYPE_p_HTMC, SWIG_POINTER_DISOWN |  0);
-    if (!SWIG_IsOK(res1)) {
-        SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "delete_HTMC" "', argument " "1"" of type '" "HTMC *""'");
-    }
-    arg1 = reinterpret_cast< HTMC * >(argp1);
-    delete arg1;
-    resultobj = SWIG_Py_Void();
-    return resultobj;
+  SWIG_Python_RaiseOrModifyTypeError("Wrong number or type of arguments for overloaded function 'HTMC_cmatch'.\n"
+    "  Possible C/C++ prototypes are:\n"
+    "    HTMC::cmatch(PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,int)\n"
+    "    HTMC::cmatch(PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *)\n");
+  return 0;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_depth(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  HTMC *arg1 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[1] ;
+  int result;
+  
+  (void)self;
+  if (!args) SWIG_fail;
+  swig_obj[0] = args;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_HTMC, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_depth" "', argument " "1"" of type '" "HTMC *""'"); 
+  }
+  arg1 = reinterpret_cast< HTMC * >(argp1);
+  result = (int)(arg1)->depth();
+  resultobj = SWIG_From_int(static_cast< int >(result));
+  return resultobj;
 fail:
-    return NULL;
-}
-
-
-SWIGINTERN PyObject *_wrap_HTMC_lookup_id(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *resultobj = 0;
-    HTMC *arg1 = (HTMC *) 0 ;
-    PyObject *arg2 = (PyObject *) 0 ;
-    PyObject *arg3 = (PyObject *) 0 ;
-    void *argp1 = 0 ;
-    int res1 = 0 ;
-    PyObject * obj0 = 0 ;
-    PyObject * obj1 = 0 ;
-    PyObject * obj2 = 0 ;
-    PyObject *result = 0 ;
-
-    if (!PyArg_ParseTuple(args, (char *)"OOO:HTMC_lookup_id", &obj0, &obj1, &obj2)) { SWIG_fail; }
-    res1 = SWIG_ConvertPtr(obj0, &argp1, SWIGTYPE_p_HTMC, 0 |  0);
-    if (!SWIG_IsOK(res1)) {
-        SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_lookup_id" "', argument " "1"" of type '" "HTMC *""'");
-    }
-    arg1 = reinterpret_cast< HTMC * >(argp1);
-    arg2 = obj1;
-    arg3 = obj2;
-    try {
-        result = (PyObject *)(arg1)->lookup_id(arg2, arg3);
-    }
-    catch (char const *_e) {
-        PyErr_SetString(PyExc_RuntimeError, _e);
-        SWIG_fail;
-
-    }
-
-    resultobj = result;
-    return resultobj;
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_HTMC_buildlevel(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  HTMC *arg1 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[1] ;
+  int result;
+  
+  (void)self;
+  if (!args) SWIG_fail;
+  swig_obj[0] = args;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_HTMC, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_buildlevel" "', argument " "1"" of type '" "HTMC *""'"); 
+  }
+  arg1 = reinterpret_cast< HTMC * >(argp1);
+  result = (int)(arg1)->buildlevel();
+  resultobj = SWIG_From_int(static_cast< int >(result));
+  return resultobj;
 fail:
-    return NULL;
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *HTMC_swigregister(PyObject *SWIGUNUSEDPARM(self), PyObject *args) {
+  PyObject *obj = NULL;
+  if (!SWIG_Python_UnpackTuple(args, "swigregister", 1, 1, &obj)) return NULL;
+  SWIG_TypeNewClientData(SWIGTYPE_p_HTMC, SWIG_NewClientData(obj));
+  return SWIG_Py_Void();
+}
+
+SWIGINTERN PyObject *HTMC_swiginit(PyObject *SWIGUNUSEDPARM(self), PyObject *args) {
+  return SWIG_Python_InitShadowInstance(args);
+}
+
+SWIGINTERN PyObject *_wrap_new_Matcher__SWIG_0(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  int arg1 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  int arg4 ;
+  int val1 ;
+  int ecode1 = 0 ;
+  int val4 ;
+  int ecode4 = 0 ;
+  Matcher *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 4) || (nobjs > 4)) SWIG_fail;
+  ecode1 = SWIG_AsVal_int(swig_obj[0], &val1);
+  if (!SWIG_IsOK(ecode1)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode1), "in method '" "new_Matcher" "', argument " "1"" of type '" "int""'");
+  } 
+  arg1 = static_cast< int >(val1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  ecode4 = SWIG_AsVal_int(swig_obj[3], &val4);
+  if (!SWIG_IsOK(ecode4)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode4), "in method '" "new_Matcher" "', argument " "4"" of type '" "int""'");
+  } 
+  arg4 = static_cast< int >(val4);
+  try {
+    result = (Matcher *)new Matcher(arg1,arg2,arg3,arg4);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = SWIG_NewPointerObj(SWIG_as_voidptr(result), SWIGTYPE_p_Matcher, SWIG_POINTER_NEW |  0 );
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_new_Matcher__SWIG_1(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  int arg1 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  int val1 ;
+  int ecode1 = 0 ;
+  Matcher *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 3) || (nobjs > 3)) SWIG_fail;
+  ecode1 = SWIG_AsVal_int(swig_obj[0], &val1);
+  if (!SWIG_IsOK(ecode1)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode1), "in method '" "new_Matcher" "', argument " "1"" of type '" "int""'");
+  } 
+  arg1 = static_cast< int >(val1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  try {
+    result = (Matcher *)new Matcher(arg1,arg2,arg3);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = SWIG_NewPointerObj(SWIG_as_voidptr(result), SWIGTYPE_p_Matcher, SWIG_POINTER_NEW |  0 );
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_new_Matcher__SWIG_2(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  int arg1 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  PyObject *arg7 = 0 ;
+  int arg8 ;
+  int val1 ;
+  int ecode1 = 0 ;
+  int val8 ;
+  int ecode8 = 0 ;
+  Matcher *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 8) || (nobjs > 8)) SWIG_fail;
+  ecode1 = SWIG_AsVal_int(swig_obj[0], &val1);
+  if (!SWIG_IsOK(ecode1)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode1), "in method '" "new_Matcher" "', argument " "1"" of type '" "int""'");
+  } 
+  arg1 = static_cast< int >(val1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  arg7 = swig_obj[6];
+  ecode8 = SWIG_AsVal_int(swig_obj[7], &val8);
+  if (!SWIG_IsOK(ecode8)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode8), "in method '" "new_Matcher" "', argument " "8"" of type '" "int""'");
+  } 
+  arg8 = static_cast< int >(val8);
+  try {
+    result = (Matcher *)new Matcher(arg1,arg2,arg3,arg4,arg5,arg6,arg7,arg8);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = SWIG_NewPointerObj(SWIG_as_voidptr(result), SWIGTYPE_p_Matcher, SWIG_POINTER_NEW |  0 );
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_new_Matcher__SWIG_3(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  int arg1 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  PyObject *arg7 = 0 ;
+  int val1 ;
+  int ecode1 = 0 ;
+  Matcher *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 7) || (nobjs > 7)) SWIG_fail;
+  ecode1 = SWIG_AsVal_int(swig_obj[0], &val1);
+  if (!SWIG_IsOK(ecode1)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode1), "in method '" "new_Matcher" "', argument " "1"" of type '" "int""'");
+  } 
+  arg1 = static_cast< int >(val1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  arg7 = swig_obj[6];
+  try {
+    result = (Matcher *)new Matcher(arg1,arg2,arg3,arg4,arg5,arg6,arg7);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = SWIG_NewPointerObj(SWIG_as_voidptr(result), SWIGTYPE_p_Matcher, SWIG_POINTER_NEW |  0 );
+  return resultobj;
+fail:
+  return NULL;
 }
 
 
-SWIGINTERN PyObject *_wrap_HTMC_intersect(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *resultobj = 0;
-    HTMC *arg1 = (HTMC *) 0 ;
-    double arg2 ;
-    double arg3 ;
-    double arg4 ;
-    int arg5 ;
-    void *argp1 = 0 ;
-    int res1 = 0 ;
-    double val2 ;
-    int ecode2 = 0 ;
-    double val3 ;
-    int ecode3 = 0 ;
-    double val4 ;
-    int ecode4 = 0 ;
-    int val5 ;
-    int ecode5 = 0 ;
-    PyObject * obj0 = 0 ;
-    PyObject * obj1 = 0 ;
-    PyObject * obj2 = 0 ;
-    PyObject * obj3 = 0 ;
-    PyObject * obj4 = 0 ;
-    PyObject *result = 0 ;
-
-    if (!PyArg_ParseTuple(args, (char *)"OOOOO:HTMC_intersect", &obj0, &obj1, &obj2, &obj3, &obj4)) { SWIG_fail; }
-    res1 = SWIG_ConvertPtr(obj0, &argp1, SWIGTYPE_p_HTMC, 0 |  0);
-    if (!SWIG_IsOK(res1)) {
-        SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_intersect" "', argument " "1"" of type '" "HTMC *""'");
-    }
-    arg1 = reinterpret_cast< HTMC * >(argp1);
-    ecode2 = SWIG_AsVal_double(obj1, &val2);
-    if (!SWIG_IsOK(ecode2)) {
-        SWIG_exception_fail(SWIG_ArgError(ecode2), "in method '" "HTMC_intersect" "', argument " "2"" of type '" "double""'");
-    }
-    arg2 = static_cast< double >(val2);
-    ecode3 = SWIG_AsVal_double(obj2, &val3);
-    if (!SWIG_IsOK(ecode3)) {
-        SWIG_exception_fail(SWIG_ArgError(ecode3), "in method '" "HTMC_intersect" "', argument " "3"" of type '" "double""'");
+SWIGINTERN PyObject *_wrap_new_Matcher(PyObject *self, PyObject *args) {
+  Py_ssize_t argc;
+  PyObject *argv[9] = {
+    0
+  };
+  
+  if (!(argc = SWIG_Python_UnpackTuple(args, "new_Matcher", 0, 8, argv))) SWIG_fail;
+  --argc;
+  if (argc == 3) {
+    int _v = 0;
+    {
+      int res = SWIG_AsVal_int(argv[0], NULL);
+      _v = SWIG_CheckState(res);
     }
-    arg3 = static_cast< double >(val3);
-    ecode4 = SWIG_AsVal_double(obj3, &val4);
-    if (!SWIG_IsOK(ecode4)) {
-        SWIG_exception_fail(SWIG_ArgError(ecode4), "in method '" "HTMC_intersect" "', argument " "4"" of type '" "double""'");
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          return _wrap_new_Matcher__SWIG_1(self, argc, argv);
+        }
+      }
     }
-    arg4 = static_cast< double >(val4);
-    ecode5 = SWIG_AsVal_int(obj4, &val5);
-    if (!SWIG_IsOK(ecode5)) {
-        SWIG_exception_fail(SWIG_ArgError(ecode5), "in method '" "HTMC_intersect" "', argument " "5"" of type '" "int""'");
+  }
+  if (argc == 4) {
+    int _v = 0;
+    {
+      int res = SWIG_AsVal_int(argv[0], NULL);
+      _v = SWIG_CheckState(res);
     }
-    arg5 = static_cast< int >(val5);
-    try {
-        result = (PyObject *)(arg1)->intersect(arg2, arg3, arg4, arg5);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          {
+            int res = SWIG_AsVal_int(argv[3], NULL);
+            _v = SWIG_CheckState(res);
+          }
+          if (_v) {
+            return _wrap_new_Matcher__SWIG_0(self, argc, argv);
+          }
+        }
+      }
     }
-    catch (char const *_e) {
-        PyErr_SetString(PyExc_RuntimeError, _e);
-        SWIG_fail;
-
+  }
+  if (argc == 7) {
+    int _v = 0;
+    {
+      int res = SWIG_AsVal_int(argv[0], NULL);
+      _v = SWIG_CheckState(res);
     }
-
-    resultobj = result;
-    return resultobj;
-fail:
-    return NULL;
-}
-
-
-SWIGINTERN PyObject *_wrap_HTMC_cmatch(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *resultobj = 0;
-    HTMC *arg1 = (HTMC *) 0 ;
-    PyObject *arg2 = (PyObject *) 0 ;
-    PyObject *arg3 = (PyObject *) 0 ;
-    PyObject *arg4 = (PyObject *) 0 ;
-    PyObject *arg5 = (PyObject *) 0 ;
-    PyObject *arg6 = (PyObject *) 0 ;
-    PyObject *arg7 = (PyObject *) 0 ;
-    PyObject *arg8 = (PyObject *) 0 ;
-    PyObject *arg9 = (PyObject *) 0 ;
-    PyObject *arg10 = (PyObject *) 0 ;
-    PyObject *arg11 = (PyObject *) 0 ;
-    void *argp1 = 0 ;
-    int res1 = 0 ;
-    PyObject * obj0 = 0 ;
-    PyObject * obj1 = 0 ;
-    PyObject * obj2 = 0 ;
-    PyObject * obj3 = 0 ;
-    PyObject * obj4 = 0 ;
-    PyObject * obj5 = 0 ;
-    PyObject * obj6 = 0 ;
-    PyObject * obj7 = 0 ;
-    PyObject * obj8 = 0 ;
-    PyObject * obj9 = 0 ;
-    PyObject * obj10 = 0 ;
-    PyObject *result = 0 ;
-
-    if (!PyArg_ParseTuple(args, (char *)"OOOOOOOOOOO:HTMC_cmatch", &obj0, &obj1, &obj2, &obj3, &obj4, &obj5, &obj6, &obj7, &obj8, &obj9, &obj10)) { SWIG_fail; }
-    res1 = SWIG_ConvertPtr(obj0, &argp1, SWIGTYPE_p_HTMC, 0 |  0);
-    if (!SWIG_IsOK(res1)) {
-        SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_cmatch" "', argument " "1"" of type '" "HTMC *""'");
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          _v = (argv[3] != 0);
+          if (_v) {
+            _v = (argv[4] != 0);
+            if (_v) {
+              _v = (argv[5] != 0);
+              if (_v) {
+                _v = (argv[6] != 0);
+                if (_v) {
+                  return _wrap_new_Matcher__SWIG_3(self, argc, argv);
+                }
+              }
+            }
+          }
+        }
+      }
     }
-    arg1 = reinterpret_cast< HTMC * >(argp1);
-    arg2 = obj1;
-    arg3 = obj2;
-    arg4 = obj3;
-    arg5 = obj4;
-    arg6 = obj5;
-    arg7 = obj6;
-    arg8 = obj7;
-    arg9 = obj8;
-    arg10 = obj9;
-    arg11 = obj10;
-    try {
-        result = (PyObject *)(arg1)->cmatch(arg2, arg3, arg4, arg5, arg6, arg7, arg8, arg9, arg10, arg11);
+  }
+  if (argc == 8) {
+    int _v = 0;
+    {
+      int res = SWIG_AsVal_int(argv[0], NULL);
+      _v = SWIG_CheckState(res);
     }
-    catch (char const *_e) {
-        PyErr_SetString(PyExc_RuntimeError, _e);
-        SWIG_fail;
-
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          _v = (argv[3] != 0);
+          if (_v) {
+            _v = (argv[4] != 0);
+            if (_v) {
+              _v = (argv[5] != 0);
+              if (_v) {
+                _v = (argv[6] != 0);
+                if (_v) {
+                  {
+                    int res = SWIG_AsVal_int(argv[7], NULL);
+                    _v = SWIG_CheckState(res);
+                  }
+                  if (_v) {
+                    return _wrap_new_Matcher__SWIG_2(self, argc, argv);
+                  }
+                }
+              }
+            }
+          }
+        }
+      }
     }
-
-    resultobj = result;
-    return resultobj;
+  }
+  
 fail:
-    return NULL;
-}
-
-
-SWIGINTERN PyObject *_wrap_HTMC_cbincount__SWIG_0(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *resultobj = 0;
-    HTMC *arg1 = (HTMC *) 0 ;
-    PyObject *arg2 = (PyObject *) 0 ;
-    PyObject *arg3 = (PyObject *) 0 ;
-    PyObject *arg4 = (PyObject *) 0 ;
-    PyObject *arg5 = (PyObject *) 0 ;
-    PyObject *arg6 = (PyObject *) 0 ;
-    PyObject *arg7 = (PyObject *) 0 ;
-    PyObject *arg8 = (PyObject *) 0 ;
-    PyObject *arg9 = (PyObject *) 0 ;
-    PyObject *arg10 = (PyObject *) 0 ;
-    PyObject *arg11 = (PyObject *) 0 ;
-    PyObject *arg12 = (PyObject *) 0 ;
-    void *argp1 = 0 ;
-    int res1 = 0 ;
-    PyObject * obj0 = 0 ;
-    PyObject * obj1 = 0 ;
-    PyObject * obj2 = 0 ;
-    PyObject * obj3 = 0 ;
-    PyObject * obj4 = 0 ;
-    PyObject * obj5 = 0 ;
-    PyObject * obj6 = 0 ;
-    PyObject * obj7 = 0 ;
-    PyObject * obj8 = 0 ;
-    PyObject * obj9 = 0 ;
-    PyObject * obj10 = 0 ;
-    PyObject * obj11 = 0 ;
-    PyObject *result = 0 ;
-
-    if (!PyArg_ParseTuple(args, (char *)"OOOOOOOOOOOO:HTMC_cbincount", &obj0, &obj1, &obj2, &obj3, &obj4, &obj5, &obj6, &obj7, &obj8, &obj9, &obj10, &obj11)) { SWIG_fail; }
-    res1 = SWIG_ConvertPtr(obj0, &argp1, SWIGTYPE_p_HTMC, 0 |  0);
-    if (!SWIG_IsOK(res1)) {
-        SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_cbincount" "', argument " "1"" of type '" "HTMC *""'");
+  SWIG_Python_RaiseOrModifyTypeError("Wrong number or type of arguments for overloaded function 'new_Matcher'.\n"
+    "  Possible C/C++ prototypes are:\n"
+    "    Matcher::Matcher(int,PyObject *,PyObject *,int)\n"
+    "    Matcher::Matcher(int,PyObject *,PyObject *)\n"
+    "    Matcher::Matcher(int,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,int)\n"
+    "    Matcher::Matcher(int,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *)\n");
+  return 0;
+}
+
+
+SWIGINTERN PyObject *_wrap_delete_Matcher(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[1] ;
+  
+  (void)self;
+  if (!args) SWIG_fail;
+  swig_obj[0] = args;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, SWIG_POINTER_DISOWN |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "delete_Matcher" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  delete arg1;
+  resultobj = SWIG_Py_Void();
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_get_depth(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[1] ;
+  int result;
+  
+  (void)self;
+  if (!args) SWIG_fail;
+  swig_obj[0] = args;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_get_depth" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  result = (int)(arg1)->get_depth();
+  resultobj = SWIG_From_int(static_cast< int >(result));
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_get_buildlevel(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[1] ;
+  int result;
+  
+  (void)self;
+  if (!args) SWIG_fail;
+  swig_obj[0] = args;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_get_buildlevel" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  result = (int)(arg1)->get_buildlevel();
+  resultobj = SWIG_From_int(static_cast< int >(result));
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_get_coordinates(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[1] ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if (!args) SWIG_fail;
+  swig_obj[0] = args;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_get_coordinates" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  try {
+    result = (PyObject *)(arg1)->get_coordinates();
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_get_buckets(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[1] ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if (!args) SWIG_fail;
+  swig_obj[0] = args;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_get_buckets" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  try {
+    result = (PyObject *)(arg1)->get_buckets();
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_match__SWIG_0(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  int arg7 ;
+  int arg8 ;
+  int arg9 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val7 ;
+  int ecode7 = 0 ;
+  int val8 ;
+  int ecode8 = 0 ;
+  int val9 ;
+  int ecode9 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 9) || (nobjs > 9)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_match" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  ecode7 = SWIG_AsVal_int(swig_obj[6], &val7);
+  if (!SWIG_IsOK(ecode7)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode7), "in method '" "Matcher_match" "', argument " "7"" of type '" "int""'");
+  } 
+  arg7 = static_cast< int >(val7);
+  ecode8 = SWIG_AsVal_int(swig_obj[7], &val8);
+  if (!SWIG_IsOK(ecode8)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode8), "in method '" "Matcher_match" "', argument " "8"" of type '" "int""'");
+  } 
+  arg8 = static_cast< int >(val8);
+  ecode9 = SWIG_AsVal_int(swig_obj[8], &val9);
+  if (!SWIG_IsOK(ecode9)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode9), "in method '" "Matcher_match" "', argument " "9"" of type '" "int""'");
+  } 
+  arg9 = static_cast< int >(val9);
+  try {
+    result = (PyObject *)(arg1)->match(arg2,arg3,arg4,arg5,arg6,arg7,arg8,arg9);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_match__SWIG_1(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  int arg7 ;
+  int arg8 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val7 ;
+  int ecode7 = 0 ;
+  int val8 ;
+  int ecode8 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 8) || (nobjs > 8)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_match" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  ecode7 = SWIG_AsVal_int(swig_obj[6], &val7);
+  if (!SWIG_IsOK(ecode7)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode7), "in method '" "Matcher_match" "', argument " "7"" of type '" "int""'");
+  } 
+  arg7 = static_cast< int >(val7);
+  ecode8 = SWIG_AsVal_int(swig_obj[7], &val8);
+  if (!SWIG_IsOK(ecode8)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode8), "in method '" "Matcher_match" "', argument " "8"" of type '" "int""'");
+  } 
+  arg8 = static_cast< int >(val8);
+  try {
+    result = (PyObject *)(arg1)->match(arg2,arg3,arg4,arg5,arg6,arg7,arg8);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_match__SWIG_2(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  int arg7 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val7 ;
+  int ecode7 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 7) || (nobjs > 7)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_match" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  ecode7 = SWIG_AsVal_int(swig_obj[6], &val7);
+  if (!SWIG_IsOK(ecode7)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode7), "in method '" "Matcher_match" "', argument " "7"" of type '" "int""'");
+  } 
+  arg7 = static_cast< int >(val7);
+  try {
+    result = (PyObject *)(arg1)->match(arg2,arg3,arg4,arg5,arg6,arg7);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_match__SWIG_3(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 6) || (nobjs > 6)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_match" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  try {
+    result = (PyObject *)(arg1)->match(arg2,arg3,arg4,arg5,arg6);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_match(PyObject *self, PyObject *args) {
+  Py_ssize_t argc;
+  PyObject *argv[10] = {
+    0
+  };
+  
+  if (!(argc = SWIG_Python_UnpackTuple(args, "Matcher_match", 0, 9, argv))) SWIG_fail;
+  --argc;
+  if (argc == 6) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          _v = (argv[3] != 0);
+          if (_v) {
+            _v = (argv[4] != 0);
+            if (_v) {
+              _v = (argv[5] != 0);
+              if (_v) {
+                return _wrap_Matcher_match__SWIG_3(self, argc, argv);
+              }
+            }
+          }
+        }
+      }
     }
-    arg1 = reinterpret_cast< HTMC * >(argp1);
-    arg2 = obj1;
-    arg3 = obj2;
-    arg4 = obj3;
-    arg5 = obj4;
-    arg6 = obj5;
-    arg7 = obj6;
-    arg8 = obj7;
-    arg9 = obj8;
-    arg10 = obj9;
-    arg11 = obj10;
-    arg12 = obj11;
-    try {
-        result = (PyObject *)(arg1)->cbincount(arg2, arg3, arg4, arg5, arg6, arg7, arg8, arg9, arg10, arg11, arg12);
+  }
+  if (argc == 7) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          _v = (argv[3] != 0);
+          if (_v) {
+            _v = (argv[4] != 0);
+            if (_v) {
+              _v = (argv[5] != 0);
+              if (_v) {
+                {
+                  int res = SWIG_AsVal_int(argv[6], NULL);
+                  _v = SWIG_CheckState(res);
+                }
+                if (_v) {
+                  return _wrap_Matcher_match__SWIG_2(self, argc, argv);
+                }
+              }
+            }
+          }
+        }
+      }
     }
-    catch (char const *_e) {
-        PyErr_SetString(PyExc_RuntimeError, _e);
-        SWIG_fail;
-
+  }
+  if (argc == 8) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          _v = (argv[3] != 0);
+          if (_v) {
+            _v = (argv[4] != 0);
+            if (_v) {
+              _v = (argv[5] != 0);
+              if (_v) {
+                {
+                  int res = SWIG_AsVal_int(argv[6], NULL);
+                  _v = SWIG_CheckState(res);
+                }
+                if (_v) {
+                  {
+                    int res = SWIG_AsVal_int(argv[7], NULL);
+                    _v = SWIG_CheckState(res);
+                  }
+                  if (_v) {
+                    return _wrap_Matcher_match__SWIG_1(self, argc, argv);
+                  }
+                }
+              }
+            }
+          }
+        }
+      }
     }
-
-    resultobj = result;
-    return resultobj;
+  }
+  if (argc == 9) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          _v = (argv[3] != 0);
+          if (_v) {
+            _v = (argv[4] != 0);
+            if (_v) {
+              _v = (argv[5] != 0);
+              if (_v) {
+                {
+                  int res = SWIG_AsVal_int(argv[6], NULL);
+                  _v = SWIG_CheckState(res);
+                }
+                if (_v) {
+                  {
+                    int res = SWIG_AsVal_int(argv[7], NULL);
+                    _v = SWIG_CheckState(res);
+                  }
+                  if (_v) {
+                    {
+                      int res = SWIG_AsVal_int(argv[8], NULL);
+                      _v = SWIG_CheckState(res);
+                    }
+                    if (_v) {
+                      return _wrap_Matcher_match__SWIG_0(self, argc, argv);
+                    }
+                  }
+                }
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+  
 fail:
-    return NULL;
-}
-
-
-SWIGINTERN PyObject *_wrap_HTMC_cbincount__SWIG_1(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *resultobj = 0;
-    HTMC *arg1 = (HTMC *) 0 ;
-    PyObject *arg2 = (PyObject *) 0 ;
-    PyObject *arg3 = (PyObject *) 0 ;
-    PyObject *arg4 = (PyObject *) 0 ;
-    PyObject *arg5 = (PyObject *) 0 ;
-    PyObject *arg6 = (PyObject *) 0 ;
-    PyObject *arg7 = (PyObject *) 0 ;
-    PyObject *arg8 = (PyObject *) 0 ;
-    PyObject *arg9 = (PyObject *) 0 ;
-    PyObject *arg10 = (PyObject *) 0 ;
-    PyObject *arg11 = (PyObject *) 0 ;
-    void *argp1 = 0 ;
-    int res1 = 0 ;
-    PyObject * obj0 = 0 ;
-    PyObject * obj1 = 0 ;
-    PyObject * obj2 = 0 ;
-    PyObject * obj3 = 0 ;
-    PyObject * obj4 = 0 ;
-    PyObject * obj5 = 0 ;
-    PyObject * obj6 = 0 ;
-    PyObject * obj7 = 0 ;
-    PyObject * obj8 = 0 ;
-    PyObject * obj9 = 0 ;
-    PyObject * obj10 = 0 ;
-    PyObject *result = 0 ;
-
-    if (!PyArg_ParseTuple(args, (char *)"OOOOOOOOOOO:HTMC_cbincount", &obj0, &obj1, &obj2, &obj3, &obj4, &obj5, &obj6, &obj7, &obj8, &obj9, &obj10)) { SWIG_fail; }
-    res1 = SWIG_ConvertPtr(obj0, &argp1, SWIGTYPE_p_HTMC, 0 |  0);
-    if (!SWIG_IsOK(res1)) {
-        SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_cbincount" "', argument " "1"" of type '" "HTMC *""'");
+  SWIG_Python_RaiseOrModifyTypeError("Wrong number or type of arguments for overloaded function 'Matcher_match'.\n"
+    "  Possible C/C++ prototypes are:\n"
+    "    Matcher::match(PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,int,int,int)\n"
+    "    Matcher::match(PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,int,int)\n"
+    "    Matcher::match(PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,int)\n"
+    "    Matcher::match(PyObject *,PyObject *,PyObject *,PyObject *,PyObject *)\n");
+  return 0;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_match_xyz__SWIG_0(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  PyObject *arg7 = 0 ;
+  int arg8 ;
+  int arg9 ;
+  int arg10 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val8 ;
+  int ecode8 = 0 ;
+  int val9 ;
+  int ecode9 = 0 ;
+  int val10 ;
+  int ecode10 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 10) || (nobjs > 10)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_match_xyz" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  arg7 = swig_obj[6];
+  ecode8 = SWIG_AsVal_int(swig_obj[7], &val8);
+  if (!SWIG_IsOK(ecode8)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode8), "in method '" "Matcher_match_xyz" "', argument " "8"" of type '" "int""'");
+  } 
+  arg8 = static_cast< int >(val8);
+  ecode9 = SWIG_AsVal_int(swig_obj[8], &val9);
+  if (!SWIG_IsOK(ecode9)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode9), "in method '" "Matcher_match_xyz" "', argument " "9"" of type '" "int""'");
+  } 
+  arg9 = static_cast< int >(val9);
+  ecode10 = SWIG_AsVal_int(swig_obj[9], &val10);
+  if (!SWIG_IsOK(ecode10)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode10), "in method '" "Matcher_match_xyz" "', argument " "10"" of type '" "int""'");
+  } 
+  arg10 = static_cast< int >(val10);
+  try {
+    result = (PyObject *)(arg1)->match_xyz(arg2,arg3,arg4,arg5,arg6,arg7,arg8,arg9,arg10);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_match_xyz__SWIG_1(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  PyObject *arg7 = 0 ;
+  int arg8 ;
+  int arg9 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val8 ;
+  int ecode8 = 0 ;
+  int val9 ;
+  int ecode9 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 9) || (nobjs > 9)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_match_xyz" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  arg7 = swig_obj[6];
+  ecode8 = SWIG_AsVal_int(swig_obj[7], &val8);
+  if (!SWIG_IsOK(ecode8)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode8), "in method '" "Matcher_match_xyz" "', argument " "8"" of type '" "int""'");
+  } 
+  arg8 = static_cast< int >(val8);
+  ecode9 = SWIG_AsVal_int(swig_obj[8], &val9);
+  if (!SWIG_IsOK(ecode9)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode9), "in method '" "Matcher_match_xyz" "', argument " "9"" of type '" "int""'");
+  } 
+  arg9 = static_cast< int >(val9);
+  try {
+    result = (PyObject *)(arg1)->match_xyz(arg2,arg3,arg4,arg5,arg6,arg7,arg8,arg9);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_match_xyz__SWIG_2(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  PyObject *arg7 = 0 ;
+  int arg8 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val8 ;
+  int ecode8 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 8) || (nobjs > 8)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_match_xyz" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  arg7 = swig_obj[6];
+  ecode8 = SWIG_AsVal_int(swig_obj[7], &val8);
+  if (!SWIG_IsOK(ecode8)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode8), "in method '" "Matcher_match_xyz" "', argument " "8"" of type '" "int""'");
+  } 
+  arg8 = static_cast< int >(val8);
+  try {
+    result = (PyObject *)(arg1)->match_xyz(arg2,arg3,arg4,arg5,arg6,arg7,arg8);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_match_xyz__SWIG_3(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  PyObject *arg7 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 7) || (nobjs > 7)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_match_xyz" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  arg7 = swig_obj[6];
+  try {
+    result = (PyObject *)(arg1)->match_xyz(arg2,arg3,arg4,arg5,arg6,arg7);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_match_xyz(PyObject *self, PyObject *args) {
+  Py_ssize_t argc;
+  PyObject *argv[11] = {
+    0
+  };
+  
+  if (!(argc = SWIG_Python_UnpackTuple(args, "Matcher_match_xyz", 0, 10, argv))) SWIG_fail;
+  --argc;
+  if (argc == 7) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          _v = (argv[3] != 0);
+          if (_v) {
+            _v = (argv[4] != 0);
+            if (_v) {
+              _v = (argv[5] != 0);
+              if (_v) {
+                _v = (argv[6] != 0);
+                if (_v) {
+                  return _wrap_Matcher_match_xyz__SWIG_3(self, argc, argv);
+                }
+              }
+            }
+          }
+        }
+      }
     }
-    arg1 = reinterpret_cast< HTMC * >(argp1);
-    arg2 = obj1;
-    arg3 = obj2;
-    arg4 = obj3;
-    arg5 = obj4;
-    arg6 = obj5;
-    arg7 = obj6;
-    arg8 = obj7;
-    arg9 = obj8;
-    arg10 = obj9;
-    arg11 = obj10;
-    try {
-        result = (PyObject *)(arg1)->cbincount(arg2, arg3, arg4, arg5, arg6, arg7, arg8, arg9, arg10, arg11);
+  }
+  if (argc == 8) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          _v = (argv[3] != 0);
+          if (_v) {
+            _v = (argv[4] != 0);
+            if (_v) {
+              _v = (argv[5] != 0);
+              if (_v) {
+                _v = (argv[6] != 0);
+                if (_v) {
+                  {
+                    int res = SWIG_AsVal_int(argv[7], NULL);
+                    _v = SWIG_CheckState(res);
+                  }
+                  if (_v) {
+                    return _wrap_Matcher_match_xyz__SWIG_2(self, argc, argv);
+                  }
+                }
+              }
+            }
+          }
+        }
+      }
     }
-    catch (char const *_e) {
-        PyErr_SetString(PyExc_RuntimeError, _e);
-        SWIG_fail;
-
+  }
+  if (argc == 9) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          _v = (argv[3] != 0);
+          if (_v) {
+            _v = (argv[4] != 0);
+            if (_v) {
+              _v = (argv[5] != 0);
+              if (_v) {
+                _v = (argv[6] != 0);
+                if (_v) {
+                  {
+                    int res = SWIG_AsVal_int(argv[7], NULL);
+                    _v = SWIG_CheckState(res);
+                  }
+                  if (_v) {
+                    {
+                      int res = SWIG_AsVal_int(argv[8], NULL);
+                      _v = SWIG_CheckState(res);
+                    }
+                    if (_v) {
+                      return _wrap_Matcher_match_xyz__SWIG_1(self, argc, argv);
+                    }
+                  }
+                }
+              }
+            }
+          }
+        }
+      }
     }
-
-    resultobj = result;
-    return resultobj;
+  }
+  if (argc == 10) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          _v = (argv[3] != 0);
+          if (_v) {
+            _v = (argv[4] != 0);
+            if (_v) {
+              _v = (argv[5] != 0);
+              if (_v) {
+                _v = (argv[6] != 0);
+                if (_v) {
+                  {
+                    int res = SWIG_AsVal_int(argv[7], NULL);
+                    _v = SWIG_CheckState(res);
+                  }
+                  if (_v) {
+                    {
+                      int res = SWIG_AsVal_int(argv[8], NULL);
+                      _v = SWIG_CheckState(res);
+                    }
+                    if (_v) {
+                      {
+                        int res = SWIG_AsVal_int(argv[9], NULL);
+                        _v = SWIG_CheckState(res);
+                      }
+                      if (_v) {
+                        return _wrap_Matcher_match_xyz__SWIG_0(self, argc, argv);
+                      }
+                    }
+                  }
+                }
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+  
 fail:
-    return NULL;
-}
-
-
-SWIGINTERN PyObject *_wrap_HTMC_cbincount(PyObject *self, PyObject *args)
-{
-    int argc;
-    PyObject *argv[13];
-    int ii;
-
-    if (!PyTuple_Check(args)) { SWIG_fail; }
-    argc = args ? (int)PyObject_Length(args) : 0;
-    for (ii = 0; (ii < 12) && (ii < argc); ii++) {
-        argv[ii] = PyTuple_GET_ITEM(args, ii);
+  SWIG_Python_RaiseOrModifyTypeError("Wrong number or type of arguments for overloaded function 'Matcher_match_xyz'.\n"
+    "  Possible C/C++ prototypes are:\n"
+    "    Matcher::match_xyz(PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,int,int,int)\n"
+    "    Matcher::match_xyz(PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,int,int)\n"
+    "    Matcher::match_xyz(PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,int)\n"
+    "    Matcher::match_xyz(PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *)\n");
+  return 0;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_bincount__SWIG_0(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  double arg2 ;
+  double arg3 ;
+  int arg4 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  PyObject *arg7 = 0 ;
+  long long arg8 ;
+  long long arg9 ;
+  int arg10 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  double val2 ;
+  int ecode2 = 0 ;
+  double val3 ;
+  int ecode3 = 0 ;
+  int val4 ;
+  int ecode4 = 0 ;
+  long long val8 ;
+  int ecode8 = 0 ;
+  long long val9 ;
+  int ecode9 = 0 ;
+  int val10 ;
+  int ecode10 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 10) || (nobjs > 10)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_bincount" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  ecode2 = SWIG_AsVal_double(swig_obj[1], &val2);
+  if (!SWIG_IsOK(ecode2)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode2), "in method '" "Matcher_bincount" "', argument " "2"" of type '" "double""'");
+  } 
+  arg2 = static_cast< double >(val2);
+  ecode3 = SWIG_AsVal_double(swig_obj[2], &val3);
+  if (!SWIG_IsOK(ecode3)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode3), "in method '" "Matcher_bincount" "', argument " "3"" of type '" "double""'");
+  } 
+  arg3 = static_cast< double >(val3);
+  ecode4 = SWIG_AsVal_int(swig_obj[3], &val4);
+  if (!SWIG_IsOK(ecode4)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode4), "in method '" "Matcher_bincount" "', argument " "4"" of type '" "int""'");
+  } 
+  arg4 = static_cast< int >(val4);
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  arg7 = swig_obj[6];
+  ecode8 = SWIG_AsVal_long_SS_long(swig_obj[7], &val8);
+  if (!SWIG_IsOK(ecode8)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode8), "in method '" "Matcher_bincount" "', argument " "8"" of type '" "long long""'");
+  } 
+  arg8 = static_cast< long long >(val8);
+  ecode9 = SWIG_AsVal_long_SS_long(swig_obj[8], &val9);
+  if (!SWIG_IsOK(ecode9)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode9), "in method '" "Matcher_bincount" "', argument " "9"" of type '" "long long""'");
+  } 
+  arg9 = static_cast< long long >(val9);
+  ecode10 = SWIG_AsVal_int(swig_obj[9], &val10);
+  if (!SWIG_IsOK(ecode10)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode10), "in method '" "Matcher_bincount" "', argument " "10"" of type '" "int""'");
+  } 
+  arg10 = static_cast< int >(val10);
+  try {
+    result = (PyObject *)(arg1)->bincount(arg2,arg3,arg4,arg5,arg6,arg7,arg8,arg9,arg10);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_bincount__SWIG_1(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  double arg2 ;
+  double arg3 ;
+  int arg4 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  PyObject *arg7 = 0 ;
+  long long arg8 ;
+  long long arg9 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  double val2 ;
+  int ecode2 = 0 ;
+  double val3 ;
+  int ecode3 = 0 ;
+  int val4 ;
+  int ecode4 = 0 ;
+  long long val8 ;
+  int ecode8 = 0 ;
+  long long val9 ;
+  int ecode9 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 9) || (nobjs > 9)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_bincount" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  ecode2 = SWIG_AsVal_double(swig_obj[1], &val2);
+  if (!SWIG_IsOK(ecode2)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode2), "in method '" "Matcher_bincount" "', argument " "2"" of type '" "double""'");
+  } 
+  arg2 = static_cast< double >(val2);
+  ecode3 = SWIG_AsVal_double(swig_obj[2], &val3);
+  if (!SWIG_IsOK(ecode3)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode3), "in method '" "Matcher_bincount" "', argument " "3"" of type '" "double""'");
+  } 
+  arg3 = static_cast< double >(val3);
+  ecode4 = SWIG_AsVal_int(swig_obj[3], &val4);
+  if (!SWIG_IsOK(ecode4)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode4), "in method '" "Matcher_bincount" "', argument " "4"" of type '" "int""'");
+  } 
+  arg4 = static_cast< int >(val4);
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  arg7 = swig_obj[6];
+  ecode8 = SWIG_AsVal_long_SS_long(swig_obj[7], &val8);
+  if (!SWIG_IsOK(ecode8)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode8), "in method '" "Matcher_bincount" "', argument " "8"" of type '" "long long""'");
+  } 
+  arg8 = static_cast< long long >(val8);
+  ecode9 = SWIG_AsVal_long_SS_long(swig_obj[8], &val9);
+  if (!SWIG_IsOK(ecode9)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode9), "in method '" "Matcher_bincount" "', argument " "9"" of type '" "long long""'");
+  } 
+  arg9 = static_cast< long long >(val9);
+  try {
+    result = (PyObject *)(arg1)->bincount(arg2,arg3,arg4,arg5,arg6,arg7,arg8,arg9);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_bincount__SWIG_2(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  double arg2 ;
+  double arg3 ;
+  int arg4 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  PyObject *arg7 = 0 ;
+  long long arg8 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  double val2 ;
+  int ecode2 = 0 ;
+  double val3 ;
+  int ecode3 = 0 ;
+  int val4 ;
+  int ecode4 = 0 ;
+  long long val8 ;
+  int ecode8 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 8) || (nobjs > 8)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_bincount" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  ecode2 = SWIG_AsVal_double(swig_obj[1], &val2);
+  if (!SWIG_IsOK(ecode2)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode2), "in method '" "Matcher_bincount" "', argument " "2"" of type '" "double""'");
+  } 
+  arg2 = static_cast< double >(val2);
+  ecode3 = SWIG_AsVal_double(swig_obj[2], &val3);
+  if (!SWIG_IsOK(ecode3)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode3), "in method '" "Matcher_bincount" "', argument " "3"" of type '" "double""'");
+  } 
+  arg3 = static_cast< double >(val3);
+  ecode4 = SWIG_AsVal_int(swig_obj[3], &val4);
+  if (!SWIG_IsOK(ecode4)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode4), "in method '" "Matcher_bincount" "', argument " "4"" of type '" "int""'");
+  } 
+  arg4 = static_cast< int >(val4);
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  arg7 = swig_obj[6];
+  ecode8 = SWIG_AsVal_long_SS_long(swig_obj[7], &val8);
+  if (!SWIG_IsOK(ecode8)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode8), "in method '" "Matcher_bincount" "', argument " "8"" of type '" "long long""'");
+  } 
+  arg8 = static_cast< long long >(val8);
+  try {
+    result = (PyObject *)(arg1)->bincount(arg2,arg3,arg4,arg5,arg6,arg7,arg8);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_bincount__SWIG_3(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  double arg2 ;
+  double arg3 ;
+  int arg4 ;
+  PyObject *arg5 = 0 ;
+  PyObject *arg6 = 0 ;
+  PyObject *arg7 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  double val2 ;
+  int ecode2 = 0 ;
+  double val3 ;
+  int ecode3 = 0 ;
+  int val4 ;
+  int ecode4 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 7) || (nobjs > 7)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_bincount" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  ecode2 = SWIG_AsVal_double(swig_obj[1], &val2);
+  if (!SWIG_IsOK(ecode2)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode2), "in method '" "Matcher_bincount" "', argument " "2"" of type '" "double""'");
+  } 
+  arg2 = static_cast< double >(val2);
+  ecode3 = SWIG_AsVal_double(swig_obj[2], &val3);
+  if (!SWIG_IsOK(ecode3)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode3), "in method '" "Matcher_bincount" "', argument " "3"" of type '" "double""'");
+  } 
+  arg3 = static_cast< double >(val3);
+  ecode4 = SWIG_AsVal_int(swig_obj[3], &val4);
+  if (!SWIG_IsOK(ecode4)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode4), "in method '" "Matcher_bincount" "', argument " "4"" of type '" "int""'");
+  } 
+  arg4 = static_cast< int >(val4);
+  arg5 = swig_obj[4];
+  arg6 = swig_obj[5];
+  arg7 = swig_obj[6];
+  try {
+    result = (PyObject *)(arg1)->bincount(arg2,arg3,arg4,arg5,arg6,arg7);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_bincount(PyObject *self, PyObject *args) {
+  Py_ssize_t argc;
+  PyObject *argv[11] = {
+    0
+  };
+  
+  if (!(argc = SWIG_Python_UnpackTuple(args, "Matcher_bincount", 0, 10, argv))) SWIG_fail;
+  --argc;
+  if (argc == 7) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      {
+        int res = SWIG_AsVal_double(argv[1], NULL);
+        _v = SWIG_CheckState(res);
+      }
+      if (_v) {
+        {
+          int res = SWIG_AsVal_double(argv[2], NULL);
+          _v = SWIG_CheckState(res);
+        }
+        if (_v) {
+          {
+            int res = SWIG_AsVal_int(argv[3], NULL);
+            _v = SWIG_CheckState(res);
+          }
+          if (_v) {
+            _v = (argv[4] != 0);
+            if (_v) {
+              _v = (argv[5] != 0);
+              if (_v) {
+                _v = (argv[6] != 0);
+                if (_v) {
+                  return _wrap_Matcher_bincount__SWIG_3(self, argc, argv);
+                }
+              }
+            }
+          }
+        }
+      }
     }
-    if (argc == 11) {
-        int _v;
-        void *vptr = 0;
-        int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_HTMC, 0);
+  }
+  if (argc == 8) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      {
+        int res = SWIG_AsVal_double(argv[1], NULL);
         _v = SWIG_CheckState(res);
+      }
+      if (_v) {
+        {
+          int res = SWIG_AsVal_double(argv[2], NULL);
+          _v = SWIG_CheckState(res);
+        }
         if (_v) {
-            _v = (argv[1] != 0);
+          {
+            int res = SWIG_AsVal_int(argv[3], NULL);
+            _v = SWIG_CheckState(res);
+          }
+          if (_v) {
+            _v = (argv[4] != 0);
             if (_v) {
-                _v = (argv[2] != 0);
+              _v = (argv[5] != 0);
+              if (_v) {
+                _v = (argv[6] != 0);
                 if (_v) {
-                    _v = (argv[3] != 0);
+                  {
+                    int res = SWIG_AsVal_long_SS_long(argv[7], NULL);
+                    _v = SWIG_CheckState(res);
+                  }
+                  if (_v) {
+                    return _wrap_Matcher_bincount__SWIG_2(self, argc, argv);
+                  }
+                }
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+  if (argc == 9) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      {
+        int res = SWIG_AsVal_double(argv[1], NULL);
+        _v = SWIG_CheckState(res);
+      }
+      if (_v) {
+        {
+          int res = SWIG_AsVal_double(argv[2], NULL);
+          _v = SWIG_CheckState(res);
+        }
+        if (_v) {
+          {
+            int res = SWIG_AsVal_int(argv[3], NULL);
+            _v = SWIG_CheckState(res);
+          }
+          if (_v) {
+            _v = (argv[4] != 0);
+            if (_v) {
+              _v = (argv[5] != 0);
+              if (_v) {
+                _v = (argv[6] != 0);
+                if (_v) {
+                  {
+                    int res = SWIG_AsVal_long_SS_long(argv[7], NULL);
+                    _v = SWIG_CheckState(res);
+                  }
+                  if (_v) {
+                    {
+                      int res = SWIG_AsVal_long_SS_long(argv[8], NULL);
+                      _v = SWIG_CheckState(res);
+                    }
                     if (_v) {
-                        _v = (argv[4] != 0);
-                        if (_v) {
-                            _v = (argv[5] != 0);
-                            if (_v) {
-                                _v = (argv[6] != 0);
-                                if (_v) {
-                                    _v = (argv[7] != 0);
-                                    if (_v) {
-                                        _v = (argv[8] != 0);
-                                        if (_v) {
-                                            _v = (argv[9] != 0);
-                                            if (_v) {
-                                                _v = (argv[10] != 0);
-                                                if (_v) {
-                                                    return _wrap_HTMC_cbincount__SWIG_1(self, args);
-                                                }
-                                            }
-                                        }
-                                    }
-                                }
-                            }
-                        }
+                      return _wrap_Matcher_bincount__SWIG_1(self, argc, argv);
                     }
+                  }
                 }
+              }
             }
+          }
         }
+      }
     }
-    if (argc == 12) {
-        int _v;
-        void *vptr = 0;
-        int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_HTMC, 0);
+  }
+  if (argc == 10) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      {
+        int res = SWIG_AsVal_double(argv[1], NULL);
         _v = SWIG_CheckState(res);
+      }
+      if (_v) {
+        {
+          int res = SWIG_AsVal_double(argv[2], NULL);
+          _v = SWIG_CheckState(res);
+        }
         if (_v) {
-            _v = (argv[1] != 0);
+          {
+            int res = SWIG_AsVal_int(argv[3], NULL);
+            _v = SWIG_CheckState(res);
+          }
+          if (_v) {
+            _v = (argv[4] != 0);
             if (_v) {
-                _v = (argv[2] != 0);
+              _v = (argv[5] != 0);
+              if (_v) {
+                _v = (argv[6] != 0);
                 if (_v) {
-                    _v = (argv[3] != 0);
+                  {
+                    int res = SWIG_AsVal_long_SS_long(argv[7], NULL);
+                    _v = SWIG_CheckState(res);
+                  }
+                  if (_v) {
+                    {
+                      int res = SWIG_AsVal_long_SS_long(argv[8], NULL);
+                      _v = SWIG_CheckState(res);
+                    }
                     if (_v) {
-                        _v = (argv[4] != 0);
-                        if (_v) {
-                            _v = (argv[5] != 0);
-                            if (_v) {
-                                _v = (argv[6] != 0);
-                                if (_v) {
-                                    _v = (argv[7] != 0);
-                                    if (_v) {
-                                        _v = (argv[8] != 0);
-                                        if (_v) {
-                                            _v = (argv[9] != 0);
-                                            if (_v) {
-                                                _v = (argv[10] != 0);
-                                                if (_v) {
-                                                    _v = (argv[11] != 0);
-                                                    if (_v) {
-                                                        return _wrap_HTMC_cbincount__SWIG_0(self, args);
-                                                    }
-                                                }
-                                            }
-                                        }
-                                    }
-                                }
-                            }
-                        }
+                      {
+                        int res = SWIG_AsVal_int(argv[9], NULL);
+                        _v = SWIG_CheckState(res);
+                      }
+                      if (_v) {
+                        return _wrap_Matcher_bincount__SWIG_0(self, argc, argv);
+                      }
                     }
+                  }
                 }
+              }
             }
+          }
         }
+      }
     }
-
+  }
+  
 fail:
-    SWIG_SetErrorMsg(PyExc_NotImplementedError, "Wrong number or type of arguments for overloaded function 'HTMC_cbincount'.\n"
-                     "  Possible C/C++ prototypes are:\n"
-                     "    HTMC::cbincount(PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *)\n"
-                     "    HTMC::cbincount(PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *,PyObject *)\n");
-    return 0;
-}
-
-
-SWIGINTERN PyObject *_wrap_HTMC_depth(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *resultobj = 0;
-    HTMC *arg1 = (HTMC *) 0 ;
-    void *argp1 = 0 ;
-    int res1 = 0 ;
-    PyObject * obj0 = 0 ;
-    int result;
-
-    if (!PyArg_ParseTuple(args, (char *)"O:HTMC_depth", &obj0)) { SWIG_fail; }
-    res1 = SWIG_ConvertPtr(obj0, &argp1, SWIGTYPE_p_HTMC, 0 |  0);
-    if (!SWIG_IsOK(res1)) {
-        SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "HTMC_depth" "', argument " "1"" of type '" "HTMC *""'");
+  SWIG_Python_RaiseOrModifyTypeError("Wrong number or type of arguments for overloaded function 'Matcher_bincount'.\n"
+    "  Possible C/C++ prototypes are:\n"
+    "    Matcher::bincount(double,double,int,PyObject *,PyObject *,PyObject *,long long,long long,int)\n"
+    "    Matcher::bincount(double,double,int,PyObject *,PyObject *,PyObject *,long long,long long)\n"
+    "    Matcher::bincount(double,double,int,PyObject *,PyObject *,PyObject *,long long)\n"
+    "    Matcher::bincount(double,double,int,PyObject *,PyObject *,PyObject *)\n");
+  return 0;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_self_match__SWIG_0(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  int arg3 ;
+  int arg4 ;
+  int arg5 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val3 ;
+  int ecode3 = 0 ;
+  int val4 ;
+  int ecode4 = 0 ;
+  int val5 ;
+  int ecode5 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 5) || (nobjs > 5)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_self_match" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  ecode3 = SWIG_AsVal_int(swig_obj[2], &val3);
+  if (!SWIG_IsOK(ecode3)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode3), "in method '" "Matcher_self_match" "', argument " "3"" of type '" "int""'");
+  } 
+  arg3 = static_cast< int >(val3);
+  ecode4 = SWIG_AsVal_int(swig_obj[3], &val4);
+  if (!SWIG_IsOK(ecode4)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode4), "in method '" "Matcher_self_match" "', argument " "4"" of type '" "int""'");
+  } 
+  arg4 = static_cast< int >(val4);
+  ecode5 = SWIG_AsVal_int(swig_obj[4], &val5);
+  if (!SWIG_IsOK(ecode5)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode5), "in method '" "Matcher_self_match" "', argument " "5"" of type '" "int""'");
+  } 
+  arg5 = static_cast< int >(val5);
+  try {
+    result = (PyObject *)(arg1)->self_match(arg2,arg3,arg4,arg5);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_self_match__SWIG_1(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  int arg3 ;
+  int arg4 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val3 ;
+  int ecode3 = 0 ;
+  int val4 ;
+  int ecode4 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 4) || (nobjs > 4)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_self_match" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  ecode3 = SWIG_AsVal_int(swig_obj[2], &val3);
+  if (!SWIG_IsOK(ecode3)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode3), "in method '" "Matcher_self_match" "', argument " "3"" of type '" "int""'");
+  } 
+  arg3 = static_cast< int >(val3);
+  ecode4 = SWIG_AsVal_int(swig_obj[3], &val4);
+  if (!SWIG_IsOK(ecode4)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode4), "in method '" "Matcher_self_match" "', argument " "4"" of type '" "int""'");
+  } 
+  arg4 = static_cast< int >(val4);
+  try {
+    result = (PyObject *)(arg1)->self_match(arg2,arg3,arg4);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_self_match__SWIG_2(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  int arg3 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  int val3 ;
+  int ecode3 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 3) || (nobjs > 3)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_self_match" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  ecode3 = SWIG_AsVal_int(swig_obj[2], &val3);
+  if (!SWIG_IsOK(ecode3)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode3), "in method '" "Matcher_self_match" "', argument " "3"" of type '" "int""'");
+  } 
+  arg3 = static_cast< int >(val3);
+  try {
+    result = (PyObject *)(arg1)->self_match(arg2,arg3);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_self_match__SWIG_3(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 2) || (nobjs > 2)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_self_match" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  try {
+    result = (PyObject *)(arg1)->self_match(arg2);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_self_match(PyObject *self, PyObject *args) {
+  Py_ssize_t argc;
+  PyObject *argv[6] = {
+    0
+  };
+  
+  if (!(argc = SWIG_Python_UnpackTuple(args, "Matcher_self_match", 0, 5, argv))) SWIG_fail;
+  --argc;
+  if (argc == 2) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        return _wrap_Matcher_self_match__SWIG_3(self, argc, argv);
+      }
     }
-    arg1 = reinterpret_cast< HTMC * >(argp1);
-    result = (int)(arg1)->depth();
-    resultobj = SWIG_From_int(static_cast< int >(result));
-    return resultobj;
+  }
+  if (argc == 3) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        {
+          int res = SWIG_AsVal_int(argv[2], NULL);
+          _v = SWIG_CheckState(res);
+        }
+        if (_v) {
+          return _wrap_Matcher_self_match__SWIG_2(self, argc, argv);
+        }
+      }
+    }
+  }
+  if (argc == 4) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        {
+          int res = SWIG_AsVal_int(argv[2], NULL);
+          _v = SWIG_CheckState(res);
+        }
+        if (_v) {
+          {
+            int res = SWIG_AsVal_int(argv[3], NULL);
+            _v = SWIG_CheckState(res);
+          }
+          if (_v) {
+            return _wrap_Matcher_self_match__SWIG_1(self, argc, argv);
+          }
+        }
+      }
+    }
+  }
+  if (argc == 5) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        {
+          int res = SWIG_AsVal_int(argv[2], NULL);
+          _v = SWIG_CheckState(res);
+        }
+        if (_v) {
+          {
+            int res = SWIG_AsVal_int(argv[3], NULL);
+            _v = SWIG_CheckState(res);
+          }
+          if (_v) {
+            {
+              int res = SWIG_AsVal_int(argv[4], NULL);
+              _v = SWIG_CheckState(res);
+            }
+            if (_v) {
+              return _wrap_Matcher_self_match__SWIG_0(self, argc, argv);
+            }
+          }
+        }
+      }
+    }
+  }
+  
 fail:
-    return NULL;
-}
-
-
-SWIGINTERN PyObject *HTMC_swigregister(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *obj;
-    if (!PyArg_ParseTuple(args, (char*)"O:swigregister", &obj)) { return NULL; }
-    SWIG_TypeNewClientData(SWIGTYPE_p_HTMC, SWIG_NewClientData(obj));
-    return SWIG_Py_Void();
-}
-
-SWIGINTERN PyObject *_wrap_new_Matcher(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *resultobj = 0;
-    int arg1 ;
-    PyObject *arg2 = (PyObject *) 0 ;
-    PyObject *arg3 = (PyObject *) 0 ;
-    int val1 ;
-    int ecode1 = 0 ;
-    PyObject * obj0 = 0 ;
-    PyObject * obj1 = 0 ;
-    PyObject * obj2 = 0 ;
-    Matcher *result = 0 ;
-
-    if (!PyArg_ParseTuple(args, (char *)"OOO:new_Matcher", &obj0, &obj1, &obj2)) { SWIG_fail; }
-    ecode1 = SWIG_AsVal_int(obj0, &val1);
-    if (!SWIG_IsOK(ecode1)) {
-        SWIG_exception_fail(SWIG_ArgError(ecode1), "in method '" "new_Matcher" "', argument " "1"" of type '" "int""'");
+  SWIG_Python_RaiseOrModifyTypeError("Wrong number or type of arguments for overloaded function 'Matcher_self_match'.\n"
+    "  Possible C/C++ prototypes are:\n"
+    "    Matcher::self_match(PyObject *,int,int,int)\n"
+    "    Matcher::self_match(PyObject *,int,int)\n"
+    "    Matcher::self_match(PyObject *,int)\n"
+    "    Matcher::self_match(PyObject *)\n");
+  return 0;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_within_polygons(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  PyObject *arg4 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[4] ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if (!SWIG_Python_UnpackTuple(args, "Matcher_within_polygons", 4, 4, swig_obj)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_within_polygons" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  arg4 = swig_obj[3];
+  try {
+    result = (PyObject *)(arg1)->within_polygons(arg2,arg3,arg4);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_nearest__SWIG_0(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  long long arg4 ;
+  double arg5 ;
+  int arg6 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  long long val4 ;
+  int ecode4 = 0 ;
+  double val5 ;
+  int ecode5 = 0 ;
+  int val6 ;
+  int ecode6 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 6) || (nobjs > 6)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_nearest" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  ecode4 = SWIG_AsVal_long_SS_long(swig_obj[3], &val4);
+  if (!SWIG_IsOK(ecode4)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode4), "in method '" "Matcher_nearest" "', argument " "4"" of type '" "long long""'");
+  } 
+  arg4 = static_cast< long long >(val4);
+  ecode5 = SWIG_AsVal_double(swig_obj[4], &val5);
+  if (!SWIG_IsOK(ecode5)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode5), "in method '" "Matcher_nearest" "', argument " "5"" of type '" "double""'");
+  } 
+  arg5 = static_cast< double >(val5);
+  ecode6 = SWIG_AsVal_int(swig_obj[5], &val6);
+  if (!SWIG_IsOK(ecode6)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode6), "in method '" "Matcher_nearest" "', argument " "6"" of type '" "int""'");
+  } 
+  arg6 = static_cast< int >(val6);
+  try {
+    result = (PyObject *)(arg1)->nearest(arg2,arg3,arg4,arg5,arg6);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_nearest__SWIG_1(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  long long arg4 ;
+  double arg5 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  long long val4 ;
+  int ecode4 = 0 ;
+  double val5 ;
+  int ecode5 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 5) || (nobjs > 5)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_nearest" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  ecode4 = SWIG_AsVal_long_SS_long(swig_obj[3], &val4);
+  if (!SWIG_IsOK(ecode4)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode4), "in method '" "Matcher_nearest" "', argument " "4"" of type '" "long long""'");
+  } 
+  arg4 = static_cast< long long >(val4);
+  ecode5 = SWIG_AsVal_double(swig_obj[4], &val5);
+  if (!SWIG_IsOK(ecode5)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode5), "in method '" "Matcher_nearest" "', argument " "5"" of type '" "double""'");
+  } 
+  arg5 = static_cast< double >(val5);
+  try {
+    result = (PyObject *)(arg1)->nearest(arg2,arg3,arg4,arg5);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_nearest__SWIG_2(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  long long arg4 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  long long val4 ;
+  int ecode4 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 4) || (nobjs > 4)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_nearest" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  ecode4 = SWIG_AsVal_long_SS_long(swig_obj[3], &val4);
+  if (!SWIG_IsOK(ecode4)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode4), "in method '" "Matcher_nearest" "', argument " "4"" of type '" "long long""'");
+  } 
+  arg4 = static_cast< long long >(val4);
+  try {
+    result = (PyObject *)(arg1)->nearest(arg2,arg3,arg4);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_nearest(PyObject *self, PyObject *args) {
+  Py_ssize_t argc;
+  PyObject *argv[7] = {
+    0
+  };
+  
+  if (!(argc = SWIG_Python_UnpackTuple(args, "Matcher_nearest", 0, 6, argv))) SWIG_fail;
+  --argc;
+  if (argc == 4) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          {
+            int res = SWIG_AsVal_long_SS_long(argv[3], NULL);
+            _v = SWIG_CheckState(res);
+          }
+          if (_v) {
+            return _wrap_Matcher_nearest__SWIG_2(self, argc, argv);
+          }
+        }
+      }
     }
-    arg1 = static_cast< int >(val1);
-    arg2 = obj1;
-    arg3 = obj2;
-    try {
-        result = (Matcher *)new Matcher(arg1, arg2, arg3);
+  }
+  if (argc == 5) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          {
+            int res = SWIG_AsVal_long_SS_long(argv[3], NULL);
+            _v = SWIG_CheckState(res);
+          }
+          if (_v) {
+            {
+              int res = SWIG_AsVal_double(argv[4], NULL);
+              _v = SWIG_CheckState(res);
+            }
+            if (_v) {
+              return _wrap_Matcher_nearest__SWIG_1(self, argc, argv);
+            }
+          }
+        }
+      }
     }
-    catch (char const *_e) {
-        PyErr_SetString(PyExc_RuntimeError, _e);
-        SWIG_fail;
-
+  }
+  if (argc == 6) {
+    int _v = 0;
+    void *vptr = 0;
+    int res = SWIG_ConvertPtr(argv[0], &vptr, SWIGTYPE_p_Matcher, 0);
+    _v = SWIG_CheckState(res);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          {
+            int res = SWIG_AsVal_long_SS_long(argv[3], NULL);
+            _v = SWIG_CheckState(res);
+          }
+          if (_v) {
+            {
+              int res = SWIG_AsVal_double(argv[4], NULL);
+              _v = SWIG_CheckState(res);
+            }
+            if (_v) {
+              {
+                int res = SWIG_AsVal_int(argv[5], NULL);
+                _v = SWIG_CheckState(res);
+              }
+              if (_v) {
+                return _wrap_Matcher_nearest__SWIG_0(self, argc, argv);
+              }
+            }
+          }
+        }
+      }
     }
-
-    resultobj = SWIG_NewPointerObj(SWIG_as_voidptr(result), SWIGTYPE_p_Matcher, SWIG_POINTER_NEW |  0);
-    return resultobj;
+  }
+  
 fail:
-    return NULL;
+  SWIG_Python_RaiseOrModifyTypeError("Wrong number or type of arguments for overloaded function 'Matcher_nearest'.\n"
+    "  Possible C/C++ prototypes are:\n"
+    "    Matcher::nearest(PyObject *,PyObject *,long long,double,int)\n"
+    "    Matcher::nearest(PyObject *,PyObject *,long long,double)\n"
+    "    Matcher::nearest(PyObject *,PyObject *,long long)\n");
+  return 0;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_add(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[3] ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if (!SWIG_Python_UnpackTuple(args, "Matcher_add", 3, 3, swig_obj)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_add" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  try {
+    result = (PyObject *)(arg1)->add(arg2,arg3);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_remove(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  PyObject *arg2 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[2] ;
+  
+  (void)self;
+  if (!SWIG_Python_UnpackTuple(args, "Matcher_remove", 2, 2, swig_obj)) SWIG_fail;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_remove" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  arg2 = swig_obj[1];
+  try {
+    (arg1)->remove(arg2);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = SWIG_Py_Void();
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_compact(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[1] ;
+  
+  (void)self;
+  if (!args) SWIG_fail;
+  swig_obj[0] = args;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_compact" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  try {
+    (arg1)->compact();
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = SWIG_Py_Void();
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_get_npoints(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[1] ;
+  long long result;
+  
+  (void)self;
+  if (!args) SWIG_fail;
+  swig_obj[0] = args;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_get_npoints" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  result = (long long)(arg1)->get_npoints();
+  resultobj = SWIG_From_long_SS_long(static_cast< long long >(result));
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_Matcher_get_nremoved(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  Matcher *arg1 = 0 ;
+  void *argp1 = 0 ;
+  int res1 = 0 ;
+  PyObject *swig_obj[1] ;
+  long long result;
+  
+  (void)self;
+  if (!args) SWIG_fail;
+  swig_obj[0] = args;
+  res1 = SWIG_ConvertPtr(swig_obj[0], &argp1,SWIGTYPE_p_Matcher, 0 |  0 );
+  if (!SWIG_IsOK(res1)) {
+    SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_get_nremoved" "', argument " "1"" of type '" "Matcher *""'"); 
+  }
+  arg1 = reinterpret_cast< Matcher * >(argp1);
+  result = (long long)(arg1)->get_nremoved();
+  resultobj = SWIG_From_long_SS_long(static_cast< long long >(result));
+  return resultobj;
+fail:
+  return NULL;
 }
 
 
-SWIGINTERN PyObject *_wrap_delete_Matcher(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *resultobj = 0;
-    Matcher *arg1 = (Matcher *) 0 ;
-    void *argp1 = 0 ;
-    int res1 = 0 ;
-    PyObject * obj0 = 0 ;
-
-    if (!PyArg_ParseTuple(args, (char *)"O:delete_Matcher", &obj0)) { SWIG_fail; }
-    res1 = SWIG_ConvertPtr(obj0, &argp1, SWIGTYPE_p_Matcher, SWIG_POINTER_DISOWN |  0);
-    if (!SWIG_IsOK(res1)) {
-        SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "delete_Matcher" "', argument " "1"" of type '" "Matcher *""'");
-    }
-    arg1 = reinterpret_cast< Matcher * >(argp1);
-    delete arg1;
-    resultobj = SWIG_Py_Void();
-    return resultobj;
+SWIGINTERN PyObject *Matcher_swigregister(PyObject *SWIGUNUSEDPARM(self), PyObject *args) {
+  PyObject *obj = NULL;
+  if (!SWIG_Python_UnpackTuple(args, "swigregister", 1, 1, &obj)) return NULL;
+  SWIG_TypeNewClientData(SWIGTYPE_p_Matcher, SWIG_NewClientData(obj));
+  return SWIG_Py_Void();
+}
+
+SWIGINTERN PyObject *Matcher_swiginit(PyObject *SWIGUNUSEDPARM(self), PyObject *args) {
+  return SWIG_Python_InitShadowInstance(args);
+}
+
+SWIGINTERN PyObject *_wrap_cached_indexes(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if (!SWIG_Python_UnpackTuple(args, "cached_indexes", 0, 0, 0)) SWIG_fail;
+  result = (PyObject *)cached_indexes();
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
 fail:
-    return NULL;
+  return NULL;
 }
 
 
-SWIGINTERN PyObject *_wrap_Matcher_get_depth(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *resultobj = 0;
-    Matcher *arg1 = (Matcher *) 0 ;
-    void *argp1 = 0 ;
-    int res1 = 0 ;
-    PyObject * obj0 = 0 ;
-    int result;
-
-    if (!PyArg_ParseTuple(args, (char *)"O:Matcher_get_depth", &obj0)) { SWIG_fail; }
-    res1 = SWIG_ConvertPtr(obj0, &argp1, SWIGTYPE_p_Matcher, 0 |  0);
-    if (!SWIG_IsOK(res1)) {
-        SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_get_depth" "', argument " "1"" of type '" "Matcher *""'");
-    }
-    arg1 = reinterpret_cast< Matcher * >(argp1);
-    result = (int)(arg1)->get_depth();
-    resultobj = SWIG_From_int(static_cast< int >(result));
-    return resultobj;
+SWIGINTERN PyObject *_wrap_clear_cached_indexes(PyObject *self, PyObject *args) {
+  PyObject *resultobj = 0;
+  
+  (void)self;
+  if (!SWIG_Python_UnpackTuple(args, "clear_cached_indexes", 0, 0, 0)) SWIG_fail;
+  clear_cached_indexes();
+  resultobj = SWIG_Py_Void();
+  return resultobj;
 fail:
-    return NULL;
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_group_labels__SWIG_0(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  long long arg1 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  int arg4 ;
+  long long val1 ;
+  int ecode1 = 0 ;
+  int val4 ;
+  int ecode4 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 4) || (nobjs > 4)) SWIG_fail;
+  ecode1 = SWIG_AsVal_long_SS_long(swig_obj[0], &val1);
+  if (!SWIG_IsOK(ecode1)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode1), "in method '" "group_labels" "', argument " "1"" of type '" "long long""'");
+  } 
+  arg1 = static_cast< long long >(val1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  ecode4 = SWIG_AsVal_int(swig_obj[3], &val4);
+  if (!SWIG_IsOK(ecode4)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode4), "in method '" "group_labels" "', argument " "4"" of type '" "int""'");
+  } 
+  arg4 = static_cast< int >(val4);
+  try {
+    result = (PyObject *)group_labels(arg1,arg2,arg3,arg4);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
+}
+
+
+SWIGINTERN PyObject *_wrap_group_labels__SWIG_1(PyObject *self, Py_ssize_t nobjs, PyObject **swig_obj) {
+  PyObject *resultobj = 0;
+  long long arg1 ;
+  PyObject *arg2 = 0 ;
+  PyObject *arg3 = 0 ;
+  long long val1 ;
+  int ecode1 = 0 ;
+  PyObject *result = 0 ;
+  
+  (void)self;
+  if ((nobjs < 3) || (nobjs > 3)) SWIG_fail;
+  ecode1 = SWIG_AsVal_long_SS_long(swig_obj[0], &val1);
+  if (!SWIG_IsOK(ecode1)) {
+    SWIG_exception_fail(SWIG_ArgError(ecode1), "in method '" "group_labels" "', argument " "1"" of type '" "long long""'");
+  } 
+  arg1 = static_cast< long long >(val1);
+  arg2 = swig_obj[1];
+  arg3 = swig_obj[2];
+  try {
+    result = (PyObject *)group_labels(arg1,arg2,arg3);
+  } catch(char const *_e) {
+    PyErr_SetString(PyExc_RuntimeError, _e);
+    SWIG_fail;
+    
+  }
+  resultobj = result;
+  if (!resultobj) SWIG_fail;
+  return resultobj;
+fail:
+  return NULL;
 }
 
 
-SWIGINTERN PyObject *_wrap_Matcher_match(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *resultobj = 0;
-    Matcher *arg1 = (Matcher *) 0 ;
-    PyObject *arg2 = (PyObject *) 0 ;
-    PyObject *arg3 = (PyObject *) 0 ;
-    PyObject *arg4 = (PyObject *) 0 ;
-    PyObject *arg5 = (PyObject *) 0 ;
-    PyObject *arg6 = (PyObject *) 0 ;
-    void *argp1 = 0 ;
-    int res1 = 0 ;
-    PyObject * obj0 = 0 ;
-    PyObject * obj1 = 0 ;
-    PyObject * obj2 = 0 ;
-    PyObject * obj3 = 0 ;
-    PyObject * obj4 = 0 ;
-    PyObject * obj5 = 0 ;
-    PyObject *result = 0 ;
-
-    if (!PyArg_ParseTuple(args, (char *)"OOOOOO:Matcher_match", &obj0, &obj1, &obj2, &obj3, &obj4, &obj5)) { SWIG_fail; }
-    res1 = SWIG_ConvertPtr(obj0, &argp1, SWIGTYPE_p_Matcher, 0 |  0);
-    if (!SWIG_IsOK(res1)) {
-        SWIG_exception_fail(SWIG_ArgError(res1), "in method '" "Matcher_match" "', argument " "1"" of type '" "Matcher *""'");
+SWIGINTERN PyObject *_wrap_group_labels(PyObject *self, PyObject *args) {
+  Py_ssize_t argc;
+  PyObject *argv[5] = {
+    0
+  };
+  
+  if (!(argc = SWIG_Python_UnpackTuple(args, "group_labels", 0, 4, argv))) SWIG_fail;
+  --argc;
+  if (argc == 3) {
+    int _v = 0;
+    {
+      int res = SWIG_AsVal_long_SS_long(argv[0], NULL);
+      _v = SWIG_CheckState(res);
     }
-    arg1 = reinterpret_cast< Matcher * >(argp1);
-    arg2 = obj1;
-    arg3 = obj2;
-    arg4 = obj3;
-    arg5 = obj4;
-    arg6 = obj5;
-    try {
-        result = (PyObject *)(arg1)->match(arg2, arg3, arg4, arg5, arg6);
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          return _wrap_group_labels__SWIG_1(self, argc, argv);
+        }
+      }
     }
-    catch (char const *_e) {
-        PyErr_SetString(PyExc_RuntimeError, _e);
-        SWIG_fail;
-
+  }
+  if (argc == 4) {
+    int _v = 0;
+    {
+      int res = SWIG_AsVal_long_SS_long(argv[0], NULL);
+      _v = SWIG_CheckState(res);
+    }
+    if (_v) {
+      _v = (argv[1] != 0);
+      if (_v) {
+        _v = (argv[2] != 0);
+        if (_v) {
+          {
+            int res = SWIG_AsVal_int(argv[3], NULL);
+            _v = SWIG_CheckState(res);
+          }
+          if (_v) {
+            return _wrap_group_labels__SWIG_0(self, argc, argv);
+          }
+        }
+      }
     }
-
-    resultobj = result;
-    return resultobj;
+  }
+  
 fail:
-    return NULL;
+  SWIG_Python_RaiseOrModifyTypeError("Wrong number or type of arguments for overloaded function 'group_labels'.\n"
+    "  Possible C/C++ prototypes are:\n"
+    "    group_labels(long long,PyObject *,PyObject *,int)\n"
+    "    group_labels(long long,PyObject *,PyObject *)\n");
+  return 0;
 }
 
 
-SWIGINTERN PyObject *Matcher_swigregister(PyObject *SWIGUNUSEDPARM(self), PyObject *args)
-{
-    PyObject *obj;
-    if (!PyArg_ParseTuple(args, (char*)"O:swigregister", &obj)) { return NULL; }
-    SWIG_TypeNewClientData(SWIGTYPE_p_Matcher, SWIG_NewClientData(obj));
-    return SWIG_Py_Void();
-}
-
 static PyMethodDef SwigMethods[] = {
-    { (char *)"SWIG_PyInstanceMethod_New", (PyCFunction)SWIG_PyInstanceMethod_New, METH_O, NULL},
-    { (char *)"new_HTMC", _wrap_new_HTMC, METH_VARARGS, NULL},
-    { (char *)"HTMC_init", _wrap_HTMC_init, METH_VARARGS, NULL},
-    { (char *)"delete_HTMC", _wrap_delete_HTMC, METH_VARARGS, NULL},
-    {
-        (char *)"HTMC_lookup_id", _wrap_HTMC_lookup_id, METH_VARARGS, (char *)"\n"
-        "Class:\n"
-        "    HTM\n"
-        "\n"
-        "Method Name:\n"
-        "    lookup_id\n"
-        "\n"
-        "Purpose:\n"
-        "\n"
-        "    Return the index of the input ra/dec at the current htm depth.   ra/dec may\n"
-        "    be arrays.\n"
-        "\n"
-        "Calling Sequence:\n"
-        "\n"
-        "    import esutil\n"
-        "    h=esutil.htm.HTM(depth)\n"
-        "    htmid = h.lookup_id(ra, dec)\n"
-        "\n"
-        "Inputs:\n"
-        "    ra,dec:  Scalars or arrays of equal length.\n"
-        "\n"
-        "Outputs:\n"
-        "    htmid:  An array with the htm id.\n"
-        "\n"
-        "Example:\n"
-        "\n"
-        "    >>> import esutil\n"
-        "    >>> h=esutil.htm.HTM(depth)\n"
-        "    >>> htmid = h.lookup_id(ra, dec)\n"
-        "\n"
-        "Revision History:\n"
-        "    2010-03-03:  SWIG wrapper completed.  Erin Sheldon, BNL.\n"
-        "\n"
-        ""
-    },
-    {
-        (char *)"HTMC_intersect", _wrap_HTMC_intersect, METH_VARARGS, (char *)"\n"
-        "Class:\n"
-        "    HTM\n"
-        "\n"
-        "Method Name:\n"
-        "    lookup_id\n"
-        "\n"
-        "Purpose:\n"
-        "\n"
-        "    Return the index of the input ra/dec at the current htm depth.   ra/dec may\n"
-        "    be arrays.\n"
-        "\n"
-        "Calling Sequence:\n"
-        "\n"
-        "    import esutil\n"
-        "    h=esutil.htm.HTM(depth)\n"
-        "    htmid = h.lookup_id(ra, dec)\n"
-        "\n"
-        "Inputs:\n"
-        "    ra,dec:  Scalars or arrays of equal length.\n"
-        "\n"
-        "Outputs:\n"
-        "    htmid:  An array with the htm id.\n"
-        "\n"
-        "Example:\n"
-        "\n"
-        "    >>> import esutil\n"
-        "    >>> h=esutil.htm.HTM(depth)\n"
-        "    >>> htmid = h.lookup_id(ra, dec)\n"
-        "\n"
-        "Revision History:\n"
-        "    2010-03-03:  SWIG wrapper completed.  Erin Sheldon, BNL.\n"
-        "\n"
-        ""
-    },
-    {
-        (char *)"HTMC_cmatch", _wrap_HTMC_cmatch, METH_VARARGS, (char *)"\n"
-        "Class:\n"
-        "    HTM\n"
-        "\n"
-        "Method Name:\n"
-        "    lookup_id\n"
-        "\n"
-        "Purpose:\n"
-        "\n"
-        "    Return the index of the input ra/dec at the current htm depth.   ra/dec may\n"
-        "    be arrays.\n"
-        "\n"
-        "Calling Sequence:\n"
-        "\n"
-        "    import esutil\n"
-        "    h=esutil.htm.HTM(depth)\n"
-        "    htmid = h.lookup_id(ra, dec)\n"
-        "\n"
-        "Inputs:\n"
-        "    ra,dec:  Scalars or arrays of equal length.\n"
-        "\n"
-        "Outputs:\n"
-        "    htmid:  An array with the htm id.\n"
-        "\n"
-        "Example:\n"
-        "\n"
-        "    >>> import esutil\n"
-        "    >>> h=esutil.htm.HTM(depth)\n"
-        "    >>> htmid = h.lookup_id(ra, dec)\n"
-        "\n"
-        "Revision History:\n"
-        "    2010-03-03:  SWIG wrapper completed.  Erin Sheldon, BNL.\n"
-        "\n"
-        ""
-    },
-    {
-        (char *)"HTMC_cbincount", _wrap_HTMC_cbincount, METH_VARARGS, (char *)"\n"
-        "Class:\n"
-        "    HTM\n"
-        "\n"
-        "Method Name:\n"
-        "    lookup_id\n"
-        "\n"
-        "Purpose:\n"
-        "\n"
-        "    Return the index of the input ra/dec at the current htm depth.   ra/dec may\n"
-        "    be arrays.\n"
-        "\n"
-        "Calling Sequence:\n"
-        "\n"
-        "    import esutil\n"
-        "    h=esutil.htm.HTM(depth)\n"
-        "    htmid = h.lookup_id(ra, dec)\n"
-        "\n"
-        "Inputs:\n"
-        "    ra,dec:  Scalars or arrays of equal length.\n"
-        "\n"
-        "Outputs:\n"
-        "    htmid:  An array with the htm id.\n"
-        "\n"
-        "Example:\n"
-        "\n"
-        "    >>> import esutil\n"
-        "    >>> h=esutil.htm.HTM(depth)\n"
-        "    >>> htmid = h.lookup_id(ra, dec)\n"
-        "\n"
-        "Revision History:\n"
-        "    2010-03-03:  SWIG wrapper completed.  Erin Sheldon, BNL.\n"
-        "\n"
-        ""
-    },
-    {
-        (char *)"HTMC_depth", _wrap_HTMC_depth, METH_VARARGS, (char *)"\n"
-        "Class:\n"
-        "    HTM\n"
-        "\n"
-        "Method Name:\n"
-        "    lookup_id\n"
-        "\n"
-        "Purpose:\n"
-        "\n"
-        "    Return the index of the input ra/dec at the current htm depth.   ra/dec may\n"
-        "    be arrays.\n"
-        "\n"
-        "Calling Sequence:\n"
-        "\n"
-        "    import esutil\n"
-        "    h=esutil.htm.HTM(depth)\n"
-        "    htmid = h.lookup_id(ra, dec)\n"
-        "\n"
-        "Inputs:\n"
-        "    ra,dec:  Scalars or arrays of equal length.\n"
-        "\n"
-        "Outputs:\n"
-        "    htmid:  An array with the htm id.\n"
-        "\n"
-        "Example:\n"
-        "\n"
-        "    >>> import esutil\n"
-        "    >>> h=esutil.htm.HTM(depth)\n"
-        "    >>> htmid = h.lookup_id(ra, dec)\n"
-        "\n"
-        "Revision History:\n"
-        "    2010-03-03:  SWIG wrapper completed.  Erin Sheldon, BNL.\n"
-        "\n"
-        ""
-    },
-    { (char *)"HTMC_swigregister", HTMC_swigregister, METH_VARARGS, NULL},
-    { (char *)"new_Matcher", _wrap_new_Matcher, METH_VARARGS, NULL},
-    { (char *)"delete_Matcher", _wrap_delete_Matcher, METH_VARARGS, NULL},
-    { (char *)"Matcher_get_depth", _wrap_Matcher_get_depth, METH_VARARGS, NULL},
-    { (char *)"Matcher_match", _wrap_Matcher_match, METH_VARARGS, NULL},
-    { (char *)"Matcher_swigregister", Matcher_swigregister, METH_VARARGS, NULL},
-    { NULL, NULL, 0, NULL }
+	 { "new_HTMC", _wrap_new_HTMC, METH_VARARGS, NULL},
+	 { "HTMC_init", _wrap_HTMC_init, METH_VARARGS, NULL},
+	 { "delete_HTMC", _wrap_delete_HTMC, METH_O, NULL},
+	 { "HTMC_lookup_id", _wrap_HTMC_lookup_id, METH_VARARGS, "\n"
+		"\n"
+		"Class:\n"
+		"    HTM\n"
+		"\n"
+		"Method Name:\n"
+		"    lookup_id\n"
+		"\n"
+		"Purpose:\n"
+		"\n"
+		"    Return the index of the input ra/dec at the current htm depth.   ra/dec may\n"
+		"    be arrays.\n"
+		"\n"
+		"Calling Sequence:\n"
+		"\n"
+		"    import esutil\n"
+		"    h=esutil.htm.HTM(depth)\n"
+		"    htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Inputs:\n"
+		"    ra,dec:  Scalars or arrays of equal length.\n"
+		"\n"
+		"Outputs:\n"
+		"    htmid:  An array with the htm id.\n"
+		"\n"
+		"Example:\n"
+		"\n"
+		"    >>> import esutil\n"
+		"    >>> h=esutil.htm.HTM(depth)\n"
+		"    >>> htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Revision History:\n"
+		"    2010-03-03:  SWIG wrapper completed.  Erin Sheldon, BNL.\n"
+		"\n"
+		""},
+	 { "HTMC_lookup_id_xyz", _wrap_HTMC_lookup_id_xyz, METH_VARARGS, "\n"
+		"\n"
+		"Class:\n"
+		"    HTM\n"
+		"\n"
+		"Method Name:\n"
+		"    lookup_id\n"
+		"\n"
+		"Purpose:\n"
+		"\n"
+		"    Return the index of the input ra/dec at the current htm depth.   ra/dec may\n"
+		"    be arrays.\n"
+		"\n"
+		"Calling Sequence:\n"
+		"\n"
+		"    import esutil\n"
+		"    h=esutil.htm.HTM(depth)\n"
+		"    htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Inputs:\n"
+		"    ra,dec:  Scalars or arrays of equal length.\n"
+		"\n"
+		"Outputs:\n"
+		"    htmid:  An array with the htm id.\n"
+		"\n"
+		"Example:\n"
+		"\n"
+		"    >>> import esutil\n"
+		"    >>> h=esutil.htm.HTM(depth)\n"
+		"    >>> htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Revision History:\n"
+		"    2010-03-03:  SWIG wrapper completed.  Erin Sheldon, BNL.\n"
+		"\n"
+		""},
+	 { "HTMC_intersect", _wrap_HTMC_intersect, METH_VARARGS, "\n"
+		"\n"
+		"Class:\n"
+		"    HTM\n"
+		"\n"
+		"Method Name:\n"
+		"    lookup_id\n"
+		"\n"
+		"Purpose:\n"
+		"\n"
+		"    Return the index of the input ra/dec at the current htm depth.   ra/dec may\n"
+		"    be arrays.\n"
+		"\n"
+		"Calling Sequence:\n"
+		"\n"
+		"    import esutil\n"
+		"    h=esutil.htm.HTM(depth)\n"
+		"    htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Inputs:\n"
+		"    ra,dec:  Scalars or arrays of equal length.\n"
+		"\n"
+		"Outputs:\n"
+		"    htmid:  An array with the htm id.\n"
+		"\n"
+		"Example:\n"
+		"\n"
+		"    >>> import esutil\n"
+		"    >>> h=esutil.htm.HTM(depth)\n"
+		"    >>> htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Revision History:\n"
+		"    2010-03-03:  SWIG wrapper completed.  Erin Sheldon, BNL.\n"
+		"\n"
+		""},
+	 { "HTMC_intersect_many", _wrap_HTMC_intersect_many, METH_VARARGS, "\n"
+		"\n"
+		"Class:\n"
+		"    HTM\n"
+		"\n"
+		"Method Name:\n"
+		"    lookup_id\n"
+		"\n"
+		"Purpose:\n"
+		"\n"
+		"    Return the index of the input ra/dec at the current htm depth.   ra/dec may\n"
+		"    be arrays.\n"
+		"\n"
+		"Calling Sequence:\n"
+		"\n"
+		"    import esutil\n"
+		"    h=esutil.htm.HTM(depth)\n"
+		"    htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Inputs:\n"
+		"    ra,dec:  Scalars or arrays of equal length.\n"
+		"\n"
+		"Outputs:\n"
+		"    htmid:  An array with the htm id.\n"
+		"\n"
+		"Example:\n"
+		"\n"
+		"    >>> import esutil\n"
+		"    >>> h=esutil.htm.HTM(depth)\n"
+		"    >>> htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Revision History:\n"
+		"    2010-03-03:  SWIG wrapper completed.  Erin Sheldon, BNL.\n"
+		"\n"
+		""},
+	 { "HTMC_intersect_many_xyz", _wrap_HTMC_intersect_many_xyz, METH_VARARGS, "\n"
+		"\n"
+		"Class:\n"
+		"    HTM\n"
+		"\n"
+		"Method Name:\n"
+		"    lookup_id\n"
+		"\n"
+		"Purpose:\n"
+		"\n"
+		"    Return the index of the input ra/dec at the current htm depth.   ra/dec may\n"
+		"    be arrays.\n"
+		"\n"
+		"Calling Sequence:\n"
+		"\n"
+		"    import esutil\n"
+		"    h=esutil.htm.HTM(depth)\n"
+		"    htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Inputs:\n"
+		"    ra,dec:  Scalars or arrays of equal length.\n"
+		"\n"
+		"Outputs:\n"
+		"    htmid:  An array with the htm id.\n"
+		"\n"
+		"Example:\n"
+		"\n"
+		"    >>> import esutil\n"
+		"    >>> h=esutil.htm.HTM(depth)\n"
+		"    >>> htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Revision History:\n"
+		"    2010-03-03:  SWIG wrapper completed.  Erin Sheldon, BNL.\n"
+		"\n"
+		""},
+	 { "HTMC_intersect_polygons", _wrap_HTMC_intersect_polygons, METH_VARARGS, "\n"
+		"\n"
+		"Class:\n"
+		"    HTM\n"
+		"\n"
+		"Method Name:\n"
+		"    lookup_id\n"
+		"\n"
+		"Purpose:\n"
+		"\n"
+		"    Return the index of the input ra/dec at the current htm depth.   ra/dec may\n"
+		"    be arrays.\n"
+		"\n"
+		"Calling Sequence:\n"
+		"\n"
+		"    import esutil\n"
+		"    h=esutil.htm.HTM(depth)\n"
+		"    htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Inputs:\n"
+		"    ra,dec:  Scalars or arrays of equal length.\n"
+		"\n"
+		"Outputs:\n"
+		"    htmid:  An array with the htm id.\n"
+		"\n"
+		"Example:\n"
+		"\n"
+		"    >>> import esutil\n"
+		"    >>> h=esutil.htm.HTM(depth)\n"
+		"    >>> htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Revision History:\n"
+		"    2010-03-03:  SWIG wrapper completed.  Erin Sheldon, BNL.\n"
+		"\n"
+		""},
+	 { "HTMC_intersect_ranges", _wrap_HTMC_intersect_ranges, METH_VARARGS, "\n"
+		"\n"
+		"Class:\n"
+		"    HTM\n"
+		"\n"
+		"Method Name:\n"
+		"    lookup_id\n"
+		"\n"
+		"Purpose:\n"
+		"\n"
+		"    Return the index of the input ra/dec at the current htm depth.   ra/dec may\n"
+		"    be arrays.\n"
+		"\n"
+		"Calling Sequence:\n"
+		"\n"
+		"    import esutil\n"
+		"    h=esutil.htm.HTM(depth)\n"
+		"    htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Inputs:\n"
+		"    ra,dec:  Scalars or arrays of equal length.\n"
+		"\n"
+		"Outputs:\n"
+		"    htmid:  An array with the htm id.\n"
+		"\n"
+		"Example:\n"
+		"\n"
+		"    >>> import esutil\n"
+		"    >>> h=esutil.htm.HTM(depth)\n"
+		"    >>> htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Revision History:\n"
+		"    2010-03-03:  SWIG wrapper completed.  Erin Sheldon, BNL.\n"
+		"\n"
+		""},
+	 { "HTMC_cmatch", _wrap_HTMC_cmatch, METH_VARARGS, "\n"
+		"\n"
+		"Class:\n"
+		"    HTM\n"
+		"\n"
+		"Method Name:\n"
+		"    lookup_id\n"
+		"\n"
+		"Purpose:\n"
+		"\n"
+		"    Return the index of the input ra/dec at the current htm depth.   ra/dec may\n"
+		"    be arrays.\n"
+		"\n"
+		"Calling Sequence:\n"
+		"\n"
+		"    import esutil\n"
+		"    h=esutil.htm.HTM(depth)\n"
+		"    htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Inputs:\n"
+		"    ra,dec:  Scalars or arrays of equal length.\n"
+		"\n"
+		"Outputs:\n"
+		"    htmid:  An array with the htm id.\n"
+		"\n"
+		"Example:\n"
+		"\n"
+		"    >>> import esutil\n"
+		"    >>> h=esutil.htm.HTM(depth)\n"
+		"    >>> htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Revision History:\n"
+		"    2010-03-03:  SWIG wrapper completed.  Erin Sheldon, BNL.\n"
+		"\n"
+		""},
+	 { "HTMC_depth", _wrap_HTMC_depth, METH_O, "\n"
+		"\n"
+		"Class:\n"
+		"    HTM\n"
+		"\n"
+		"Method Name:\n"
+		"    lookup_id\n"
+		"\n"
+		"Purpose:\n"
+		"\n"
+		"    Return the index of the input ra/dec at the current htm depth.   ra/dec may\n"
+		"    be arrays.\n"
+		"\n"
+		"Calling Sequence:\n"
+		"\n"
+		"    import esutil\n"
+		"    h=esutil.htm.HTM(depth)\n"
+		"    htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Inputs:\n"
+		"    ra,dec:  Scalars or arrays of equal length.\n"
+		"\n"
+		"Outputs:\n"
+		"    htmid:  An array with the htm id.\n"
+		"\n"
+		"Example:\n"
+		"\n"
+		"    >>> import esutil\n"
+		"    >>> h=esutil.htm.HTM(depth)\n"
+		"    >>> htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Revision History:\n"
+		"    2010-03-03:  SWIG wrapper completed.  Erin Sheldon, BNL.\n"
+		"\n"
+		""},
+	 { "HTMC_buildlevel", _wrap_HTMC_buildlevel, METH_O, "\n"
+		"\n"
+		"Class:\n"
+		"    HTM\n"
+		"\n"
+		"Method Name:\n"
+		"    lookup_id\n"
+		"\n"
+		"Purpose:\n"
+		"\n"
+		"    Return the index of the input ra/dec at the current htm depth.   ra/dec may\n"
+		"    be arrays.\n"
+		"\n"
+		"Calling Sequence:\n"
+		"\n"
+		"    import esutil\n"
+		"    h=esutil.htm.HTM(depth)\n"
+		"    htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Inputs:\n"
+		"    ra,dec:  Scalars or arrays of equal length.\n"
+		"\n"
+		"Outputs:\n"
+		"    htmid:  An array with the htm id.\n"
+		"\n"
+		"Example:\n"
+		"\n"
+		"    >>> import esutil\n"
+		"    >>> h=esutil.htm.HTM(depth)\n"
+		"    >>> htmid = h.lookup_id(ra, dec)\n"
+		"\n"
+		"Revision History:\n"
+		"    2010-03-03:  SWIG wrapper completed.  Erin Sheldon, BNL.\n"
+		"\n"
+		""},
+	 { "HTMC_swigregister", HTMC_swigregister, METH_O, NULL},
+	 { "HTMC_swiginit", HTMC_swiginit, METH_VARARGS, NULL},
+	 { "new_Matcher", _wrap_new_Matcher, METH_VARARGS, NULL},
+	 { "delete_Matcher", _wrap_delete_Matcher, METH_O, NULL},
+	 { "Matcher_get_depth", _wrap_Matcher_get_depth, METH_O, NULL},
+	 { "Matcher_get_buildlevel", _wrap_Matcher_get_buildlevel, METH_O, NULL},
+	 { "Matcher_get_coordinates", _wrap_Matcher_get_coordinates, METH_O, NULL},
+	 { "Matcher_get_buckets", _wrap_Matcher_get_buckets, METH_O, NULL},
+	 { "Matcher_match", _wrap_Matcher_match, METH_VARARGS, NULL},
+	 { "Matcher_match_xyz", _wrap_Matcher_match_xyz, METH_VARARGS, NULL},
+	 { "Matcher_bincount", _wrap_Matcher_bincount, METH_VARARGS, NULL},
+	 { "Matcher_self_match", _wrap_Matcher_self_match, METH_VARARGS, NULL},
+	 { "Matcher_within_polygons", _wrap_Matcher_within_polygons, METH_VARARGS, NULL},
+	 { "Matcher_nearest", _wrap_Matcher_nearest, METH_VARARGS, NULL},
+	 { "Matcher_add", _wrap_Matcher_add, METH_VARARGS, NULL},
+	 { "Matcher_remove", _wrap_Matcher_remove, METH_VARARGS, NULL},
+	 { "Matcher_compact", _wrap_Matcher_compact, METH_O, NULL},
+	 { "Matcher_get_npoints", _wrap_Matcher_get_npoints, METH_O, NULL},
+	 { "Matcher_get_nremoved", _wrap_Matcher_get_nremoved, METH_O, NULL},
+	 { "Matcher_swigregister", Matcher_swigregister, METH_O, NULL},
+	 { "Matcher_swiginit", Matcher_swiginit, METH_VARARGS, NULL},
+	 { "cached_indexes", _wrap_cached_indexes, METH_NOARGS, NULL},
+	 { "clear_cached_indexes", _wrap_clear_cached_indexes, METH_NOARGS, NULL},
+	 { "group_labels", _wrap_group_labels, METH_VARARGS, NULL},
+	 { NULL, NULL, 0, NULL }
 };
 
 
@@ -4334,34 +7399,33 @@ static swig_type_info _swigt__p_Matcher = {"_p_Matcher", "Matcher *", 0, 0, (voi
 static swig_type_info _swigt__p_char = {"_p_char", "char *", 0, 0, (void*)0, 0};
 
 static swig_type_info *swig_type_initial[] = {
-    &_swigt__p_HTMC,
-    &_swigt__p_Matcher,
-    &_swigt__p_char,
+  &_swigt__p_HTMC,
+  &_swigt__p_Matcher,
+  &_swigt__p_char,
 };
 
-static swig_cast_info _swigc__p_HTMC[] = {  {&_swigt__p_HTMC, 0, 0, 0}, {0, 0, 0, 0}};
-static swig_cast_info _swigc__p_Matcher[] = {  {&_swigt__p_Matcher, 0, 0, 0}, {0, 0, 0, 0}};
-static swig_cast_info _swigc__p_char[] = {  {&_swigt__p_char, 0, 0, 0}, {0, 0, 0, 0}};
+static swig_cast_info _swigc__p_HTMC[] = {  {&_swigt__p_HTMC, 0, 0, 0},{0, 0, 0, 0}};
+static swig_cast_info _swigc__p_Matcher[] = {  {&_swigt__p_Matcher, 0, 0, 0},{0, 0, 0, 0}};
+static swig_cast_info _swigc__p_char[] = {  {&_swigt__p_char, 0, 0, 0},{0, 0, 0, 0}};
 
 static swig_cast_info *swig_cast_initial[] = {
-    _swigc__p_HTMC,
-    _swigc__p_Matcher,
-    _swigc__p_char,
+  _swigc__p_HTMC,
+  _swigc__p_Matcher,
+  _swigc__p_char,
 };
 
 
 /* -------- TYPE CONVERSION AND EQUIVALENCE RULES (END) -------- */
 
 static swig_const_info swig_const_table[] = {
-    {0, 0, 0, 0.0, 0, 0}
-};
+{0, 0, 0, 0.0, 0, 0}};
 
 #ifdef __cplusplus
 }
 #endif
 /* -----------------------------------------------------------------------------
  * Type initialization:
- * This problem is tough by the requirement that no dynamic
+ * This problem is made tough by the requirement that no dynamic
  * memory is used. Also, since swig_type_info structures store pointers to
  * swig_cast_info structures and swig_cast_info structures store pointers back
  * to swig_type_info structures, we need some lookup code at initialization.
@@ -4372,19 +7436,24 @@ static swig_const_info swig_const_table[] = {
  * array with the correct data and linking the correct swig_cast_info
  * structures together.
  *
- * The generated swig_type_info structures are assigned staticly to an initial
+ * The generated swig_type_info structures are assigned statically to an initial
  * array. We just loop through that array, and handle each type individually.
  * First we lookup if this type has been already loaded, and if so, use the
  * loaded structure instead of the generated one. Then we have to fill in the
- * cast linked list. The cast data is initially stored in something like a
+ * cast dependencies. The cast data is initially stored in something like a
  * two-dimensional array. Each row corresponds to a type (there are the same
  * number of rows as there are in the swig_type_initial array). Each entry in
  * a column is one of the swig_cast_info structures for that type.
  * The cast_initial array is actually an array of arrays, because each row has
- * a variable number of columns. So to actually build the cast linked list,
- * we find the array of casts associated with the type, and loop through it
- * adding the casts to the list. The one last trick we need to do is making
- * sure the type pointer in the swig_cast_info struct is correct.
+ * a variable number of columns.
+ *
+ * We loop through the cast[] array associated with the type and mark casts
+ * which have not been defined in previously loaded modules by assigning
+ * cast pointer value to cast->next. We also hash cast->type->name string
+ * and store the value in the cast->value field. If we encounter swig_cast_info
+ * structure that represents a cast to self we move it to the beginning
+ * of the cast array. One trick we need to do is making sure the type pointer
+ * in the swig_cast_info struct is correct.
  *
  * First off, we lookup the cast->type name to see if it is already loaded.
  * There are three cases to handle:
@@ -4396,8 +7465,71 @@ static swig_const_info swig_const_table[] = {
  *     cast->type) are loaded, THEN the cast info has already been loaded by
  *     the previous module so we just ignore it.
  *  3) Finally, if cast->type has not already been loaded, then we add that
- *     swig_cast_info to the linked list (because the cast->type) pointer will
+ *     swig_cast_info to the list (because the cast->type) pointer will
  *     be correct.
+ *
+ * Once the cast array has been set up AND it does have new casts that need
+ * to be added we sort non-self cast entries to move filtered out entries
+ * to the end of the array and to arrange the rest in the increasing order
+ * of their type pointer values. We store the index of the last added entry
+ * in the cast->value field of the entry[0] (overwriting the name hash). Then
+ * we sort <next|value> fields of the remaining entries to arrange hash values
+ * in the increasing order. This way cast->next->type->name field matches
+ * the cast->value hash.
+ *
+ * Example:
+ * Array of casts for type stored at 0x5000, cast to type stored at 0x3000
+ * has already been loaded
+ *
+ *      After sweep-and-hash:   After sort-by-type:    After sort-by-hash:
+ *        ________________       ________________       ________________
+ *       |                |     |                |     |                |
+ * Entry |  type = 0x5000 |     |  type = 0x5000 |     |  type = 0x5000 |
+ *   0   |                |     |                |     |                |
+ *       |  next = Entry0 |     |  next = Entry0 |     |  next = Entry0 |
+ *       | value = 1212   |     | value = 3      |     | value = 3      |
+ *       |                |     |                |     |                |
+ *       |================|     |================|     |================|
+ *       |                |     |                |     |                |
+ * Entry |  type = 0x2000 |     |  type = 0x1000 |     |  type = 0x1000 |
+ *   1   |                |     |                |     |                |
+ *       |  next = Entry1 |     |  next = Entry1 |     |  next = Entry3 |
+ *       | value = 3434   |     | value = 4545   |     | value = 2323   |
+ *       |________________|     |________________|     |________________|
+ *       |                |     |                |     |                |
+ * Entry |  type = 0x3000 |     |  type = 0x2000 |     |  type = 0x2000 |
+ *   2   |                |     |                |     |                |
+ *       |  next = 0      |     |  next = Entry2 |     |  next = Entry2 |
+ *       | value = 0      |     | value = 3434   |     | value = 3434   |
+ *       |________________|     |________________|     |________________|
+ *       |                |     |                |     |                |
+ * Entry |  type = 0x1000 |     |  type = 0x4000 |     |  type = 0x4000 |
+ *   3   |                |     |                |     |                |
+ *       |  next = Entry3 |     |  next = Entry3 |     |  next = Entry1 |
+ *       | value = 4545   |     | value = 2323   |     | value = 4545   |
+ *       |________________|     |________________|     |________________|
+ *       |                |     |                |     |                |
+ * Entry |  type = 0x4000 |     |  type = 0x3000 |     |  type = 0x3000 |
+ *   4   |                |     |                |     |                |
+ *       |  next = Entry4 |     |  next = 0      |     |  next = 0      |
+ *       | value = 2323   |     | value = 0      |     | value = 0      |
+ *       |________________|     |________________|     |________________|
+ *
+ * Once the cast array has been initialized, we use cast[0]->next field to link
+ * it into the list of cast arrays for the type.
+ *              ____    ____    ____
+ * type->cast->|next|->|next|->|next|->0
+ *             |----|  |----|  |----|
+ *             |----|  |----|  |----|
+ *             |----|  |----|  |----|
+ *
+ * Subsequent cast resolution works as follows:
+ *
+ * 1. Check whether the type matches the first entry in the current cast array.
+ * 2. If not, then do a binary search over the (0:cast->value] interval using
+ *    either type address or the hash value of the type name.
+ * 3. If not found, then move over to the next cast array (cast[0]->next).
+ *
  * ----------------------------------------------------------------------------- */
 
 #ifdef __cplusplus
@@ -4411,156 +7543,248 @@ extern "C" {
 #define SWIGRUNTIME_DEBUG
 #endif
 
+#ifndef SWIG_INIT_CLIENT_DATA_TYPE
+#define SWIG_INIT_CLIENT_DATA_TYPE void *
+#endif
 
-SWIGRUNTIME void
-SWIG_InitializeModule(void *clientdata)
-{
-    size_t i;
-    swig_module_info *module_head, *iter;
-    int found, init;
-
-    /* check to see if the circular list has been setup, if not, set it up */
-    if (swig_module.next == 0) {
-        /* Initialize the swig_module */
-        swig_module.type_initial = swig_type_initial;
-        swig_module.cast_initial = swig_cast_initial;
-        swig_module.next = &swig_module;
-        init = 1;
-    }
-    else {
-        init = 0;
-    }
-
-    /* Try and load any already created modules */
-    module_head = SWIG_GetModule(clientdata);
-    if (!module_head) {
-        /* This is the first module loaded for this interpreter */
-        /* so set the swig module into the interpreter */
-        SWIG_SetModule(clientdata, &swig_module);
-        module_head = &swig_module;
-    }
-    else {
-        /* the interpreter has loaded a SWIG module, but has it loaded this one? */
-        found = 0;
-        iter = module_head;
-        do {
-            if (iter == &swig_module) {
-                found = 1;
-                break;
-            }
-            iter = iter->next;
-        }
-        while (iter != module_head);
+/*
+ * Sort function that puts cast entries with nonzero 'next' at the front
+ * of the array while ordering them by addresses of their 'type' structs.
+ */
+SWIGINTERN int SWIG_CastCmpStruct(const void *pa, const void *pb) {
+  swig_cast_info *pca = (swig_cast_info *)pa;
+  swig_cast_info *pcb = (swig_cast_info *)pb;
+  /* Entries with next != 0 (newly mapped) come before entries with next == 0 (already loaded) */
+  if (!pca->next && pcb->next) return 1;
+  if (pca->next && !pcb->next) return -1;
+  /* Within the same group, sort by type pointer for binary search */
+  if (pca->type < pcb->type) return -1;
+  if (pca->type > pcb->type) return 1;
+  return 0;
+}
 
-        /* if the is found in the list, then all is done and we may leave */
-        if (found) { return; }
-        /* otherwise we must add out module into the list */
-        swig_module.next = module_head->next;
-        module_head->next = &swig_module;
+/*
+ * Shell-sort 'next' and 'value' field pairs to order them by 'value'.
+ */
+SWIGINTERN void SWIG_CastHashSort(swig_cast_info *cast, int size) {
+  const int hmax = size/9;
+  int h, i;
+  for(h = 1; h <= hmax; h = 3*h+1);
+  for(; h > 0; h /= 3)
+  {
+    for(i = h; i < size; ++i)
+    {
+      swig_cast_info *p = cast[i].next;
+      unsigned int hash = cast[i].value;
+      int j = i;
+      while(j >= h && hash < cast[j-h].value)
+      {
+        cast[j].next = cast[j-h].next;
+        cast[j].value = cast[j-h].value;
+        j -= h;
+      }
+      cast[j].next = p;
+      cast[j].value = hash;
     }
+  }
+}
 
-    /* When multiple interpreters are used, a module could have already been initialized in
-         a different interpreter, but not yet have a pointer in this interpreter.
-         In this case, we do not want to continue adding types... everything should be
-         set up already */
-    if (init == 0) { return; }
-
-    /* Now work on filling in swig_module.types */
+SWIGRUNTIME void
+SWIG_InitializeModule(SWIG_INIT_CLIENT_DATA_TYPE clientdata) {
+  size_t i;
+  swig_module_info *module_head, *iter;
+  int init;
+  
+  /* check to see if the circular list has been setup, if not, set it up */
+  if (swig_module.next==0) {
+    /* Initialize the swig_module */
+    swig_module.type_initial = swig_type_initial;
+    swig_module.cast_initial = swig_cast_initial;
+    swig_module.next = &swig_module;
+    init = 1;
+  } else {
+    init = 0;
+  }
+  
+  /* Try and load any already created modules */
+  module_head = SWIG_GetModule(clientdata);
+  if (!module_head) {
+    /* This is the first module loaded for this interpreter */
+    /* so set the swig module into the interpreter */
+    SWIG_SetModule(clientdata, &swig_module);
+  } else {
+    /* the interpreter has loaded a SWIG module, but has it loaded this one? */
+    iter=module_head;
+    do {
+      if (iter==&swig_module) {
+        /* Our module is already in the list, so there's nothing more to do. */
+        return;
+      }
+      iter=iter->next;
+    } while (iter!= module_head);
+    
+    /* otherwise we must add our module into the list */
+    swig_module.next = module_head->next;
+    module_head->next = &swig_module;
+  }
+  
+  /* When multiple interpreters are used, a module could have already been initialized in
+       a different interpreter, but not yet have a pointer in this interpreter.
+       In this case, we do not want to continue adding types... everything should be
+       set up already */
+  if (init == 0) return;
+  
+  /* Now work on filling in swig_module.types */
 #ifdef SWIGRUNTIME_DEBUG
-    printf("SWIG_InitializeModule: size %d\n", swig_module.size);
-#endif
-    for (i = 0; i < swig_module.size; ++i) {
-        swig_type_info *type = 0;
-        swig_type_info *ret;
-        swig_cast_info *cast;
-
+  printf("SWIG_InitializeModule: size %lu\n", (unsigned long)swig_module.size);
+#endif
+  for (i = 0; i < swig_module.size; ++i) {
+    swig_type_info *type = 0;
+    swig_type_info *target_type;
+    swig_cast_info *cast, *first;
+    int num_mapped = 0;
+    
 #ifdef SWIGRUNTIME_DEBUG
-        printf("SWIG_InitializeModule: type %d %s\n", i, swig_module.type_initial[i]->name);
+    printf("SWIG_InitializeModule: type %lu %s\n", (unsigned long)i, swig_module.type_initial[i]->name);
 #endif
-
-        /* if there is another module already loaded */
-        if (swig_module.next != &swig_module) {
-            type = SWIG_MangledTypeQueryModule(swig_module.next, &swig_module, swig_module.type_initial[i]->name);
-        }
-        if (type) {
-            /* Overwrite clientdata field */
+    
+    /* if there is another module already loaded */
+    if (swig_module.next != &swig_module) {
+      type = SWIG_MangledTypeQueryModule(swig_module.next, &swig_module, swig_module.type_initial[i]->name);
+    }
+    if (type) {
+      /* Overwrite clientdata field */
 #ifdef SWIGRUNTIME_DEBUG
-            printf("SWIG_InitializeModule: found type %s\n", type->name);
+      printf("SWIG_InitializeModule: found type %s\n", type->name);
 #endif
-            if (swig_module.type_initial[i]->clientdata) {
-                type->clientdata = swig_module.type_initial[i]->clientdata;
+      if (swig_module.type_initial[i]->clientdata) {
+        type->clientdata = swig_module.type_initial[i]->clientdata;
 #ifdef SWIGRUNTIME_DEBUG
-                printf("SWIG_InitializeModule: found and overwrite type %s \n", type->name);
+        printf("SWIG_InitializeModule: found and overwrite type %s \n", type->name);
 #endif
-            }
-        }
-        else {
-            type = swig_module.type_initial[i];
-        }
-
-        /* Insert casting types */
-        cast = swig_module.cast_initial[i];
-        while (cast->type) {
-            /* Don't need to add information already in the list */
-            ret = 0;
+      }
+    } else {
+      type = swig_module.type_initial[i];
+    }
+    
+    /* Insert casting types */
+    cast = first = swig_module.cast_initial[i];
+    while (cast->type) {
+      /* Don't need to add information already in the list */
+      target_type = 0;
 #ifdef SWIGRUNTIME_DEBUG
-            printf("SWIG_InitializeModule: look cast %s\n", cast->type->name);
+      printf("SWIG_InitializeModule: look cast %s\n", cast->type->name);
 #endif
-            if (swig_module.next != &swig_module) {
-                ret = SWIG_MangledTypeQueryModule(swig_module.next, &swig_module, cast->type->name);
+      if (swig_module.next != &swig_module) {
+        target_type = SWIG_MangledTypeQueryModule(swig_module.next, &swig_module, cast->type->name);
+        if (target_type) {
+          /* Target type already defined in another module */
 #ifdef SWIGRUNTIME_DEBUG
-                if (ret) { printf("SWIG_InitializeModule: found cast %s\n", ret->name); }
+          printf("SWIG_InitializeModule: found cast %s\n", target_type->name);
 #endif
-            }
-            if (ret) {
-                if (type == swig_module.type_initial[i]) {
+          if (type == swig_module.type_initial[i]) {
 #ifdef SWIGRUNTIME_DEBUG
-                    printf("SWIG_InitializeModule: skip old type %s\n", ret->name);
+            printf("SWIG_InitializeModule: skip old type %s\n", target_type->name);
 #endif
-                    cast->type = ret;
-                    ret = 0;
-                }
-                else {
-                    /* Check for casting already in the list */
-                    swig_cast_info *ocast = SWIG_TypeCheck(ret->name, type);
+            cast->type = target_type;
+            target_type = 0;
+          } else {
+            /* Check if this cast is already in the list */
+            swig_cast_info *ocast = SWIG_TypeCheck(target_type->name, type);
 #ifdef SWIGRUNTIME_DEBUG
-                    if (ocast) { printf("SWIG_InitializeModule: skip old cast %s\n", ret->name); }
+            if (ocast) printf("SWIG_InitializeModule: skip old cast %s\n", target_type->name);
 #endif
-                    if (!ocast) { ret = 0; }
-                }
+            if (!ocast) {
+              cast->type = target_type;
+              target_type = 0;
             }
-
-            if (!ret) {
+          }
+        }
+      }
+      
+      if (!target_type) {
 #ifdef SWIGRUNTIME_DEBUG
-                printf("SWIG_InitializeModule: adding cast %s\n", cast->type->name);
+        printf("SWIG_InitializeModule: adding cast %s\n", cast->type->name);
 #endif
-                if (type->cast) {
-                    type->cast->prev = cast;
-                    cast->next = type->cast;
-                }
-                type->cast = cast;
-            }
-            cast++;
+        /* Set inclusion mark for sorting */
+        cast->next = cast;
+        num_mapped++;
+        
+        if (type == cast->type) {
+#ifdef SWIGRUNTIME_DEBUG
+          printf("%s : self cast at pos [%li]\n", type->name, cast - first);
+#endif
+          if (cast - first) {
+            /* Move cast to itself to the first entry in the array */
+            
+            swig_cast_info tmp = *cast;
+            *cast = *first;
+            *first = tmp;
+          }
+          first++;
+          
+        } else {
+          cast->value = SWIG_Hash(cast->type->name, (unsigned int)strlen(cast->type->name));
         }
-        /* Set entry in modules->types array equal to the type */
-        swig_module.types[i] = type;
+      }
+      cast++;
+    }
+    
+    if (num_mapped) {
+      if (cast - first) {
+        swig_cast_info *tmp;
+        
+        /* Sort casts by type address for binary search in SWIG_TypeCheckStruct */
+        qsort(first, (size_t)(cast - first), sizeof(swig_cast_info), SWIG_CastCmpStruct);
+        
+        /* Remap back links for added entries */
+        cast = swig_module.cast_initial[i] + num_mapped;
+        for (tmp = first; tmp < cast; tmp++) {
+          tmp->next = tmp;
+        }
+      }
+      
+      /* Set the value field of the first entry to the index of the last added entry */
+      cast = swig_module.cast_initial[i];
+      cast->value = (unsigned int)(num_mapped - 1);
+      
+      num_mapped -= (int)(first - cast);
+      if (num_mapped > 1) {
+        /* Sort <'next','value'> pairs by 'value' for binary search in SWIG_TypeCheck */
+        
+        SWIG_CastHashSort(first, num_mapped);
+      }
+      
+      first = type->cast;
+      if (first) {
+        /* Link the current set into the list of cast arrays */
+        cast->next = first->next;
+        first->next = cast;
+      } else {
+        cast->next = 0;
+        type->cast = cast;
+      }
     }
-    swig_module.types[i] = 0;
-
+    
+    /* Set entry in modules->types array equal to the type */
+    swig_module.types[i] = type;
+  }
+  swig_module.types[i] = 0;
+  
 #ifdef SWIGRUNTIME_DEBUG
-    printf("**** SWIG_InitializeModule: Cast List ******\n");
-    for (i = 0; i < swig_module.size; ++i) {
-        int j = 0;
-        swig_cast_info *cast = swig_module.cast_initial[i];
-        printf("SWIG_InitializeModule: type %d %s\n", i, swig_module.type_initial[i]->name);
-        while (cast->type) {
-            printf("SWIG_InitializeModule: cast type %s\n", cast->type->name);
-            cast++;
-            ++j;
-        }
-        printf("---- Total casts: %d\n", j);
+  printf("**** SWIG_InitializeModule: Cast List ******\n");
+  for (i = 0; i < swig_module.size; ++i) {
+    int j = 0;
+    swig_cast_info *cast = swig_module.cast_initial[i];
+    printf("SWIG_InitializeModule: type %lu %s\n", (unsigned long)i, swig_module.type_initial[i]->name);
+    while (cast->type) {
+      printf("SWIG_InitializeModule: cast type %s\n", cast->type->name);
+      cast++;
+      ++j;
     }
-    printf("**** SWIG_InitializeModule: Cast List ******\n");
+    printf("---- Total casts: %d\n",j);
+  }
+  printf("**** SWIG_InitializeModule: Cast List ******\n");
 #endif
 }
 
@@ -4570,34 +7794,34 @@ SWIG_InitializeModule(void *clientdata)
 * SWIG_TypeClientData(type, clientdata) a second time.
 */
 SWIGRUNTIME void
-SWIG_PropagateClientData(void)
-{
-    size_t i;
-    swig_cast_info *equiv;
-    static int init_run = 0;
-
-    if (init_run) { return; }
-    init_run = 1;
-
-    for (i = 0; i < swig_module.size; i++) {
-        if (swig_module.types[i]->clientdata) {
-            equiv = swig_module.types[i]->cast;
-            while (equiv) {
-                if (!equiv->converter) {
-                    if (equiv->type && !equiv->type->clientdata) {
-                        SWIG_TypeClientData(equiv->type, swig_module.types[i]->clientdata);
-                    }
-                }
-                equiv = equiv->next;
-            }
+SWIG_PropagateClientData(void) {
+  size_t i;
+  static int init_run = 0;
+  
+  if (init_run) return;
+  init_run = 1;
+  
+  for (i = 0; i < swig_module.size; i++) {
+    if (swig_module.types[i]->clientdata) {
+      swig_cast_info *head, *cast;
+      head = swig_module.types[i]->cast;
+      while (head) {
+        for (cast = head; (cast - head) <= head->value; cast++) {
+          if (!cast->converter) {
+            if (cast->type && !cast->type->clientdata)
+            SWIG_TypeClientData(cast->type, swig_module.types[i]->clientdata);
+          }
         }
+        head = head->next;
+      }
     }
+  }
 }
 
 #ifdef __cplusplus
 #if 0
 {
-    /* c-mode */
+  /* c-mode */
 #endif
 }
 #endif
@@ -4607,460 +7831,238 @@ SWIG_PropagateClientData(void)
 #ifdef __cplusplus
 extern "C" {
 #endif
-
-/* Python-specific SWIG API */
-#define SWIG_newvarlink()                             SWIG_Python_newvarlink()
-#define SWIG_addvarlink(p, name, get_attr, set_attr)  SWIG_Python_addvarlink(p, name, get_attr, set_attr)
-#define SWIG_InstallConstants(d, constants)           SWIG_Python_InstallConstants(d, constants)
-
-/* -----------------------------------------------------------------------------
- * global variable support code.
- * ----------------------------------------------------------------------------- */
-
-typedef struct swig_globalvar {
-    char       *name;                  /* Name of global variable */
-    PyObject *(*get_attr)(void);       /* Return the current value */
-    int (*set_attr)(PyObject *);       /* Set the value */
-    struct swig_globalvar *next;
-} swig_globalvar;
-
-typedef struct swig_varlinkobject {
-    PyObject_HEAD
-    swig_globalvar *vars;
-} swig_varlinkobject;
-
-SWIGINTERN PyObject *
-swig_varlink_repr(swig_varlinkobject *SWIGUNUSEDPARM(v))
-{
-#if PY_VERSION_HEX >= 0x03000000
-    return PyUnicode_InternFromString("<Swig global variables>");
-#else
-    return PyBytes_FromString("<Swig global variables>");
-#endif
-}
-
-SWIGINTERN PyObject *
-swig_varlink_str(swig_varlinkobject *v)
-{
-#if PY_VERSION_HEX >= 0x03000000
-    PyObject *str = PyUnicode_InternFromString("(");
-    PyObject *tail;
-    PyObject *joined;
-    swig_globalvar *var;
-    for (var = v->vars; var; var = var->next) {
-        tail = PyUnicode_FromString(var->name);
-        joined = PyUnicode_Concat(str, tail);
-        Py_DecRef(str);
-        Py_DecRef(tail);
-        str = joined;
-        if (var->next) {
-            tail = PyUnicode_InternFromString(", ");
-            joined = PyUnicode_Concat(str, tail);
-            Py_DecRef(str);
-            Py_DecRef(tail);
-            str = joined;
-        }
-    }
-    tail = PyUnicode_InternFromString(")");
-    joined = PyUnicode_Concat(str, tail);
-    Py_DecRef(str);
-    Py_DecRef(tail);
-    str = joined;
-#else
-    PyObject *str = PyBytes_FromString("(");
-    swig_globalvar *var;
-    for (var = v->vars; var; var = var->next) {
-        PyBytes_ConcatAndDel(&str, PyBytes_FromString(var->name));
-        if (var->next) { PyBytes_ConcatAndDel(&str, PyBytes_FromString(", ")); }
-    }
-    PyBytes_ConcatAndDel(&str, PyBytes_FromString(")"));
-#endif
-    return str;
-}
-
-SWIGINTERN int
-swig_varlink_print(swig_varlinkobject *v, FILE *fp, int SWIGUNUSEDPARM(flags))
-{
-    char *tmp;
-    PyObject *str = swig_varlink_str(v);
-    fprintf(fp, "Swig global variables ");
-    fprintf(fp, "%s\n", tmp = SWIG_Python_str_AsChar(str));
-    SWIG_Python_str_DelForPy3(tmp);
-    Py_DECREF(str);
-    return 0;
-}
-
-SWIGINTERN void
-swig_varlink_dealloc(swig_varlinkobject *v)
-{
-    swig_globalvar *var = v->vars;
-    while (var) {
-        swig_globalvar *n = var->next;
-        free(var->name);
-        free(var);
-        var = n;
-    }
-}
-
-SWIGINTERN PyObject *
-swig_varlink_getattr(swig_varlinkobject *v, char *n)
-{
-    PyObject *res = NULL;
-    swig_globalvar *var = v->vars;
-    while (var) {
-        if (strcmp(var->name, n) == 0) {
-            res = (*var->get_attr)();
-            break;
-        }
-        var = var->next;
-    }
-    if (res == NULL && !PyErr_Occurred()) {
-        PyErr_SetString(PyExc_NameError, "Unknown C global variable");
-    }
-    return res;
-}
-
-SWIGINTERN int
-swig_varlink_setattr(swig_varlinkobject *v, char *n, PyObject *p)
-{
-    int res = 1;
-    swig_globalvar *var = v->vars;
-    while (var) {
-        if (strcmp(var->name, n) == 0) {
-            res = (*var->set_attr)(p);
-            break;
-        }
-        var = var->next;
-    }
-    if (res == 1 && !PyErr_Occurred()) {
-        PyErr_SetString(PyExc_NameError, "Unknown C global variable");
-    }
-    return res;
-}
-
-SWIGINTERN PyTypeObject*
-swig_varlink_type(void)
-{
-    static char varlink__doc__[] = "Swig var link object";
-    static PyTypeObject varlink_type;
-    static int type_init = 0;
-    if (!type_init) {
-        const PyTypeObject tmp = {
-            /* PyObject header changed in Python 3 */
-#if PY_VERSION_HEX >= 0x03000000
-            PyVarObject_HEAD_INIT(NULL, 0)
-#else
-            PyObject_HEAD_INIT(NULL)
-            0,                                  /* ob_size */
-#endif
-            (char *)"swigvarlink",              /* tp_name */
-            sizeof(swig_varlinkobject),         /* tp_basicsize */
-            0,                                  /* tp_itemsize */
-            (destructor) swig_varlink_dealloc,  /* tp_dealloc */
-            (printfunc) swig_varlink_print,     /* tp_print */
-            (getattrfunc) swig_varlink_getattr, /* tp_getattr */
-            (setattrfunc) swig_varlink_setattr, /* tp_setattr */
-            0,                                  /* tp_compare */
-            (reprfunc) swig_varlink_repr,       /* tp_repr */
-            0,                                  /* tp_as_number */
-            0,                                  /* tp_as_sequence */
-            0,                                  /* tp_as_mapping */
-            0,                                  /* tp_hash */
-            0,                                  /* tp_call */
-            (reprfunc) swig_varlink_str,        /* tp_str */
-            0,                                  /* tp_getattro */
-            0,                                  /* tp_setattro */
-            0,                                  /* tp_as_buffer */
-            0,                                  /* tp_flags */
-            varlink__doc__,                     /* tp_doc */
-            0,                                  /* tp_traverse */
-            0,                                  /* tp_clear */
-            0,                                  /* tp_richcompare */
-            0,                                  /* tp_weaklistoffset */
-#if PY_VERSION_HEX >= 0x02020000
-            0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, /* tp_iter -> tp_weaklist */
-#endif
-#if PY_VERSION_HEX >= 0x02030000
-            0,                                  /* tp_del */
-#endif
-#if PY_VERSION_HEX >= 0x02060000
-            0,                                  /* tp_version */
-#endif
-#ifdef COUNT_ALLOCS
-            0, 0, 0, 0                          /* tp_alloc -> tp_next */
-#endif
-        };
-        varlink_type = tmp;
-        type_init = 1;
-#if PY_VERSION_HEX < 0x02020000
-        varlink_type.ob_type = &PyType_Type;
-#else
-        if (PyType_Ready(&varlink_type) < 0) {
-            return NULL;
-        }
-#endif
-    }
-    return &varlink_type;
-}
-
-/* Create a variable linking object for use later */
-SWIGINTERN PyObject *
-SWIG_Python_newvarlink(void)
-{
-    swig_varlinkobject *result = PyObject_NEW(swig_varlinkobject, swig_varlink_type());
-    if (result) {
-        result->vars = 0;
-    }
-    return ((PyObject*) result);
-}
-
-SWIGINTERN void
-SWIG_Python_addvarlink(PyObject *p, char *name, PyObject * (*get_attr)(void), int (*set_attr)(PyObject *p))
-{
-    swig_varlinkobject *v = (swig_varlinkobject *) p;
-    swig_globalvar *gv = (swig_globalvar *) malloc(sizeof(swig_globalvar));
-    if (gv) {
-        size_t size = strlen(name) + 1;
-        gv->name = (char *)malloc(size);
-        if (gv->name) {
-            strncpy(gv->name, name, size);
-            gv->get_attr = get_attr;
-            gv->set_attr = set_attr;
-            gv->next = v->vars;
-        }
-    }
-    v->vars = gv;
-}
-
-SWIGINTERN PyObject *
-SWIG_globals(void)
-{
-    static PyObject *_SWIG_globals = 0;
-    if (!_SWIG_globals) { _SWIG_globals = SWIG_newvarlink(); }
-    return _SWIG_globals;
-}
-
-/* -----------------------------------------------------------------------------
- * constants/methods manipulation
- * ----------------------------------------------------------------------------- */
-
-/* Install Constants */
-SWIGINTERN void
-SWIG_Python_InstallConstants(PyObject *d, swig_const_info constants[])
-{
+  
+  /* -----------------------------------------------------------------------------
+   * constants/methods manipulation
+   * ----------------------------------------------------------------------------- */
+  
+  /* Install Constants */
+  SWIGINTERN void
+  SWIG_Python_InstallConstants(PyObject *d, swig_const_info constants[]) {
     PyObject *obj = 0;
     size_t i;
     for (i = 0; constants[i].type; ++i) {
-        switch (constants[i].type) {
-        case SWIG_PY_POINTER:
-            obj = SWIG_InternalNewPointerObj(constants[i].pvalue, *(constants[i]).ptype, 0);
-            break;
-        case SWIG_PY_BINARY:
-            obj = SWIG_NewPackedObj(constants[i].pvalue, constants[i].lvalue, *(constants[i].ptype));
-            break;
-        default:
-            obj = 0;
-            break;
-        }
-        if (obj) {
-            PyDict_SetItemString(d, constants[i].name, obj);
-            Py_DECREF(obj);
-        }
+      switch(constants[i].type) {
+      case SWIG_PY_POINTER:
+        obj = SWIG_InternalNewPointerObj(constants[i].pvalue, *(constants[i]).ptype,0);
+        break;
+      case SWIG_PY_BINARY:
+        obj = SWIG_NewPackedObj(constants[i].pvalue, (size_t)constants[i].lvalue, *(constants[i].ptype));
+        break;
+      default:
+        obj = 0;
+        break;
+      }
+      if (obj) {
+        PyDict_SetItemString(d, constants[i].name, obj);
+        SWIG_Py_DECREF(obj);
+      }
     }
-}
-
-/* -----------------------------------------------------------------------------*/
-/* Fix SwigMethods to carry the callback ptrs when needed */
-/* -----------------------------------------------------------------------------*/
-
-SWIGINTERN void
-SWIG_Python_FixMethods(PyMethodDef *methods,
-                       swig_const_info *const_table,
-                       swig_type_info **types,
-                       swig_type_info **types_initial)
-{
+  }
+  
+  /* -----------------------------------------------------------------------------
+   * Patch %callback methods' docstrings to hold the callback ptrs
+   * -----------------------------------------------------------------------------*/
+  
+  SWIGINTERN void
+  SWIG_Python_FixMethods(PyMethodDef *methods, const swig_const_info *const_table, swig_type_info **types, swig_type_info **types_initial) {
     size_t i;
     for (i = 0; methods[i].ml_name; ++i) {
-        const char *c = methods[i].ml_doc;
-        if (c && (c = strstr(c, "swig_ptr: "))) {
-            int j;
-            swig_const_info *ci = 0;
-            const char *name = c + 10;
-            for (j = 0; const_table[j].type; ++j) {
-                if (strncmp(const_table[j].name, name,
-                            strlen(const_table[j].name)) == 0) {
-                    ci = &(const_table[j]);
-                    break;
-                }
-            }
-            if (ci) {
-                void *ptr = (ci->type == SWIG_PY_POINTER) ? ci->pvalue : 0;
-                if (ptr) {
-                    size_t shift = (ci->ptype) - types;
-                    swig_type_info *ty = types_initial[shift];
-                    size_t ldoc = (c - methods[i].ml_doc);
-                    size_t lptr = strlen(ty->name) + 2 * sizeof(void*) + 2;
-                    char *ndoc = (char*)malloc(ldoc + lptr + 10);
-                    if (ndoc) {
-                        char *buff = ndoc;
-                        strncpy(buff, methods[i].ml_doc, ldoc);
-                        buff += ldoc;
-                        strncpy(buff, "swig_ptr: ", 10);
-                        buff += 10;
-                        SWIG_PackVoidPtr(buff, ptr, ty->name, lptr);
-                        methods[i].ml_doc = ndoc;
-                    }
-                }
+      const char *c = methods[i].ml_doc;
+      if (!c) continue;
+      c = strstr(c, "swig_ptr: ");
+      if (c) {
+        int j;
+        const swig_const_info *ci = 0;
+        const char *name = c + 10;
+        for (j = 0; const_table[j].type; ++j) {
+          if (strncmp(const_table[j].name, name, 
+              strlen(const_table[j].name)) == 0) {
+            ci = &(const_table[j]);
+            break;
+          }
+        }
+        if (ci) {
+          void *ptr = (ci->type == SWIG_PY_POINTER) ? ci->pvalue : 0;
+          if (ptr) {
+            size_t shift = (size_t)((ci->ptype) - types);
+            swig_type_info *ty = types_initial[shift];
+            size_t ldoc = (size_t)(c - methods[i].ml_doc);
+            size_t lptr = strlen(ty->name)+2*sizeof(void*)+2;
+            char *ndoc = (char*)malloc(ldoc + lptr + 10);
+            if (ndoc) {
+              char *buff = ndoc;
+              memcpy(buff, methods[i].ml_doc, ldoc);
+              buff += ldoc;
+              memcpy(buff, "swig_ptr: ", 10);
+              buff += 10;
+              SWIG_PackVoidPtr(buff, ptr, ty->name, lptr);
+              methods[i].ml_doc = ndoc;
             }
+          }
         }
+      }
     }
-}
-
+  } 
+  
 #ifdef __cplusplus
 }
 #endif
 
+
+
+
 /* -----------------------------------------------------------------------------*
  *  Partial Init method
  * -----------------------------------------------------------------------------*/
 
+SWIGINTERN int SWIG_mod_exec(PyObject *module);
+
 #ifdef __cplusplus
 extern "C"
 #endif
 
-SWIGEXPORT
-#if PY_VERSION_HEX >= 0x03000000
+SWIGEXPORT 
 PyObject*
-#else
-void
+SWIG_init(void) {
+  static PyModuleDef_Slot SwigSlots[] = {
+    {
+      Py_mod_exec, (void *)SWIG_mod_exec 
+    },
+#ifdef SWIGPYTHON_NOGIL
+#ifdef Py_GIL_DISABLED
+    {
+      Py_mod_gil, Py_MOD_GIL_NOT_USED 
+    },
 #endif
-SWIG_init(void)
-{
-    PyObject *m, *d, *md;
-#if PY_VERSION_HEX >= 0x03000000
-    static struct PyModuleDef SWIG_module = {
-# if PY_VERSION_HEX >= 0x03020000
-        PyModuleDef_HEAD_INIT,
-# else
-        {
-            PyObject_HEAD_INIT(NULL)
-            NULL, /* m_init */
-            0,    /* m_index */
-            NULL, /* m_copy */
-        },
-# endif
-        (char *) SWIG_name,
-        NULL,
-        -1,
-        SwigMethods,
-        NULL,
-        NULL,
-        NULL,
-        NULL
-    };
 #endif
-
+    {
+      0, NULL 
+    }
+  };
+  
+  static struct PyModuleDef SWIG_module = {
+    PyModuleDef_HEAD_INIT,
+    SWIG_name,
+    NULL,
+    0,
+    SwigMethods,
+    SwigSlots,
+    NULL,
+    NULL,
+    NULL
+  };
+  
+  return PyModuleDef_Init(&SWIG_module);
+}
+
+SWIGINTERN int SWIG_mod_exec(PyObject *m) {
+  PyObject *d, *md, *globals;
+  
 #if defined(SWIGPYTHON_BUILTIN)
-    static SwigPyClientData SwigPyObject_clientdata = {
-        0, 0, 0, 0, 0, 0, 0
-    };
-    static PyGetSetDef this_getset_def = {
-        (char *)"this", &SwigPyBuiltin_ThisClosure, NULL, NULL, NULL
-    };
-    static SwigPyGetSet thisown_getset_closure = {
-        (PyCFunction) SwigPyObject_own,
-        (PyCFunction) SwigPyObject_own
-    };
-    static PyGetSetDef thisown_getset_def = {
-        (char *)"thisown", SwigPyBuiltin_GetterClosure, SwigPyBuiltin_SetterClosure, NULL, &thisown_getset_closure
-    };
-    PyObject *metatype_args;
-    PyTypeObject *builtin_pytype;
-    int builtin_base_count;
-    swig_type_info *builtin_basetype;
-    PyObject *tuple;
-    PyGetSetDescrObject *static_getset;
-    PyTypeObject *metatype;
-    SwigPyClientData *cd;
-    PyObject *public_interface, *public_symbol;
-    PyObject *this_descr;
-    PyObject *thisown_descr;
-    int i;
-
-    (void)builtin_pytype;
-    (void)builtin_base_count;
-    (void)builtin_basetype;
-    (void)tuple;
-    (void)static_getset;
-
-    /* metatype is used to implement static member variables. */
-    metatype_args = Py_BuildValue("(s(O){})", "SwigPyObjectType", &PyType_Type);
-    assert(metatype_args);
-    metatype = (PyTypeObject *) PyType_Type.tp_call((PyObject *) &PyType_Type, metatype_args, NULL);
-    assert(metatype);
-    Py_DECREF(metatype_args);
-    metatype->tp_setattro = (setattrofunc) &SwigPyObjectType_setattro;
-    assert(PyType_Ready(metatype) >= 0);
-#endif
-
-    /* Fix SwigMethods to carry the callback ptrs when needed */
-    SWIG_Python_FixMethods(SwigMethods, swig_const_table, swig_types, swig_type_initial);
-
-#if PY_VERSION_HEX >= 0x03000000
-    m = PyModule_Create(&SWIG_module);
-#else
-    m = Py_InitModule((char *) SWIG_name, SwigMethods);
-#endif
-    md = d = PyModule_GetDict(m);
-    (void)md;
-
-    SWIG_InitializeModule(0);
-
+  static SwigPyClientData SwigPyObject_clientdata = {
+    0, 0, 0, 0, 0, 0, 0
+  };
+  static PyGetSetDef this_getset_def = {
+    (char *)"this", &SwigPyBuiltin_ThisClosure, NULL, NULL, NULL
+  };
+  static SwigPyGetSet thisown_getset_closure = {
+    SwigPyObject_own,
+    SwigPyObject_own
+  };
+  static PyGetSetDef thisown_getset_def = {
+    (char *)"thisown", SwigPyBuiltin_GetterClosure, SwigPyBuiltin_SetterClosure, NULL, &thisown_getset_closure
+  };
+  PyTypeObject *builtin_pytype;
+  int builtin_base_count;
+  swig_type_info *builtin_basetype;
+  PyObject *tuple;
+  PyGetSetDescrObject *static_getset;
+  PyTypeObject *metatype;
+  PyTypeObject *swigpyobject;
+  SwigPyClientData *cd;
+  PyObject *public_interface, *public_symbol;
+  PyObject *this_descr;
+  PyObject *thisown_descr;
+  PyObject *self = 0;
+  int i;
+  
+  (void)builtin_pytype;
+  (void)builtin_base_count;
+  (void)builtin_basetype;
+  (void)tuple;
+  (void)static_getset;
+  (void)self;
+  
+  /* Metaclass is used to implement static member variables */
+  metatype = SwigPyObjectType_Type();
+  assert(metatype);
+  
+  SwigPyStaticVar_Type();
+#endif
+  
+  (void)globals;
+  
+  /* Create singletons now to avoid potential deadlocks with multi-threaded usage after module initialization */
+  SWIG_runtime_data_module();
+  SWIG_This();
+  SWIG_Python_TypeCache();
+  SwigPyPacked_Type();
+  SwigVarLink_Type();
+#ifndef SWIGPYTHON_BUILTIN
+  SwigPyObject_Type();
+#endif
+  
+  /* Fix SwigMethods to carry the callback ptrs when needed */
+  SWIG_Python_FixMethods(SwigMethods, swig_const_table, swig_types, swig_type_initial);
+  
+#ifdef SWIGPYTHON_NOGIL
+#ifdef Py_GIL_DISABLED
+  PyUnstable_Module_SetGIL(m, Py_MOD_GIL_NOT_USED);
+#endif
+#endif
+  
+  md = d = PyModule_GetDict(m);
+  (void)md;
+  
+  SWIG_InitializeModule(0);
+  
 #ifdef SWIGPYTHON_BUILTIN
-    SwigPyObject_stype = SWIG_MangledTypeQuery("_p_SwigPyObject");
-    assert(SwigPyObject_stype);
-    cd = (SwigPyClientData*) SwigPyObject_stype->clientdata;
-    if (!cd) {
-        SwigPyObject_stype->clientdata = &SwigPyObject_clientdata;
-        SwigPyObject_clientdata.pytype = SwigPyObject_TypeOnce();
-    }
-    else if (SwigPyObject_TypeOnce()->tp_basicsize != cd->pytype->tp_basicsize) {
-        PyErr_SetString(PyExc_RuntimeError, "Import error: attempted to load two incompatible swig-generated modules.");
-# if PY_VERSION_HEX >= 0x03000000
-        return NULL;
-# else
-        return;
-# endif
-    }
-
-    /* All objects have a 'this' attribute */
-    this_descr = PyDescr_NewGetSet(SwigPyObject_type(), &this_getset_def);
-    (void)this_descr;
-
-    /* All objects have a 'thisown' attribute */
-    thisown_descr = PyDescr_NewGetSet(SwigPyObject_type(), &thisown_getset_def);
-    (void)thisown_descr;
-
-    public_interface = PyList_New(0);
-    public_symbol = 0;
-    (void)public_symbol;
-
-    PyDict_SetItemString(md, "__all__", public_interface);
-    Py_DECREF(public_interface);
-    for (i = 0; SwigMethods[i].ml_name != NULL; ++i) {
-        SwigPyBuiltin_AddPublicSymbol(public_interface, SwigMethods[i].ml_name);
-    }
-    for (i = 0; swig_const_table[i].name != 0; ++i) {
-        SwigPyBuiltin_AddPublicSymbol(public_interface, swig_const_table[i].name);
-    }
-#endif
-
-    SWIG_InstallConstants(d, swig_const_table);
-
-#if PY_VERSION_HEX >= 0x03000000
-    return m;
-#else
-    return;
-#endif
+  swigpyobject = SwigPyObject_TypeOnce();
+  
+  SwigPyObject_stype = SWIG_MangledTypeQuery("_p_SwigPyObject");
+  assert(SwigPyObject_stype);
+  cd = (SwigPyClientData*) SwigPyObject_stype->clientdata;
+  if (!cd) {
+    SwigPyObject_stype->clientdata = &SwigPyObject_clientdata;
+    SwigPyObject_clientdata.pytype = swigpyobject;
+  } else if (swigpyobject->tp_basicsize != cd->pytype->tp_basicsize) {
+    PyErr_SetString(PyExc_RuntimeError, "Import error: attempted to load two incompatible swig-generated modules.");
+    return -1;
+  }
+  
+  /* All objects have a 'this' attribute */
+  this_descr = PyDescr_NewGetSet(SwigPyObject_Type(), &this_getset_def);
+  (void)this_descr;
+  
+  /* All objects have a 'thisown' attribute */
+  thisown_descr = PyDescr_NewGetSet(SwigPyObject_Type(), &thisown_getset_def);
+  (void)thisown_descr;
+  
+  public_interface = PyList_New(0);
+  public_symbol = 0;
+  (void)public_symbol;
+  
+  PyDict_SetItemString(md, "__all__", public_interface);
+  SWIG_Py_DECREF(public_interface);
+  for (i = 0; SwigMethods[i].ml_name != NULL; ++i)
+  SwigPyBuiltin_AddPublicSymbol(public_interface, SwigMethods[i].ml_name);
+  for (i = 0; swig_const_table[i].name != 0; ++i)
+  SwigPyBuiltin_AddPublicSymbol(public_interface, swig_const_table[i].name);
+#endif
+  
+  SWIG_InstallConstants(d,swig_const_table);
+  
+  return 0;
 }
 
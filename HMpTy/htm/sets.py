@@ -10,6 +10,7 @@ import numpy as np
 from fundamentals import tools
 from builtins import zip
 from builtins import object
+from collections.abc import Sequence
 import sys
 import os
 os.environ['TERM'] = 'vt100'
@@ -27,6 +28,8 @@ class sets(object):
     - ``radius`` -- the radius to crossmatch the list of coordinates against itself (degrees)
     - ``sourceList`` -- the list of source information to be divided into associated sets (same length as ``ra`` and ``dec``)
     - ``convertToArray`` -- convert the coordinates into an array. Default *True*. Can bypass the conversion check if you are sure coordinates in numpy array
+    - ``transitive`` -- link the sources transitively (friends-of-friends), so any two sources within ``radius`` of each other always end up in the same set. Default *False*, each source not yet in a set starts a new set (in list order) and takes the unassigned sources within ``radius`` of it
+    - ``depth`` -- the depth of the HTM mesh used to match the sources. Default *"auto"*, chosen from the radius and the density of the coordinates (see `HMpTy.htm.choose_depth`)
 
 
     **Usage**
@@ -46,7 +49,13 @@ class sets(object):
     ```
 
     ``raList`` and ``decList`` are the coordinates for the sources found in the ``transientList`` and are therefore the same length as the `transientList`` (it's up to the user to create these lists).
-    This code will group the sources into set of associated transients which are within a radius of 10 arcsec from one-another. ``allMatches`` is a list of lists, each contained list being an associate group of sources.
+    This code will group the sources into set of associated transients which are within a radius of 10 arcsec from one-another. ``allMatches`` is a list of lists, each contained list being an associate group of sources. The sets are only built into lists as they are accessed.
+
+    For large lists it is cheaper to work with the integer set label of each source directly:
+
+    ```python
+    labels = xmatcher.labels
+    ```
 
     .. image:: https://i.imgur.com/hHExDqR.png
         :width: 800px
@@ -62,7 +71,9 @@ class sets(object):
             dec,
             radius,
             sourceList,
-            convertToArray=True
+            convertToArray=True,
+            transitive=False,
+            depth="auto"
     ):
         self.log = log
         log.debug("instansiating a new 'sets' object")
@@ -71,39 +82,22 @@ class sets(object):
         self.radius = radius
         self.sourceList = sourceList
         self.convertToArray = convertToArray
+        self.transitive = transitive
+        self._labels = None
+        self._order = None
         # Initial Actions
-        htmLevelSideLenDeg = {0: 109.127009219124,
-                              1: 54.563504609562,
-                              2: 27.281752304781,
-                              3: 13.640876152391,
-                              4: 6.820438076195,
-                              5: 3.410219038098,
-                              6: 1.705109519049,
-                              7: 0.852554759524,
-                              8: 0.426277379762,
-                              9: 0.213138689881,
-                              10: 0.106569344941,
-                              11: 0.053284672470,
-                              12: 0.026642336235,
-                              13: 0.013321168118,
-                              14: 0.006660584059,
-                              15: 0.003330292029,
-                              16: 0.001665146015,
-                              17: 0.000832573007,
-                              18: 0.000416286504,
-                              19: 0.000208143252,
-                              20: 0.000104071626,
-                              21: 0.000052035813,
-                              22: 0.000026017906,
-                              23: 0.000013008953,
-                              24: 0.000006504477,
-                              25: 0.000003252238}
-
-        self.htmDepth = None
-        for k, v in htmLevelSideLenDeg.items():
-            if self.radius > v:
-                self.htmDepth = k - 1
-                break
+        self.depthEstimate = None
+        if depth == "auto":
+            from HMpTy.htm import choose_depth
+            self.depthEstimate = choose_depth(
+                ra=ra,
+                dec=dec,
+                radius=radius,
+                convertToArray=convertToArray,
+                log=self.log
+            )
+            depth = self.depthEstimate["depth"]
+        self.htmDepth = depth
 
         from HMpTy import HTM
         self.mesh = HTM(
@@ -118,10 +112,53 @@ class sets(object):
             self):
         """*all of the assocaited sets of sources*
 
+        A list-like view of the sets, each set being a list of sources from ``sourceList``. The lists are built from the set labels as they are accessed.
+
         See the class for usage
         """
+        self._group_sources()
+        return _setList(self.sourceList, self._labels, self._order)
+
+    @property
+    def labels(
+            self):
+        """*the integer label of the set each source belongs to*
+
+        Sets are numbered from 0 in the order of their first source in ``sourceList``, so ``labels[i] == labels[j]`` when sources ``i`` and ``j`` are in the same set.
+
+        **Usage**
+
+        ```python
+        labels = xmatcher.labels
+        ```
+        """
+        self._group_sources()
+        return self._labels
+
+    def _group_sources(
+            self):
+        """*label the sets of sources, once*
+        """
+        if self._labels is not None:
+            return
+
+        self.log.debug('starting the ``_group_sources`` method')
+
+        # EACH PAIR (i, j) IS FOUND ONCE, WITH i < j. ROWS ARE ORDERED BY i
+        # AND THE PARTNERS IN A ROW BY SEPARATION
+        matchIndices1, matchIndices2, seps = self.mesh.self_match(
+            ra=self.ra,
+            dec=self.dec,
+            radius=self.radius,
+            convertToArray=self.convertToArray
+        )
+
+        from HMpTy.htm import _htmcCode
+        self._labels, self._order = _htmcCode.group_labels(
+            len(self.sourceList), matchIndices1, matchIndices2, int(bool(self.transitive)))
 
-        return self._extract_all_sets_from_list()
+        self.log.debug('completed the ``_group_sources`` method')
+        return None
 
     def _extract_all_sets_from_list(
             self):
@@ -134,31 +171,50 @@ class sets(object):
         """
         self.log.debug('starting the ``_extract_all_sets_from_list`` method')
 
-        matchIndices1, matchIndices2, seps = self.mesh.match(
-            ra1=self.ra,
-            dec1=self.dec,
-            ra2=self.ra,
-            dec2=self.dec,
-            radius=self.radius,
-            maxmatch=0,  # 1 = match closest 1, 0 = match all,
-            convertToArray=self.convertToArray
-        )
-
-        anchorIndicies = set()
-        childIndicies = set()
-        allMatches = []
-        thisMatch = None
-        for m1, m2, s in zip(matchIndices1, matchIndices2, seps):
-            if m1 not in anchorIndicies and m1 not in childIndicies:
-                if thisMatch:
-                    allMatches.append(thisMatch)
-                thisMatch = [self.sourceList[m1]]
-                anchorIndicies.add(m1)
-            if m2 not in anchorIndicies and m2 not in childIndicies:
-                childIndicies.add(m2)
-                thisMatch.append(self.sourceList[m2])
-        if thisMatch:
-            allMatches.append(thisMatch)
+        allMatches = list(self.match)
 
         self.log.debug('completed the ``_extract_all_sets_from_list`` method')
         return allMatches
+
+
+class _setList(Sequence):
+    """
+    *a read-only list of the sets of sources, each built from the set labels when it is accessed*
+
+    **Key Arguments**
+
+    - ``sourceList`` -- the list of sources
+    - ``labels`` -- the set label of each source
+    - ``order`` -- the source indices listed set by set
+    """
+
+    def __init__(
+            self,
+            sourceList,
+            labels,
+            order):
+        self.sourceList = sourceList
+        self.order = order
+        numSets = int(labels.max()) + 1 if len(labels) else 0
+        self.offsets = np.searchsorted(labels[order], np.arange(numSets + 1))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("set index out of range")
+        return [self.sourceList[i] for i in self.order[self.offsets[index]:self.offsets[index + 1]]]
+
+    def __eq__(self, other):
+        if not isinstance(other, (Sequence, list)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self):
+        return "<%d sets of sources>" % (len(self),)
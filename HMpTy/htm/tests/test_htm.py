@@ -220,6 +220,1169 @@ class test_htm(unittest.TestCase):
         for h, r, d in zip(htmids, raList1, decList1):
             print(r, d, " --> ", h)
 
+    def test_lookup_id_descent(self):
+
+        import numpy as np
+        from HMpTy import HTM
+        raList1 = [200.0, 175.23, 21.36]
+        decList1 = [24.3, -28.25, -15.32]
+        expected = {
+            0: [13, 9, 8],
+            2: [218, 154, 131],
+            3: [874, 617, 527],
+            7: [223776, 158151, 135076],
+            10: [14321677, 10121669, 8644917],
+            13: [916587361, 647786866, 553274738],
+            16: [58661591161, 41458359474, 35409583274],
+            20: [15017367337366, 10613340025465, 9064853318235],
+            25: [15377784153463125, 10868060186076273, 9282409797873489]
+        }
+        for depth, ids in list(expected.items()):
+            mesh = HTM(
+                depth=depth,
+                log=log
+            )
+            htmids = mesh.lookup_id(raList1, decList1)
+            self.assertEqual(list(htmids), ids)
+
+        # COARSER IDS ARE THE DEEPER IDS SHIFTED RIGHT 2 BITS PER LEVEL
+        rng = np.random.default_rng(1)
+        ra = rng.uniform(0., 360., 10000)
+        dec = np.degrees(np.arcsin(rng.uniform(-1., 1., 10000)))
+        deepIds = HTM(depth=25, log=log).lookup_id(ra, dec)
+        for depth in range(0, 25):
+            htmids = HTM(depth=depth, log=log).lookup_id(ra, dec)
+            self.assertTrue(
+                (htmids == deepIds >> (2 * (25 - depth))).all())
+
+    def test_cached_meshes(self):
+
+        import numpy as np
+        from HMpTy import HTM, Matcher
+        from HMpTy.htm import cached_meshes, clear_cached_meshes
+        clear_cached_meshes()
+        self.assertEqual(cached_meshes(), [])
+
+        raList1 = [200.0, 175.23, 21.36]
+        decList1 = [24.3, -28.25, -15.32]
+        mesh = HTM(depth=16, log=log)
+        deepMesh = HTM(depth=16, log=log, buildlevel=6)
+        coordinateSet = Matcher(
+            log=log, ra=raList1, dec=decList1, depth=16, buildlevel=6)
+        HTM(depth=16, log=log)
+        self.assertEqual(deepMesh.buildlevel, 6)
+        self.assertEqual(coordinateSet.buildlevel, 6)
+
+        meshes = cached_meshes()
+        self.assertEqual([(m["depth"], m["buildlevel"])
+                          for m in meshes], [(16, 2), (16, 6)])
+        self.assertTrue(meshes[1]["bytes"] > meshes[0]["bytes"])
+        print(meshes)
+
+        # THE MESH LEVELS KEPT IN MEMORY DO NOT CHANGE THE IDS
+        rng = np.random.default_rng(2)
+        ra = rng.uniform(0., 360., 10000)
+        dec = np.degrees(np.arcsin(rng.uniform(-1., 1., 10000)))
+        self.assertTrue(
+            (mesh.lookup_id(ra, dec) == deepMesh.lookup_id(ra, dec)).all())
+        self.assertTrue((mesh.intersect(ra=200., dec=24.3, radius=0.01) ==
+                         deepMesh.intersect(ra=200., dec=24.3, radius=0.01)).all())
+
+        # CLEARING THE CACHE LEAVES EXISTING MESHES USABLE
+        clear_cached_meshes()
+        self.assertEqual(cached_meshes(), [])
+        mesh.lookup_id(ra, dec)
+
+        # MATCHING THROUGH A MESH REUSES ITS BUILDLEVEL
+        clear_cached_meshes()
+        mesh12 = HTM(depth=12, log=log, buildlevel=4)
+        mesh12.match(ra[:100], dec[:100], ra, dec, 0.1, maxmatch=0)
+        for results in mesh12.match_iter(ra[:100], dec[:100], ra, dec, 0.1, maxmatch=0):
+            pass
+        mesh12.self_match(ra[:100], dec[:100], 0.1)
+        self.assertEqual([(m["depth"], m["buildlevel"])
+                          for m in cached_meshes()], [(12, 4)])
+
+    def test_matcher_releases_gil(self):
+
+        import time
+        import threading
+        import numpy as np
+        from HMpTy import Matcher
+        rng = np.random.default_rng(2)
+        ra = rng.uniform(0., 10., 200000)
+        dec = rng.uniform(0., 10., 200000)
+        coordinateSet = Matcher(
+            log=log, ra=ra, dec=dec, depth=16, convertToArray=False)
+        ra2 = rng.uniform(0., 10., 50000)
+        dec2 = rng.uniform(0., 10., 50000)
+
+        # A PYTHON THREAD TICKS WHILE THE MATCH RUNS. HOLDING THE GIL, THE
+        # MATCH WOULD LET IT RUN AT MOST A SWITCH INTERVAL INTO THE CALL,
+        # ON ANY NUMBER OF CORES
+        ticks = []
+        done = threading.Event()
+
+        def tick():
+            while not done.is_set():
+                ticks.append(time.perf_counter())
+                time.sleep(0.001)
+
+        thread = threading.Thread(target=tick)
+        thread.start()
+        try:
+            time.sleep(0.01)
+            start = time.perf_counter()
+            coordinateSet.match(
+                ra=ra2, dec=dec2, radius=20. / 3600., maxmatch=0)
+            stop = time.perf_counter()
+        finally:
+            done.set()
+            thread.join()
+
+        margin = max(0.25 * (stop - start), 0.02)
+        during = [t for t in ticks if start + margin < t < stop - margin]
+        print("MATCH: %0.2fs TICKS DURING: %d" % (stop - start, len(during)))
+        self.assertTrue(len(during) > 0)
+
+    @unittest.skipIf((os.cpu_count() or 1) < 4, "needs 4 or more cores to measure a threaded speedup")
+    def test_matcher_threaded_speedup(self):
+
+        import time
+        import threading
+        import numpy as np
+        from HMpTy import Matcher
+        rng = np.random.default_rng(3)
+        ra = rng.uniform(0., 10., 200000)
+        dec = rng.uniform(0., 10., 200000)
+        coordinateSet = Matcher(
+            log=log, ra=ra, dec=dec, depth=16, convertToArray=False)
+
+        nthreads = 4
+        inputs = []
+        for i in range(nthreads):
+            inputs.append((rng.uniform(0., 10., 50000),
+                           rng.uniform(0., 10., 50000)))
+
+        def match(i):
+            coordinateSet.match(
+                ra=inputs[i][0], dec=inputs[i][1], radius=5. / 3600., maxmatch=0)
+
+        start = time.time()
+        for i in range(nthreads):
+            match(i)
+        serial = time.time() - start
+
+        threads = [threading.Thread(target=match, args=(i,))
+                   for i in range(nthreads)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        threaded = time.time() - start
+
+        print("SERIAL: %0.2fs THREADED: %0.2fs SPEEDUP: %0.2f" %
+              (serial, threaded, serial / threaded))
+        self.assertTrue(serial / threaded > 0.7 * nthreads)
+
+    def test_matcher_nthreads_order(self):
+
+        import numpy as np
+        from HMpTy import Matcher, HTM
+        rng = np.random.default_rng(4)
+        ra = rng.uniform(0., 1., 20000)
+        dec = rng.uniform(0., 1., 20000)
+        coordinateSet = Matcher(
+            log=log, ra=ra, dec=dec, depth=12, convertToArray=False)
+
+        # MANY MORE BLOCKS THAN THREADS, WITH A PART BLOCK AT THE END
+        ra2 = rng.uniform(0., 1., 140001)
+        dec2 = rng.uniform(0., 1., 140001)
+        for maxmatch in (0, 1):
+            serial = coordinateSet.match(
+                ra=ra2, dec=dec2, radius=20. / 3600., maxmatch=maxmatch)
+            threaded = coordinateSet.match(
+                ra=ra2, dec=dec2, radius=20. / 3600., maxmatch=maxmatch, nthreads=3)
+            for s, t in zip(serial, threaded):
+                self.assertTrue(np.array_equal(s, t))
+
+        mesh16 = HTM(depth=16, log=log)
+        serial = mesh16.match(ra1=ra2[:1000], dec1=dec2[:1000], ra2=ra,
+                              dec2=dec, radius=20. / 3600., maxmatch=0)
+        threaded = mesh16.match(ra1=ra2[:1000], dec1=dec2[:1000], ra2=ra,
+                                dec2=dec, radius=20. / 3600., maxmatch=0, nthreads=4)
+        for s, t in zip(serial, threaded):
+            self.assertTrue(np.array_equal(s, t))
+
+        # MORE THREADS THAN CORES ARE CUT TO THE NUMBER OF CORES
+        many = coordinateSet.match(
+            ra=ra2[:5000], dec=dec2[:5000], radius=20. / 3600., maxmatch=0, nthreads=10000)
+        few = coordinateSet.match(
+            ra=ra2[:5000], dec=dec2[:5000], radius=20. / 3600., maxmatch=0)
+        for s, t in zip(few, many):
+            self.assertTrue(np.array_equal(s, t))
+        with self.assertRaises(RuntimeError):
+            coordinateSet.match(
+                ra=ra2[:10], dec=dec2[:10], radius=20. / 3600., nthreads=-1)
+
+    def test_matcher_save_load(self):
+
+        import numpy as np
+        from HMpTy import Matcher
+        rng = np.random.default_rng(5)
+        ra = rng.uniform(0., 2., 20000)
+        dec = rng.uniform(0., 2., 20000)
+        coordinateSet = Matcher(
+            log=log, ra=ra, dec=dec, depth=14, convertToArray=False)
+        pathToMatcher = pathToOutputDir + "/catalogue.matcher"
+        coordinateSet.save(pathToMatcher)
+
+        ra2 = rng.uniform(0., 2., 2000)
+        dec2 = rng.uniform(0., 2., 2000)
+        expected = coordinateSet.match(
+            ra=ra2, dec=dec2, radius=30. / 3600., maxmatch=0)
+        for mmap in (True, False):
+            loaded = Matcher.load(pathToMatcher, mmap=mmap, log=log)
+            self.assertEqual(loaded.depth, 14)
+            if mmap:
+                # THE COORDINATES ARE READ STRAIGHT FROM THE MAPPED FILE
+                self.assertIsInstance(
+                    loaded.get_coordinates()[0].base, np.memmap)
+            matches = loaded.match(
+                ra=ra2, dec=dec2, radius=30. / 3600., maxmatch=0)
+            for e, m in zip(expected, matches):
+                self.assertTrue(np.array_equal(e, m))
+
+        # SAVING OVER THE FILE A MATCHER IS MAPPED FROM LEAVES THAT MATCHER
+        # READING THE OLD FILE
+        pathToResaved = pathToOutputDir + "/resaved.matcher"
+        coordinateSet.save(pathToResaved)
+        loaded = Matcher.load(pathToResaved, log=log)
+        loaded.save(pathToResaved)
+        Matcher(log=log, ra=ra2, dec=dec2, depth=14).save(pathToResaved)
+        matches = loaded.match(
+            ra=ra2, dec=dec2, radius=30. / 3600., maxmatch=0)
+        for e, m in zip(expected, matches):
+            self.assertTrue(np.array_equal(e, m))
+        self.assertEqual(Matcher.load(pathToResaved, log=log).npoints, 2000)
+
+        with open(pathToOutputDir + "/not.matcher", "wb") as f:
+            f.write(b"not a matcher file" * 10)
+        with self.assertRaises(ValueError):
+            Matcher.load(pathToOutputDir + "/not.matcher")
+
+        # A CORRUPT BUCKET INDEX IS REJECTED, NOT LEFT TO CRASH THE MATCH
+        ids, offsets, perm, xyz = coordinateSet.get_buckets()
+        with open(pathToMatcher, "rb") as f:
+            saved = f.read()
+        pathToCorrupt = pathToOutputDir + "/corrupt.matcher"
+        # THE npoints, nids AND nbucketed HEADER COUNTS
+        counts = np.frombuffer(saved[24:48], dtype="<i8")
+        for array, index, value in [(offsets, 5, 10**12), (offsets, 0, 1),
+                                    (offsets, 5, -1), (ids, 3, ids[2]),
+                                    (ids, 0, 7), (perm, 7, ra.size),
+                                    (perm, 7, -1), (counts, 0, -5),
+                                    (counts, 1, -5), (counts, 2, -5)]:
+            start = saved.find(array.tobytes())
+            self.assertTrue(start > 0)
+            corrupt = array.copy()
+            corrupt[index] = value
+            with open(pathToCorrupt, "wb") as f:
+                f.write(saved[:start] + corrupt.tobytes() +
+                        saved[start + corrupt.nbytes:])
+            with self.assertRaises(ValueError):
+                Matcher.load(pathToCorrupt, log=log)
+
+        # ONLY THE CURRENT FILE VERSION IS READ
+        with open(pathToCorrupt, "wb") as f:
+            f.write(saved[:8] + np.uint32(2).tobytes() + saved[12:])
+        with self.assertRaises(ValueError):
+            Matcher.load(pathToCorrupt, log=log)
+
+    def test_matcher_small_separations(self):
+
+        import numpy as np
+        from HMpTy import Matcher, HTM
+        # OFFSETS ALONG A MERIDIAN ARE EXACTLY THE SEPARATION
+        offsets = np.array([0.001, 0.01, 0.1, 0.5]) / 3600.
+        ra = np.array([200.0] * 4)
+        dec = 24.3 + offsets
+        coordinateSet = Matcher(
+            log=log, ra=ra, dec=dec, depth=16, convertToArray=False)
+        matchIndices1, matchIndices2, seps = coordinateSet.match(
+            ra=np.array([200.0]), dec=np.array([24.3]), radius=1. / 3600., maxmatch=0)
+        self.assertEqual(list(matchIndices2), [0, 1, 2, 3])
+        self.assertTrue(np.allclose(seps, offsets, rtol=1e-6, atol=0))
+
+        # A RADIUS BELOW THE PRECISION OF cos(radius) STILL MATCHES
+        matchIndices1, matchIndices2, seps = coordinateSet.match(
+            ra=np.array([200.0]), dec=np.array([24.3]), radius=0.002 / 3600., maxmatch=0)
+        self.assertEqual(list(matchIndices2), [0])
+
+        mesh16 = HTM(depth=16, log=log)
+        matchIndices1, matchIndices2, seps = mesh16.match(
+            ra1=[200.0], dec1=[24.3], ra2=ra, dec2=dec, radius=1. / 3600., maxmatch=0)
+        self.assertTrue(np.allclose(seps, offsets, rtol=1e-6, atol=0))
+
+    def test_matcher_without_separations(self):
+
+        import numpy as np
+        from HMpTy import Matcher, HTM
+        rng = np.random.RandomState(8)
+        ra = rng.uniform(10., 12., 20000)
+        dec = rng.uniform(-1., 1., 20000)
+        ra2 = rng.uniform(10., 12., 200)
+        dec2 = rng.uniform(-1., 1., 200)
+        coordinateSet = Matcher(
+            log=log, ra=ra, dec=dec, depth=12, convertToArray=False)
+
+        # A LARGE RADIUS, SO MANY TRIXELS LIE WHOLLY INSIDE THE CIRCLES
+        matchIndices1, matchIndices2, seps = coordinateSet.match(
+            ra=ra2, dec=dec2, radius=0.2, maxmatch=0)
+        results = coordinateSet.match(
+            ra=ra2, dec=dec2, radius=0.2, maxmatch=0, separations=False)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(set(zip(matchIndices1, matchIndices2)),
+                         set(zip(results[0], results[1])))
+
+        # WITH A maxmatch THE CLOSEST PAIRS ARE STILL RETURNED IN ORDER
+        matchIndices1, matchIndices2, seps = coordinateSet.match(
+            ra=ra2, dec=dec2, radius=0.2, maxmatch=3)
+        results = coordinateSet.match(
+            ra=ra2, dec=dec2, radius=0.2, maxmatch=3, separations=False)
+        self.assertTrue(np.array_equal(matchIndices1, results[0]))
+        self.assertTrue(np.array_equal(matchIndices2, results[1]))
+
+        mesh12 = HTM(depth=12, log=log)
+        results = mesh12.match(ra1=ra2, dec1=dec2, ra2=ra, dec2=dec,
+                               radius=0.2, maxmatch=3, separations=False)
+        self.assertEqual(len(results), 2)
+        self.assertTrue(np.array_equal(matchIndices2, results[1]))
+
+    def test_matcher_maxmatch_selection(self):
+
+        import numpy as np
+        from HMpTy import Matcher
+        rng = np.random.RandomState(9)
+        ra = rng.uniform(10., 11., 20000)
+        dec = rng.uniform(-0.5, 0.5, 20000)
+        # DUPLICATED POINTS GIVE TIED SEPARATIONS
+        ra = np.concatenate([ra, ra[:2000]])
+        dec = np.concatenate([dec, dec[:2000]])
+        ra2 = rng.uniform(10.1, 10.9, 300)
+        dec2 = rng.uniform(-0.4, 0.4, 300)
+        coordinateSet = Matcher(
+            log=log, ra=ra, dec=dec, depth=12, convertToArray=False)
+
+        allIndices1, allIndices2, allSeps = coordinateSet.match(
+            ra=ra2, dec=dec2, radius=0.05, maxmatch=0)
+        self.assertTrue(np.all(np.diff(allIndices1) >= 0))
+        for maxmatch in (1, 2, 7):
+            matchIndices1, matchIndices2, seps = coordinateSet.match(
+                ra=ra2, dec=dec2, radius=0.05, maxmatch=maxmatch)
+            # THE SAME AS TRUNCATING THE FULLY SORTED MATCHES FOR EACH POINT
+            rank = np.arange(allIndices1.size) - np.searchsorted(
+                allIndices1, allIndices1)
+            keep = rank < maxmatch
+            self.assertTrue(np.array_equal(matchIndices1, allIndices1[keep]))
+            self.assertTrue(np.array_equal(matchIndices2, allIndices2[keep]))
+            self.assertTrue(np.array_equal(seps, allSeps[keep]))
+
+    def test_matcher_result_arrays(self):
+
+        import gc
+        import numpy as np
+        from HMpTy import Matcher
+        rng = np.random.RandomState(10)
+        ra = rng.uniform(10., 11., 5000)
+        dec = rng.uniform(-0.5, 0.5, 5000)
+        coordinateSet = Matcher(
+            log=log, ra=ra, dec=dec, depth=12, convertToArray=False)
+        for nthreads in (1, 2):
+            results = coordinateSet.match(
+                ra=ra, dec=dec, radius=0.02, maxmatch=0, nthreads=nthreads)
+            self.assertEqual([r.dtype for r in results],
+                             [np.dtype('i8'), np.dtype('i8'), np.dtype('f8')])
+            self.assertTrue(all(r.flags.writeable for r in results))
+
+        # THE ARRAYS OWN THEIR MEMORY ONCE THE MATCHER HAS GONE
+        del coordinateSet
+        gc.collect()
+        self.assertTrue(np.all(results[2] <= 0.02))
+        results[2][:] = 0.
+
+        # NO MATCHES STILL GIVES (EMPTY) ARRAYS
+        coordinateSet = Matcher(
+            log=log, ra=ra, dec=dec, depth=12, convertToArray=False)
+        results = coordinateSet.match(
+            ra=np.array([200.]), dec=np.array([60.]), radius=0.02, maxmatch=0)
+        self.assertEqual([r.size for r in results], [0, 0, 0])
+
+    def test_matcher_match_iter(self):
+
+        import numpy as np
+        from HMpTy import Matcher, HTM
+        rng = np.random.RandomState(11)
+        ra = rng.uniform(10., 11., 5000)
+        dec = rng.uniform(-0.5, 0.5, 5000)
+        ra2 = rng.uniform(10., 11., 2500)
+        dec2 = rng.uniform(-0.5, 0.5, 2500)
+        radius = rng.uniform(0.005, 0.02, 2500)
+        coordinateSet = Matcher(
+            log=log, ra=ra, dec=dec, depth=12, convertToArray=False)
+
+        expected = coordinateSet.match(
+            ra=ra2, dec=dec2, radius=radius, maxmatch=0)
+        chunks = list(coordinateSet.match_iter(
+            ra=ra2, dec=dec2, radius=radius, maxmatch=0, chunk_size=1000))
+        self.assertEqual(len(chunks), 3)
+        self.assertTrue(chunks[1][0].min() >= 1000)
+        for e, c in zip(expected, zip(*chunks)):
+            self.assertTrue(np.array_equal(e, np.concatenate(c)))
+
+        chunks = list(coordinateSet.match_iter(
+            ra=ra2, dec=dec2, radius=0.01, maxmatch=1, chunk_size=700,
+            separations=False))
+        expected = coordinateSet.match(
+            ra=ra2, dec=dec2, radius=0.01, maxmatch=1)
+        self.assertEqual(len(chunks[0]), 2)
+        for e, c in zip(expected, zip(*chunks)):
+            self.assertTrue(np.array_equal(e, np.concatenate(c)))
+
+        mesh12 = HTM(depth=12, log=log)
+        expected = mesh12.match(
+            ra1=ra2, dec1=dec2, ra2=ra, dec2=dec, radius=0.01, maxmatch=0)
+        chunks = list(mesh12.match_iter(
+            ra1=ra2, dec1=dec2, ra2=ra, dec2=dec, radius=0.01, maxmatch=0,
+            chunk_size=1000))
+        for e, c in zip(expected, zip(*chunks)):
+            self.assertTrue(np.array_equal(e, np.concatenate(c)))
+
+        with self.assertRaises(ValueError):
+            next(coordinateSet.match_iter(
+                ra=ra2, dec=dec2, radius=0.01, chunk_size=0))
+
+    def test_matcher_match_to_file(self):
+
+        import numpy as np
+        from HMpTy import Matcher
+        rng = np.random.RandomState(12)
+        ra = rng.uniform(10., 11., 5000)
+        dec = rng.uniform(-0.5, 0.5, 5000)
+        coordinateSet = Matcher(
+            log=log, ra=ra, dec=dec, depth=12, convertToArray=False)
+
+        expected = coordinateSet.match(
+            ra=ra, dec=dec, radius=0.02, maxmatch=0, nthreads=2)
+        filename = pathToOutputDir + "/matches.npy"
+        nmatches = coordinateSet.match_to_file(
+            ra=ra, dec=dec, radius=0.02, filename=filename, maxmatch=0, nthreads=2)
+        self.assertEqual(nmatches, expected[0].size)
+        matches = np.load(filename, mmap_mode="r")
+        self.assertEqual(matches.dtype.names, ("i1", "i2", "sep"))
+        for field, e in zip(matches.dtype.names, expected):
+            self.assertTrue(np.array_equal(matches[field], e))
+        del matches
+
+        nmatches = coordinateSet.match_to_file(
+            ra=np.array([200.]), dec=np.array([60.]), radius=0.02,
+            filename=filename, separations=False)
+        matches = np.load(filename)
+        self.assertEqual(nmatches, 0)
+        self.assertEqual(matches.dtype.names, ("i1", "i2"))
+        self.assertEqual(matches.size, 0)
+
+    def test_matcher_match_to_file_unwritable(self):
+
+        from HMpTy import Matcher
+        coordinateSet = Matcher(
+            log=log, ra=[10., 10.5], dec=[0., 0.2], depth=12)
+        filename = pathToOutputDir + "/no_such_dir/matches.npy"
+        for attempt in range(3):
+            with self.assertRaises(RuntimeError) as context:
+                coordinateSet.match_to_file(
+                    ra=[10.], dec=[0.], radius=0.1, filename=filename)
+            self.assertEqual(str(context.exception),
+                             "Cannot open file: %s : No such file or directory" % (filename,))
+
+    @unittest.skipIf(not os.path.isdir("/proc/self/fd"), "needs /proc to count open files")
+    def test_matcher_match_to_file_error(self):
+
+        import resource
+        import signal
+        import numpy as np
+        from HMpTy import Matcher
+        rng = np.random.RandomState(12)
+        ra = rng.uniform(10., 11., 5000)
+        dec = rng.uniform(-0.5, 0.5, 5000)
+        coordinateSet = Matcher(
+            log=log, ra=ra, dec=dec, depth=12, convertToArray=False)
+
+        # CAP THE FILE SIZE SO THE WRITE FAILS PART WAY THROUGH. THE FILE
+        # MUST BE CLOSED AND THE PARTIAL .NPY REMOVED
+        filename = pathToOutputDir + "/matches_error.npy"
+        nopen = len(os.listdir("/proc/self/fd"))
+        limits = resource.getrlimit(resource.RLIMIT_FSIZE)
+        handler = signal.signal(signal.SIGXFSZ, signal.SIG_IGN)
+        resource.setrlimit(resource.RLIMIT_FSIZE, (4096, limits[1]))
+        try:
+            for nthreads in (1, 2):
+                with self.assertRaises(RuntimeError):
+                    coordinateSet.match_to_file(
+                        ra=ra, dec=dec, radius=0.02, filename=filename,
+                        maxmatch=0, nthreads=nthreads)
+                self.assertFalse(os.path.exists(filename))
+        finally:
+            resource.setrlimit(resource.RLIMIT_FSIZE, limits)
+            signal.signal(signal.SIGXFSZ, handler)
+        self.assertEqual(len(os.listdir("/proc/self/fd")), nopen)
+
+    @unittest.skipIf(not os.path.isfile("/proc/self/statm"), "needs /proc to read the process size")
+    def test_matcher_out_of_memory(self):
+
+        import resource
+        import numpy as np
+        from HMpTy import Matcher
+        rng = np.random.RandomState(10)
+        ra = rng.uniform(0., 1., 2000)
+        dec = rng.uniform(0., 1., 2000)
+        coordinateSet = Matcher(
+            log=log, ra=ra, dec=dec, depth=10, convertToArray=False)
+
+        # CAP THE ADDRESS SPACE WELL BELOW THE ~1GB OF RESULTS. GROWING THE
+        # RESULTS MUST RAISE, NOT ABORT THE INTERPRETER
+        size = int(open("/proc/self/statm").read().split()[0]) * resource.getpagesize()
+        limits = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (size + (256 << 20), limits[1]))
+        try:
+            for nthreads in (1, 2):
+                with self.assertRaises(RuntimeError):
+                    coordinateSet.match(
+                        ra=np.repeat(ra, 10), dec=np.repeat(dec, 10), radius=5.,
+                        maxmatch=0, nthreads=nthreads)
+        finally:
+            resource.setrlimit(resource.RLIMIT_AS, limits)
+        self.assertEqual(coordinateSet.match(ra[:3], dec[:3], 1e-6)[0].size, 3)
+
+    def test_intersect_many(self):
+
+        import numpy as np
+        from HMpTy import HTM
+        rng = np.random.RandomState(13)
+        ra = rng.uniform(0., 360., 200)
+        dec = np.degrees(np.arcsin(rng.uniform(-1., 1., 200)))
+        radii = rng.uniform(1., 60., 200) / 3600.
+        mesh16 = HTM(depth=16, log=log)
+
+        perCircle = [mesh16.intersect(r, d, rad, inclusive=True, convertCoordinates=False)
+                     for r, d, rad in zip(ra, dec, radii)]
+        offsets, trixelArray = mesh16.intersect_many(
+            ra, dec, radii, unique=False, convertToArray=False)
+        self.assertEqual(offsets.size, ra.size + 1)
+        for i, ids in enumerate(perCircle):
+            self.assertTrue(np.array_equal(
+                trixelArray[offsets[i]:offsets[i + 1]], ids))
+
+        trixelArray = mesh16.intersect_many(
+            ra, dec, radii, convertToArray=False)
+        self.assertTrue(np.array_equal(
+            trixelArray, np.unique(np.concatenate(perCircle))))
+
+        # A SINGLE RADIUS AND ONLY THE FULLY ENCLOSED TRIXELS
+        offsets, trixelArray = mesh16.intersect_many(
+            ra[:5], dec[:5], 0.05, inclusive=False, unique=False, convertToArray=False)
+        for i in range(5):
+            self.assertTrue(np.array_equal(
+                trixelArray[offsets[i]:offsets[i + 1]],
+                mesh16.intersect(ra[i], dec[i], 0.05, inclusive=False, convertCoordinates=False)))
+
+        with self.assertRaises(ValueError):
+            mesh16.intersect_many(ra, dec, radii[:3], convertToArray=False)
+
+    def test_intersect_ranges(self):
+
+        import numpy as np
+        from HMpTy import HTM
+        rng = np.random.RandomState(14)
+        ra = rng.uniform(0., 360., 100)
+        dec = np.degrees(np.arcsin(rng.uniform(-1., 1., 100)))
+        mesh16 = HTM(depth=16, log=log)
+
+        def expand(ranges):
+            return np.concatenate([np.arange(lo, hi + 1) for lo, hi in ranges])
+
+        trixelArray = mesh16.intersect(
+            ra[0], dec[0], 1. / 60., convertCoordinates=False)
+        ranges = mesh16.intersect_ranges(
+            ra[0], dec[0], 1. / 60., convertCoordinates=False)
+        self.assertEqual(ranges.shape[1], 2)
+        self.assertTrue(ranges.shape[0] < trixelArray.size)
+        self.assertTrue(np.all(ranges[1:, 0] > ranges[:-1, 1] + 1))
+        self.assertTrue(np.array_equal(expand(ranges), np.unique(trixelArray)))
+
+        # DEEPER AND SHALLOWER TARGET DEPTHS
+        ranges = mesh16.intersect_ranges(
+            ra[0], dec[0], 1. / 60., depth=18, convertCoordinates=False)
+        self.assertTrue(np.array_equal(
+            np.unique(expand(ranges) >> 4), np.unique(trixelArray)))
+        ranges = mesh16.intersect_ranges(
+            ra[0], dec[0], 1. / 60., depth=12, convertCoordinates=False)
+        self.assertTrue(np.array_equal(
+            expand(ranges), np.unique(trixelArray >> 8)))
+
+        # MANY CIRCLES
+        ranges = mesh16.intersect_ranges_many(
+            ra, dec, 10. / 3600., convertToArray=False)
+        self.assertTrue(np.array_equal(expand(ranges), mesh16.intersect_many(
+            ra, dec, 10. / 3600., convertToArray=False)))
+        offsets, ranges = mesh16.intersect_ranges_many(
+            ra, dec, 10. / 3600., unique=False, convertToArray=False)
+        for i in range(ra.size):
+            self.assertTrue(np.array_equal(
+                ranges[offsets[i]:offsets[i + 1]],
+                mesh16.intersect_ranges(ra[i], dec[i], 10. / 3600., convertCoordinates=False)))
+
+    def test_lookup_ids(self):
+
+        import numpy as np
+        from HMpTy import HTM
+        rng = np.random.RandomState(15)
+        ra = np.concatenate([rng.uniform(0., 360., 20000), [0., 90., 45.]])
+        dec = np.concatenate(
+            [np.degrees(np.arcsin(rng.uniform(-1., 1., 20000))), [90., 0., 0.]])
+        mesh10 = HTM(depth=10, log=log)
+        htmIds = mesh10.lookup_ids(ra, dec, depths=[3, 7, 10, 13, 16])
+        self.assertEqual(sorted(htmIds.keys()), [3, 7, 10, 13, 16])
+        for depth, ids in list(htmIds.items()):
+            mesh = HTM(depth=depth, log=log)
+            self.assertTrue(np.array_equal(ids, mesh.lookup_id(ra, dec)))
+
+        htmIds = mesh10.lookup_ids([200.0], [24.3])
+        self.assertEqual(int(htmIds[16][0]), 58661591161)
+        self.assertEqual(int(htmIds[7][0]), 223776)
+
+        with self.assertRaises(ValueError):
+            mesh10.lookup_ids(ra, dec, depths=[7, 26])
+
+    def test_cartesian_input(self):
+
+        import numpy as np
+        from HMpTy import HTM, Matcher
+        rng = np.random.RandomState(16)
+        n = 20000
+        ra1 = rng.uniform(0., 360., n)
+        dec1 = np.degrees(np.arcsin(rng.uniform(-1., 1., n)))
+        ra2 = rng.uniform(0., 360., n)
+        dec2 = np.degrees(np.arcsin(rng.uniform(-1., 1., n)))
+
+        def to_xyz(ra, dec):
+            cosdec = np.cos(np.radians(dec))
+            return (cosdec * np.cos(np.radians(ra)),
+                    cosdec * np.sin(np.radians(ra)), np.sin(np.radians(dec)))
+        x1, y1, z1 = to_xyz(ra1, dec1)
+        x2, y2, z2 = to_xyz(ra2, dec2)
+
+        mesh = HTM(depth=16, log=log)
+        # THE VECTORS DO NOT NEED TO BE UNIT LENGTH
+        self.assertTrue(np.array_equal(
+            mesh.lookup_id_xyz(2. * x1, 2. * y1, 2. * z1), mesh.lookup_id(ra1, dec1)))
+        self.assertTrue(np.array_equal(
+            mesh.intersect_xyz(x1[:50], y1[:50], z1[:50], 0.05),
+            mesh.intersect_many(ra1[:50], dec1[:50], 0.05)))
+
+        coordinateSet = Matcher(
+            log=log, ra=ra1, dec=dec1, depth=10, convertToArray=False)
+        xyzSet = Matcher.from_xyz(x1, y1, z1, depth=10, log=log)
+        m1, m2, seps = coordinateSet.match(ra2, dec2, 1.0, maxmatch=0)
+        for thisSet in (coordinateSet, xyzSet):
+            xm1, xm2, xseps = thisSet.match_xyz(x2, y2, z2, 1.0, maxmatch=0)
+            self.assertTrue(np.array_equal(m1, xm1))
+            self.assertTrue(np.array_equal(m2, xm2))
+            self.assertTrue(np.allclose(seps, xseps, rtol=0, atol=1e-10))
+
+        ra, dec = xyzSet.get_coordinates()
+        self.assertTrue(np.allclose(dec, dec1, rtol=0, atol=1e-10))
+
+        with self.assertRaises(RuntimeError):
+            mesh.lookup_id_xyz([0.], [0.], [0.])
+        with self.assertRaises(ValueError):
+            xyzSet.match_xyz(x2, y2[:10], z2, 1.0)
+
+    def test_bincount(self):
+
+        import numpy as np
+        from HMpTy import HTM, Matcher
+        rng = np.random.RandomState(17)
+        n = 5000
+        ra1 = rng.uniform(0., 5., n)
+        dec1 = rng.uniform(-2.5, 2.5, n)
+        ra2 = rng.uniform(0., 5., n)
+        dec2 = rng.uniform(-2.5, 2.5, n)
+        rmin, rmax, nbin = 1. / 3600, 0.1, 8
+
+        def brute_force(m1, m2, seps):
+            logbin = (np.log10(rmax) - np.log10(rmin)) / nbin
+            bins = np.floor((np.log10(seps) - np.log10(rmin)) / logbin)
+            bins = bins[(bins >= 0) & (bins < nbin)].astype(int)
+            return np.bincount(bins, minlength=nbin)
+
+        mesh = HTM(depth=12, log=log)
+        coordinateSet = Matcher(log=log, ra=ra1, dec=dec1, depth=12)
+
+        # PAIRS BETWEEN TWO SETS
+        rlower, rupper, counts = mesh.bincount(
+            rmin, rmax, nbin, ra2, dec2, ra1, dec1)
+        m1, m2, seps = coordinateSet.match(ra2, dec2, rmax, maxmatch=0)
+        self.assertTrue(np.array_equal(counts, brute_force(m1, m2, seps)))
+        self.assertTrue(np.allclose(rlower[0], rmin))
+        self.assertTrue(np.allclose(rupper[-1], rmax))
+
+        # THE OLD cbincount SIGNATURE STILL WORKS, WITH A WARNING
+        with self.assertWarns(DeprecationWarning):
+            oldCounts = mesh.cbincount(
+                rmin, rmax, nbin, ra2, dec2, ra1, dec1, None, None, None)
+        self.assertTrue(np.array_equal(oldCounts, counts))
+
+        # EACH UNORDERED PAIR WITHIN ONE SET COUNTED ONCE, WHATEVER THE
+        # NUMBER OF THREADS
+        calls = []
+        rlower, rupper, counts = mesh.bincount(
+            rmin, rmax, nbin, ra1, dec1, nthreads=3,
+            progress=lambda ndone, ntotal: calls.append((ndone, ntotal)))
+        m1, m2, seps = coordinateSet.match(ra1, dec1, rmax, maxmatch=0)
+        keep = m1 < m2
+        self.assertTrue(np.array_equal(
+            counts, brute_force(m1[keep], m2[keep], seps[keep])))
+        self.assertEqual(calls[-1], (n, n))
+
+        rlower, rupper, selfCounts = coordinateSet.bincount(
+            0.01, 1., 4, scale=100.)
+        rlower, rupper, crossCounts = coordinateSet.bincount(
+            0.01, 1., 4, ra=ra1, dec=dec1, scale=np.full(n, 100.))
+        self.assertTrue(np.array_equal(2 * selfCounts, crossCounts))
+
+        with self.assertRaises(ValueError):
+            mesh.bincount(rmax, rmin, nbin, ra1, dec1)
+
+    def test_polygons(self):
+
+        import numpy as np
+        from HMpTy import HTM, Matcher
+        rng = np.random.RandomState(18)
+        n = 50000
+        ra = rng.uniform(145., 155., n)
+        dec = rng.uniform(-3., 7., n)
+
+        def to_xyz(ra, dec):
+            cosdec = np.cos(np.radians(dec))
+            return np.stack([cosdec * np.cos(np.radians(ra)),
+                             cosdec * np.sin(np.radians(ra)), np.sin(np.radians(dec))], -1)
+
+        raVertices = [[150.1, 151.3, 151.3, 150.1], [148., 149., 148.5]]
+        decVertices = [[2.1, 2.1, 3.3, 3.3], [0., 0., 1.5]]
+
+        mesh = HTM(depth=10, log=log)
+        coordinateSet = Matcher(log=log, ra=ra, dec=dec, depth=10)
+        htmIds = mesh.lookup_id(ra, dec)
+        offsets, indices = coordinateSet.within_polygon_many(
+            raVertices, decVertices)
+        trixelOffsets, trixels = mesh.intersect_polygon_many(
+            raVertices, decVertices)
+        self.assertEqual(len(offsets), 3)
+        self.assertEqual(len(trixelOffsets), 3)
+
+        points = to_xyz(ra, dec)
+        for i, (vr, vd) in enumerate(zip(raVertices, decVertices)):
+            corners = to_xyz(np.array(vr), np.array(vd))
+            inside = np.ones(n, dtype=bool)
+            for j in range(len(vr)):
+                inside &= points.dot(
+                    np.cross(corners[j], corners[(j + 1) % len(vr)])) >= 0
+            expected = np.nonzero(inside)[0]
+            self.assertTrue(np.array_equal(
+                indices[offsets[i]:offsets[i + 1]], expected))
+            self.assertTrue(np.array_equal(
+                coordinateSet.within_polygon(vr, vd), expected))
+
+            # THE COVER HOLDS EVERY POINT INSIDE, WHATEVER THE VERTEX ORDER
+            cover = mesh.intersect_polygon(vr[::-1], vd[::-1])
+            self.assertTrue(np.array_equal(
+                np.sort(cover), np.sort(trixels[trixelOffsets[i]:trixelOffsets[i + 1]])))
+            self.assertTrue(np.isin(htmIds[expected], cover).all())
+            full = mesh.intersect_polygon(vr, vd, inclusive=False)
+            self.assertTrue(inside[np.isin(htmIds, full)].all())
+
+        with self.assertRaises(RuntimeError):
+            mesh.intersect_polygon([0., 10., 20.], [0., 0., 0.])
+        with self.assertRaises(ValueError):
+            coordinateSet.within_polygon_many([[0., 1., 1.]], [])
+
+    def test_self_match(self):
+
+        import numpy as np
+        from HMpTy import HTM, Matcher
+        rng = np.random.RandomState(19)
+        n = 20000
+        ra = rng.uniform(0., 2., n)
+        dec = rng.uniform(-1., 1., n)
+        radius = 0.01
+
+        mesh = HTM(depth=12, log=log)
+        coordinateSet = Matcher(log=log, ra=ra, dec=dec, depth=12)
+        m1, m2, seps = coordinateSet.match(ra, dec, radius, maxmatch=0)
+
+        s1, s2, sseps = mesh.self_match(ra, dec, radius)
+        keep = m1 < m2
+        self.assertTrue(np.array_equal(s1, m1[keep]))
+        self.assertTrue(np.array_equal(s2, m2[keep]))
+        self.assertTrue(np.array_equal(sseps, seps[keep]))
+
+        s1, s2, sseps = coordinateSet.self_match(
+            radius, include_self=True, nthreads=3)
+        keep = m1 <= m2
+        self.assertTrue(np.array_equal(s1, m1[keep]))
+        self.assertTrue(np.array_equal(s2, m2[keep]))
+
+        s1, s2 = mesh.self_match(ra, dec, radius, separations=False)
+        self.assertEqual(
+            sorted(zip(s1, s2)), sorted(zip(m1[m1 < m2], m2[m1 < m2])))
+
+        with self.assertRaises(ValueError):
+            coordinateSet.self_match(np.full(n, radius))
+
+    def test_htm_match_dec_trim(self):
+
+        import numpy as np
+        from HMpTy import HTM, Matcher
+        rng = np.random.RandomState(21)
+        ra1 = rng.uniform(0., 5., 5000)
+        dec1 = rng.uniform(-3., 3., 5000)
+        ra2 = rng.uniform(0., 5., 8000)
+        dec2 = rng.uniform(-2., 2., 8000)
+        radius = rng.uniform(0.001, 0.05, 5000)
+
+        mesh = HTM(depth=12, log=log)
+        coordinateSet = Matcher(log=log, ra=ra2, dec=dec2, depth=12)
+
+        # THE DEC PRE-TRIM MUST NOT CHANGE THE MATCHES, AND PER-POINT RADII
+        # STAY WITH THEIR OWN POINTS OF THE FIRST LIST
+        for r in (0.02, radius):
+            m1, m2, seps = coordinateSet.match(ra1, dec1, r, maxmatch=0)
+            t1, t2, tseps = mesh.match(ra1, dec1, ra2, dec2, r, maxmatch=0)
+            self.assertEqual(sorted(zip(t1, t2)), sorted(zip(m1, m2)))
+            self.assertTrue(np.all(
+                tseps <= np.broadcast_to(r, ra1.shape)[t1] + 1e-12))
+
+        # NOTHING WITHIN THE DEC BANDS
+        t1, t2, tseps = mesh.match(ra1, dec1, ra2, dec2 + 10., 0.01)
+        self.assertEqual(len(t1), 0)
+
+        with self.assertRaises(ValueError):
+            mesh.match(ra1, dec1, ra2, dec2[:-1], 0.01)
+        with self.assertRaises(ValueError):
+            mesh.match(ra1, dec1, ra2, dec2, radius[:-1])
+
+    def test_choose_depth(self):
+
+        import numpy as np
+        from HMpTy import HTM, Matcher
+        from HMpTy.htm import choose_depth
+        rng = np.random.RandomState(22)
+        n = 50000
+        ra = rng.uniform(0., 5., n)
+        dec = rng.uniform(-2.5, 2.5, n)
+        radius = 2. / 3600.
+
+        coordinateSet = Matcher(log=log, ra=ra, dec=dec,
+                                depth="auto", radius=radius)
+        estimate = coordinateSet.depthEstimate
+        self.assertEqual(coordinateSet.depth, estimate["depth"])
+        self.assertTrue(0 <= estimate["depth"] <= 24)
+
+        # THE ESTIMATED CANDIDATES ARE THE POINTS IN THE TRIXELS AROUND EACH
+        # SEARCH POSITION, SO AT LEAST ONE (THE POINT ITSELF) AND WITHIN A
+        # FACTOR OF A FEW OF THE MEAN COUNT IN A TRIXEL AT THAT DEPTH
+        mesh = HTM(depth=estimate["depth"], log=log)
+        ids = np.sort(mesh.lookup_id(ra, dec))
+        cover = [mesh.intersect(ra[i], dec[i], radius) for i in range(200)]
+        measured = np.mean([(np.searchsorted(ids, c, 'right') -
+                             np.searchsorted(ids, c, 'left')).sum() for c in cover])
+        self.assertTrue(estimate["candidates"] >= 1)
+        self.assertTrue(0.5 < estimate["candidates"] / measured < 2.)
+
+        # THE MATCHES DO NOT DEPEND ON THE DEPTH
+        m1, m2, seps = coordinateSet.match(ra[:2000], dec[:2000], radius, maxmatch=0)
+        fixed = Matcher(log=log, ra=ra, dec=dec, depth=16)
+        f1, f2, fseps = fixed.match(ra[:2000], dec[:2000], radius, maxmatch=0)
+        self.assertEqual(sorted(zip(m1, m2)), sorted(zip(f1, f2)))
+        hmesh = HTM(depth=16, log=log)
+        h1, h2, hseps = hmesh.match(ra[:2000], dec[:2000], ra, dec, radius,
+                                    maxmatch=0, depth="auto")
+        self.assertEqual(sorted(zip(h1, h2)), sorted(zip(f1, f2)))
+
+        # POINTS IN TIGHT CLUSTERS HAVE MORE CANDIDATES PER SEARCH THAN THE
+        # SAME NUMBER SPREAD EVENLY, SO NEED A DEEPER MESH
+        cra = np.repeat(ra[:10], n // 10) + rng.normal(0., 0.01, n)
+        cdec = np.repeat(dec[:10], n // 10) + rng.normal(0., 0.01, n)
+        clustered = choose_depth(cra, cdec, radius, log=log)
+        self.assertTrue(clustered["candidates"] > estimate["candidates"])
+        self.assertTrue(clustered["depth"] > estimate["depth"])
+
+        with self.assertRaises(ValueError):
+            Matcher(log=log, ra=ra, dec=dec, depth="auto")
+
+    def test_matcher_add_remove(self):
+
+        import numpy as np
+        from HMpTy import Matcher
+        rng = np.random.RandomState(23)
+        n = 12000
+        ra = rng.uniform(0., 3., n)
+        dec = rng.uniform(-1.5, 1.5, n)
+        qra = rng.uniform(0., 3., 2000)
+        qdec = rng.uniform(-1.5, 1.5, 2000)
+        radius = 0.01
+
+        coordinateSet = Matcher(log=log, ra=ra[:6000], dec=dec[:6000], depth=12)
+        removed = set()
+        for start in range(6000, n, 1500):
+            indices = coordinateSet.add(
+                ra[start:start + 1500], dec[start:start + 1500])
+            self.assertTrue(np.array_equal(
+                indices, np.arange(start, start + 1500)))
+            drop = rng.choice(start + 1500, 200, replace=False)
+            coordinateSet.remove(drop)
+            removed.update(drop.tolist())
+
+            # MATCHING THE LIVE MATCHER GIVES THE SAME PAIRS AS A MATCHER
+            # BUILT FROM THE POINTS LEFT, UNDER THE SAME INDICES
+            live = np.array(sorted(set(range(start + 1500)) - removed))
+            rebuilt = Matcher(log=log, ra=ra[live], dec=dec[live], depth=12)
+            for maxmatch in (0, 1):
+                m1, m2, seps = coordinateSet.match(
+                    qra, qdec, radius, maxmatch=maxmatch)
+                r1, r2, rseps = rebuilt.match(
+                    qra, qdec, radius, maxmatch=maxmatch)
+                self.assertEqual(sorted(zip(m1, m2, seps)),
+                                 sorted(zip(r1, live[r2], rseps)))
+            m1, m2 = coordinateSet.match(
+                qra, qdec, radius, maxmatch=0, separations=False)
+            r1, r2 = rebuilt.match(
+                qra, qdec, radius, maxmatch=0, separations=False)
+            self.assertEqual(sorted(zip(m1, m2)), sorted(zip(r1, live[r2])))
+
+        self.assertEqual(coordinateSet.npoints, n)
+        self.assertEqual(coordinateSet.nremoved, len(removed))
+
+        # SELF MATCHES, SAVING AND LOADING ALL SEE THE SAME POINTS
+        s1, s2, sseps = coordinateSet.self_match(radius)
+        r1, r2, rseps = rebuilt.self_match(radius)
+        self.assertEqual(sorted(zip(s1, s2)), sorted(zip(live[r1], live[r2])))
+
+        coordinateSet.compact()
+        m1, m2, seps = coordinateSet.match(qra, qdec, radius, maxmatch=0)
+        path = pathToOutputDir + "/add_remove.matcher"
+        coordinateSet.save(path)
+        loaded = Matcher.load(path, log=log)
+        self.assertEqual(loaded.npoints, n)
+        self.assertEqual(loaded.nremoved, len(removed))
+        l1, l2, lseps = loaded.match(qra, qdec, radius, maxmatch=0)
+        self.assertTrue(np.array_equal(l1, m1))
+        self.assertTrue(np.array_equal(l2, m2))
+
+        with self.assertRaises(ValueError):
+            coordinateSet.remove([n])
+
+    def test_matcher_add_while_matching(self):
+
+        import threading
+        import numpy as np
+        from HMpTy import Matcher
+        rng = np.random.RandomState(26)
+        n = 50000
+        ra = rng.uniform(0., 5., 3 * n)
+        dec = rng.uniform(-2.5, 2.5, 3 * n)
+        qra = rng.uniform(0., 5., 5000)
+        qdec = rng.uniform(-2.5, 2.5, 5000)
+        radius = 0.02
+
+        coordinateSet = Matcher(log=log, ra=ra[:n], dec=dec[:n], depth=12)
+
+        # MATCH IN ONE THREAD WHILE THE MAIN THREAD ADDS, REMOVES AND COMPACTS
+        done = threading.Event()
+        results = []
+        errors = []
+
+        def match():
+            try:
+                while not done.is_set():
+                    m1, m2, seps = coordinateSet.match(
+                        qra, qdec, radius, maxmatch=0)
+                    nearest, nseps = coordinateSet.nearest(qra[:500], qdec[:500])
+                    results.append((m2.max(), seps.max(), nearest.max()))
+            except Exception as e:
+                errors.append(e)
+
+        removed = set()
+        thread = threading.Thread(target=match)
+        thread.start()
+        try:
+            for start in range(n, 3 * n, 5000):
+                coordinateSet.add(ra[start:start + 5000],
+                                  dec[start:start + 5000])
+                drop = rng.randint(0, start, 500)
+                coordinateSet.remove(drop)
+                removed.update(drop.tolist())
+                if start % 20000 == 0:
+                    coordinateSet.compact()
+        finally:
+            done.set()
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertTrue(len(results) > 0)
+        for maxIndex, maxSep, maxNearest in results:
+            self.assertTrue(maxIndex < 3 * n)
+            self.assertTrue(maxNearest < 3 * n)
+            self.assertTrue(maxSep <= radius)
+
+        # THE FINISHED MATCHER IS THE SAME AS ONE BUILT FROM THE POINTS LEFT
+        self.assertEqual(coordinateSet.npoints, 3 * n)
+        self.assertEqual(coordinateSet.nremoved, len(removed))
+        live = np.array(sorted(set(range(3 * n)) - removed))
+        rebuilt = Matcher(log=log, ra=ra[live], dec=dec[live], depth=12)
+        m1, m2, seps = coordinateSet.match(qra, qdec, radius, maxmatch=0)
+        r1, r2, rseps = rebuilt.match(qra, qdec, radius, maxmatch=0)
+        self.assertEqual(set(zip(m1, m2)), set(zip(r1, live[r2])))
+
+    def test_matcher_keeps_own_coordinates(self):
+
+        import numpy as np
+        from HMpTy import Matcher
+        rng = np.random.RandomState(27)
+        ra = rng.uniform(0., 2., 5000)
+        dec = rng.uniform(-1., 1., 5000)
+        qra = rng.uniform(0., 2., 1000)
+        qdec = rng.uniform(-1., 1., 1000)
+
+        coordinateSet = Matcher(log=log, ra=ra, dec=dec,
+                                depth=12, convertToArray=False)
+        m1, m2, seps = coordinateSet.match(qra, qdec, 0.01, maxmatch=0)
+
+        # CHANGING THE INPUT ARRAYS IN PLACE DOES NOT CHANGE THE MATCHER
+        ra[:] = 0.
+        dec[::2] += 0.5
+        a1, a2, aseps = coordinateSet.match(qra, qdec, 0.01, maxmatch=0)
+        self.assertTrue(np.array_equal(a1, m1))
+        self.assertTrue(np.array_equal(a2, m2))
+        self.assertTrue(np.array_equal(aseps, seps))
+        self.assertTrue(np.all(coordinateSet.get_coordinates()[0] > 0.))
+
+    def test_matcher_nearest(self):
+
+        import numpy as np
+        from HMpTy import Matcher
+        rng = np.random.RandomState(24)
+        n = 5000
+        ra = rng.uniform(0., 360., n)
+        dec = np.degrees(np.arcsin(rng.uniform(-1., 1., n)))
+        qra = rng.uniform(0., 360., 300)
+        qdec = np.degrees(np.arcsin(rng.uniform(-1., 1., 300)))
+        # ON THE ROOT TRIXEL CORNERS AND EDGES
+        qra = np.append(qra, [0., 90., 45., 0.])
+        qdec = np.append(qdec, [0., 90., 0., -45.])
+
+        def unit(r, d):
+            r, d = np.radians(r), np.radians(d)
+            return np.array([np.cos(d) * np.cos(r), np.cos(d) * np.sin(r), np.sin(d)]).T
+
+        # BRUTE-FORCE SEPARATIONS OF EVERY QUERY TO EVERY POINT
+        allSeps = np.degrees(np.arccos(
+            np.clip(np.dot(unit(qra, qdec), unit(ra, dec).T), -1., 1.)))
+        allSeps[:, 7] = np.inf
+        order = np.argsort(allSeps, axis=1)
+
+        for depth in (6, 14):
+            coordinateSet = Matcher(log=log, ra=ra, dec=dec, depth=depth)
+            coordinateSet.remove([7])
+            for k in (1, 4):
+                indices, seps = coordinateSet.nearest(qra, qdec, k=k)
+                self.assertEqual(indices.shape, (qra.size, k))
+                self.assertTrue(np.array_equal(indices, order[:, :k]))
+                self.assertTrue(np.allclose(
+                    seps, np.take_along_axis(allSeps, order[:, :k], 1)))
+
+            # THE NEAREST AGREE WITH THE CLOSEST MATCHES WITHIN A RADIUS
+            indices, seps = coordinateSet.nearest(
+                qra, qdec, k=3, max_radius=2.0, nthreads=2)
+            m1, m2, mseps = coordinateSet.match(qra, qdec, 2.0, maxmatch=3)
+            self.assertEqual((indices >= 0).sum(), m1.size)
+            self.assertTrue(np.array_equal(indices[indices >= 0], m2))
+            self.assertTrue(np.all(np.isinf(seps[indices < 0])))
+
+        # FEWER POINTS THAN NEIGHBOURS ASKED FOR
+        small = Matcher(log=log, ra=ra[:2], dec=dec[:2], depth=10)
+        indices, seps = small.nearest(qra[:5], qdec[:5], k=3)
+        self.assertTrue(np.all(indices[:, 2] == -1))
+        self.assertTrue(np.array_equal(
+            np.sort(indices[:, :2], axis=1), np.tile([0, 1], (5, 1))))
+
+        with self.assertRaises(ValueError):
+            small.nearest(qra, qdec, k=0)
+
+    def test_matcher_from_htmids(self):
+
+        import numpy as np
+        from HMpTy import HTM, Matcher
+        rng = np.random.RandomState(25)
+        n = 20000
+        ra = rng.uniform(0., 360., n)
+        dec = np.degrees(np.arcsin(rng.uniform(-1., 1., n)))
+        htm16Ids = HTM(depth=16, log=log).lookup_id(ra, dec)
+
+        # DEEPER IDS ARE TRUNCATED, GIVING THE SAME BUCKETS AS THE LOOKUPS
+        for depth in (16, 12):
+            coordinateSet = Matcher.from_htmids(
+                ra, dec, htm16Ids, depth=depth, log=log)
+            built = Matcher(log=log, ra=ra, dec=dec, depth=depth)
+            self.assertEqual(coordinateSet.depth, depth)
+            for a, b in zip(coordinateSet.get_buckets(), built.get_buckets()):
+                self.assertTrue(np.array_equal(a, b))
+            m1, m2, seps = coordinateSet.match(ra[:500], dec[:500], 0.5, maxmatch=0)
+            b1, b2, bseps = built.match(ra[:500], dec[:500], 0.5, maxmatch=0)
+            self.assertTrue(np.array_equal(m1, b1))
+            self.assertTrue(np.array_equal(m2, b2))
+
+        # PLAIN LISTS WITHOUT convertToArray, AND THE MATCHER KEEPS ITS OWN
+        # COPY OF THE COORDINATES
+        raCopy = ra.copy()
+        coordinateSet = Matcher.from_htmids(
+            list(raCopy), list(dec), list(htm16Ids), depth=16, log=log,
+            convertToArray=False)
+        self.assertTrue(np.array_equal(coordinateSet.get_coordinates()[0], ra))
+        coordinateSet = Matcher.from_htmids(
+            raCopy, dec, htm16Ids, depth=16, log=log, convertToArray=False)
+        raCopy[:] = 0.
+        self.assertTrue(np.array_equal(coordinateSet.get_coordinates()[0], ra))
+        with self.assertRaises(ValueError):
+            Matcher.from_htmids(
+                list(ra[:-1]), list(dec), list(htm16Ids), depth=16, log=log,
+                convertToArray=False)
+
+        # THE SAMPLED VALIDATION CATCHES IDS THAT DO NOT BELONG TO THEIR ROWS
+        shuffled = htm16Ids.copy()
+        rng.shuffle(shuffled)
+        with self.assertRaises(ValueError):
+            Matcher.from_htmids(ra, dec, shuffled, depth=16, log=log)
+        Matcher.from_htmids(ra, dec, shuffled, depth=16, log=log, validate=0)
+
+        # IDS SHALLOWER THAN THE DEPTH, OR NOT HTM IDS AT ALL
+        with self.assertRaises(ValueError):
+            Matcher.from_htmids(ra, dec, htm16Ids >> 8, depth=16, log=log)
+        with self.assertRaises(ValueError):
+            Matcher.from_htmids(ra, dec, htm16Ids * 2, depth=16, log=log)
+
     def test_htm_function_exception(self):
 
         from HMpTy import htm
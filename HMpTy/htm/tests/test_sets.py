@@ -90,6 +90,53 @@ class test_sets(unittest.TestCase):
         )
         allMatches = xmatcher.match
 
+    def test_sets_labels_function(self):
+
+        import numpy as np
+        from HMpTy.htm import sets
+        xmatcher = sets(
+            log=log,
+            ra=raList,
+            dec=decList,
+            radius=old_div(10, (60. * 60.)),
+            sourceList=transientList
+        )
+        labels = xmatcher.labels
+        allMatches = xmatcher.match
+        self.assertEqual(len(labels), len(transientList))
+        self.assertEqual(len(allMatches), labels.max() + 1)
+        self.assertEqual(allMatches, xmatcher._extract_all_sets_from_list())
+        for i, m in enumerate(allMatches):
+            self.assertEqual(
+                sorted(m), sorted(np.array(transientList, dtype=object)[labels == i].tolist()))
+
+        # TRANSITIVE LINKING MERGES EVERY CHAIN OF SOURCES WITHIN THE RADIUS,
+        # SO GIVES NO MORE SETS THAN ANCHOR-BASED LINKING
+        fof = sets(
+            log=log,
+            ra=raList,
+            dec=decList,
+            radius=old_div(10, (60. * 60.)),
+            sourceList=transientList,
+            transitive=True
+        )
+        self.assertTrue(len(fof.match) <= len(allMatches))
+        m1, m2, seps = fof.mesh.self_match(
+            raList, decList, old_div(10, (60. * 60.)))
+        self.assertTrue(np.array_equal(fof.labels[m1], fof.labels[m2]))
+
+        # THE SETS DO NOT DEPEND ON THE MESH DEPTH
+        self.assertEqual(xmatcher.htmDepth, xmatcher.depthEstimate["depth"])
+        fixed = sets(
+            log=log,
+            ra=raList,
+            dec=decList,
+            radius=old_div(10, (60. * 60.)),
+            sourceList=transientList,
+            depth=16
+        )
+        self.assertTrue(np.array_equal(fixed.labels, labels))
+
     def test_sets_function_exception(self):
 
         from HMpTy.htm import sets
@@ -134,6 +134,12 @@ public:
 
     void init(PyObject* obj)  throw (const char *);
 
+    // As init(obj), but an input array that init would reference as it is
+    // is copied, so the data can not be changed in place from python
+    // behind our back.  For arrays that are kept after the call.
+
+    void init_copy(PyObject* obj)  throw (const char *);
+
     // Initialize from scratch based on size and typenum
     //
     // This can be called at *any time* and any existing data will
@@ -403,8 +409,8 @@ void NumpyVector<T>::init(PyObject* obj)  throw (const char *)
 
         if (descr->type_num == mTypeNum && PyArray_ISNOTSWAPPED(array)) {
             // We are set!  Just copy the reference.
-            mArray = PyArray_Cast((PyArrayObject*) array, mTypeNum);
-            Py_INCREF(array);
+            mArray = obj;
+            Py_INCREF(obj);
         }
         else {
             // Either it is not the right type or it is byteswapped.  So we
@@ -468,6 +474,28 @@ void NumpyVector<T>::init(PyObject* obj)  throw (const char *)
 
 }
 
+template <class T>
+void NumpyVector<T>::init_copy(PyObject* obj)  throw (const char *)
+{
+    init(obj);
+
+    if (mArray != obj) {
+        // already converted to a new array
+        return;
+    }
+
+    PyObject* copy = PyArray_NewCopy((PyArrayObject*) mArray, NPY_CORDER);
+    if (copy == NULL) {
+        throw "Could not copy array";
+    }
+    Py_DECREF(mArray);
+    mArray = copy;
+
+    if (mNdim != 0) {
+        mStride = PyArray_STRIDE((PyArrayObject*) mArray, 0);
+    }
+}
+
 
 
 
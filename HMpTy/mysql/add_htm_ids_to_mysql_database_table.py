@@ -257,16 +257,15 @@ def add_htm_ids_to_mysql_database_table(
 
         from HMpTy import htm
         mesh16 = htm.HTM(16)
-        mesh13 = htm.HTM(13)
-        mesh10 = htm.HTM(10)
-        mesh07 = htm.HTM(7)
 
         log.debug(
             'calculating htmIds for batch of %s rows in %s db table' % (batchSize, tableName, ))
-        htm16Ids = mesh16.lookup_id(raList, decList)
-        htm13Ids = mesh13.lookup_id(raList, decList)
-        htm10Ids = mesh10.lookup_id(raList, decList)
-        htm07Ids = mesh07.lookup_id(raList, decList)
+        # ONE LOOKUP AT DEPTH 16, THE COARSER IDS ARE BIT SHIFTS OF IT
+        htmIds = mesh16.lookup_ids(raList, decList, depths=[7, 10, 13, 16])
+        htm16Ids = htmIds[16]
+        htm13Ids = htmIds[13]
+        htm10Ids = htmIds[10]
+        htm07Ids = htmIds[7]
         log.debug(
             'finshed calculating htmIds for batch of %s rows in %s db table' % (batchSize, tableName, ))
 
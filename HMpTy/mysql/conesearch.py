@@ -392,18 +392,10 @@ class conesearch(object):
         # CONVERT RADIUS TO DEGREES
         r = self.radius/(60. * 60.)
 
-        # VECTORIZED COMPUTATION OF TRIXELS FOR ALL RA, DEC PAIRS
-        trixelArray = np.concatenate([
-            self.mesh.intersect(
-                ra1, dec1, r, inclusive=True, convertCoordinates=False
-            ) for ra1, dec1 in zip(self.ra, self.dec)
-        ])
-
-        # GET UNIQUE TRIXELS
-        if trixelArray.size < 10000:
-            trixelArray = np.array(list(set(trixelArray)))
-        else:
-            trixelArray = np.unique(trixelArray)
+        # UNIQUE TRIXELS COVERING ALL THE CIRCLES IN ONE NATIVE CALL
+        trixelArray = self.mesh.intersect_many(
+            self.ra, self.dec, r, inclusive=True, unique=True, convertToArray=False
+        )
 
         self.log.debug(
             'completed the ``_get_trixel_ids_that_overlap_conesearch_circles`` method')
@@ -495,8 +487,7 @@ class conesearch(object):
         dbDecs = []
         dbDecs[:] = [d[self.decCol] for d in dbRows]
 
-        # 7 SEEMS TO BE GIVING OPTIMAL SPEED FOR MATCHES (VERY ROUGH SPEED
-        # TESTS)
+        # THIS MESH ONLY CARRIES THE match CALL BELOW, ITS DEPTH IS NOT USED
         mesh = HTM(
             depth=7,
             log=self.log
@@ -514,7 +505,10 @@ class conesearch(object):
             ra2=np.array(dbRas),
             dec2=np.array(dbDecs),
             radius=float(self.radius/(60. * 60.)),
-            maxmatch=maxmatch  # 1 = match closest 1, 0 = match all
+            maxmatch=maxmatch,  # 1 = match closest 1, 0 = match all
+            # THE MATCHER DEPTH IS CHOSEN FROM THE RADIUS AND THE DENSITY OF
+            # THE DATABASE ROWS
+            depth="auto"
         )
         end_time = time.time()
 
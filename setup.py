@@ -89,8 +89,7 @@ install_requires = [
     'multiprocess',
     'unicodecsv',
     'pandas',
-    'pymysql',
-    'scipy'
+    'pymysql'
 ]
 
 